@@ -9,23 +9,20 @@ from astropy.io import fits
 from spectral_cube import Projection
 from pandas import DataFrame
 
-from paths import (fourteenB_wGBT_HI_file_dict, fourteenB_HI_file_dict,
-                   gbt_HI_data_path, alltables_path,
+from paths import (gbt_HI_data_path, alltables_path,
                    fourteenB_HI_data_wGBT_path)
 from constants import (hi_mass_conversion_Jy, distance, hi_freq,
                        hi_mass_conversion)
+from cube_registry import fourteenB_HI_products, fourteenB_wGBT_HI_products
 
-mom0_feath = Projection.from_hdu(fits.open(fourteenB_wGBT_HI_file_dict['Moment0']))
-mom0 = Projection.from_hdu(fits.open(fourteenB_HI_file_dict['Moment0']))
+mom0_feath = fourteenB_wGBT_HI_products.projection('Moment0')
+mom0 = fourteenB_HI_products.projection('Moment0')
 
 gbt_name = gbt_HI_data_path("14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088_spectralregrid_registered.mom0.fits")
 mom0_gbt = Projection.from_hdu(fits.open(gbt_name)[0])
 
-feath_mask = fits.open(fourteenB_wGBT_HI_file_dict['Source_Mask'])[0]
-mask = fits.open(fourteenB_HI_file_dict['Source_Mask'])[0]
-
-feath_spatial_mask = feath_mask.data.sum(0)
-spatial_mask = mask.data.sum(0)
+feath_spatial_mask = fourteenB_wGBT_HI_products.hdu('Source_Mask').data.sum(0)
+spatial_mask = fourteenB_HI_products.hdu('Source_Mask').data.sum(0)
 
 sigma_noise = 2.8 * u.K
 
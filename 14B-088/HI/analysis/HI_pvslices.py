@@ -5,7 +5,6 @@ Create PV-slices of the spectrally down-sampled HI cube.
 
 from spectral_cube import SpectralCube, Projection
 import pvextractor as pv
-from astropy.utils.console import ProgressBar
 from astropy.io import fits
 from astropy import units as u
 import numpy as np
@@ -14,6 +13,7 @@ import matplotlib.pyplot as plt
 from paths import fourteenB_HI_data_wGBT_path, fourteenB_wGBT_HI_file_dict
 from galaxy_params import gal_feath as gal
 from constants import distance
+from pvslice_engine import extract_pv_slices
 
 
 # Radius cut-off from galaxy frame to observation frame
@@ -48,9 +48,10 @@ if __name__ == "__main__":
 
     check_paths = False
 
-    pvslices = []
+    # Wide slices and thinner slices with the normal cube
     paths = []
-    for theta in ProgressBar(thetas):
+    paths_thin = []
+    for theta in thetas:
 
         # Adjust path length based on inclination
         obs_rad = obs_radius(max_rad, theta, gal)
@@ -67,6 +68,13 @@ if __name__ == "__main__":
                                     width=ang_width)
         paths.append(pv_path)
 
+        pv_path_thin = pv.PathFromCenter(gal.center_position,
+                                         length=ang_length,
+                                         angle=theta + gal.position_angle,
+                                         sample=20,
+                                         width=200)
+        paths_thin.append(pv_path_thin)
+
         if check_paths:
 
             plt.imshow(mom0.value, origin='lower')
@@ -85,78 +93,26 @@ if __name__ == "__main__":
             raw_input("{}".format(theta))
             plt.clf()
 
-        # Set NaNs to zero. We're averaging over very large areas here.
-        pvslice = pv.extract_pv_slice(cube, pv_path, respect_nan=False)
+    # Extract all of the slices in one pass over the cube.
+    # Set NaNs to zero. We're averaging over very large areas here.
+    all_pvslices = extract_pv_slices(cube, paths + paths_thin,
+                                     respect_nan=False)
+    pvslices = all_pvslices[:len(thetas)]
+    pvslices_thin = all_pvslices[len(thetas):]
+
+    for theta, pvslice, pvslice_thin in zip(thetas, pvslices, pvslices_thin):
 
         filename = "downsamp_1kms/M33_14B-088_HI.GBT_feathered_PA_{}_pvslice.fits".format(int(theta.value))
         pvslice.writeto(fourteenB_HI_data_wGBT_path(filename, no_check=True), overwrite=True)
 
-        pvslices.append(pvslice)
+        filename = "downsamp_1kms/M33_14B-088_HI.GBT_feathered_PA_{}_pvslice_200arcsec_width.fits".format(int(theta.value))
+        pvslice_thin.writeto(fourteenB_HI_data_wGBT_path(filename, no_check=True), overwrite=True)
 
     # Make a major axis PV slice with the rotation subtracted cube
     rotcube = SpectralCube.read(fourteenB_HI_data_wGBT_path("downsamp_1kms/M33_14B-088_HI.clean.image.GBT_feathered.rotation_corrected.1kms.fits"))
 
-    theta = 0.0 * u.deg
-    obs_rad = obs_radius(max_rad, theta, gal)
-
-    # Now convert the physical size in the observed frame to an angular size
-    ang_length = 2 * phys_to_ang(obs_rad, distance)
-
-    ang_width = 2 * phys_to_ang(obs_radius(max_rad, theta + 90 * u.deg, gal),
-                                distance)
+    # Same grid and path as the PA=0 slice, so the weights are reused
+    pvslice = extract_pv_slices(rotcube, paths[:1], respect_nan=False)[0]
 
-    pv_path = pv.PathFromCenter(gal.center_position, length=ang_length,
-                                angle=theta + gal.position_angle,
-                                sample=20,
-                                width=ang_width)
-
-    pvslice = pv.extract_pv_slice(rotcube, pv_path, respect_nan=False)
-
-    filename = "downsamp_1kms/M33_14B-088_HI.GBT_feathered.rotation_corrected_PA_{}_pvslice.fits".format(int(theta.value))
+    filename = "downsamp_1kms/M33_14B-088_HI.GBT_feathered.rotation_corrected_PA_{}_pvslice.fits".format(int(thetas[0].value))
     pvslice.writeto(fourteenB_HI_data_wGBT_path(filename, no_check=True), overwrite=True)
-
-
-    # Make thinner PV slices with the normal cube
-    pvslices_thin = []
-    paths_thin = []
-    for theta in ProgressBar(thetas):
-
-        # Adjust path length based on inclination
-        obs_rad = obs_radius(max_rad, theta, gal)
-
-        # Now convert the physical size in the observed frame to an angular size
-        ang_length = 2 * phys_to_ang(obs_rad, distance)
-
-        ang_width = 200
-
-        pv_path = pv.PathFromCenter(gal.center_position, length=ang_length,
-                                    angle=theta + gal.position_angle,
-                                    sample=20,
-                                    width=ang_width)
-        paths_thin.append(pv_path)
-
-        if check_paths:
-
-            plt.imshow(mom0.value, origin='lower')
-            plt.contour(radius <= max_rad, colors='r')
-            center = gal.to_center_position_pixel(wcs=cube.wcs)
-            plt.plot(center[0], center[1], 'bD')
-
-            for i, posn in enumerate(pv_path.get_xy(cube.wcs)):
-                if i == 0:
-                    symb = "c^"
-                else:
-                    symb = "g^"
-                plt.plot(posn[0], posn[1], symb)
-
-            plt.draw()
-            raw_input("{}".format(theta))
-            plt.clf()
-
-        # Set NaNs to zero. We're averaging over very large areas here.
-        pvslice = pv.extract_pv_slice(cube, pv_path, respect_nan=False)
-
-        filename = "downsamp_1kms/M33_14B-088_HI.GBT_feathered_PA_{}_pvslice_200arcsec_width.fits".format(int(theta.value))
-        pvslice.writeto(fourteenB_HI_data_wGBT_path(filename, no_check=True), overwrite=True)
-
-        pvslices_thin.append(pvslice)
@@ -16,6 +16,7 @@ import matplotlib.pyplot as plt
 
 from paths import (fourteenB_HI_data_wGBT_path, allfigs_path,
                    fourteenB_wGBT_HI_file_dict)
+from pvslice_engine import extract_pv_slices
 
 rotsub_cube = SpectralCube.read(fourteenB_wGBT_HI_file_dict['RotSub_Cube'])
 
@@ -26,8 +27,7 @@ path1 = pv.Path([(580, 1320), (695, 1461)], width=15)
 path2 = pv.Path([(680, 1300), (580, 1460)], width=15)
 
 
-pvslice1 = pv.extract_pv_slice(rotsub_cube, path1)
-pvslice2 = pv.extract_pv_slice(rotsub_cube, path2)
+pvslice1, pvslice2 = extract_pv_slices(rotsub_cube, [path1, path2])
 
 # Write out the paths as ds9 regions
 x_cent1 = int((695 + 580) / 2.)
@@ -3,19 +3,22 @@
 Create a set of thin PV slices
 '''
 
-from spectral_cube import SpectralCube, Projection
-from astropy.io import fits
+from spectral_cube import SpectralCube
 from astropy import units as u
+from astropy.coordinates import Angle
 import numpy as np
+import pvextractor as pv
+from regions import RectangleSkyRegion, write_ds9
 
-from cube_analysis.disk_pvslices import disk_pvslices
-
-from paths import fourteenB_HI_data_wGBT_path, fourteenB_wGBT_HI_file_dict
+from paths import fourteenB_HI_data_wGBT_path
 from galaxy_params import gal_feath
+from constants import distance
+from pvslice_engine import extract_pv_slices
+
+from HI_pvslices import obs_radius, phys_to_ang
 
 
 cube = SpectralCube.read(fourteenB_HI_data_wGBT_path("downsamp_1kms/M33_14B-088_HI.clean.image.GBT_feathered.1kms.fits"))
-mom0 = Projection.from_hdu(fits.open(fourteenB_wGBT_HI_file_dict["Moment0"])[0])
 
 
 thetas = np.arange(0, 180, 5) * u.deg
@@ -28,9 +31,36 @@ save_name = fourteenB_HI_data_wGBT_path("downsamp_1kms/M33_14B-088_HI.clean.imag
                                         no_check=True)
 
 
-# Run pv slicing
+# Run pv slicing. All of the paths are extracted in one pass over the cube.
+
+paths = []
+regions = []
+for theta in thetas:
+
+    # Adjust path length based on inclination
+    ang_length = 2 * phys_to_ang(obs_radius(max_rad, theta, gal_feath),
+                                 distance)
+
+    paths.append(pv.PathFromCenter(gal_feath.center_position,
+                                   length=ang_length,
+                                   angle=theta + gal_feath.position_angle,
+                                   sample=20,
+                                   width=pv_width))
+
+    regions.append(RectangleSkyRegion(center=gal_feath.center_position,
+                                      height=Angle(ang_length),
+                                      width=Angle(pv_width),
+                                      angle=Angle(theta +
+                                                  gal_feath.position_angle)))
+
+pvslices = extract_pv_slices(cube, paths, respect_nan=False)
+
+for theta, pvslice in zip(thetas, pvslices):
+    pvslice.writeto("{0}_PA_{1}_pvslice_{2}{3}_width.fits"
+                    .format(save_name, int(theta.value), pv_width.value,
+                            pv_width.unit),
+                    overwrite=True)
 
-disk_pvslices(cube, gal_feath, thetas, pv_width, max_rad,
-              save_name=save_name, quicklook=False, mom0=mom0,
-              save_kwargs=dict(overwrite=True),
-              save_regions=True)
+write_ds9(regions, "{0}_pvslice_{1}{2}_width.reg".format(save_name,
+                                                         pv_width.value,
+                                                         pv_width.unit))
@@ -4,6 +4,7 @@ Use the clean cloud sample from cloud_catalog.py to find the CO and HI spectra
 over each cloud.
 '''
 
+import os
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.utils.console import ProgressBar
@@ -12,7 +13,6 @@ from scipy import ndimage as nd
 from spectral_cube import SpectralCube
 from spectral_cube.lower_dimensional_structures import Projection
 from spectral_cube.cube_utils import average_beams
-from reproject import reproject_interp
 import numpy as np
 import matplotlib.pyplot as plt
 from multiprocessing import Pool
@@ -22,10 +22,15 @@ from signal_id import Noise
 from cube_analysis.spectra_shifter import cube_shifter
 
 from analysis.paths import (fourteenB_HI_data_path, iram_co21_data_path,
-                            paper1_figures_path)
+                            paper1_figures_path, c_hi_analysispath)
 from analysis.constants import hi_freq, cube_name, moment1_name
 from analysis.galaxy_params import gal
 from analysis.plotting_styles import onecolumn_figure, align_yaxis
+from reprojection_weights import reproject_cached
+
+os.sys.path.insert(0, c_hi_analysispath(""))
+
+from spectral_features import cube_spectral_features
 
 
 hi_cube = SpectralCube.read(fourteenB_HI_data_path(cube_name))
@@ -53,23 +58,16 @@ cube = cube.with_mask(cloud_mask)
 # snr = SpectralCube(data=noise.snr.copy(), wcs=cube.wcs)
 
 
-# Create a CO centroid map where the GMC mask is valid.
-def peak_velocity(y, x, cube):
-    argmax = np.nanargmax(cube[:, y, x].value)
-    return cube.spectral_axis[argmax]
-
-
+# Create a CO peak velocity map where the GMC mask is valid.
 peak_intens = cube.max(0)
 valid_mask = cloud_mask.sum(0) > 0
 
 cube_specinterp = cube.spectral_interpolate(hi_cube.spectral_axis)
 mom1 = cube_specinterp.moment1()
 # mom1[~peak_mask] = np.NaN
-peak_vels_arr = np.zeros_like(mom1) * np.NaN
-pbar = ProgressBar(len(zip(*np.where(valid_mask))))
-for y, x in zip(*np.where(valid_mask)):
-    peak_vels_arr[y, x] = peak_velocity(y, x, cube_specinterp)
-    pbar.update()
+spec_feats = cube_spectral_features(cube_specinterp, spatial_mask=valid_mask,
+                                    num_cores=6)
+peak_vels_arr = spec_feats['peak_velocity'].to(mom1.unit).value
 
 # Moment 1 and peak vels need to be somewhat close to each other
 # max_diff = 20 * u.km / u.s
@@ -79,13 +77,15 @@ for y, x in zip(*np.where(valid_mask)):
 peak_vels = Projection(peak_vels_arr, unit=mom1.unit, wcs=mom1.wcs)
 peak_vels.write(iram_co21_data_path("m33.co21_iram.masked.peakvel.fits", no_check=True))
 
-mom1_reproj_arr = reproject_interp(mom1.hdu,
+# The CO maps and the cloud mask share a grid, so the interpolation weights
+# onto the HI grid are computed once and reused for every map and cloud.
+mom1_reproj_arr = reproject_cached(mom1.hdu,
                                    hi_cube.wcs.celestial,
                                    shape_out=hi_cube.shape[1:])[0]
 mom1_reproj = Projection(mom1_reproj_arr, unit=mom1.unit,
                          wcs=hi_cube.wcs.celestial)
 peak_vels_reproj_arr = \
-    reproject_interp(peak_vels.hdu,
+    reproject_cached(peak_vels.hdu,
                      hi_cube.wcs.celestial,
                      shape_out=hi_cube.shape[1:])[0]
 peak_vels_reproj = Projection(peak_vels_reproj_arr, unit=mom1.unit,
@@ -143,7 +143,7 @@ for i in ProgressBar(num_clouds):
     cloud_avg_specs_co[i] = co_spec / co_count
 
     # Now regrid plane onto the HI and do the same.
-    plane_reproj = reproject_interp((plane, WCS(cloud_mask_hdu.header).celestial),
+    plane_reproj = reproject_cached((plane, WCS(cloud_mask_hdu.header).celestial),
                                     hi_cube.wcs.celestial,
                                     shape_out=hi_cube.shape[1:])[0] > 0
     xy_posns_hi = np.where(plane_reproj)
@@ -1,12 +1,9 @@
-from basics import BubbleFinder2D
 from basics.utils import sig_clip
 from spectral_cube import SpectralCube
 import astropy.units as u
 import matplotlib.pyplot as p
-import scipy.ndimage as nd
 from scipy.stats import binned_statistic
 import numpy as np
-from skimage.segmentation import find_boundaries
 from skimage.morphology import medial_axis
 from astropy.utils.console import ProgressBar
 from corner import hist2d
@@ -19,13 +16,17 @@ from astropy.table import Table, Column
 
 from paths import (fourteenB_HI_data_wGBT_path,
                    iram_co21_14B088_data_path,
-                   allfigs_path)
+                   allfigs_path, c_hi_analysispath)
 from constants import hi_freq
 from galaxy_params import gal_feath as gal
 from plotting_styles import (default_figure, twocolumn_figure,
                              onecolumn_figure,
                              twocolumn_twopanel_figure)
 
+os.sys.path.insert(0, c_hi_analysispath(""))
+
+from mask_distances import iterate_channel_distances, BinnedAccumulator
+
 
 default_figure()
 
@@ -44,6 +45,9 @@ np.random.seed(34678953)
 
 # Plot a bunch
 verbose = False
+# Channels are masked in parallel. Verbose plotting is done in the main
+# process as the channels finish.
+num_cores = 4
 # slicer = (slice(825, 1033), slice(360, 692))
 slicer = (slice(None), slice(None))
 
@@ -61,78 +65,112 @@ vels = co_cube.spectral_axis.to(u.km / u.s)[7:-15]
 radii = gal.radius(header=hi_cube[0].header)
 max_radius = 6.0 * u.kpc
 
-all_dists = []
-all_radii = []
-all_vals_hi = []
-all_vals_co = []
-edge_masks = []
-skeleton_dists = []
-skeleton_dists_pix = []
-skeleton_widths = []
-
-masks = []
-
 hi_beam = hi_cube.beam
+jtok = hi_beam.jtok(hi_freq).value
 
 # Estimate the noise level in an equivalent slab
 hi_mom0 = hi_cube[-1]
-sigma = sig_clip(hi_mom0.value, nsig=10) * \
-    hi_beam.jtok(hi_freq).value
+sigma = sig_clip(hi_mom0.value, nsig=10) * jtok
 
 # Skip the first 7 channels
 i_offset = 7
+chans = np.arange(len(vels)) + i_offset
+
+# Now apply a radial boundary to the edge mask where the CO data is valid
+# This is the same cut-off used to define the valid clouds
+radial_cut = radii <= max_radius
+radii_cut = radii.to(u.pc).value[radial_cut]
+
+# Radial bins for splitting the profiles
+dr = 500 * u.pc
+max_radius = max_radius.to(u.pc)
+nbins = np.int(np.floor(max_radius / dr))
+rad_groups = np.floor(radii_cut / dr.value).astype(int)
 
-for i, vel in enumerate(ProgressBar(vels)):
+# The binned profiles are accumulated channel-by-channel, rather than
+# keeping every pixel from every channel.
+edge_bins = np.arange(-30, 30, 1)
+edge_acc = BinnedAccumulator(edge_bins, ['hi', 'co'])
+edge_acc_rad = BinnedAccumulator(edge_bins, ['hi', 'co'], ngroups=nbins)
 
-    hi_chan = hi_cube[i + i_offset] * hi_beam.jtok(hi_freq) / u.Jy
-    co_chan = co_cube[i + i_offset]
+skel_bins = np.arange(0, 36, 1)
+skel_acc = BinnedAccumulator(skel_bins, ['hi', 'co'])
+skel_acc_rad = BinnedAccumulator(skel_bins, ['hi', 'co'], ngroups=nbins)
 
-    # Need a mask from the HI
-    # Adjust the sigma in a single channel to the moment0 in the slab
-    # sigma = 0.00152659 * hi_slab.shape[0] * \
-    #     np.abs((hi_slab.spectral_axis[1] - hi_slab.spectral_axis[0]).value)
+# HI intensity bins for the CDFs within the masks
+cdf_bins = np.concatenate([[-np.inf], np.arange(-20, 200, 0.05), [np.inf]])
+cdf_acc = BinnedAccumulator(cdf_bins, ['hi', 'co'])
 
-    bub = BubbleFinder2D(hi_chan, auto_cut=False, sigma=sigma)
-    bub.create_mask(bkg_nsig=5, region_min_nsig=10, mask_clear_border=False)
+# Only the pixels on the skeletons are kept, and a random subset of the
+# others for the scatter plots.
+skel_radii = []
+skel_widths = []
+skel_vals_hi = []
+skel_vals_co = []
 
-    skeleton, dists = medial_axis(~bub.mask, return_distance=True)
-    skeleton_dists.append(skeleton * dists)
+scatter_frac = 0.02
+scatter_dists = []
+scatter_vals_hi = []
+scatter_vals_co = []
 
-    edge_mask = find_boundaries(bub.mask, connectivity=2, mode='outer')
-    hole_mask = bub.mask.copy()
-    # Now apply a radial boundary to the edge mask where the CO data is valid
-    # This is the same cut-off used to define the valid clouds
-    radial_cut = radii <= max_radius
-    edge_mask *= radial_cut
-    edge_masks.append(edge_mask)
+# Keep one of the masks for the figures below.
+example_chan = 40
+example_mask = None
 
-    dist_trans = nd.distance_transform_edt(~edge_mask)
-    # Assign negative values to regions within holes.
-    dist_trans[hole_mask] = -dist_trans[hole_mask]
+pbar = ProgressBar(len(chans))
 
-    # hist = p.hist(co_mom0.value[np.isfinite(co_mom0.value)], bins=100)
-    # p.draw()
-    # raw_input("?")
-    # p.clf()
+for out in iterate_channel_distances(hi_cube, chans, sigma, radial_cut,
+                                     jtok=jtok, num_cores=num_cores,
+                                     bkg_nsig=5, region_min_nsig=10):
 
-    # print(np.nanmin(co_mom0.value))
+    i = out['chan'] - i_offset
 
-    # print(np.nanmax(co_mom0.value[radial_cut]))
-    # print(np.nanmin(co_mom0.value[radial_cut]))
+    hi_chan = hi_cube[out['chan']] * hi_beam.jtok(hi_freq) / u.Jy
+    co_chan = co_cube[out['chan']]
 
-    all_dists.extend(list(dist_trans[radial_cut]))
-    all_radii.extend(list(radii.value[radial_cut]))
-    all_vals_hi.extend(list(hi_chan.value[radial_cut]))
-    all_vals_co.extend(list(co_chan.value[radial_cut]))
+    vals_hi = hi_chan.value[radial_cut]
+    vals_co = co_chan.value[radial_cut]
+    dists = out['edge_dist'][radial_cut]
+    widths = out['skeleton_width'][radial_cut]
+    skel_dists = out['skeleton_dist'][radial_cut]
+
+    vals = {'hi': vals_hi, 'co': vals_co}
+
+    edge_acc.add(dists, vals)
+    edge_acc_rad.add(dists, vals, groups=rad_groups)
+
+    in_mask = dists > 0
+    cdf_acc.add(vals_hi[in_mask], {'hi': vals_hi[in_mask],
+                                   'co': vals_co[in_mask]})
+
+    selector_pts = np.logical_and(vals_co > 0,
+                                  np.logical_and(vals_hi > 0,
+                                                 skel_dists < 35))
+    sel_vals = {'hi': vals_hi[selector_pts], 'co': vals_co[selector_pts]}
+    skel_acc.add(skel_dists[selector_pts], sel_vals)
+    skel_acc_rad.add(skel_dists[selector_pts], sel_vals,
+                     groups=rad_groups[selector_pts])
 
     # Track the width of the mask
-    skeleton_widths.extend(list((skeleton * dists)[radial_cut]))
-    # Also record all of the distances from the centre of the skeletons
-    skeleton_dists_pix.extend(list(nd.distance_transform_edt(~skeleton)[radial_cut]))
+    on_skel = widths > 0
+    skel_radii.append(radii_cut[on_skel])
+    skel_widths.append(widths[on_skel])
+    skel_vals_hi.append(vals_hi[on_skel])
+    skel_vals_co.append(vals_co[on_skel])
+
+    keep = np.logical_and(selector_pts,
+                          np.random.rand(selector_pts.size) < scatter_frac)
+    scatter_dists.append(skel_dists[keep])
+    scatter_vals_hi.append(vals_hi[keep])
+    scatter_vals_co.append(vals_co[keep])
 
-    masks.append(~bub.mask)
+    if i == example_chan:
+        example_mask = out['mask']
 
     if verbose:
+        vel = vels[i]
+        edge_mask = out['edge_mask']
+
         print("Velocity: {}".format(vel))
 
         fig, ax = p.subplots(1, 2, sharex=True, sharey=True,
@@ -157,13 +195,16 @@ for i, vel in enumerate(ProgressBar(vels)):
         raw_input("Next plot?")
         p.clf()
 
-all_dists = np.array(all_dists)
-all_radii = np.array(all_radii)
-all_vals_hi = np.array(all_vals_hi)
-all_vals_co = np.array(all_vals_co)
+    pbar.update()
+
+skel_radii = np.concatenate(skel_radii)
+skel_widths = np.concatenate(skel_widths)
+skel_vals_hi = np.concatenate(skel_vals_hi)
+skel_vals_co = np.concatenate(skel_vals_co)
 
-skeleton_widths = np.array(skeleton_widths)
-skeleton_dists_pix = np.array(skeleton_dists_pix)
+scatter_dists = np.concatenate(scatter_dists)
+scatter_vals_hi = np.concatenate(scatter_vals_hi)
+scatter_vals_co = np.concatenate(scatter_vals_co)
 
 # Make a figure from one of the channels to highlight the mask shape
 twocolumn_twopanel_figure()
@@ -179,7 +220,7 @@ fig.add_colorbar()
 fig.colorbar.set_axis_label_text("HI Intensity (K)")
 fig.show_contour(co_cube[47][spatial_slice].hdu, cmap='autumn',
                  levels=[0.05, 0.1, 0.2, 0.3])
-fig.show_contour(fits.PrimaryHDU(masks[40].astype(int), hi_cube[0].header),
+fig.show_contour(fits.PrimaryHDU(example_mask.astype(int), hi_cube[0].header),
                  colors=[sb.color_palette()[-1]], levels=[0.5])
 fig.hide_axis_labels()
 
@@ -199,7 +240,7 @@ fig = FITSFigure((hi_cube[47][spatial_slice] * hi_beam.jtok(hi_freq).value).hdu,
 fig.show_grayscale(invert=True, vmin=None, vmax=80, stretch='sqrt')
 fig.add_colorbar()
 fig.colorbar.set_axis_label_text("HI Intensity (K)")
-fig.show_contour(fits.PrimaryHDU(medial_axis(masks[40]).astype(int),
+fig.show_contour(fits.PrimaryHDU(medial_axis(example_mask).astype(int),
                                  hi_cube[0].header),
                  colors=[sb.color_palette()[-1]], levels=[0.5])
 fig.show_contour(co_cube[47][spatial_slice].hdu, cmap='autumn',
@@ -213,20 +254,12 @@ fig.savefig(osjoin(fig_path, "mask_skel_img_vel_minus196.png"))
 fig.close()
 
 # Now bin all of the distances against the HI and CO intensities.
-bins = np.arange(-30, 30, 1)
-hi_vals, bin_edges, bin_num = \
-    binned_statistic(all_dists, all_vals_hi,
-                     bins=bins,
-                     statistic=np.mean)
+bins = edge_bins
+bin_edges = edge_bins
+hi_vals = edge_acc.mean('hi')
+co_vals = edge_acc.mean('co')
 
-co_vals, bin_edges, bin_num = \
-    binned_statistic(all_dists, all_vals_co,
-                     bins=bins,
-                     statistic=np.mean)
-
-binned_elements = \
-    binned_statistic(all_dists, np.ones_like(all_dists), bins=bins,
-                     statistic=np.sum)[0]
+binned_elements = edge_acc.count[0]
 
 # Require that there be 100 points in each bin
 bin_cutoff = binned_elements >= 100
@@ -238,25 +271,11 @@ bin_centers = bin_centers[bin_cutoff]
 co_vals = co_vals[bin_cutoff]
 hi_vals = hi_vals[bin_cutoff]
 
-# Let's bootstrap to get errors in the distance bins
-niters = 100
-hi_samps = np.zeros((niters, len(bin_centers)))
-co_samps = np.zeros((niters, len(bin_centers)))
-print("Bootstrapping")
-for i in ProgressBar(niters):
-    hi_samps[i] = \
-        binned_statistic(all_dists, np.random.permutation(all_vals_hi),
-                         bins=bins,
-                         statistic=np.mean)[0][bin_cutoff]
-
-    co_samps[i] = \
-        binned_statistic(all_dists, np.random.permutation(all_vals_co),
-                         bins=bins,
-                         statistic=np.mean)[0][bin_cutoff]
-
-# Take the stds in the distribution for each bin
-hi_errs = np.nanstd(hi_samps, axis=0)
-co_errs = np.nanstd(co_samps, axis=0)
+# The errors are the spread in the bin means when the intensities are
+# randomly permuted between the distance bins. These follow from the binned
+# sums, without needing to re-bin permuted copies of every pixel.
+hi_errs = edge_acc.permutation_std('hi')[bin_cutoff]
+co_errs = edge_acc.permutation_std('co')[bin_cutoff]
 
 # Convert the bin_centers to pc
 pixscale = \
@@ -344,14 +363,16 @@ p.close()
 # Compare the CDFs of the intensities within the masks to demonstrate CO
 # is not colocated with all of the HI
 
-pos_hi = all_vals_hi[all_dists > 0]
-pos_co = all_vals_co[all_dists > 0]
+# The cumulative sums are taken over the binned HI intensities. The last bin
+# is open-ended so it is not plotted.
+cdf_hi = np.cumsum(cdf_acc.sums['hi'][0]) / cdf_acc.sums['hi'][0].sum()
+cdf_co = np.cumsum(cdf_acc.sums['co'][0]) / cdf_acc.sums['co'][0].sum()
 
 onecolumn_figure()
 
-p.plot(np.sort(pos_hi), np.cumsum(np.sort(pos_hi)) / np.sum(pos_hi), "-",
+p.plot(cdf_bins[1:-1], cdf_hi[:-1], "-",
        label="HI")
-p.plot(np.sort(pos_hi), np.cumsum(pos_co[np.argsort(pos_hi)]) / np.sum(pos_co),
+p.plot(cdf_bins[1:-1], cdf_co[:-1],
        "--", label="CO")
 p.legend(loc='upper left', frameon=True)
 p.grid()
@@ -365,12 +386,6 @@ p.savefig(osjoin(fig_path, "inmask_hi_co_cdfs.png"))
 p.close()
 
 # Perform the same analysis split up into radial bins
-dr = 500 * u.pc
-
-max_radius = max_radius.to(u.pc)
-
-nbins = np.int(np.floor(max_radius / dr))
-
 inneredge = np.linspace(0, max_radius - dr, nbins)
 outeredge = np.linspace(dr, max_radius, nbins)
 
@@ -390,33 +405,15 @@ fig.text(0.04, 0.5, 'Normalized Intensity', va='center', rotation='vertical')
 p.subplots_adjust(hspace=0.1,
                   wspace=0.1)
 
-hi_vals_rad = []
-hi_errs_rad = []
-co_vals_rad = []
-co_errs_rad = []
-
 for ctr, (r0, r1) in enumerate(zip(inneredge,
                                    outeredge)):
 
     r, c = np.unravel_index(ctr, (Nrows, Ncols))
 
-    idx = np.logical_and(all_radii >= r0.value,
-                         all_radii < r1.value)
-
-    hi_vals_bin, bin_edges, bin_num = \
-        binned_statistic(all_dists[idx], all_vals_hi[idx],
-                         bins=bins,
-                         statistic=np.mean)
+    hi_vals_bin = edge_acc_rad.mean('hi', group=ctr)
+    co_vals_bin = edge_acc_rad.mean('co', group=ctr)
 
-    co_vals_bin, bin_edges, bin_num = \
-        binned_statistic(all_dists[idx], all_vals_co[idx],
-                         bins=bins,
-                         statistic=np.mean)
-
-    binned_elements = \
-        binned_statistic(all_dists[idx], np.ones_like(all_dists)[idx],
-                         bins=bins,
-                         statistic=np.sum)[0]
+    binned_elements = edge_acc_rad.count[ctr]
 
     bin_cutoff = binned_elements >= 30
 
@@ -427,30 +424,8 @@ for ctr, (r0, r1) in enumerate(zip(inneredge,
     co_vals_bin = co_vals_bin[bin_cutoff]
     hi_vals_bin = hi_vals_bin[bin_cutoff]
 
-    hi_samps = np.zeros((niters, len(bin_centers)))
-    co_samps = np.zeros((niters, len(bin_centers)))
-    print("Bootstrapping")
-    for i in ProgressBar(niters):
-        hi_samps[i] = \
-            binned_statistic(all_dists[idx],
-                             np.random.permutation(all_vals_hi[idx]),
-                             bins=bins,
-                             statistic=np.mean)[0][bin_cutoff]
-
-        co_samps[i] = \
-            binned_statistic(all_dists[idx],
-                             np.random.permutation(all_vals_co[idx]),
-                             bins=bins,
-                             statistic=np.mean)[0][bin_cutoff]
-
-    # Take the stds in the distribution for each bin
-    hi_errs_bin = np.nanstd(hi_samps, axis=0)
-    co_errs_bin = np.nanstd(co_samps, axis=0)
-
-    hi_vals_rad.append(hi_vals)
-    hi_errs_rad.append(hi_errs)
-    co_vals_rad.append(co_vals)
-    co_errs_rad.append(co_errs)
+    hi_errs_bin = edge_acc_rad.permutation_std('hi', group=ctr)[bin_cutoff]
+    co_errs_bin = edge_acc_rad.permutation_std('co', group=ctr)[bin_cutoff]
 
     ax[r, c].errorbar(bin_centers * pixscale,
                       hi_vals_bin / np.nanmax(hi_vals_bin),
@@ -496,12 +471,10 @@ onecolumn_figure()
 # Is the variation being driven by a change in the width of the regions?
 bins = np.arange(0, 6.5, 0.5) * 1000
 dists, bin_edges, bin_num = \
-    binned_statistic(all_radii[skeleton_widths > 0],
-                     skeleton_widths[skeleton_widths > 0],
+    binned_statistic(skel_radii, skel_widths,
                      bins=bins, statistic=np.mean)
 dist_std = \
-    binned_statistic(all_radii[skeleton_widths > 0],
-                     skeleton_widths[skeleton_widths > 0],
+    binned_statistic(skel_radii, skel_widths,
                      bins=bins, statistic=np.std)[0]
 
 bin_width = (bin_edges[1] - bin_edges[0])
@@ -510,8 +483,8 @@ bin_centers = bin_edges[1:] - bin_width / 2
 ang_conv = (hi_mom0.header["CDELT2"] * u.deg).to(u.arcsec)
 phys_conv = ang_conv.to(u.rad).value * 840e3 * u.pc
 
-p.plot(all_radii[skeleton_widths > 0] / 1000.,
-       skeleton_widths[skeleton_widths > 0] * phys_conv.value,
+p.plot(skel_radii / 1000.,
+       skel_widths * phys_conv.value,
        'ko', alpha=0.1, ms=3.0, zorder=-1)
 
 p.errorbar(bin_centers / 1000., dists * phys_conv.value,
@@ -532,15 +505,15 @@ twocolumn_twopanel_figure()
 
 fig, ax = p.subplots(1, 2, sharex=True)
 
-hist2d(skeleton_widths[skeleton_widths > 0] * phys_conv.value,
-       all_vals_co[skeleton_widths > 0], bins=10,
+hist2d(skel_widths * phys_conv.value,
+       skel_vals_co, bins=10,
        ax=ax[1], data_kwargs={"alpha": 0.6})
 ax[1].set_xlabel("Mask Width (pc)")
 ax[1].set_ylabel(r"CO Intensity (K)")
 ax[1].grid()
 
-hist2d(skeleton_widths[skeleton_widths > 0] * phys_conv.value,
-       all_vals_hi[skeleton_widths > 0], bins=10,
+hist2d(skel_widths * phys_conv.value,
+       skel_vals_hi, bins=10,
        ax=ax[0], data_kwargs={"alpha": 0.6})
 ax[0].set_xlabel("Mask Width (pc)")
 ax[0].set_ylabel(r"HI Intensity (K)")
@@ -553,36 +526,18 @@ p.savefig(osjoin(fig_path, "mask_widthvsintensity.png"))
 p.close()
 
 # HI vs. CO with all skeleton distances (not just on the skeleton like above)
-bins = np.arange(0, 36, 1)
-
-selector_pts = np.logical_and(all_vals_co > 0,
-                              np.logical_and(all_vals_hi > 0,
-                                             skeleton_dists_pix < 35))
+bins = skel_bins
 
-hi_mean, bin_edges, bin_num = \
-    binned_statistic(skeleton_dists_pix[selector_pts],
-                     all_vals_hi[selector_pts],
-                     bins=bins, statistic=np.mean)
-
-hi_std = \
-    binned_statistic(skeleton_dists_pix[selector_pts],
-                     all_vals_hi[selector_pts],
-                     bins=bins, statistic=np.std)[0]
-
-co_mean = \
-    binned_statistic(skeleton_dists_pix[selector_pts],
-                     all_vals_co[selector_pts],
-                     bins=bins, statistic=np.mean)[0]
-
-co_std = \
-    binned_statistic(skeleton_dists_pix[selector_pts],
-                     all_vals_co[selector_pts],
-                     bins=bins, statistic=np.std)[0]
+hi_mean = skel_acc.mean('hi')
+hi_std = skel_acc.std('hi')
+co_mean = skel_acc.mean('co')
+co_std = skel_acc.std('co')
 
+bin_edges = skel_bins
 bin_width = (bin_edges[1] - bin_edges[0])
 bin_centers = bin_edges[1:] - bin_width / 2
 
-num_in_bins = np.bincount(bin_num)[1:]
+num_in_bins = skel_acc.count[0]
 # Num. indep't points divided by number of pixels in one beam.
 num_indept = num_in_bins / 41.
 
@@ -590,15 +545,15 @@ twocolumn_twopanel_figure()
 
 fig, ax = p.subplots(1, 2, sharex=True)
 
-ax[1].plot(skeleton_dists_pix[selector_pts] * phys_conv.value,
-           all_vals_co[selector_pts], 'ko', ms=2.0, alpha=0.6,
+ax[1].plot(scatter_dists * phys_conv.value,
+           scatter_vals_co, 'ko', ms=2.0, alpha=0.6,
            rasterized=True, zorder=-1)
 ax[1].set_xlabel("Distance from Mask Centre (pc)")
 ax[1].set_ylabel(r"CO Intensity (K)")
 ax[1].grid()
 
-ax[0].plot(skeleton_dists_pix[selector_pts] * phys_conv.value,
-           all_vals_hi[selector_pts], 'ko', ms=2.0, alpha=0.6,
+ax[0].plot(scatter_dists * phys_conv.value,
+           scatter_vals_hi, 'ko', ms=2.0, alpha=0.6,
            rasterized=True, zorder=-1)
 ax[0].set_xlabel("Distance from Mask Centre (pc)")
 ax[0].set_ylabel(r"HI Intensity (K)")
@@ -720,33 +675,15 @@ for ctr, (r0, r1) in enumerate(zip(inneredge,
 
     r, c = np.unravel_index(ctr, (Nrows, Ncols))
 
-    idx = np.logical_and(all_radii >= r0.value,
-                         all_radii < r1.value)
-
-    idx = np.logical_and(selector_pts, idx)
-
-    hi_mean_rad, bin_edges, bin_num = \
-        binned_statistic(skeleton_dists_pix[idx],
-                         all_vals_hi[idx],
-                         bins=bins, statistic=np.mean)
-    hi_std_rad = \
-        binned_statistic(skeleton_dists_pix[idx],
-                         all_vals_hi[idx],
-                         bins=bins, statistic=np.std)[0]
-
-    co_mean_rad = \
-        binned_statistic(skeleton_dists_pix[idx],
-                         all_vals_co[idx],
-                         bins=bins, statistic=np.mean)[0]
+    hi_mean_rad = skel_acc_rad.mean('hi', group=ctr)
+    hi_std_rad = skel_acc_rad.std('hi', group=ctr)
 
-    co_std_rad = \
-        binned_statistic(skeleton_dists_pix[idx],
-                         all_vals_co[idx],
-                         bins=bins, statistic=np.std)[0]
+    co_mean_rad = skel_acc_rad.mean('co', group=ctr)
+    co_std_rad = skel_acc_rad.std('co', group=ctr)
 
-    num_in_bins_rad = np.bincount(bin_num)[1:]
+    num_in_bins_rad = skel_acc_rad.count[ctr]
     # Num. indep't points divided by number of pixels in one beam.
-    num_indept_rad = num_in_bins / 41.
+    num_indept_rad = num_in_bins_rad / 41.
 
     bin_width = (bin_edges[1] - bin_edges[0])
     bin_centers = bin_edges[1:] - bin_width / 2
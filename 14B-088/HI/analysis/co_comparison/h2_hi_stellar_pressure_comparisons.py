@@ -34,6 +34,7 @@ from plotting_styles import (default_figure, onecolumn_figure,
                              twocolumn_twopanel_figure,
                              fullpage_figure)
 from galaxy_params import gal_feath as gal
+from resolution_pyramid import ResolutionPyramid
 
 
 from cube_analysis.h2_models import (Pext_star, Pext_sum,
@@ -55,7 +56,14 @@ tab = Table.read(fourteenB_HI_data_wGBT_path("tables/sd_radial_500pc_w_stellar_d
 dust_col_hdu = fits.open(osjoin(data_path, "m33_dust.surface.density_FB.beta=1.8_gauss41.0_regrid_bksub.fits"))[0]
 dust_temp_hdu = fits.open(osjoin(data_path, "m33_dust.temperature_FB.beta=1.8_gauss41.0_regrid_bksub.fits"))[0]
 
-hi_mom0 = Projection.from_hdu(fits.open(fourteenB_wGBT_HI_file_dict['Moment0']))
+# Convolved and regridded maps are cached and shared with other scripts
+pyramid = ResolutionPyramid(osjoin(data_path, "resolution_pyramid"))
+
+pyramid.register("hi_mom0", fourteenB_wGBT_HI_file_dict['Moment0'],
+                 levels={38 * u.arcsec: fourteenB_HI_data_wGBT_path("smooth_2beam/M33_14B-088_HI.clean.image.GBT_feathered.38arcsec.mom0.fits"),
+                         95 * u.arcsec: fourteenB_HI_data_wGBT_path("smooth_5beam/M33_14B-088_HI.clean.image.GBT_feathered.95arcsec.mom0.fits")})
+
+hi_mom0 = pyramid.get("hi_mom0")
 co_mom0 = Projection.from_hdu(fits.open(iram_co21_14B088_data_path("m33.co21_iram.14B-088_HI.mom0.fits")))
 
 # In K m s-1
@@ -84,13 +92,14 @@ radius = gal.radius(header=hi_mom0.header).to(u.kpc)
 
 dust_col_hdr = dust_col_hdu.header.copy()
 dust_col_hdr['BUNIT'] = "solMass / pc2"
-dust_surfdens = Projection.from_hdu(fits.PrimaryHDU(dust_col_hdu.data[0],
-                                                    dust_col_hdr))
-dust_surfdens_rep = dust_surfdens.reproject(hi_mom0.header)
+pyramid.register("dust_surfdens", fits.PrimaryHDU(dust_col_hdu.data[0],
+                                                  dust_col_hdr))
+dust_surfdens_rep = pyramid.get("dust_surfdens", header=hi_mom0.header)
 
-dust_surfdens_sigma = Projection.from_hdu(fits.PrimaryHDU(dust_col_hdu.data[2],
-                                                          dust_col_hdr))
-dust_surfdens_sigma_rep = dust_surfdens_sigma.reproject(hi_mom0.header)
+pyramid.register("dust_surfdens_sigma",
+                 fits.PrimaryHDU(dust_col_hdu.data[2], dust_col_hdr))
+dust_surfdens_sigma_rep = pyramid.get("dust_surfdens_sigma",
+                                      header=hi_mom0.header)
 
 # Apply inclination correction
 dust_surfdens_rep = dust_surfdens_rep * np.cos(gal.inclination)
@@ -99,13 +108,14 @@ dust_surfdens_sigma_rep = dust_surfdens_sigma_rep * np.cos(gal.inclination)
 
 dust_temp_hdr = dust_temp_hdu.header.copy()
 dust_temp_hdr['BUNIT'] = "K"
-dust_temp = Projection.from_hdu(fits.PrimaryHDU(dust_temp_hdu.data[0],
-                                                dust_temp_hdr))
-dust_temp_rep = dust_temp.reproject(hi_mom0.header)
+pyramid.register("dust_temp", fits.PrimaryHDU(dust_temp_hdu.data[0],
+                                              dust_temp_hdr))
+dust_temp_rep = pyramid.get("dust_temp", header=hi_mom0.header)
 
-stellar_surfdens = Projection.from_hdu(fits.open(osjoin(data_path, "m33.stellarmass.fits")))
-stellar_surfdens = stellar_surfdens * u.solMass / u.kpc**2
-stellar_surfdens_rep = stellar_surfdens.reproject(hi_mom0.header).to(u.solMass / u.pc**2)
+pyramid.register("stellar_surfdens", osjoin(data_path, "m33.stellarmass.fits"))
+stellar_surfdens_rep = pyramid.get("stellar_surfdens", header=hi_mom0.header)
+stellar_surfdens_rep = \
+    (stellar_surfdens_rep * u.solMass / u.kpc**2).to(u.solMass / u.pc**2)
 
 
 # Pressure comparisons
@@ -181,10 +191,11 @@ plt.close()
 # the same CO resolution?
 
 # Convert to K km/s in HI
-hi_mom0_2beam = Projection.from_hdu(fits.open(fourteenB_HI_data_wGBT_path("smooth_2beam/M33_14B-088_HI.clean.image.GBT_feathered.38arcsec.mom0.fits")))
+# The smoothed moment maps are made from the smoothed cubes
+hi_mom0_2beam = pyramid.get("hi_mom0", beam=38 * u.arcsec)
 hi_mom0_2beam[np.isnan(hi_mom0)] = np.NaN
 
-hi_mom0_5beam = Projection.from_hdu(fits.open(fourteenB_HI_data_wGBT_path("smooth_5beam/M33_14B-088_HI.clean.image.GBT_feathered.95arcsec.mom0.fits")))
+hi_mom0_5beam = pyramid.get("hi_mom0", beam=95 * u.arcsec)
 hi_mom0_5beam[np.isnan(hi_mom0)] = np.NaN
 
 
@@ -1,21 +1,21 @@
 
-from spectral_cube import SpectralCube, Projection
+from spectral_cube import Projection
 import numpy as np
 import matplotlib.pyplot as p
 from astropy.io import fits
 from astropy.wcs import WCS
 import astropy.units as u
 import os
-from reproject import reproject_interp
 from astropy.visualization import AsinhStretch
 from astropy.visualization.mpl_normalize import ImageNormalize
 
-from paths import (fourteenB_HI_file_dict, fourteenB_wGBT_HI_file_dict,
-                   allfigs_path,
+from paths import (allfigs_path,
                    iram_co21_14B088_data_path, data_path)
 from constants import hi_freq
 from plotting_styles import (twocolumn_figure, onecolumn_figure,
                              default_figure)
+from reprojection_weights import reproject_cached
+from cube_registry import fourteenB_HI_products, fourteenB_wGBT_HI_products
 
 '''
 Investigating skewness and kurtosis in the 14B-088 cube.
@@ -25,9 +25,7 @@ if not os.path.exists(allfigs_path("HI_maps")):
     os.mkdir(allfigs_path("HI_maps"))
 
 
-cube = SpectralCube.read(fourteenB_HI_file_dict["Cube"])
-mask = fits.open(fourteenB_HI_file_dict["Source_Mask"])[0].data > 0
-cube = cube.with_mask(mask)
+cube = fourteenB_HI_products.cube("Cube", mask_key="Source_Mask")
 
 # Checked whether these variations in the spectra are driven by rotation
 # There is not significant change on these scales.
@@ -35,40 +33,27 @@ cube = cube.with_mask(mask)
 # mask = fits.open(fourteenB_HI_data_path(rotsub_mask_name))[0].data > 0
 # cube = cube.with_mask(mask)
 
-mom0_hdu = fits.open(fourteenB_HI_file_dict['Moment0'])[0]
-mom0 = Projection.from_hdu(mom0_hdu)
-
-mom1_hdu = fits.open(fourteenB_HI_file_dict['Moment1'])[0]
-mom1 = Projection.from_hdu(mom1_hdu)
-
-lwidth_hdu = fits.open(fourteenB_HI_file_dict["LWidth"])[0]
-lwidth = Projection.from_hdu(lwidth_hdu)
-
-skew_hdu = fits.open(fourteenB_HI_file_dict['Skewness'])[0]
-skew = Projection.from_hdu(skew_hdu)
-
-kurt_hdu = fits.open(fourteenB_HI_file_dict['Kurtosis'])[0]
-kurt = Projection.from_hdu(kurt_hdu)
-
-peaktemps_hdu = fits.open(fourteenB_wGBT_HI_file_dict["PeakTemp"])[0]
-peaktemps = Projection.from_hdu(peaktemps_hdu)
-
-peakvels_hdu = fits.open(fourteenB_HI_file_dict['PeakVels'])[0]
-peakvels = Projection.from_hdu(peakvels_hdu)
+mom0 = fourteenB_HI_products.projection('Moment0')
+mom1 = fourteenB_HI_products.projection('Moment1')
+lwidth = fourteenB_HI_products.projection("LWidth")
+skew = fourteenB_HI_products.projection('Skewness')
+kurt = fourteenB_HI_products.projection('Kurtosis')
+peaktemps = fourteenB_wGBT_HI_products.projection("PeakTemp")
+peakvels = fourteenB_HI_products.projection('PeakVels')
 
 # Feathered Skew and Kurt
-skew_feather_hdu = fits.open(fourteenB_wGBT_HI_file_dict['Skewness'])[0]
-skew_feather = Projection.from_hdu(skew_feather_hdu)
-
-kurt_feather_hdu = fits.open(fourteenB_wGBT_HI_file_dict['Kurtosis'])[0]
-kurt_feather = Projection.from_hdu(kurt_feather_hdu)
+skew_feather = fourteenB_wGBT_HI_products.projection('Skewness')
+kurt_feather = fourteenB_wGBT_HI_products.projection('Kurtosis')
 
 # CO and 3.6 um for comparison
 co_hdu = fits.open(iram_co21_14B088_data_path("m33.co21_iram.14B-088_HI.mom0.fits"))[0]
 co_map = Projection(co_hdu.data, wcs=WCS(co_hdu.header), unit=u.K)
 
 irac1_hdu = fits.open(os.path.join(data_path, "Spitzer/irac1_3.6um/ch1_122_bgsub.fits"))[0]
-irac1_reproj = reproject_interp(irac1_hdu, mom0.header)[0]
+# The interpolation weights onto the HI grid are saved and reused
+irac1_reproj = reproject_cached(irac1_hdu, mom0.header,
+                                cache_dir=os.path.join(data_path,
+                                                       "reprojection_weights"))[0]
 irac1_map = Projection(irac1_reproj, wcs=mom0.wcs, unit=u.MJy / u.sr)
 
 # Make a nice 2 panel figure
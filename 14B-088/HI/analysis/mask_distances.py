@@ -0,0 +1,280 @@
+
+'''
+Distances from the edges and skeletons of the HI channel masks, and binned
+statistics that are accumulated channel-by-channel.
+
+The per-channel masks and distance transforms are independent, so they are
+computed in a pool. The binned statistics only need the counts, sums and sums
+of squares in each bin, so the per-pixel values of each channel can be
+dropped once they are added to a `BinnedAccumulator`.
+'''
+
+import numpy as np
+import scipy.ndimage as nd
+import astropy.units as u
+from astropy.wcs import WCS
+from multiprocessing import Pool
+from skimage.segmentation import find_boundaries
+from skimage.morphology import medial_axis
+
+
+def channel_mask_distances(hi_chan, sigma, radial_cut, bkg_nsig=5,
+                           region_min_nsig=10):
+    '''
+    Create the HI mask for one channel and find the distance of each pixel
+    from the mask edges and the mask skeleton.
+
+    Parameters
+    ----------
+    hi_chan : spectral_cube.Projection
+        HI channel in K.
+    sigma : float
+        Noise level used to create the mask.
+    radial_cut : np.ndarray
+        Boolean array of where the mask edges are valid.
+
+    Returns
+    -------
+    out : dict
+        'mask' is True within the HI mask, 'edge_mask' is the mask
+        boundary, 'edge_dist' is the distance from the nearest edge
+        (negative outside of the mask), 'skeleton_width' is the distance to
+        the edge along the skeleton and zero elsewhere, and 'skeleton_dist'
+        is the distance from the nearest skeleton pixel.
+    '''
+    from basics import BubbleFinder2D
+
+    bub = BubbleFinder2D(hi_chan, auto_cut=False, sigma=sigma)
+    bub.create_mask(bkg_nsig=bkg_nsig, region_min_nsig=region_min_nsig,
+                    mask_clear_border=False)
+
+    skeleton, dists = medial_axis(~bub.mask, return_distance=True)
+
+    edge_mask = find_boundaries(bub.mask, connectivity=2, mode='outer')
+    edge_mask *= radial_cut
+
+    dist_trans = nd.distance_transform_edt(~edge_mask)
+    # Assign negative values to regions within holes.
+    dist_trans[bub.mask] = -dist_trans[bub.mask]
+
+    return {'mask': ~bub.mask,
+            'edge_mask': edge_mask,
+            'edge_dist': dist_trans,
+            'skeleton_width': skeleton * dists,
+            'skeleton_dist': nd.distance_transform_edt(~skeleton)}
+
+
+def _channel_worker(args):
+    chan, hi_data, hi_header, sigma, radial_cut, mask_kwargs = args
+
+    from spectral_cube.lower_dimensional_structures import Projection
+    from radio_beam import Beam
+
+    hi_chan = Projection(hi_data, unit=u.K, wcs=WCS(hi_header),
+                         beam=Beam.from_fits_header(hi_header))
+
+    out = channel_mask_distances(hi_chan, sigma, radial_cut, **mask_kwargs)
+    out['chan'] = chan
+
+    return out
+
+
+def iterate_channel_distances(hi_cube, channels, sigma, radial_cut,
+                              jtok=None, num_cores=1, **mask_kwargs):
+    '''
+    Compute `channel_mask_distances` for a set of channels in a pool. The
+    results are yielded in channel order as they finish, so only a few
+    channels are held in memory at once.
+
+    Parameters
+    ----------
+    hi_cube : spectral_cube.SpectralCube
+        HI cube.
+    channels : list
+        Channels to use.
+    sigma : float
+        Noise level in K.
+    radial_cut : np.ndarray
+        Boolean array of where the mask edges are valid.
+    jtok : float, optional
+        Jy/beam to K conversion factor for the cube.
+    num_cores : int, optional
+        Number of processes.
+
+    Yields
+    ------
+    out : dict
+        Output of `channel_mask_distances` with the channel in 'chan'.
+    '''
+    if jtok is None:
+        jtok = 1.
+
+    header = hi_cube.wcs.celestial.to_header()
+    header.update(hi_cube.beam.to_header_keywords())
+
+    def arg_gen():
+        for chan in channels:
+            hi_data = hi_cube[chan].value * jtok
+            yield chan, hi_data, header, sigma, radial_cut, mask_kwargs
+
+    if num_cores > 1:
+        pool = Pool(num_cores)
+        try:
+            for out in pool.imap(_channel_worker, arg_gen()):
+                yield out
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for args in arg_gen():
+            yield _channel_worker(args)
+
+
+class BinnedAccumulator(object):
+    '''
+    Running counts, sums and sums of squares of values in bins, optionally
+    split into groups (e.g., radial bins).
+
+    The bins follow `scipy.stats.binned_statistic`: the last bin includes
+    its right edge. Non-finite values are ignored.
+
+    Parameters
+    ----------
+    bins : np.ndarray
+        Bin edges.
+    names : list
+        Names of the quantities to accumulate.
+    ngroups : int, optional
+        Number of groups.
+    '''
+    def __init__(self, bins, names, ngroups=1):
+        self.bins = np.asarray(bins, dtype=float)
+        self.names = list(names)
+        self.ngroups = ngroups
+
+        shape = (ngroups, len(self.bins) - 1)
+
+        self.count = np.zeros(shape, dtype=int)
+        self.counts = dict((name, np.zeros(shape, dtype=int))
+                           for name in self.names)
+        self.sums = dict((name, np.zeros(shape)) for name in self.names)
+        self.sumsqs = dict((name, np.zeros(shape)) for name in self.names)
+
+        # Totals over all values in each group, including those outside of
+        # the bins. These are the populations for the permutation errors.
+        self.total_counts = dict((name, np.zeros(ngroups, dtype=int))
+                                 for name in self.names)
+        self.total_sums = dict((name, np.zeros(ngroups))
+                               for name in self.names)
+        self.total_sumsqs = dict((name, np.zeros(ngroups))
+                                 for name in self.names)
+
+    @property
+    def nbins(self):
+        return len(self.bins) - 1
+
+    @property
+    def bin_centers(self):
+        return 0.5 * (self.bins[1:] + self.bins[:-1])
+
+    def add(self, x, values, groups=None):
+        '''
+        Add values to the bins.
+
+        Parameters
+        ----------
+        x : np.ndarray
+            Values that are binned.
+        values : dict
+            Arrays of each quantity with the same shape as `x`.
+        groups : np.ndarray, optional
+            Group index for each value. Values with indices outside of
+            [0, ngroups) are ignored.
+        '''
+        x = np.asarray(x, dtype=float).ravel()
+
+        if groups is None:
+            groups = np.zeros(x.shape, dtype=int)
+        else:
+            groups = np.asarray(groups, dtype=int).ravel()
+
+        in_group = (groups >= 0) & (groups < self.ngroups) & np.isfinite(x)
+
+        bin_idx = np.searchsorted(self.bins, x, side='right') - 1
+        bin_idx[x == self.bins[-1]] = self.nbins - 1
+        in_bin = in_group & (bin_idx >= 0) & (bin_idx < self.nbins)
+
+        flat_idx = groups[in_bin] * self.nbins + bin_idx[in_bin]
+        size = self.ngroups * self.nbins
+        shape = (self.ngroups, self.nbins)
+
+        self.count += np.bincount(flat_idx, minlength=size).reshape(shape)
+
+        for name in self.names:
+            vals = np.asarray(values[name], dtype=float).ravel()
+            finite = np.isfinite(vals)
+
+            sel = finite[in_bin]
+            idx = flat_idx[sel]
+            v = vals[in_bin][sel]
+
+            self.counts[name] += \
+                np.bincount(idx, minlength=size).reshape(shape)
+            self.sums[name] += \
+                np.bincount(idx, weights=v, minlength=size).reshape(shape)
+            self.sumsqs[name] += \
+                np.bincount(idx, weights=v**2,
+                            minlength=size).reshape(shape)
+
+            sel = in_group & finite
+            grp = groups[sel]
+            v = vals[sel]
+
+            self.total_counts[name] += \
+                np.bincount(grp, minlength=self.ngroups)
+            self.total_sums[name] += \
+                np.bincount(grp, weights=v, minlength=self.ngroups)
+            self.total_sumsqs[name] += \
+                np.bincount(grp, weights=v**2, minlength=self.ngroups)
+
+    def mean(self, name, group=0):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums[name][group] / self.counts[name][group]
+
+    def std(self, name, group=0):
+        '''
+        Standard deviation in each bin (with ddof=0, as `np.std`).
+        '''
+        n = self.counts[name][group].astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = self.sumsqs[name][group] / n - \
+                (self.sums[name][group] / n)**2
+        return np.sqrt(np.clip(var, 0., None))
+
+    def permutation_std(self, name, group=0):
+        '''
+        Standard deviation of the bin means when the values are randomly
+        permuted between all of the points in the group.
+
+        A bin with n of the N values in the group is a sample drawn without
+        replacement, so the variance of its mean is
+        var / n * (N - n) / (N - 1), where var is the variance of all N
+        values. This is the limit of repeatedly binning randomly permuted
+        values.
+        '''
+        N = float(self.total_counts[name][group])
+        n = self.counts[name][group].astype(float)
+
+        if N < 2:
+            return np.zeros_like(n) * np.NaN
+
+        var = self.total_sumsqs[name][group] / N - \
+            (self.total_sums[name][group] / N)**2
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var_mean = var / n * (N - n) / (N - 1)
+
+        out = np.sqrt(np.clip(var_mean, 0., None))
+        out[n == 0] = np.NaN
+
+        return out
@@ -21,34 +21,51 @@ from scipy.special import erf
 from cube_analysis.spectral_stacking_models import fit_hwhm
 
 
-def mix_mu(mu_samps, f=None):
-
+def _mix_weights(mu_samps, f=None):
+    '''
+    Component weights, broadcast to the shape of `mu_samps`. The components
+    are along the last axis.
+    '''
     if f is not None:
-        assert mu_samps.size == f.size
-        assert f.sum() == 1.
+        f = np.broadcast_to(f, mu_samps.shape)
+        assert np.allclose(f.sum(-1), 1.)
     else:
-        f = np.ones_like(mu_samps) / float(mu_samps.size)
+        f = np.ones_like(mu_samps) / float(mu_samps.shape[-1])
+
+    return f
+
+
+def mix_mu(mu_samps, f=None):
+    '''
+    Mean of a mixture of normals. The components are along the last axis, so
+    the means of many mixtures (e.g., one per pixel) are found at once.
+    '''
+    mu_samps = np.asarray(mu_samps)
+
+    f = _mix_weights(mu_samps, f)
 
-    return np.sum(f * mu_samps)
+    return np.sum(f * mu_samps, axis=-1)
 
 
 def mix_variance(mu_samps, var_samps, f=None, mu=None):
+    '''
+    Variance of a mixture of normals.
+    '''
+    mu_samps = np.asarray(mu_samps)
 
     if mu is None:
         mu = mix_mu(mu_samps, f)
 
-    if f is not None:
-        assert mu_samps.size == f.size
-        assert f.sum() == 1.
-    else:
-        f = np.ones_like(mu_samps) / float(mu_samps.size)
-
-    term1 = np.sum(f * (var_samps + mu_samps**2)) - mu**2
+    f = _mix_weights(mu_samps, f)
 
-    return term1 - mu**2
+    return np.sum(f * (var_samps + mu_samps**2), axis=-1) - mu**2
 
 
 def mix_skew(mu_samps, var_samps, f=None, mu=None, var=None):
+    '''
+    Skewness of a mixture of normals.
+    '''
+    mu_samps = np.asarray(mu_samps)
 
     if mu is None:
         mu = mix_mu(mu_samps, f)
@@ -56,18 +73,20 @@ def mix_skew(mu_samps, var_samps, f=None, mu=None, var=None):
     if var is None:
         var = mix_variance(mu_samps, var_samps, f, mu=mu)
 
-    if f is not None:
-        assert mu_samps.size == f.size
-        assert f.sum() == 1.
-    else:
-        f = np.ones_like(mu_samps) / float(mu_samps.size)
+    f = _mix_weights(mu_samps, f)
+
+    diff = mu_samps - np.expand_dims(mu, -1)
 
-    term1 = np.sum(f * (mu_samps - mu) * (3 * var + (mu_samps - mu)**2))
+    term1 = np.sum(f * diff * (3 * var_samps + diff**2), axis=-1)
 
     return term1 / var**1.5
 
 
 def mix_kurt(mu_samps, var_samps, f=None, mu=None, var=None):
+    '''
+    Kurtosis (not the excess) of a mixture of normals.
+    '''
+    mu_samps = np.asarray(mu_samps)
 
     if mu is None:
         mu = mix_mu(mu_samps, f)
@@ -75,21 +94,58 @@ def mix_kurt(mu_samps, var_samps, f=None, mu=None, var=None):
     if var is None:
         var = mix_variance(mu_samps, var_samps, f, mu=mu)
 
-    terma = 3 * var_samps**2
-    termb = 6 * (mu_samps - mu)**2 * var_samps
-    termc = (mu_samps - mu)**4
+    f = _mix_weights(mu_samps, f)
 
-    if f is not None:
-        assert mu_samps.size == f.size
-        assert f.sum() == 1.
-    else:
-        f = np.ones_like(mu_samps) / float(mu_samps.size)
+    diff = mu_samps - np.expand_dims(mu, -1)
+
+    terma = 3 * var_samps**2
+    termb = 6 * diff**2 * var_samps
+    termc = diff**4
 
-    term1 = np.sum(f * (terma + termb + termc))
+    term1 = np.sum(f * (terma + termb + termc), axis=-1)
 
     return term1 / var**2
 
 
+def mix_moments(mu_samps, var_samps, f=None):
+    '''
+    Mean, variance, skewness and kurtosis of mixtures of normals, sharing the
+    intermediate terms. The components are along the last axis, so the
+    arrays can hold one mixture per pixel of an image.
+
+    Parameters
+    ----------
+    mu_samps : np.ndarray
+        Means of the components.
+    var_samps : np.ndarray
+        Variances of the components. Must broadcast with `mu_samps`.
+    f : np.ndarray, optional
+        Weights of the components, summing to one along the last axis.
+        Defaults to equal weights.
+
+    Returns
+    -------
+    mu, var, skew, kurt : np.ndarray
+        Moments with the shape of `mu_samps` without the last axis.
+    '''
+    mu_samps = np.asarray(mu_samps)
+    var_samps = np.broadcast_to(var_samps, mu_samps.shape)
+
+    f = _mix_weights(mu_samps, f)
+
+    mu = np.sum(f * mu_samps, axis=-1)
+
+    diff = mu_samps - mu[..., np.newaxis]
+    diff2 = diff**2
+
+    var = np.sum(f * (var_samps + diff2), axis=-1)
+    skew = np.sum(f * diff * (3 * var_samps + diff2), axis=-1) / var**1.5
+    kurt = np.sum(f * (3 * var_samps**2 + 6 * diff2 * var_samps +
+                       diff2**2), axis=-1) / var**2
+
+    return mu, var, skew, kurt
+
+
 def lwidth(T):
     return np.sqrt((co.k_B * T) / (1.4 * co.m_p)).to(u.km / u.s)
 
@@ -113,15 +169,95 @@ def pearson7_profile(mu, std, kurt):
     return lambda x: (1 + ((x - mu) / alpha)**2) ** (-m)
 
 
-def create_profile(vels, mu_samps, std_samps):
+def create_profile(vels, mu_samps, std_samps, chunk=1000):
     '''
     Create the equivalent stacked profile shape.
+
+    The components are along the last axis of `mu_samps` and `std_samps`,
+    and are evaluated as one (components x channels) array for each chunk of
+    components. Leading axes (e.g., pixels) give one profile each.
+
+    Parameters
+    ----------
+    vels : np.ndarray
+        Velocity axis.
+    mu_samps : np.ndarray
+        Centres of the components.
+    std_samps : np.ndarray
+        Widths of the components. Must broadcast with `mu_samps`.
+    chunk : int, optional
+        Number of components evaluated together.
+
+    Returns
+    -------
+    yvals : np.ndarray
+        Profiles normalized to a peak of one, with shape
+        mu_samps.shape[:-1] + vels.shape.
     '''
+    mu_samps = np.asarray(mu_samps, dtype=float)
+    std_samps = np.broadcast_to(std_samps, mu_samps.shape)
+
+    yvals = np.zeros(mu_samps.shape[:-1] + vels.shape)
+
+    for start in range(0, mu_samps.shape[-1], chunk):
+        mu = mu_samps[..., start:start + chunk, np.newaxis]
+        std = std_samps[..., start:start + chunk, np.newaxis]
+
+        yvals += np.exp(-(vels - mu)**2 / (2 * std**2)).sum(-2)
+
+    return yvals / yvals.max(-1, keepdims=True)
+
+
+def create_profile_hist(vels, mu_samps, std_samps, nbins=50):
+    '''
+    Approximate `create_profile` by binning the components.
+
+    The component centres are binned onto the velocity axis (sharing each
+    centre between the two nearest channels) separately for `nbins` bins in
+    width. Each binned histogram is convolved with a Gaussian at the width of
+    its bin. The cost does not depend on the number of components. `vels`
+    must be evenly spaced.
+
+    Returns
+    -------
+    yvals : np.ndarray
+        Profile normalized to a peak of one.
+    '''
+    mu_samps = np.asarray(mu_samps, dtype=float).ravel()
+    std_samps = np.broadcast_to(std_samps, mu_samps.shape).ravel()
+
+    dv = vels[1] - vels[0]
+    nchan = vels.size
+
+    # Linear assignment of the centres to the channels
+    posn = (mu_samps - vels[0]) / dv
+    lower = np.floor(posn).astype(int)
+    frac = posn - lower
+
+    # Bins in width, with the components at their mean width in each bin
+    edges = np.linspace(std_samps.min(), std_samps.max(), nbins + 1)
+    std_bin = np.clip(np.digitize(std_samps, edges) - 1, 0, nbins - 1)
+
+    # Extend the axis so components near the edges keep their wings
+    pad = int(np.ceil(5 * std_samps.max() / np.abs(dv))) + 1
+    offsets = np.arange(-pad, pad + 1) * np.abs(dv)
+
+    yvals = np.zeros(nchan + 2 * pad)
+
+    for i in np.unique(std_bin):
+        in_bin = std_bin == i
+
+        hist = np.zeros(nchan + 2 * pad + 1)
+        idx = np.clip(lower[in_bin] + pad, 0, hist.size - 2)
+        np.add.at(hist, idx, 1 - frac[in_bin])
+        np.add.at(hist, idx + 1, frac[in_bin])
+
+        std = std_samps[in_bin].mean()
+        kern = np.exp(-offsets**2 / (2 * std**2))
 
-    yvals = np.zeros_like(vels)
+        yvals += np.convolve(hist[:-1], kern, mode='same')
 
-    for mu, std in zip(mu_samps, std_samps):
-        yvals += gauss(mu, std)(vels)
+    yvals = yvals[pad:pad + nchan]
 
     return yvals / yvals.max()
 
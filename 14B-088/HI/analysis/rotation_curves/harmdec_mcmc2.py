@@ -5,7 +5,9 @@ This is Dario Colombo's code.
 
 import warnings
 import os
+import hashlib
 import emcee
+from multiprocessing import Pool
 
 import numpy as np
 import math
@@ -24,6 +26,8 @@ from astropy.table import Table
 from astropy.coordinates import SkyCoord
 from astropy.utils.console import ProgressBar
 
+from mcmc_utils import integrated_autocorr_time, get_chain
+
 
 def clean_hd2d(hd):
 
@@ -36,26 +40,47 @@ def clean_hd2d(hd):
     return hd
 
 
-def log_hd(p, hds, vobs, evobs, psi, incl, order):
+def harmonic_basis(psi, incl, order):
+    '''
+    Design matrix of the harmonic terms. The columns are the cos and sin
+    terms of each order: [cos(psi), sin(psi), cos(2 psi), ...] * sin(incl).
+    '''
+    basis = np.empty((len(psi), 2 * order))
+    for i in range(order):
+        basis[:, 2 * i] = np.cos((i + 1) * psi) * np.sin(incl)
+        basis[:, 2 * i + 1] = np.sin((i + 1) * psi) * np.sin(incl)
+
+    return basis
+
+
+def log_hd(p, hds, vobs, evobs, psi, incl, order, basis=None):
+    '''
+    Log-likelihood of the harmonic terms. `p` can be a single set of
+    parameters or an array of shape (nwalkers, ndim), in which case all
+    walkers are evaluated at once. Passing the precomputed `basis` from
+    `harmonic_basis` avoids recomputing the trig. terms on every call.
+    '''
+
+    p = np.asarray(p, dtype=float)
+    single = p.ndim == 1
+    p = np.atleast_2d(p)
+
+    if basis is None:
+        basis = harmonic_basis(psi, incl, order)
 
-    vmod = p[0]
     # priors =  ss.norm.logpdf(p[0],loc=hds[0],scale=20)
 
-    for i in range(1, order + 1):
-        vmod = vmod + p[2 * i - 1] * np.cos(i * psi) * np.sin(incl) \
-            + p[2 * i] * np.sin(i * psi) * np.sin(incl)
-        """
-          priors = priors + ss.norm.logpdf(p[2*i-1],loc=hds[2*i-1],scale=20.) + \
-            ss.norm.logpdf(p[2*i],loc=hds[2*i],scale=20.)
-        """
+    vmod = p[:, :1] + np.dot(p[:, 1:2 * order + 1], basis.T)
 
     p1 = (vmod - vobs)**2 / evobs**2
-    p1 = np.nansum(p1)
+    p1 = np.nansum(p1, axis=1)
 
     lp = - p1  # + priors
 
-    if np.isnan(lp):
-        return -np.inf
+    lp[np.isnan(lp)] = -np.inf
+
+    if single:
+        return lp[0]
 
     return lp
 
@@ -102,7 +127,212 @@ def deproj(data, hd, incl=45., pa=180., dist=5e6, aoff=None, doff=None,
     return Rgal, Psigal
 
 
-def harmdec(data, hd, props, order=1, blind=False):
+def _ring_key(ring_edges, vobs, evobs, psi, incl, vsys, order, nburn,
+              nsteps, thin, autocorr_check, autocorr_factor, seed):
+    '''
+    Hash of the data and settings of a ring fit, so a checkpoint is only
+    used for the same inputs.
+    '''
+    sha = hashlib.sha1()
+
+    for arr in (ring_edges, vobs, evobs, psi):
+        sha.update(np.ascontiguousarray(arr, dtype=float).view(np.uint8))
+
+    settings = (incl, vsys, order, nburn, nsteps, thin, autocorr_check,
+                autocorr_factor, seed)
+    sha.update(repr(settings).encode('utf-8'))
+
+    return sha.hexdigest()
+
+
+def _load_ring_checkpoint(filename, key):
+    '''
+    Load a finished ring fit. Returns None if there is no checkpoint or it
+    was made with different data or settings.
+    '''
+    if filename is None or not os.path.exists(filename):
+        return None
+
+    saved = np.load(filename)
+
+    if 'key' not in saved.files or str(saved['key']) != key:
+        warnings.warn("Checkpoint {} does not match the ring data or "
+                      "settings. Refitting.".format(filename))
+        return None
+
+    return dict((key, saved[key]) for key in saved.files)
+
+
+def _save_ring_checkpoint(filename, out):
+    # Write to a temporary file first so an interrupted write cannot leave
+    # behind a partial checkpoint.
+    tmp_name = filename + ".tmp"
+    with open(tmp_name, 'wb') as tmp_file:
+        np.savez(tmp_file, **out)
+    os.rename(tmp_name, filename)
+
+
+def _fit_ring(args):
+    '''
+    Least-squares guess and MCMC fit of the harmonic terms in one ring.
+    '''
+
+    (j, ring_edges, svobs, sevobs, sppsi, incl, vsys, order, nburn, nsteps,
+     thin, autocorr_check, autocorr_factor, seed, checkpoint, key) = args
+
+    ndim = 2 * order + 1
+
+    out = {'ring_edges': np.asarray(ring_edges),
+           'order': order,
+           'key': key,
+           'guess': np.zeros(ndim) * np.NaN,
+           'ephds': np.zeros(ndim) * np.NaN,
+           'emhds': np.zeros(ndim) * np.NaN,
+           'chain': np.zeros((0, 2 * ndim, ndim)),
+           'nsteps': 0,
+           'tau': np.zeros(ndim) * np.NaN,
+           'converged': False}
+
+    rng = np.random.RandomState(seed)
+
+    # Guessing the harmonic terms with SVD
+    A = harmonic_basis(sppsi, incl, order)
+
+    B = svobs - vsys
+
+    try:
+
+        x, _, _, _ = np.linalg.lstsq(A, B)
+
+        guess = np.append(vsys, x)
+
+        # Optimize the model with MCMC
+        nwalkers = 2 * ndim
+        p0 = np.zeros((nwalkers, ndim))
+        p0[:, 0] = rng.randn(nwalkers) * 20 + vsys
+        p0[:, 1:] = rng.randn(nwalkers, ndim - 1) * 50 + guess[1:]
+
+        mhds = [0.] + list(guess[1:])
+
+        sampler_kwargs = {}
+        if int(emcee.__version__.split('.')[0]) >= 3:
+            # Evaluate all walkers in one call
+            sampler_kwargs['vectorize'] = True
+        else:
+            sampler_kwargs['threads'] = 1
+
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, log_hd,
+                                        args=[mhds, svobs, sevobs, sppsi,
+                                              incl, order],
+                                        kwargs={'basis': A},
+                                        **sampler_kwargs)
+        sampler.random_state = rng.get_state()
+
+        sampler.run_mcmc(p0, nburn)
+        pos = get_chain(sampler)[-1]
+        sampler.reset()
+
+        # Run the production steps in chunks and stop once the chain is
+        # long compared to the autocorrelation time, and the estimate of the
+        # autocorrelation time is stable.
+        if autocorr_check is None:
+            autocorr_check = nsteps
+
+        old_tau = np.inf
+        converged = False
+        nrun = 0
+        while nrun < nsteps:
+            nchunk = min(autocorr_check, nsteps - nrun)
+            sampler.run_mcmc(pos, nchunk)
+            nrun += nchunk
+
+            chain = get_chain(sampler)
+            pos = chain[-1]
+
+            if nrun < nsteps:
+                tau = integrated_autocorr_time(chain)
+                converged = np.all(autocorr_factor * tau < nrun) & \
+                    np.all(np.abs(old_tau - tau) / tau < 0.01)
+                old_tau = tau
+
+                if converged:
+                    break
+
+        chain = get_chain(sampler)
+        flatchain = chain[::thin].reshape((-1, ndim))
+
+        # Filling the hd parameter values
+        med = np.median(flatchain, axis=0)
+        out['guess'] = guess
+        out['ephds'] = np.percentile(flatchain, 75, axis=0) - med
+        out['emhds'] = med - np.percentile(flatchain, 25, axis=0)
+        out['chain'] = chain[::thin]
+        out['nsteps'] = nrun
+        out['tau'] = integrated_autocorr_time(chain)
+        out['converged'] = converged
+
+    except ValueError:
+        pass
+
+    if checkpoint is not None:
+        _save_ring_checkpoint(checkpoint, out)
+
+    return j, out
+
+
+def harmdec(data, hd, props, order=1, blind=False, num_cores=1, nburn=500,
+            nsteps=4000, thin=5, autocorr_check=None, autocorr_factor=50,
+            checkpoint_dir=None, seed=None):
+    '''
+    Harmonic decomposition of a velocity field in rings.
+
+    The rings are independent, so they can be fit in a pool with
+    `num_cores` processes. When `checkpoint_dir` is given, the fit to each
+    ring is saved when it finishes and rings with a saved fit are not refit,
+    so an interrupted run can be resumed.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Velocity field with the systemic velocity subtracted.
+    hd : astropy.io.fits.Header
+        Header of the velocity field.
+    props : list
+        [aoff, doff, dist, incl, pa, vsys, rmax, beam].
+    order : int, optional
+        Harmonic order.
+    blind : bool, optional
+        Disable plotting the model.
+    num_cores : int, optional
+        Number of processes to fit the rings with.
+    nburn : int, optional
+        Burn-in steps for each ring.
+    nsteps : int, optional
+        Maximum number of production steps for each ring.
+    thin : int, optional
+        Thinning of the chains used for the percentiles.
+    autocorr_check : int, optional
+        Check for convergence every `autocorr_check` production steps and
+        stop once the chain is longer than `autocorr_factor` times the
+        autocorrelation time and the time estimate changes by <1%. Disabled
+        by default.
+    autocorr_factor : float, optional
+        See `autocorr_check`.
+    checkpoint_dir : str, optional
+        Folder for the per-ring chain checkpoints.
+    seed : int, optional
+        Seed for the random state. Each ring uses `seed + j`.
+
+    Returns
+    -------
+    rads : list
+        Median radius of each ring.
+    hds, ephds, emhds : lists
+        Least-squares harmonic terms of each ring, and the upper and lower
+        errors from the MCMC chains.
+    mask, vmod, rotmod : np.ndarray
+        Ring numbers, model velocity field, and rotation-only model.
+    '''
 
     # Reading file and header
     data = data.squeeze()
@@ -149,23 +379,83 @@ def harmdec(data, hd, props, order=1, blind=False):
     if rmax is None:
         rmax = np.nanmax(rr)
 
+    # Define all of the rings first
+    ring_edges = []
+    while rmaj < rmax:
+        ring_edges.append((rmin, rmaj))
+        rmin = rmaj
+        rmaj = rmin + dr
+
+    nrings = len(ring_edges)
+
+    if seed is None:
+        seeds = np.random.randint(0, 2**31 - 1, size=nrings)
+    else:
+        seeds = seed + np.arange(nrings)
+
+    if checkpoint_dir is not None and not os.path.exists(checkpoint_dir):
+        os.mkdir(checkpoint_dir)
+
+    ring_idx = []
+    ring_fits = [None] * nrings
+    tasks = []
+
+    for j, (rmin, rmaj) in enumerate(ring_edges):
+
+        # Select the ring
+        idx = (rr > rmin) & (rr <= rmaj)
+        ring_idx.append(idx)
+
+        if checkpoint_dir is not None:
+            checkpoint = os.path.join(checkpoint_dir,
+                                      "harmdec_ring_{0:03d}.npz".format(j))
+        else:
+            checkpoint = None
+
+        # Without a given seed, each run draws new seeds, so only the
+        # remaining settings can be compared.
+        key = _ring_key((rmin, rmaj), vobs[idx], evobs[idx], ppsi[idx], incl,
+                        vsys, order, nburn, nsteps, thin, autocorr_check,
+                        autocorr_factor,
+                        None if seed is None else int(seeds[j]))
+
+        ring_fits[j] = _load_ring_checkpoint(checkpoint, key)
+
+        if ring_fits[j] is None:
+            tasks.append((j, (rmin, rmaj), vobs[idx], evobs[idx], ppsi[idx],
+                          incl, vsys, order, nburn, nsteps, thin,
+                          autocorr_check, autocorr_factor, seeds[j],
+                          checkpoint, key))
+
+    # Start the harmonic decomposition
+    peixe = ProgressBar(max(len(tasks), 1))
+
+    if num_cores > 1 and len(tasks) > 1:
+        pool = Pool(num_cores)
+        results = pool.imap_unordered(_fit_ring, tasks)
+    else:
+        pool = None
+        results = (_fit_ring(task) for task in tasks)
+
+    try:
+        for n, (j, out) in enumerate(results):
+            ring_fits[j] = out
+            peixe.update(n + 1)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
     # Empty list to accomodate harmonic terms
     rads = []
-    shds = [[] for i in range(2 * order + 1)]
     hds = [[] for i in range(2 * order + 1)]
     emhds = [[] for i in range(2 * order + 1)]
     ephds = [[] for i in range(2 * order + 1)]
 
-    # Start the harmonic decomposition
-    j = 0
-    jmax = np.int((rmax - rmin) / beam)
     mask = np.zeros(vobs.shape)
     vmod = np.zeros(vobs.shape)
     rotmod = np.zeros(vobs.shape)
 
-    # peixe = fish.ProgressFish(total=jmax)
-    peixe = ProgressBar(jmax)
-
     if not blind:
 
             # plt.switch_backend('Qt4Agg')
@@ -175,103 +465,17 @@ def harmdec(data, hd, props, order=1, blind=False):
         ax2 = fig.add_subplot(132)
         ax3 = fig.add_subplot(133)
 
-    """
-    ffig = plt.figure(figsize=(20,10))
-    axf0 = ffig.add_subplot(131)
-    axf1 = ffig.add_subplot(132)
-    axf2 = ffig.add_subplot(133)
-    """
+    for j, idx in enumerate(ring_idx):
 
-    while rmaj < rmax:
-
-        # peixe.animate(amount=j)
-        peixe.update(j)
-
-        # Select the ring
-        idx = (rr > rmin) & (rr <= rmaj)
         rads.append(np.nanmedian(rr[idx]))
-        svobs = vobs[idx]
-        sevobs = evobs[idx]
         sppsi = ppsi[idx]
 
         mask[idx] = j
 
-        # Guessing the harmonic terms with SVD
-        A = np.zeros((len(svobs), 2 * order))
-        for i in range(order):
-            A[:, 2 * i] = np.cos((i + 1) * sppsi) * np.sin(incl)
-            A[:, 2 * i + 1] = np.sin((i + 1) * sppsi) * np.sin(incl)
-
-        B = svobs - vsys
-
-        try:
-
-            x, _, _, _ = np.linalg.lstsq(A, B)
-
-            """
-            U,s,V = np.linalg.svd(A, full_matrices = False)
-            c = np.dot(U.T,B) # c = U^t*b
-            w = np.linalg.solve(np.diag(s),c) # w = V^t*c
-            x = np.dot(V.T,w)
-            """
-
-            shds[0].append(vsys)
-            # emhds[0].append(1.)
-            # ephds[0].append(1.)
-
-            for i in range(1, order + 1):
-                shds[2 * i - 1].append(x[2 * i - 2])
-                shds[2 * i].append(x[2 * i - 1])
-                # emhds[2*i-1].append(1.)
-                # ephds[2*i-1].append(1.)
-                # emhds[2*i].append(1.)
-                # ephds[2*i].append(1.)
-
-            # Optimize the model with MCMC
-            ndim = 2 * order + 1
-            nwalkers = 2 * ndim
-            p0 = np.zeros((nwalkers, ndim))
-            p0[:, 0] = np.random.randn(nwalkers) * 20 + vsys
-
-            mhds = [0.]
-            for i in range(1, ndim):
-                p0[:, i] = np.random.randn(nwalkers) * 50 + shds[i][j]
-                #p0[:,i] = np.random.uniform(size = nwalkers, low = shds[i][j]-20., high = shds[i][j]+20.)
-                mhds.append(shds[i][j])
-
-            sampler = emcee.EnsembleSampler(nwalkers, ndim, log_hd,
-                                            args=[mhds, svobs, sevobs, sppsi,
-                                                  incl, order],
-                                            threads=1)
-
-            pos, prob, state = sampler.run_mcmc(p0, 500, thin=5)
-            sampler.reset()
-            pos, prob, state = sampler.run_mcmc(pos, 4000, thin=5)
-
-            """
-            axf0.plot(sampler.flatchain[:,0])
-            axf1.plot(sampler.flatchain[:,1])
-            axf2.plot(sampler.flatchain[:,2])
-            plt.draw()
-            """
-
-            # Filling the hd parameter values
-            for i in range(ndim):
-                hds[i].append(shds[i][j])
-                ephds[i].append(np.percentile(sampler.flatchain[:, i], 75) -
-                                np.median(sampler.flatchain[:, i]))
-                emhds[i].append(np.median(sampler.flatchain[:, i]) -
-                                np.percentile(sampler.flatchain[:, i], 25))
-
-        except ValueError:
-
-            ndim = 2 * order + 1
-
-            for i in range(ndim):
-                shds[i].append(np.nan)
-                hds[i].append(np.nan)
-                ephds[i].append(np.nan)
-                emhds[i].append(np.nan)
+        for i in range(2 * order + 1):
+            hds[i].append(ring_fits[j]['guess'][i])
+            ephds[i].append(ring_fits[j]['ephds'][i])
+            emhds[i].append(ring_fits[j]['emhds'][i])
 
         # Making the model
         vmod[idx] = vsys
@@ -281,35 +485,21 @@ def harmdec(data, hd, props, order=1, blind=False):
 
         rotmod[idx] = hds[1][j] * np.cos(sppsi) * np.sin(incl)
 
-        if not blind:
-
-            vmodp = vmod.copy()
-            vmodp[vmodp == 0] = np.nan
-            vmodp = vmodp.reshape(data.shape[0], data.shape[1])
-            resp = data - vmodp
-
-            vmin = np.nanmin(data)
-            vmax = np.nanmax(data)
+    if not blind:
 
-            im = ax1.matshow(data, origin='lower', vmin=vmin, vmax=vmax)
-            im = ax2.matshow(vmodp, origin='lower', vmin=vmin, vmax=vmax)
-            im = ax3.matshow(resp, origin='lower', vmin=vmin, vmax=vmax)
+        vmodp = vmod.copy()
+        vmodp[vmodp == 0] = np.nan
+        vmodp = vmodp.reshape(data.shape[0], data.shape[1])
+        resp = data - vmodp
 
-            """
-            im = ax3.matshow(resp, origin='lower',\
-                        vmin=np.percentile(resp, 25),\
-                vmax=np.percentile(resp, 75))
-            if j == 0:
-                cbar = fig.colorbar(im)
-            else:
-                cbar.draw_all()
-            """
+        vmin = np.nanmin(data)
+        vmax = np.nanmax(data)
 
-            plt.draw()
+        im = ax1.matshow(data, origin='lower', vmin=vmin, vmax=vmax)
+        im = ax2.matshow(vmodp, origin='lower', vmin=vmin, vmax=vmax)
+        im = ax3.matshow(resp, origin='lower', vmin=vmin, vmax=vmax)
 
-        rmin = rmaj
-        rmaj = rmin + dr
-        j += 1
+        plt.draw()
 
     mask = mask.reshape(data.shape[0], data.shape[1])
     vmod = vmod.reshape(data.shape[0], data.shape[1])
@@ -368,7 +558,11 @@ if __name__ == "__main__":
     props = [ra0, dec0, dist, incl, pa, 0., rmax, beam]
     # rads, hds, ephds, emhds, mask, rec, rotmod = \
     #     harmdec(data, hd, props, order=order, blind=True)
-    out = harmdec(data, hd, props, order=order, blind=True)
+    # Fit the rings in parallel, and keep each ring's chain so the fit can
+    # be resumed.
+    out = harmdec(data, hd, props, order=order, blind=True, num_cores=6,
+                  autocorr_check=500,
+                  checkpoint_dir=os.path.join(out_path, "ring_chains"))
 
     rec[rec == 0] = np.nan
     print filename, "Residual = ", np.nanmedian(data - rec)
@@ -14,10 +14,11 @@ from cube_analysis.rotation_curves.curve_fitting import (oortA_brandt,
                                                          epifreq_brandt,
                                                          vcirc_brandt)
 
-from paths import (fourteenB_wGBT_HI_file_dict, allfigs_path,
+from paths import (allfigs_path,
                    fourteenB_HI_data_wGBT_path, iram_co21_14B088_data_path)
 from galaxy_params import gal_feath as gal
 from constants import hi_mass_conversion, hi_freq
+from cube_registry import fourteenB_wGBT_HI_products
 
 from plotting_styles import (default_figure, onecolumn_figure,
                              twocolumn_twopanel_figure)
@@ -48,9 +49,9 @@ def toomre_sd_criteria(sigma, kappa):
     return crit_sd.to(u.solMass / u.pc**2)
 
 
-mom0 = Projection.from_hdu(fits.open(fourteenB_wGBT_HI_file_dict['Moment0'])[0])
+mom0 = fourteenB_wGBT_HI_products.projection('Moment0')
 
-lwidth = Projection.from_hdu(fits.open(fourteenB_wGBT_HI_file_dict['LWidth'])[0]).to(u.km / u.s)
+lwidth = fourteenB_wGBT_HI_products.projection('LWidth', unit=u.km / u.s)
 
 SurfDens_HI = mom0.quantity * mom0.beam.jtok(hi_freq) * (u.beam / u.Jy) * \
     hi_mass_conversion * np.cos(gal.inclination) / (1000. * u.m / u.km)
@@ -0,0 +1,162 @@
+
+'''
+NaN-aware two-point correlation surfaces of 2D maps.
+
+The Pearson correlation between a map and a shifted copy of itself is
+computed at every lag at once. Each of the sums needed for the correlation
+(number of valid pairs, sums and sums of squares of both members of the pair,
+and the sum of the products) is a cross-correlation of the validity mask, the
+masked data, or the masked squared data. These are all computed with FFTs, so
+the cost is a handful of FFTs of the map instead of one pass over the map per
+lag.
+'''
+
+import numpy as np
+
+try:
+    from scipy.fftpack import next_fast_len
+except ImportError:
+    next_fast_len = lambda size: size
+
+
+def _cross_correlate(fft_a, fft_b, shape):
+    '''
+    Cross-correlation sum_x a(x) b(x + s) from the real FFTs of a and b.
+    '''
+    return np.fft.irfftn(np.conj(fft_a) * fft_b, s=shape)
+
+
+def twopt_corr(image, max_radius=51, boundary='cut', min_pts=2):
+    '''
+    Compute the two-point correlation surface of an image with NaNs.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        2D map. Invalid pixels should be NaN.
+    max_radius : int, optional
+        Size of the square correlation surface. Lags from -max_radius // 2 to
+        max_radius - max_radius // 2 - 1 are computed along each axis.
+    boundary : {'cut', 'continuous'}, optional
+        With 'cut', only pairs of pixels that are both within the image are
+        used. With 'continuous', the image is treated as periodic (as with
+        `np.roll`).
+    min_pts : int, optional
+        Minimum number of valid pixel pairs needed at a lag. Lags with fewer
+        pairs are set to NaN.
+
+    Returns
+    -------
+    corr_surface : np.ndarray
+        Correlation coefficients with shape (max_radius, max_radius). The
+        element [j, i] is the correlation for a shift of `lags[i]` along the
+        first axis and `lags[j]` along the second axis, where
+        `lags = np.arange(max_radius) - max_radius // 2`.
+    '''
+    image = np.asarray(image, dtype=float)
+
+    if image.ndim != 2:
+        raise ValueError("image must be 2D.")
+
+    pix_lags = np.arange(max_radius) - max_radius // 2
+
+    mask = np.isfinite(image)
+
+    if mask.sum() < min_pts:
+        raise ValueError("image has fewer than min_pts finite values.")
+
+    # Remove the mean to limit the cancellation in the variance terms.
+    data = np.where(mask, image - np.nanmean(image), 0.)
+    mask = mask.astype(float)
+
+    if boundary == 'cut':
+        # Zero-pad so the FFTs do not wrap around for the requested lags.
+        # Extra padding does not change the result, so pad up to a size
+        # with small prime factors.
+        max_lag = np.abs(pix_lags).max()
+        shape = tuple(next_fast_len(size + max_lag) for size in image.shape)
+    elif boundary == 'continuous':
+        shape = image.shape
+    else:
+        raise ValueError("boundary must be 'cut' or 'continuous'.")
+
+    fft_mask = np.fft.rfftn(mask, s=shape)
+    fft_data = np.fft.rfftn(data, s=shape)
+    fft_data_sq = np.fft.rfftn(data**2, s=shape)
+
+    # Sums over the valid pairs (x, x + s)
+    n_pairs = np.rint(_cross_correlate(fft_mask, fft_mask, shape))
+    sum_a = _cross_correlate(fft_data, fft_mask, shape)
+    sum_b = _cross_correlate(fft_mask, fft_data, shape)
+    sum_a_sq = _cross_correlate(fft_data_sq, fft_mask, shape)
+    sum_b_sq = _cross_correlate(fft_mask, fft_data_sq, shape)
+    sum_ab = _cross_correlate(fft_data, fft_data, shape)
+
+    # Only keep the requested lags. Negative lags are at the end of each
+    # axis.
+    idx = np.ix_(pix_lags % shape[0], pix_lags % shape[1])
+
+    n_pairs = n_pairs[idx]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = n_pairs * sum_ab[idx] - sum_a[idx] * sum_b[idx]
+        var_a = n_pairs * sum_a_sq[idx] - sum_a[idx]**2
+        var_b = n_pairs * sum_b_sq[idx] - sum_b[idx]**2
+
+        corr = cov / np.sqrt(var_a * var_b)
+
+    corr[n_pairs < max(min_pts, 2)] = np.NaN
+    corr[~np.isfinite(corr)] = np.NaN
+    corr = np.clip(corr, -1., 1.)
+
+    # Zero lag is exactly one.
+    corr[max_radius // 2, max_radius // 2] = 1.
+
+    # Match the [y_shift, x_shift] ordering of the surface
+    return corr.T
+
+
+def correlation_scale(corr_surface, level=np.exp(-1)):
+    '''
+    Estimate the correlation scale from the width of the contour at `level`
+    that encloses zero lag.
+
+    Parameters
+    ----------
+    corr_surface : np.ndarray
+        Output of `twopt_corr`.
+    level : float, optional
+        Contour level. Defaults to 1 / e.
+
+    Returns
+    -------
+    scale : float
+        Quadrature sum of the semi-major and semi-minor axes of an ellipse
+        fit to the contour, in pixels.
+    scale_error : float
+        Uncertainty in `scale`.
+    '''
+    from turbustat.statistics.pca.width_estimate import \
+        (get_contour_path, fit_2D_ellipse)
+
+    max_radius = corr_surface.shape[0]
+    pix_lags = (np.arange(max_radius) - max_radius // 2)
+
+    ymat, xmat = np.meshgrid(pix_lags, pix_lags, indexing='ij')
+
+    paths = get_contour_path(xmat, ymat, corr_surface, level)
+    pidx = np.where([p.contains_point((0, 0)) for p in paths])[0]
+
+    if len(pidx) == 0:
+        raise ValueError("No contour at level {} encloses zero lag."
+                         .format(level))
+
+    output = fit_2D_ellipse(paths[pidx[0]].vertices)
+
+    scale = np.sqrt(output[0]**2 + output[1]**2)
+
+    scale_error = \
+        np.sqrt((output[0] * output[2])**2 +
+                (output[1] * output[3])**2) / scale
+
+    return scale, scale_error
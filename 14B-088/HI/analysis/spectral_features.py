@@ -0,0 +1,240 @@
+
+'''
+Per-pixel spectral features of a cube, computed for all spectra at once.
+
+The cube is read in spatial tiles, each copied into a contiguous array, and
+the features of every spectrum in a tile are computed with array operations.
+The tiles can be processed in a pool while the next tiles are read. One pass
+over the cube gives:
+
+* the velocity of the peak channel,
+* the velocity of the peak from a parabola fit to the peak channel and its
+  neighbours,
+* the peak intensity,
+* the half-width at half-maximum of the region around the peak that is above
+  half of the peak.
+'''
+
+import numpy as np
+from multiprocessing import Pool
+from spectral_cube.lower_dimensional_structures import Projection
+
+
+feature_names = ['peak_velocity', 'peak_velocity_parabolic',
+                 'peak_intensity', 'hwhm']
+
+
+def spectra_features(spectra, spec_axis):
+    '''
+    Compute the spectral features of a set of spectra.
+
+    Parameters
+    ----------
+    spectra : np.ndarray
+        Spectra with the spectral dimension first, e.g., (nchan, ny, nx) or
+        (nchan, nspec). Masked values should be NaN.
+    spec_axis : np.ndarray
+        Spectral axis values.
+
+    Returns
+    -------
+    features : dict
+        Arrays of each feature with the spatial shape of `spectra`. Spectra
+        that are entirely NaN have NaN features.
+    '''
+    spec_axis = np.asarray(spec_axis, dtype=float)
+
+    nchan = spectra.shape[0]
+    spat_shape = spectra.shape[1:]
+
+    spectra = spectra.reshape((nchan, -1))
+    nspec = spectra.shape[1]
+
+    valid = np.isfinite(spectra).any(0)
+
+    filled = np.where(np.isfinite(spectra), spectra, -np.inf)
+    argmax = filled.argmax(0)
+
+    cols = np.arange(nspec)
+    peak = filled[argmax, cols]
+
+    peak_vel = spec_axis[argmax]
+
+    # Parabolic interpolation using the neighbouring channels. Peaks at the
+    # edge or next to a masked channel keep the channel velocity.
+    lower = np.clip(argmax - 1, 0, nchan - 1)
+    upper = np.clip(argmax + 1, 0, nchan - 1)
+
+    y0 = filled[lower, cols]
+    y2 = filled[upper, cols]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        denom = y0 - 2 * peak + y2
+        offset = 0.5 * (y0 - y2) / denom
+
+    interior = (argmax > 0) & (argmax < nchan - 1) & np.isfinite(y0) & \
+        np.isfinite(y2) & (denom < 0)
+    offset = np.where(interior, offset, 0.)
+
+    chan_width = 0.5 * (spec_axis[upper] - spec_axis[lower])
+    parab_vel = peak_vel + offset * chan_width
+
+    # Contiguous region around the peak above half of the peak. The edges
+    # are the nearest channels on either side that are below the half
+    # maximum (masked channels count as below).
+    half_max = 0.5 * peak
+    below = ~(filled >= half_max)
+
+    chans = np.arange(nchan)[:, np.newaxis]
+    left = np.where(below & (chans < argmax), chans, -1).max(0)
+    right = np.where(below & (chans > argmax), chans, nchan).min(0)
+
+    def crossing(edge, inner):
+        # Linearly interpolate the half maximum crossing between the edge
+        # channel and the first channel above the half maximum.
+        inside = (edge >= 0) & (edge < nchan)
+        edge_c = np.clip(edge, 0, nchan - 1)
+        y_edge = filled[edge_c, cols]
+        y_inner = filled[inner, cols]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = (y_inner - half_max) / (y_inner - y_edge)
+
+        frac = np.where(inside & np.isfinite(y_edge) & np.isfinite(frac),
+                        frac, 0.)
+
+        # Without a measured crossing, the extent ends at the last channel
+        # above the half maximum.
+        return spec_axis[inner] + frac * (spec_axis[edge_c] -
+                                          spec_axis[inner])
+
+    left_vel = crossing(left, np.clip(left + 1, 0, nchan - 1))
+    right_vel = crossing(right, np.clip(right - 1, 0, nchan - 1))
+
+    hwhm = 0.5 * np.abs(right_vel - left_vel)
+
+    features = {'peak_velocity': peak_vel,
+                'peak_velocity_parabolic': parab_vel,
+                'peak_intensity': peak,
+                'hwhm': hwhm}
+
+    for name in features:
+        arr = features[name].astype(float)
+        arr[~valid] = np.NaN
+        features[name] = arr.reshape(spat_shape)
+
+    return features
+
+
+def _tile_features(args):
+    slices, spectra, spec_axis, tile_mask = args
+
+    features = spectra_features(spectra, spec_axis)
+
+    if tile_mask is not None:
+        for name in features:
+            features[name][~tile_mask] = np.NaN
+
+    return slices, features
+
+
+def _iter_tiles(cube, mask, tile_shape, spec_axis):
+    '''
+    Read spatial tiles of the cube that contain at least one pixel in the
+    mask.
+    '''
+    ny, nx = cube.shape[1:]
+
+    for y0 in range(0, ny, tile_shape[0]):
+        for x0 in range(0, nx, tile_shape[1]):
+            slices = (slice(y0, min(y0 + tile_shape[0], ny)),
+                      slice(x0, min(x0 + tile_shape[1], nx)))
+
+            tile_mask = None
+            if mask is not None:
+                tile_mask = mask[slices]
+                if not tile_mask.any():
+                    continue
+
+            spectra = \
+                np.ascontiguousarray(cube.filled_data[(slice(None),) +
+                                                      slices].value,
+                                     dtype=float)
+
+            yield slices, spectra, spec_axis, tile_mask
+
+
+def cube_spectral_features(cube, spatial_mask=None, tile_shape=(128, 128),
+                           num_cores=1, spectral_unit=None):
+    '''
+    Compute the peak velocity, parabolic peak velocity, peak intensity and
+    HWHM for every spectrum in a cube in one pass.
+
+    Parameters
+    ----------
+    cube : spectral_cube.SpectralCube
+        Cube to use. The cube's mask is applied.
+    spatial_mask : np.ndarray, optional
+        2D mask of the pixels to compute. All other pixels are NaN. Tiles
+        without any valid pixels are not read.
+    tile_shape : tuple, optional
+        Spatial size of the tiles read from the cube.
+    num_cores : int, optional
+        Number of processes used to compute the tile features.
+    spectral_unit : astropy.units.Unit, optional
+        Unit of the spectral axis used for the velocities. Defaults to the
+        cube's spectral unit.
+
+    Returns
+    -------
+    features : dict
+        Projections of each feature in `feature_names`.
+    '''
+    if spectral_unit is not None:
+        cube = cube.with_spectral_unit(spectral_unit)
+
+    spec_axis = cube.spectral_axis
+    spec_unit = spec_axis.unit
+    spec_axis = spec_axis.value
+
+    if spatial_mask is not None:
+        spatial_mask = np.asarray(spatial_mask, dtype=bool)
+        if spatial_mask.shape != cube.shape[1:]:
+            raise ValueError("spatial_mask must match the spatial shape of "
+                             "the cube.")
+
+    out = dict((name, np.empty(cube.shape[1:]) * np.NaN)
+               for name in feature_names)
+
+    tiles = _iter_tiles(cube, spatial_mask, tile_shape, spec_axis)
+
+    if num_cores > 1:
+        pool = Pool(num_cores)
+        results = pool.imap_unordered(_tile_features, tiles)
+    else:
+        pool = None
+        results = (_tile_features(tile) for tile in tiles)
+
+    try:
+        for slices, features in results:
+            for name in feature_names:
+                out[name][slices] = features[name]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    units = {'peak_velocity': spec_unit,
+             'peak_velocity_parabolic': spec_unit,
+             'peak_intensity': cube.unit,
+             'hwhm': spec_unit}
+
+    proj_kwargs = {}
+    if hasattr(cube, 'beam'):
+        proj_kwargs['beam'] = cube.beam
+
+    wcs = cube.wcs.celestial
+
+    return dict((name, Projection(out[name], unit=units[name], wcs=wcs,
+                                  **proj_kwargs))
+                for name in feature_names)
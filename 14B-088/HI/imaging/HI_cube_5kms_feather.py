@@ -22,7 +22,7 @@ vla_cube = SpectralCube.read(osjoin(fivekms_noSD_path, "M33_14B-088_HI_5kms.clea
 num_cores = 4
 
 gbt_path = os.path.join(data_path, "GBT")
-gbt_name = os.path.join(gbt_path, "14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088_spectralregrid_registered.fits")
+gbt_name = os.path.join(gbt_path, "14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088_registered.fits")
 gbt_cube = SpectralCube.read(gbt_name)
 
 # First regrid the velocity to match the 5 km/s VLA cube
@@ -11,18 +11,15 @@ from astropy import log
 from astropy.convolution import Gaussian1DKernel
 import numpy as np
 
-from cube_analysis.io_utils import save_to_huge_fits
-
 from paths import (fourteenB_HI_data_wGBT_path,
                    fourteenB_wGBT_HI_file_dict,
                    iram_co21_14B088_data_path)
+from spectral_downsample import downsample_cube
 
 
-cube = SpectralCube.read(fourteenB_wGBT_HI_file_dict['Cube'])
+num_cores = 4
 
-# Smooth to the largest beam
-log.info("Convolving to largest beam.")
-cube = cube.convolve_to(largest_beam(cube.beams))
+cube = SpectralCube.read(fourteenB_wGBT_HI_file_dict['Cube'])
 
 # Open up the CO cube to get the spectral resolution
 co_cube = SpectralCube.read(iram_co21_14B088_data_path("m33.co21_iram.14B-088_HI.fits"))
@@ -38,22 +35,17 @@ chan_width = np.diff(cube.spectral_axis[:2])[0]
 num_chans = targ_res / chan_width
 kernel = Gaussian1DKernel(num_chans / np.sqrt(8 * np.log(2)))
 
-# Smooth first
-log.info("Spectrally smoothing.")
-new_cube = cube.spectral_smooth(kernel)
-
-# Then interpolate
-log.info("Spectral interpolating.")
-
-new_cube = new_cube.spectral_interpolate(co_cube.spectral_axis)
-
-log.info("Writing out.")
 out_folder = fourteenB_HI_data_wGBT_path("downsamp_to_co", no_check=True)
 if not os.path.exists(out_folder):
     os.mkdir(out_folder)
-save_to_huge_fits(fourteenB_HI_data_wGBT_path('downsamp_to_co/M33_14B-088_HI.clean.image.GBT_feathered.2.6kms.fits',
-                                              no_check=True),
-                  new_cube, chunk=50)
+
+# Smooth to the largest beam, spectrally smooth and interpolate in one pass
+log.info("Convolving to largest beam, smoothing and interpolating.")
+downsample_cube(fourteenB_wGBT_HI_file_dict['Cube'], co_cube.spectral_axis,
+                fourteenB_HI_data_wGBT_path('downsamp_to_co/M33_14B-088_HI.clean.image.GBT_feathered.2.6kms.fits',
+                                            no_check=True),
+                kernel=kernel, target_beam=largest_beam(cube.beams),
+                num_cores=num_cores)
 
 # # Do the same for the rotation-corrected cube
 # cube = SpectralCube.read(fourteenB_wGBT_HI_file_dict['RotSub_Cube'])
@@ -12,36 +12,42 @@ import matplotlib.pyplot as plt
 from pandas import DataFrame
 import scipy.ndimage as nd
 
-from cube_analysis.feather_cubes import flux_recovery
+from flux_budget import FluxBudget
 
 from paths import (fourteenB_HI_data_path, fourteenB_HI_file_dict,
                    fourteenB_wGBT_HI_file_dict,
-                   gbt_HI_data_path, allfigs_path, paper1_tables_path)
-from constants import pb_lim, hi_mass_conversion_Jy, distance
+                   gbt_HI_data_path, data_path, allfigs_path,
+                   paper1_tables_path)
+from constants import pb_lim, hi_mass_conversion_Jy, distance, hi_freq
 from plotting_styles import default_figure, onecolumn_figure
 
-# Load the non-pb masked cube
-vla_cube = SpectralCube.read(fourteenB_HI_file_dict["Cube"])
-vla_source_mask = fits.open(fourteenB_HI_file_dict["Source_Mask"])[0].data > 0
-vla_cube = vla_cube.with_mask(vla_source_mask)
+# Each cube is summed within its own signal mask
+vla_name = (fourteenB_HI_file_dict["Cube"],
+            fourteenB_HI_file_dict["Source_Mask"])
 
-gbt_name = gbt_HI_data_path("14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088_spectralregrid_registered.fits")
-gbt_cube = SpectralCube.read(gbt_name)
+# Registered to the full VLA grid by sd_regridding/sd_offsets.py. It is
+# summed over the cutout that matches the primary beam cut cubes.
+gbt_name = gbt_HI_data_path("14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088_registered.fits")
 
-feathered_cube = SpectralCube.read(fourteenB_wGBT_HI_file_dict["Cube"])
-feather_source_mask = \
-    fits.open(fourteenB_wGBT_HI_file_dict["Source_Mask"])[0].data > 0
-feathered_cube = feathered_cube.with_mask(feather_source_mask)
+feathered_name = (fourteenB_wGBT_HI_file_dict["Cube"],
+                  fourteenB_wGBT_HI_file_dict["Source_Mask"])
 
 pbcov = fits.open(fourteenB_HI_data_path("M33_14B-088_pbcov.fits"))[0]
 mask = pbcov.data > pb_lim
 # Cut to be the same shape as the PB masked cubes
 mask = mask[nd.find_objects(mask)[0]]
 
-total_vla_profile, total_gbt_profile = \
-    flux_recovery(vla_cube, gbt_cube, mask=mask, num_cores=6)
-total_feathered_profile, total_gbt_profile = \
-    flux_recovery(feathered_cube, gbt_cube, mask=mask, num_cores=6)
+# The total spectra are cached, so only new or changed cubes are summed
+budget = FluxBudget(os.path.join(data_path, "flux_budget"), restfreq=hi_freq)
+spectra = budget.total_spectra({"VLA": vla_name, "GBT": gbt_name,
+                                "VLA+GBT": feathered_name},
+                               {"pbcov": mask}, num_cores=6)
+
+total_vla_profile = spectra["VLA"]["pbcov"]
+total_gbt_profile = spectra["GBT"]["pbcov"]
+total_feathered_profile = spectra["VLA+GBT"]["pbcov"]
+
+vla_cube = SpectralCube.read(fourteenB_HI_file_dict["Cube"])
 
 vel_axis = vla_cube.spectral_axis.to(u.km / u.s).value
 
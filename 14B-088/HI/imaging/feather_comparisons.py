@@ -24,7 +24,7 @@ from plotting_styles import onecolumn_figure, default_figure, twocolumn_figure
 vla_cube = SpectralCube.read(fourteenB_HI_data_path("M33_14B-088_HI.clean.image.fits"))
 
 gbt_path = os.path.join(data_path, "GBT")
-gbt_registered_cube = SpectralCube.read(os.path.join(gbt_path, "14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088_spectralregrid_registered.fits"))
+gbt_registered_cube = SpectralCube.read(os.path.join(gbt_path, "14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088_registered.fits"))
 
 beam_fwhm = lambda diam: ((1.18 * hi_freq.to(u.cm, u.spectral())) / diam.to(u.cm)) * u.rad
 
@@ -445,14 +445,14 @@ print("Scale factor: {0}+/-{1}".format(np.exp(cauchy_fit_875[0]),
 
 # Open up the GBT cube and update the beam parameters
 import astropy.io.fits as fits
-gbt_hdu = fits.open(os.path.join(gbt_path, "14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088_spectralregrid_registered.fits"),
+gbt_hdu = fits.open(os.path.join(gbt_path, "14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088_registered.fits"),
                     mode='update')
 gbt_hdu[0].header.update(Beam(beam_fwhm(87.5 * u.m).to(u.deg)).to_header_keywords())
 gbt_hdu.flush()
 gbt_hdu.close()
 
 # And the low-res version too
-gbt_hdu = fits.open(os.path.join(gbt_path, "14B-088_items/m33_gbt_vlsr_Tmb_14B088_spectralregrid_registered.fits"),
+gbt_hdu = fits.open(os.path.join(gbt_path, "14B-088_items/m33_gbt_vlsr_Tmb_14B088_registered.fits"),
                     mode='update')
 gbt_hdu[0].header.update(Beam(beam_fwhm(87.5 * u.m).to(u.deg)).to_header_keywords())
 gbt_hdu.flush()
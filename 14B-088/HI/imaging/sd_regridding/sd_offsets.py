@@ -1,6 +1,10 @@
 
 '''
 Check the positional offsets between the VLA cube and the SD datasets.
+
+Uses the SD cubes already regridded onto the VLA grid by arecibo_regrid.py,
+ebhis_regrid.py and gbt_regrid.py, so the registered cubes are on the VLA
+grid as well.
 '''
 
 from spectral_cube import SpectralCube
@@ -20,24 +24,23 @@ vla_cube = SpectralCube.read(fourteenB_HI_data_path("M33_14B-088_HI.clean.image.
 
 arecibo_path = os.path.join(data_path, "Arecibo")
 
-# Spectral interpolation, followed by reprojection.
+# Spectrally and spatially regridded to the VLA cube.
 arecibo_name = \
-    os.path.join(arecibo_path,
-                 "14B-088_items_new/m33_arecibo_14B088_spectralregrid.fits")
+    os.path.join(arecibo_path, "14B-088_items_new/m33_arecibo_14B088.fits")
 arecibo_cube = SpectralCube.read(arecibo_name)
 
 ebhis_path = os.path.join(data_path, "EBHIS")
 
-# Spectral interpolation, followed by reprojection.
-ebhis_name = os.path.join(ebhis_path, "14B-088_items/m33_ebhis_14B088_spectralregrid.fits")
+# Spectrally and spatially regridded to the VLA cube.
+ebhis_name = os.path.join(ebhis_path, "14B-088_items/m33_ebhis_14B088.fits")
 ebhis_cube = SpectralCube.read(ebhis_name)
 
 
 gbt_path = os.path.join(data_path, "GBT")
-gbt_name = os.path.join(gbt_path, "14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088_spectralregrid.fits")
+gbt_name = os.path.join(gbt_path, "14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088.fits")
 gbt_cube = SpectralCube.read(gbt_name)
 
-gbt_lowres_name = os.path.join(gbt_path, "14B-088_items/m33_gbt_vlsr_Tmb_14B088_spectralregrid.fits")
+gbt_lowres_name = os.path.join(gbt_path, "14B-088_items/m33_gbt_vlsr_Tmb_14B088.fits")
 gbt_lowres_cube = SpectralCube.read(gbt_lowres_name)
 
 
@@ -90,28 +93,28 @@ save_shift(os.path.join(gbt_path, "14B-088_items/14B-088_pixel_shifts.csv"),
 log.info("Shifting and saving Arecibo cube")
 arecibo_shift_name = \
     os.path.join(arecibo_path,
-                 "14B-088_items_new/m33_arecibo_14B088_spectralregrid_registered.fits")
+                 "14B-088_items_new/m33_arecibo_14B088_registered.fits")
 spatial_shift_cube(arecibo_cube, *median_arecibo_offset, save_shifted=True,
                    save_name=arecibo_shift_name, num_cores=num_cores)
 
 log.info("Shifting and saving EBHIS cube")
 ebhis_shift_name = \
     os.path.join(ebhis_path,
-                 "14B-088_items/m33_ebhis_14B088_spectralregrid_registered.fits")
+                 "14B-088_items/m33_ebhis_14B088_registered.fits")
 spatial_shift_cube(ebhis_cube, *median_ebhis_offset, save_shifted=True,
                    save_name=ebhis_shift_name, num_cores=num_cores)
 
 log.info("Shifting and saving GBT cube")
 gbt_shift_name = \
     os.path.join(gbt_path,
-                 "14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088_spectralregrid_registered.fits")
+                 "14B-088_items/m33_gbt_vlsr_highres_Tmb_14B088_registered.fits")
 spatial_shift_cube(gbt_cube, *median_gbt_offset, save_shifted=True,
                    save_name=gbt_shift_name, num_cores=num_cores)
 
 log.info("Shifting and saving LR GBT cube")
 gbt_lowres_shift_name = \
     os.path.join(gbt_path,
-                 "14B-088_items/m33_gbt_vlsr_Tmb_14B088_spectralregrid_registered.fits")
+                 "14B-088_items/m33_gbt_vlsr_Tmb_14B088_registered.fits")
 spatial_shift_cube(gbt_lowres_cube, *median_gbt_lowres_offset,
                    save_shifted=True,
                    save_name=gbt_lowres_shift_name, num_cores=num_cores)
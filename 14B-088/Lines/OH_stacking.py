@@ -6,11 +6,13 @@ Do large-scale OH stacking based on the peak HI velocity
 from spectral_cube.analysis_utilities import stack_spectra
 from spectral_cube import SpectralCube, Projection
 from astropy.io import fits
+from astropy.wcs import WCS
 import astropy.units as u
 import numpy as np
 
 from paths import fourteenB_wGBT_HI_file_dict
 from galaxy_params import gal_feath as gal
+from reprojection_weights import reproject_cached
 
 peakvels = Projection.from_hdu(fits.open(fourteenB_wGBT_HI_file_dict['PeakVels'])[0])
 
@@ -39,7 +41,10 @@ for line in oh_lines:
     reproj_hdr['NAXIS'] = 2
     reproj_hdr['NAXIS2'] = oh_cube.shape[1]
     reproj_hdr['NAXIS1'] = oh_cube.shape[2]
-    peakvels_reproj = peakvels.reproject(reproj_hdr)
+    # The OH lines share a grid, so the weights are only computed once.
+    peakvels_reproj = \
+        Projection(reproject_cached(peakvels.hdu, reproj_hdr)[0],
+                   unit=peakvels.unit, wcs=WCS(reproj_hdr))
 
     radii = gal.radius(header=reproj_hdr)
 
@@ -4,6 +4,8 @@
 
 # Execute with:
 # casa -c find_flag_badscans.py directory_with_MSs True True
+# Use "Auto" instead of the first True to propose the bad scans from the
+# visibility statistics (see flagging_scripts/scan_statistics.py).
 
 import sys
 import os
@@ -19,7 +21,9 @@ def listdir_fullpath(d):
     return [os.path.join(d, f) for f in os.listdir(d)]
 
 line_direc = sys.argv[-3]
-find_bad_scans = True if sys.argv[-2] == "True" else False
+find_bad_scans = True if sys.argv[-2] in ["True", "Auto"] else False
+# Propose the bad scans from the visibility statistics instead of by eye
+auto_find_bad_scans = True if sys.argv[-2] == "Auto" else False
 plot_bad_scans = True if sys.argv[-1] == "True" else False
 
 line_name = line_direc.rstrip("/").split("/")[-1]
@@ -30,9 +34,31 @@ bad_scan_dict = {}
 ms_names = []
 
 if find_bad_scans:
+    if auto_find_bad_scans:
+        from paths import root
+        os.sys.path.insert(0, os.path.join(root, "flagging_scripts"))
+        from scan_statistics import find_bad_scans as auto_bad_scans
+
     for f in os.listdir(line_direc):
         if f.endswith(".ms"):
             print("Found MS!: " + f.split("/")[-1])
+
+            if auto_find_bad_scans:
+                ms_names.append(os.path.join(line_direc, f))
+
+                spw_bad_scans, rankings = \
+                    auto_bad_scans(os.path.join(line_direc, f))
+
+                # Combine the proposals for all SPWs and categories
+                bad_scans = set()
+                for spw_scans in spw_bad_scans.values():
+                    for scans in spw_scans.values():
+                        bad_scans.update([int(num) for num in scans.split(",")
+                                          if len(num) > 0])
+                bad_scan_dict[f.split("/")[-1]] = \
+                    ",".join([str(num) for num in sorted(bad_scans)])
+                continue
+
             # Check if the scan plots directory exists
             plot_direc = os.path.join(line_direc, "scan_plots",
                                       f.rstrip(".ms")+"_scan_plots")
@@ -695,8 +695,67 @@ def spwsforfield(vis,field):
 # Imports
 # -------
 
+import os
+import fnmatch
 import numpy
 
+# ------------------------------------------------------------------------------
+
+# Ranking cache
+# -------------
+
+# The reference antenna list is recomputed at the start of every calibration
+# stage, but it only changes when the flags do.  The rankings are kept here
+# along with the flag version of the MS they were computed from.
+
+_refant_cache = dict()
+
+# ------------------------------------------------------------------------------
+
+# _ms_flag_version
+
+# Description:
+# ------------
+# This function returns a token that changes whenever the flags of the MS are
+# modified (by flagdata, flagmanager restores, applycal, etc.).  The token is
+# the names, modification times and sizes of the data files of the main table,
+# which is where the FLAG column is stored.  For a multi-MS (MMS) the main
+# table only references the sub-MSs in SUBMSS, which hold the FLAG column, so
+# the data files of each sub-MS are included as well.
+
+# Inputs:
+# -------
+# vis - This python string contains the MS name.
+
+# Outputs:
+# --------
+# The python tuple containing the flag version, returned via the function
+# value.
+
+# ------------------------------------------------------------------------------
+
+def _ms_flag_version( vis ):
+
+	tables = [ vis ]
+
+	submss = os.path.join( vis, 'SUBMSS' )
+	if os.path.isdir( submss ):
+		for subms in sorted( os.listdir( submss ) ):
+			subms = os.path.join( submss, subms )
+			if os.path.isdir( subms ): tables.append( subms )
+
+	version = list()
+
+	for table in tables:
+		for fname in sorted( os.listdir( table ) ):
+			if not fname.startswith( 'table.f' ): continue
+			fullname = os.path.join( table, fname )
+			stat = os.stat( fullname )
+			version.append( ( os.path.relpath( fullname, vis ),
+				stat.st_mtime, stat.st_size ) )
+
+	return tuple( version )
+
 # ------------------------------------------------------------------------------
 # class RefAntHeuristics
 # ------------------------------------------------------------------------------
@@ -847,12 +906,23 @@ class RefAntHeuristics:
 		if not ( self.geometry or self.flagging ): return []
 
 
-		# Get the antenna names and initialize the score dictionary
+		# Return the cached ranking if the flags have not changed since
+		# it was calculated
 
-		names = self._get_names()
+		key = ( os.path.abspath( self.vis ), str( self.field ),
+			str( self.spw ), str( self.intent ), self.geometry,
+			self.flagging )
+		version = _ms_flag_version( self.vis )
 
-		score = dict()
-		for n in names: score[n] = 0.0
+		if key in _refant_cache and _refant_cache[key][0] == version:
+			refAnt, self.geoScore, self.flagScore = _refant_cache[key][1:]
+			return list( refAnt )
+
+
+		# Get the antenna names and initialize the score array
+
+		names = numpy.array( self._get_names() )
+		score = numpy.zeros( len(names) )
 
 
 		# For each selected heuristic, add the score for each antenna
@@ -862,37 +932,38 @@ class RefAntHeuristics:
 
 		if self.geometry:
 			geoClass = RefAntGeometry( self.vis )
-			self.geoScore = geoClass.calc_score()
-			for n in names: score[n] += self.geoScore[n]
+			geoNames, geoArray = geoClass.calc_score_array()
+			score += geoArray
+			self.geoScore = dict( zip( geoNames, geoArray ) )
 
 		if self.flagging:
 			flagClass = RefAntFlagging( self.vis, self.field,
-			    self.spw, self.intent )
-			self.flagScore = flagClass.calc_score()
-			for n in names:
-                            try:
-                                score[n] += self.flagScore[n]
-                            except KeyError, e:
-                                logprint ("WARNING: antenna "+str(e)+", is completely flagged and missing from calibrators.ms", logfileout='logs/refantwarnings.log')
+				self.spw, self.intent )
+			flagNames, flagArray, nRows = flagClass.calc_score_array()
+			score += flagArray
+			self.flagScore = dict( zip( flagNames[nRows > 0],
+				flagArray[nRows > 0] ) )
+			for n in flagNames[nRows == 0]:
+				logprint ("WARNING: antenna "+str(n)+", is completely flagged and missing from "+self.vis, logfileout='logs/refantwarnings.log')
 
 
 		# Calculate the final score and return the list of ranked
 		# reference antennas.  NB: The best antennas have the highest
-		# score, so a reverse sort is required.
-
-		keys = numpy.array( score.keys() )
-		values = numpy.array( score.values() )
-		argSort = numpy.argsort( values )[::-1]
+		# score, so the scores are negated for the sort.  The stable sort
+		# keeps the ANTENNA table order for ties.
 
-		refAntUpper = keys[argSort]
+		argSort = numpy.argsort( -score, kind='mergesort' )
 
 		refAnt = list()
-		for r in refAntUpper: refAnt.append( r.lower() )
+		for r in names[argSort]: refAnt.append( r.lower() )
+
+		_refant_cache[key] = ( version, refAnt, self.geoScore,
+			self.flagScore )
 
 
 		# Return the list of ranked reference antennas
 
-		return( refAnt )
+		return( list( refAnt ) )
 
 # ------------------------------------------------------------------------------
 
@@ -1059,22 +1130,63 @@ class RefAntGeometry:
 
 	def calc_score( self ):
 
-		# Get the antenna information, measures, and locations
+		# Calculate the scores and convert them to a dictionary
+
+		names, score = self.calc_score_array()
+
+		return dict( zip( names, score ) )
+
+# ------------------------------------------------------------------------------
+
+# RefAntGeometry::calc_score_array
+
+# Description:
+# ------------
+# This public member function calculates the geometry score for each antenna
+# as arrays ordered like the ANTENNA subtable.
+
+# NB: The radii, longitudes, and latitudes are calculated directly from the
+# ITRF positions.  The measures tool is only used for other reference frames.
+
+# Inputs:
+# -------
+# None.
+
+# Outputs:
+# --------
+# The python tuple containing the numpy arrays of antenna names and scores,
+# returned via the function value.
+
+# ------------------------------------------------------------------------------
+
+	def calc_score_array( self ):
+
+		# Get the antenna information and locations
 
 		info = self._get_info()
-		measures = self._get_measures( info )
-		radii, longs, lats = self._get_latlongrad( info, measures )
+
+		if info['position_keywords']['MEASINFO']['Ref'] == 'ITRF':
+			radii, longs, lats = self._get_latlongrad_array( info )
+		else:
+			measures = self._get_measures( info )
+			radiusDict, longDict, latDict = self._get_latlongrad( info,
+				measures )
+			radii = numpy.array( [radiusDict[n] for n in info['name']] )
+			longs = numpy.array( [longDict[n] for n in info['name']] )
+			lats = numpy.array( [latDict[n] for n in info['name']] )
 
 
 		# Calculate the antenna distances and scores
 
-		distance = self._calc_distance( radii, longs, lats )
-		score = self._calc_score( distance )
+		distance = self._calc_distance_array( radii, longs, lats )
 
+		fFar = distance / float( numpy.max(distance) )
+		score = ( 1.0 - fFar ) * len(distance)
 
-		# Return the scores
 
-		return score
+		# Return the names and scores
+
+		return numpy.asarray( info['name'] ), score
 
 # ------------------------------------------------------------------------------
 
@@ -1292,6 +1404,85 @@ class RefAntGeometry:
 
 # ------------------------------------------------------------------------------
 
+# RefAntGeometry::_get_latlongrad_array
+
+# Description:
+# ------------
+# This private member function gets the latitude, longitude and radius (from the
+# center of the earth) for all antennas at once from the ITRF positions.
+
+# Inputs:
+# -------
+# info - This python dictionary contains the antenna information from private
+#        member function _get_info().
+
+# Outputs:
+# --------
+# The python tuple containing the radius (m), longitude (rad), and latitude
+# (rad) numpy arrays, returned via the function value.
+
+# ------------------------------------------------------------------------------
+
+	def _get_latlongrad_array( self, info ):
+
+		# Convert the positions to metres
+
+		qaLoc = casac.quanta()
+
+		units = info['position_keywords']['QuantumUnits']
+		scale = numpy.array( [qaLoc.convert( qaLoc.quantity( 1.0, u ),
+			'm' )['value'] for u in units] )
+
+		del qaLoc
+
+		xyz = info['position'] * scale[:,numpy.newaxis]
+
+
+		# Calculate the spherical coordinates
+
+		radii = numpy.sqrt( numpy.sum( xyz**2, axis=0 ) )
+		longs = numpy.arctan2( xyz[1], xyz[0] )
+		lats = numpy.arcsin( xyz[2] / radii )
+
+		return radii, longs, lats
+
+# ------------------------------------------------------------------------------
+
+# RefAntGeometry::_calc_distance_array
+
+# Description:
+# ------------
+# This private member function calculates the antenna distances from the array
+# reference, which is the median location, from arrays of the radii,
+# longitudes, and latitudes.
+
+# Inputs:
+# -------
+# radii - This numpy array contains the radius for each antenna.
+# longs - This numpy array contains the longitude for each antenna.
+# lats  - This numpy array contains the latitude for each antenna.
+
+# Outputs:
+# --------
+# The numpy array containing the antenna distances from the array reference,
+# returned via the function value.
+
+# ------------------------------------------------------------------------------
+
+	def _calc_distance_array( self, radii, longs, lats ):
+
+		longValues = longs - numpy.median( longs )
+
+		x = longValues * numpy.cos( lats ) * radii
+		x -= numpy.median( x )
+
+		y = lats * radii
+		y -= numpy.median( y )
+
+		return numpy.hypot( x, y )
+
+# ------------------------------------------------------------------------------
+
 # RefAntGeometry::_calc_distance
 
 # Description:
@@ -1542,6 +1733,38 @@ class RefAntFlagging:
 
 # ------------------------------------------------------------------------------
 
+# RefAntFlagging::calc_score_array
+
+# Description:
+# ------------
+# This public member function calculates the flagging score for each antenna as
+# arrays ordered like the ANTENNA subtable.
+
+# Inputs:
+# -------
+# None.
+
+# Outputs:
+# --------
+# The python tuple containing the numpy arrays of antenna names, scores and
+# number of selected rows for each antenna, returned via the function value.
+# Antennas without any selected rows have a score of zero.
+
+# ------------------------------------------------------------------------------
+
+	def calc_score_array( self ):
+
+		names, nGood, nRows = self._get_good_array()
+
+		if numpy.max( nGood ) > 0:
+			fGood = nGood / float( numpy.max(nGood) )
+		else:
+			fGood = numpy.zeros( len(nGood) )
+
+		return names, fGood * len(nGood[nRows > 0]), nRows
+
+# ------------------------------------------------------------------------------
+
 # RefAntFlagging::_get_good
 
 # Description:
@@ -1556,7 +1779,8 @@ class RefAntFlagging:
 # Outputs:
 # --------
 # The dictionary containing the number of unflagged (good) data from the MS,
-# returned via the function value.
+# returned via the function value.  Antennas without selected data are not
+# included, matching the flagdata summary.
 
 # Modification history:
 # ---------------------
@@ -1567,30 +1791,184 @@ class RefAntFlagging:
 
 	def _get_good( self ):
 
-                #Update April 2015 to use the flagging task
-                task_args = {'vis'          : self.vis, 
-                           'mode'         : 'summary',
-                           'field'        : self.field,
-                           'spw'          : self.spw,
-                           'intent'       : self.intent,
-                           'display'      : '',
-                           'flagbackup'   : False,
-                           'savepars'     : False}
+		names, nGood, nRows = self._get_good_array()
 
-                d = flagdata(**task_args)                                               
+		good = dict()
+		for n, g, r in zip( names, nGood, nRows ):
+			if r > 0: good[n] = g
 
+		return( good )
 
+# ------------------------------------------------------------------------------
 
-		# Calculate the number of good data for each antenna and return
-		# them
+# RefAntFlagging::_get_selection
 
-		antenna = d['antenna']
-		good = dict()
+# Description:
+# ------------
+# This private member function converts the field, spw and intent selections
+# to TaQL conditions on the main table of the MS.
 
-		for a in antenna.keys():
-			good[a] = antenna[a]['total'] - antenna[a]['flagged']
+# Inputs:
+# -------
+# None.
 
-		return( good )
+# Outputs:
+# --------
+# The python tuple containing the list of TaQL conditions and the list of the
+# selected data description IDs, returned via the function value.
+
+# ------------------------------------------------------------------------------
+
+	def _get_selection( self ):
+
+		def join( sel ):
+			if isinstance( sel, (list, tuple) ):
+				return ','.join( [str(s) for s in sel] )
+			return str( sel )
+
+		field = join( self.field )
+		spw = join( self.spw )
+		intent = join( self.intent )
+
+		conditions = list()
+
+		msLoc = casac.ms()
+
+		if field != '':
+			fieldIDs = msLoc.msseltoindex( vis=self.vis, field=field )['field']
+			conditions.append( 'FIELD_ID IN [%s]' %
+				','.join( [str(f) for f in fieldIDs] ) )
+
+		if spw != '':
+			spwIDs = msLoc.msseltoindex( vis=self.vis, spw=spw )['spw']
+		else:
+			spwIDs = None
+
+		del msLoc
+
+
+		# Map the spectral windows to data description IDs
+
+		tbLoc = casac.table()
+
+		tbLoc.open( self.vis+'/DATA_DESCRIPTION' )
+		ddSpw = tbLoc.getcol( 'SPECTRAL_WINDOW_ID' )
+		tbLoc.close()
+
+		ddIDs = [dd for dd, s in enumerate( ddSpw )
+			if spwIDs is None or s in spwIDs]
+
+
+		# Match the intents against the observing modes of the STATE
+		# subtable
+
+		if intent != '':
+
+			patterns = list()
+			for p in intent.split( ',' ):
+				p = p.strip()
+				if '*' not in p: p = '*' + p + '*'
+				patterns.append( p )
+
+			tbLoc.open( self.vis+'/STATE' )
+			obsModes = tbLoc.getcol( 'OBS_MODE' )
+			tbLoc.close()
+
+			stateIDs = [i for i, mode in enumerate( obsModes )
+				if any( [fnmatch.fnmatch( mode, p ) for p in patterns] )]
+			conditions.append( 'STATE_ID IN [%s]' %
+				','.join( [str(s) for s in stateIDs] ) )
+
+		del tbLoc
+
+		return conditions, ddIDs
+
+# ------------------------------------------------------------------------------
+
+# RefAntFlagging::_get_good_array
+
+# Description:
+# ------------
+# This private member function gets the number of unflagged (good) data for
+# each antenna in one pass through the FLAG column of the MS.
+
+# NB: Each data description is read separately since the FLAG shape can differ
+# between spectral windows.  The rows are read in chunks to limit the memory
+# use for spectral windows with many channels.
+
+# Inputs:
+# -------
+# maxElements - The maximum number of flags read at once.  The default is 2e8.
+
+# Outputs:
+# --------
+# The python tuple containing the numpy arrays of antenna names, number of
+# good data and number of selected rows for each antenna, returned via the
+# function value.
+
+# ------------------------------------------------------------------------------
+
+	def _get_good_array( self, maxElements=2e8 ):
+
+		tbLoc = casac.table()
+
+		tbLoc.open( self.vis+'/ANTENNA' )
+		names = tbLoc.getcol( 'NAME' )
+		tbLoc.close()
+
+		nAnt = len( names )
+
+		nGood = numpy.zeros( nAnt )
+		nRows = numpy.zeros( nAnt, dtype=int )
+
+		conditions, ddIDs = self._get_selection()
+
+		tbLoc.open( self.vis )
+
+		for dd in ddIDs:
+
+			query = ' AND '.join( conditions + ['DATA_DESC_ID==%i' % dd] )
+			subLoc = tbLoc.query( query,
+				columns='ANTENNA1,ANTENNA2,FLAG' )
+
+			nRow = subLoc.nrows()
+			if nRow == 0:
+				subLoc.close()
+				continue
+
+			flagShape = subLoc.getcell( 'FLAG', 0 ).shape
+			nElem = flagShape[0] * flagShape[1]
+			chunk = max( 1, int( maxElements / nElem ) )
+
+			for startRow in range( 0, nRow, chunk ):
+
+				n = min( chunk, nRow - startRow )
+
+				flag = subLoc.getcol( 'FLAG', startrow=startRow, nrow=n )
+				ant1 = subLoc.getcol( 'ANTENNA1', startrow=startRow, nrow=n )
+				ant2 = subLoc.getcol( 'ANTENNA2', startrow=startRow, nrow=n )
+
+				rowGood = nElem - flag.sum( axis=(0,1) )
+
+				# Autocorrelations are only counted once
+
+				cross = ( ant1 != ant2 ).astype( float )
+
+				nGood += numpy.bincount( ant1, weights=rowGood,
+					minlength=nAnt )
+				nGood += numpy.bincount( ant2, weights=rowGood * cross,
+					minlength=nAnt )
+
+				nRows += numpy.bincount( ant1, minlength=nAnt )
+				nRows += numpy.bincount( ant2, weights=cross,
+					minlength=nAnt ).astype( int )
+
+			subLoc.close()
+
+		tbLoc.close()
+		del tbLoc
+
+		return numpy.asarray( names ), nGood, nRows
 
 # ------------------------------------------------------------------------------
 
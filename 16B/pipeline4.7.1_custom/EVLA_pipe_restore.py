@@ -61,9 +61,20 @@ if not os.path.exists(timing_file):
 else:
     timelog=open(timing_file,'a')
 
+# Per-stage and per-task resource timeline (see casa_tools.pipeline_profiling)
+if 'profiler' not in globals():
+    try:
+        from casa_tools.pipeline_profiling import PipelineProfiler
+        profiler = PipelineProfiler('logs/timing.jsonl')
+        profiler.instrument(globals())
+    except ImportError:
+        profiler = None
+
 def runtiming(pipestate, status):
     '''Determine profile for a given state/stage of the pipeline
     '''
+    if profiler is not None:
+        profiler.stage(pipestate, status)
     time_list.append({'pipestate':pipestate, 'time':time.time(), 'status':status})
 
     if (status == "end"):
@@ -5,7 +5,7 @@ For comparison, smooth and regrid to the 14B data.
 
 import os
 
-from cube_analysis.reprojection import reproject_cube
+from grid_match import match_cubes
 
 from paths import (data_path, fourteenB_wGBT_HI_file_dict,
                    seventeenB_02kms_wGBT_HI_file_dict,
@@ -14,42 +14,30 @@ from paths import (data_path, fourteenB_wGBT_HI_file_dict,
                    seventeenB_HI_data_1kms_wGBT_path)
 
 
-out_folder = seventeenB_HI_data_02kms_wGBT_path("14B_match",
-                                                no_check=True)
-
-if not os.path.exists(out_folder):
-    os.mkdir(out_folder)
-
-out_name = seventeenB_02kms_wGBT_HI_file_dict['Cube'].split("/")[-1].rstrip(".fits") + \
-    ".14B_match.fits"
-
-reproject_cube(seventeenB_02kms_wGBT_HI_file_dict['Cube'],
-               fourteenB_wGBT_HI_file_dict['Cube'],
-               out_name,
-               output_folder=out_folder,
-               save_spectral=False,
-               is_huge=True,
-               reproject_type='spatial',
-               common_beam=True,
-               verbose=True,
-               chunk=40)
-
-out_folder = seventeenB_HI_data_1kms_wGBT_path("14B_match",
-                                                no_check=True)
-
-if not os.path.exists(out_folder):
-    os.mkdir(out_folder)
-
-out_name = seventeenB_1kms_wGBT_HI_file_dict['Cube'].split("/")[-1].rstrip(".fits") + \
-    ".14B_match.fits"
-
-reproject_cube(seventeenB_1kms_wGBT_HI_file_dict['Cube'],
-               fourteenB_wGBT_HI_file_dict['Cube'],
-               out_name,
-               output_folder=out_folder,
-               save_spectral=False,
-               is_huge=True,
-               reproject_type='spatial',
-               common_beam=True,
-               verbose=True,
-               chunk=40)
+input_files = []
+output_files = []
+
+for file_dict, path_func in \
+    [(seventeenB_02kms_wGBT_HI_file_dict, seventeenB_HI_data_02kms_wGBT_path),
+     (seventeenB_1kms_wGBT_HI_file_dict, seventeenB_HI_data_1kms_wGBT_path)]:
+
+    out_folder = path_func("14B_match", no_check=True)
+
+    if not os.path.exists(out_folder):
+        os.mkdir(out_folder)
+
+    out_name = file_dict['Cube'].split("/")[-1].rstrip(".fits") + \
+        ".14B_match.fits"
+
+    input_files.append(file_dict['Cube'])
+    output_files.append(os.path.join(out_folder, out_name))
+
+# Both spectral resolutions are on the same grid, so the convolution kernels
+# and reprojection weights are shared.
+match_cubes(input_files,
+            fourteenB_wGBT_HI_file_dict['Cube'],
+            output_files,
+            chunk=40,
+            num_cores=4,
+            cache_dir=os.path.join(data_path, "reprojection_weights"),
+            verbose=True)
@@ -14,14 +14,14 @@ import astropy.units as u
 import matplotlib.pyplot as plt
 from pandas import DataFrame
 
-from cube_analysis.feather_cubes import flux_recovery
+from flux_budget import FluxBudget
 
 from paths import (seventeenB_HI_data_02kms_path,
                    seventeenB_HI_data_02kms_wGBT_path,
                    seventeenB_HI_data_1kms_path,
                    seventeenB_HI_data_1kms_wGBT_path,
                    data_path, allfigs_path, paper1_tables_path)
-from constants import pb_lim, hi_mass_conversion_Jy, distance
+from constants import pb_lim, hi_mass_conversion_Jy, distance, hi_freq
 from plotting_styles import default_figure, onecolumn_figure
 
 # Set which of the cubes to use
@@ -34,23 +34,29 @@ chunk = 8
 if run_gbt_02kms:
 
     # Load the non-pb masked cube
-    vla_cube = SpectralCube.read(seventeenB_HI_data_02kms_path("M33_14B_17B_HI_contsub_width_02kms.image.pbcor.fits"))
+    vla_name = seventeenB_HI_data_02kms_path("M33_14B_17B_HI_contsub_width_02kms.image.pbcor.fits")
+    vla_cube = SpectralCube.read(vla_name)
 
+    # Regridded onto the VLA cube by gbt_regrid.py
     gbt_path = os.path.join(data_path, "GBT")
-    gbt_name = os.path.join(gbt_path, "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_02kms_spectralregrid.fits")
-    gbt_cube = SpectralCube.read(gbt_name)
+    gbt_name = os.path.join(gbt_path, "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_02kms.fits")
 
-    feathered_cube = SpectralCube.read(seventeenB_HI_data_02kms_wGBT_path("M33_14B_17B_HI_contsub_width_02kms.image.pbcor.GBT_feathered.fits"))
+    feathered_name = seventeenB_HI_data_02kms_wGBT_path("M33_14B_17B_HI_contsub_width_02kms.image.pbcor.GBT_feathered.fits")
 
     pbcov = SpectralCube.read(seventeenB_HI_data_02kms_path("M33_14B_17B_HI_contsub_width_02kms.pb.fits"))
     mask = pbcov[0].value > pb_lim
 
-    total_vla_profile, total_gbt_profile = \
-        flux_recovery(vla_cube, gbt_cube, mask=mask, num_cores=num_cores,
-                      chunk=chunk)
-    total_feathered_profile, total_gbt_profile = \
-        flux_recovery(feathered_cube, gbt_cube, mask=mask, num_cores=num_cores,
-                      chunk=chunk)
+    # The total spectra are cached, so only new or changed cubes are summed
+    budget = FluxBudget(os.path.join(data_path, "flux_budget"),
+                        restfreq=hi_freq)
+    spectra = budget.total_spectra({"VLA": vla_name, "GBT": gbt_name,
+                                    "VLA+GBT": feathered_name},
+                                   {"pbcov": mask}, num_cores=num_cores,
+                                   chunk=chunk)
+
+    total_vla_profile = spectra["VLA"]["pbcov"]
+    total_gbt_profile = spectra["GBT"]["pbcov"]
+    total_feathered_profile = spectra["VLA+GBT"]["pbcov"]
 
     vel_axis = vla_cube.spectral_axis.to(u.km / u.s).value
 
@@ -115,25 +121,30 @@ if run_gbt_02kms:
 if run_gbt_1kms:
 
     # Load the non-pb masked cube
-    vla_cube = SpectralCube.read(seventeenB_HI_data_1kms_path("M33_14B_17B_HI_contsub_width_1kms.image.pbcor.fits"))
+    vla_name = seventeenB_HI_data_1kms_path("M33_14B_17B_HI_contsub_width_1kms.image.pbcor.fits")
+    vla_cube = SpectralCube.read(vla_name)
 
+    # Regridded onto the VLA cube by gbt_regrid.py
     gbt_path = os.path.join(data_path, "GBT")
-    gbt_name = os.path.join(gbt_path, "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_1kms_spectralregrid.fits")
-    gbt_cube = SpectralCube.read(gbt_name)
+    gbt_name = os.path.join(gbt_path, "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_1kms.fits")
 
-    feathered_cube = SpectralCube.read(seventeenB_HI_data_1kms_wGBT_path("M33_14B_17B_HI_contsub_width_1kms.image.pbcor.GBT_feathered.fits"))
+    feathered_name = seventeenB_HI_data_1kms_wGBT_path("M33_14B_17B_HI_contsub_width_1kms.image.pbcor.GBT_feathered.fits")
 
     pbcov = SpectralCube.read(seventeenB_HI_data_1kms_path("M33_14B_17B_HI_contsub_width_1kms.pb.fits"))
     mask = pbcov[0].value > pb_lim
 
-    total_vla_profile, total_gbt_profile = \
-        flux_recovery(vla_cube, gbt_cube, mask=mask, num_cores=num_cores,
-                      chunk=chunk, spec_check_kwargs={'rtol': 0.03},
-                      verbose=False)
-    total_feathered_profile, total_gbt_profile = \
-        flux_recovery(feathered_cube, gbt_cube, mask=mask, num_cores=num_cores,
-                      chunk=chunk, spec_check_kwargs={'rtol': 0.03},
-                      verbose=False)
+    # The total spectra are cached, so only new or changed cubes are summed
+    budget = FluxBudget(os.path.join(data_path, "flux_budget"),
+                        restfreq=hi_freq)
+    spectra = budget.total_spectra({"VLA": vla_name, "GBT": gbt_name,
+                                    "VLA+GBT": feathered_name},
+                                   {"pbcov": mask}, num_cores=num_cores,
+                                   chunk=chunk, spec_rtol=0.03,
+                                   verbose=False)
+
+    total_vla_profile = spectra["VLA"]["pbcov"]
+    total_gbt_profile = spectra["GBT"]["pbcov"]
+    total_feathered_profile = spectra["VLA+GBT"]["pbcov"]
 
     vel_axis = vla_cube.spectral_axis.to(u.km / u.s).value
 
@@ -212,6 +223,7 @@ if run_gbt_1kms:
                      beams=vla_cube.beams if hasattr(vla_cube, 'beams') else None)
     vla_spec.write(seventeenB_HI_data_1kms_path("M33_14B_17B_HI_contsub_width_1kms.image.pbcor.total_flux_spec.fits", no_check=True))
 
+    feathered_cube = SpectralCube.read(feathered_name)
     spec = feathered_cube[:, 0, 0]
 
     vla_feath_spec = VRODS(total_feathered_profile,
@@ -220,6 +232,7 @@ if run_gbt_1kms:
                            beams=vla_cube.beams if hasattr(vla_cube, 'beams') else None)
     vla_feath_spec.write(seventeenB_HI_data_1kms_wGBT_path("M33_14B_17B_HI_contsub_width_1kms.image.pbcor.GBT_feathered.total_flux_spec.fits", no_check=True))
 
+    gbt_cube = SpectralCube.read(gbt_name)
     spec = gbt_cube[:, 0, 0]
 
     gbt_spec = OneDSpectrum(total_gbt_profile,
@@ -227,6 +240,6 @@ if run_gbt_1kms:
                             meta=spec.meta,
                             beam=gbt_cube.beam)
     gbt_spec.write(os.path.join(gbt_path,
-                      "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_1kms_spectralregrid.total_flux_spec.fits"))
+                      "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_1kms.total_flux_spec.fits"))
 
 default_figure()
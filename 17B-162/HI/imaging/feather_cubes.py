@@ -10,19 +10,21 @@ from astropy import log
 import scipy.ndimage as nd
 import numpy as np
 
-from cube_analysis.feather_cubes import feather_cube
-
 from paths import (seventeenB_HI_data_02kms_path,
                    seventeenB_HI_data_1kms_path,
                    data_path)
 from constants import hi_freq
+from feather_engine import feather_cube
 
 # Set which of the cubes to feather
 run_gbt_02kms = False
 run_gbt_1kms = True
 
+# Channel blocks are split between the processes, and each FFT uses
+# fft_threads threads
 num_cores = 2
-chunk = 50
+fft_threads = 4
+chunk = 8
 
 
 def taper_weights(mask, sigma, nsig_cut=3):
@@ -47,8 +49,8 @@ def taper_weights(mask, sigma, nsig_cut=3):
 if run_gbt_02kms:
     log.info("Feathering with 0.2 km/s GBT")
 
-    # Load the non-pb masked cube
-    vla_cube = SpectralCube.read(seventeenB_HI_data_02kms_path("M33_14B_17B_HI_contsub_width_02kms.image.pbcor.fits"))
+    # The non-pb masked cube
+    vla_name = seventeenB_HI_data_02kms_path("M33_14B_17B_HI_contsub_width_02kms.image.pbcor.fits")
 
     pb_cube = SpectralCube.read(seventeenB_HI_data_02kms_path("M33_14B_17B_HI_contsub_width_02kms.pb.fits"))
     # PB minimally changes over the frequency range. So just grab one plane
@@ -59,8 +61,7 @@ if run_gbt_02kms:
     weight = taper_weights(np.isfinite(pb_plane), 30, nsig_cut=5)
 
     gbt_path = osjoin(data_path, "GBT")
-    gbt_name = osjoin(gbt_path, "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_02kms_spectralregrid.fits")
-    gbt_cube = SpectralCube.read(gbt_name)
+    gbt_name = osjoin(gbt_path, "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_02kms.fits")
 
     output_path = osjoin(data_path,
                          "VLA/17B-162/HI/full_imaging_02kms_wGBT/")
@@ -70,17 +71,17 @@ if run_gbt_02kms:
     save_name = osjoin(output_path,
                        "M33_14B_17B_HI_contsub_width_02kms.image.pbcor.GBT_feathered.fits")
 
-    feather_cube(vla_cube, gbt_cube, restfreq=hi_freq, save_feather=True,
-                 save_name=save_name, num_cores=num_cores,
+    feather_cube(vla_name, gbt_name, save_name, restfreq=hi_freq,
+                 num_cores=num_cores, fft_threads=fft_threads,
                  weights=weight, chunk=chunk, verbose=False)
 
 if run_gbt_1kms:
     log.info("Feathering with 1 km/s GBT")
 
-    # Load the non-pb masked cube
-    vla_cube = SpectralCube.read(seventeenB_HI_data_1kms_path("M33_14B_17B_HI_contsub_width_1kms.image.fits"))
+    # The non-pb masked cube
+    vla_name = seventeenB_HI_data_1kms_path("M33_14B_17B_HI_contsub_width_1kms.image.fits")
 
-    pb_cube = SpectralCube.read(seventeenB_HI_data_1kms_path("M33_14B_17B_HI_contsub_width_1kms.pb.fits"))
+    pb_name = seventeenB_HI_data_1kms_path("M33_14B_17B_HI_contsub_width_1kms.pb.fits")
     # PB minimally changes over the frequency range. So just grab one plane
     # pb_plane = pb_cube[0]
 
@@ -90,8 +91,7 @@ if run_gbt_1kms:
 
     gbt_path = osjoin(data_path, "GBT")
     gbt_name = osjoin(gbt_path,
-                      "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_1kms_spectralregrid.fits")
-    gbt_cube = SpectralCube.read(gbt_name)
+                      "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_1kms.fits")
 
     output_path = osjoin(data_path, "VLA/17B-162/HI/full_imaging_1kms_wGBT/")
     if not os.path.exists(output_path):
@@ -100,13 +100,11 @@ if run_gbt_1kms:
     save_name = osjoin(output_path,
                        "M33_14B_17B_HI_contsub_width_1kms.image.pbcor.GBT_feathered.fits")
 
-    feather_cube(vla_cube, gbt_cube, pb_hi=pb_cube,
-                 restfreq=hi_freq, save_feather=True,
-                 save_name=save_name, overwrite=True,
-                 num_cores=num_cores,
+    feather_cube(vla_name, gbt_name, save_name, pb_hi=pb_name,
+                 restfreq=hi_freq, overwrite=True,
+                 num_cores=num_cores, fft_threads=fft_threads,
                  # weights=weight,
                  chunk=chunk, verbose=False,
-                 relax_spectral_check=False,
                  # NOTE: there is an offset of ~0.4 km/s between the cubes
                  # The big GBT beam means this really doesn't matter (I
                  # manually checked). The difference is 0.36 times the
@@ -115,7 +113,7 @@ if run_gbt_1kms:
                  # the frequency in the individual channel MSs used in
                  # imaging. It's not even a half-channel offset like I
                  # would expect if the MS frequency was the channel edge...
-                 spec_check_kwargs={'rtol': 0.4})
+                 spec_rtol=0.4)
 
     # Now resave a minimal version of the feathered cube
     # cube = SpectralCube.read(save_name)
@@ -11,16 +11,14 @@ from astropy.io import fits
 from astropy.wcs import WCS
 from spectral_cube import SpectralCube
 from radio_beam import Beam
-from astropy.utils.console import ProgressBar
 import numpy as np
 import os
 import astropy.units as u
 
-from cube_analysis.io_utils import create_huge_fits
-
 from paths import (seventeenB_HI_data_02kms_path,
                    seventeenB_HI_data_1kms_path, data_path)
 from constants import hi_freq
+from sd_regrid import regrid_single_dish
 
 run_02kms = False
 run_1kms = True
@@ -33,7 +31,9 @@ if not os.path.exists(os.path.join(gbt_path, '17B-162_items')):
 # Ta* to T_mb as per @low-sky
 Tmb_conv = 1.052
 
-cube = SpectralCube.read(os.path.join(gbt_path, "m33_gbt_vlsr_highres.fits"))
+input_file = os.path.join(gbt_path, "m33_gbt_vlsr_highres.fits")
+
+cube = SpectralCube.read(input_file)
 
 # Update the beams to be the optimal found for the 14B data
 beam_fwhm = lambda diam: ((1.18 * hi_freq.to(u.cm, u.spectral())) /
@@ -76,26 +76,9 @@ if run_02kms:
     # del_vel = np.abs(vla_spat_hdr['CDELT3'])
     # nchan = 1359
 
-    save_name = os.path.join(gbt_path, "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_02kms_spectralregrid.fits")
-
-    # Spectral interpolation, followed by reprojection.
-    if not os.path.exists(save_name):
-
-        cube = cube.spectral_interpolate(vla_cube.spectral_axis)
-        cube = cube.with_beam(Beam(gbt_eff_beam))
-
-        if cube._is_huge:
-            output_fits = create_huge_fits(save_name, cube.header,
-                                           return_hdu=True)
-
-            for chan in ProgressBar(cube.shape[0]):
-                output_fits[0].data[chan] = cube[chan].value * Tmb_conv
-            output_fits.flush()
-            output_fits.close()
-        else:
-            (cube * Tmb_conv).write(save_name, overwrite=True)
-    else:
-        cube = SpectralCube.read(save_name)
+    # Spectral interpolation and reprojection are done together, so the data
+    # are only read and written once.
+    cube = cube.with_beam(Beam(gbt_eff_beam))
 
     # Make the reprojected header
     new_header = cube.header.copy()
@@ -118,21 +101,14 @@ if run_02kms:
     # We're going to convert to Tmb below
     new_header.comments['BUNIT'] = 'Tmb'
 
-    # Build up the reprojected cube per channel
-    out_path = os.path.join(gbt_path, '17B-162_items')
-
     save_name = os.path.join(gbt_path,
                              "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_02kms.fits")
-    output_fits = create_huge_fits(save_name, new_header, return_hdu=True)
 
-    targ_header = vla_cube[0].header
-    for chan in ProgressBar(cube.shape[0]):
-        reproj_chan = \
-            cube[chan].reproject(targ_header).value.astype(np.float32)
-        output_fits[0].data[chan] = reproj_chan
-        if chan % 100 == 0:
-            output_fits.flush()
-    output_fits.close()
+    regrid_single_dish(input_file, vla_cube.spectral_axis,
+                       vla_cube[0].header, save_name, new_header,
+                       scale=Tmb_conv, num_cores=4,
+                       cache_dir=os.path.join(gbt_path,
+                                              "reprojection_weights"))
 
 if run_1kms:
     # Load the non-pb masked cube
@@ -153,27 +129,9 @@ if run_1kms:
 
     vel_axis = vel_to_freq(freq_axis, unit=u.m / u.s)
 
-    save_name = os.path.join(gbt_path,
-                             "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_1kms_spectralregrid.fits")
-
-    # Spectral interpolation, followed by reprojection.
-    if not os.path.exists(save_name):
-
-        cube = cube.spectral_interpolate(vel_axis)
-        cube = cube.with_beam(Beam(gbt_eff_beam))
-
-        if cube._is_huge:
-            output_fits = create_huge_fits(save_name, cube.header,
-                                           return_hdu=True)
-
-            for chan in ProgressBar(cube.shape[0]):
-                output_fits[0].data[chan] = cube[chan].value * Tmb_conv
-            output_fits.flush()
-            output_fits.close()
-        else:
-            (cube * Tmb_conv).write(save_name, overwrite=True)
-    else:
-        cube = SpectralCube.read(save_name)
+    # Spectral interpolation and reprojection are done together, so the data
+    # are only read and written once.
+    cube = cube.with_beam(Beam(gbt_eff_beam))
 
     # Make the reprojected header
     new_header = cube.header.copy()
@@ -183,6 +141,8 @@ if run_1kms:
     new_header["NAXIS3"] = nchan
     new_header['CUNIT3'] = 'm s-1'
     new_header['CRVAL3'] = vel_axis[0].value
+    new_header['CDELT3'] = (vel_axis[1] - vel_axis[0]).value
+    new_header['CRPIX3'] = 1
     kwarg_skip = ['TELESCOP', 'BUNIT', 'INSTRUME']
     for key in cube.header:
         if key == 'HISTORY':
@@ -198,27 +158,19 @@ if run_1kms:
     # We're going to convert to Tmb below
     new_header.comments['BUNIT'] = 'Tmb'
 
-    # Build up the reprojected cube per channel
-    out_path = os.path.join(gbt_path, '17B-162_items')
-
     save_name = os.path.join(gbt_path,
                              "17B-162_items/m33_gbt_vlsr_highres_Tmb_17B162_1kms.fits")
-    output_fits = create_huge_fits(save_name, new_header, return_hdu=True)
 
     targ_header = WCS(vla_spat_hdr).celestial.to_header()
     targ_header["NAXIS"] = 2
     targ_header["NAXIS1"] = vla_pbmask.shape[1]
     targ_header["NAXIS2"] = vla_pbmask.shape[0]
 
-    for chan in ProgressBar(cube.shape[0]):
-        reproj_chan = \
-            cube[chan].reproject(targ_header).value.astype(np.float32)
-        output_fits[0].data[chan] = reproj_chan
-        if chan % 100 == 0:
-            output_fits.flush()
-    output_fits.close()
+    regrid_single_dish(input_file, vel_axis, targ_header, save_name,
+                       new_header, scale=Tmb_conv, num_cores=4,
+                       cache_dir=os.path.join(gbt_path,
+                                              "reprojection_weights"))
 
-    del output_fits
     del cube
 
     # Also create a clean mask version from the regridded data.
@@ -0,0 +1,71 @@
+
+'''
+Update the moment maps, peak temperatures and peak-velocity radial stacks of
+the 1 km/s cube after re-imaging some of the channels, without rerunning the
+full pipeline on the cube.
+
+The first run builds the partial sums from the assembled cube (see
+concat_channels.py) and the signal mask from cube_pipeline.py. Afterwards,
+only the replaced channels are read.
+
+Usage:
+python update_channel_products.py chan_num chan_image.fits [chan_num chan_image.fits ...]
+'''
+
+import os
+import sys
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+
+from incremental_products import IncrementalProducts
+
+from paths import seventeenB_HI_data_1kms_path, seventeenB_1kms_HI_file_dict
+from galaxy_params import gal_feath as gal
+
+
+args = sys.argv[1:]
+if len(args) % 2 != 0:
+    raise ValueError("Give pairs of channel numbers and channel images.")
+
+channel_images = dict((int(chan), img) for chan, img in
+                      zip(args[::2], args[1::2]))
+
+out_folder = seventeenB_HI_data_1kms_path("incremental_products",
+                                          no_check=True)
+if not os.path.exists(out_folder):
+    os.mkdir(out_folder)
+
+cube_name = seventeenB_1kms_HI_file_dict["Cube"]
+
+header = fits.getheader(cube_name)
+
+# Radial bins of 100 pc out to 8 kpc, as in the radial stacking scripts
+dr = 100 * u.pc
+max_radius = (8.0 * u.kpc).to(u.pc)
+
+radius = gal.radius(header=header).to(u.pc)
+radial_bins = np.floor((radius / dr).decompose().value).astype(int)
+radial_bins[radius >= max_radius] = -1
+
+# Peak velocities from the pipeline products are held fixed
+peakvels = fits.open(seventeenB_1kms_HI_file_dict["PeakVels"])[0].data * \
+    u.m / u.s
+
+stacks = {"peakvels": (peakvels, radial_bins)}
+
+products = IncrementalProducts(cube_name,
+                               os.path.join(out_folder, "partial_sums.npz"),
+                               mask_file=seventeenB_1kms_HI_file_dict["Source_Mask"],
+                               stacks=stacks, vsys=gal.vsys)
+
+products.replace_channels(channel_images)
+
+products.write_maps(os.path.join(out_folder,
+                                 os.path.basename(cube_name)[:-5]))
+
+for name in products.stacks:
+    np.save(os.path.join(out_folder,
+                         "radial_stacking_{0}_{1}{2}.npy"
+                         .format(name, int(dr.value), dr.unit)),
+            products.stack(name).value)
@@ -20,6 +20,19 @@ context.set_state('ProjectSummary', 'telescope', 'EVLA')
 context.set_state('ProjectSummary', 'proposal_code', '17B-162')
 context.set_state('ProjectSummary', 'piname', 'Eric Koch')
 
+# Record the resource use of each pipeline and CASA task in logs/timing.jsonl
+# when casa_tools is available
+try:
+    from casa_tools.pipeline_profiling import (PipelineProfiler,
+                                               default_profiled_tasks)
+    profiler = PipelineProfiler('logs/timing.jsonl')
+    profiler.instrument(globals(),
+                        [name for name in globals().keys()
+                         if name.startswith("hifv_")] +
+                        default_profiled_tasks)
+except ImportError:
+    profiler = None
+
 try:
     hifv_importdata(ocorr_mode='co', nocopy=False, vis=[mySDM],
                     createmms='automatic', asis='Receiver CalAtmosphere',
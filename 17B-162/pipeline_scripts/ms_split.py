@@ -4,6 +4,11 @@ import os
 from shutil import copyfile
 from tasks import split, importasdm
 
+repo_path = os.path.expanduser("~/ownCloud/code_development/VLA_Lband/")
+sys.path.insert(0, os.path.join(repo_path, "flagging_scripts"))
+from flag_compiler import (compile_flag_files, ms_metadata,
+                           validate_flag_rules, write_flag_file)
+
 '''
 Identify the continuum and line SPWs and split into separate MSs and
 directories.
@@ -32,6 +37,29 @@ else:
 
 ms_active = mySDM + ".ms"
 
+
+def compile_and_write_flags(flag_filename, vis, out_filename):
+    '''
+    Merge the overlapping manual flags for the track and check them against
+    the split MS before the pipeline applies them in one flagdata call.
+    Nothing is written when a rule selects data that is not in the MS.
+    '''
+    rules = compile_flag_files(flag_filename)
+
+    problems = validate_flag_rules(rules, ms_metadata(vis))
+
+    for rule, problem in problems:
+        print("Flag check: {0} -- {1}".format(rule.to_command(), problem))
+
+    if len(problems) > 0:
+        raise ValueError("{0} problems found in {1}. Fix the flag file "
+                         "before running the pipeline."
+                         .format(len(problems), flag_filename))
+
+    write_flag_file(rules, out_filename,
+                    header="Compiled from {}".format(flag_filename))
+
+
 print("Given inputs:")
 print("SDM: {}".format(mySDM))
 print("Make MMS: {}".format(parallel_run))
@@ -62,10 +90,7 @@ if split_lines:
     flag_path = os.path.expanduser("~/ownCloud/code_development/VLA_Lband/17B-162/pipeline_scripts/track_flagging")
     full_flag_filename = os.path.join(flag_path, flag_filename)
 
-    if os.path.exists(full_flag_filename):
-        copyfile(full_flag_filename,
-                 os.path.join(lines_folder, "additional_flagging.txt"))
-    else:
+    if not os.path.exists(full_flag_filename):
         print("No additional flagging script found in the VLA_Lband repo"
               " for lines.")
 
@@ -73,6 +98,12 @@ if split_lines:
           outputvis=lines_folder + "/" + mySDM + ".speclines.ms",
           spw="8~17", datacolumn='DATA', field="")
 
+    if os.path.exists(full_flag_filename):
+        compile_and_write_flags(full_flag_filename,
+                                lines_folder + "/" + mySDM + ".speclines.ms",
+                                os.path.join(lines_folder,
+                                             "additional_flagging.txt"))
+
 # While it would be nice to remove the pol cal scans here, the pipeline
 # will fail when running fluxboot because there is no other calibration
 # field to transfer to! We can avoid this by just keeping all of the
@@ -90,10 +121,7 @@ if split_cont:
     flag_filename = "{}_continuum_flags.txt".format(parentdir)
     flag_path = os.path.expanduser("~/ownCloud/code_development/VLA_Lband/17B-162/pipeline_scripts/track_flagging")
     full_flag_filename = os.path.join(flag_path, flag_filename)
-    if os.path.exists(full_flag_filename):
-        copyfile(full_flag_filename,
-                 os.path.join(cont_folder, "additional_flagging.txt"))
-    else:
+    if not os.path.exists(full_flag_filename):
         print("No additional flagging script found in the VLA_Lband repo"
               " for continuum.")
 
@@ -101,3 +129,9 @@ if split_cont:
           outputvis=cont_folder + "/" + mySDM + ".continuum.ms",
           spw="0~7", datacolumn='DATA',
           field="")
+
+    if os.path.exists(full_flag_filename):
+        compile_and_write_flags(full_flag_filename,
+                                cont_folder + "/" + mySDM + ".continuum.ms",
+                                os.path.join(cont_folder,
+                                             "additional_flagging.txt"))
@@ -8,3 +8,5 @@ from mytools import *
 from split_by_channels import image_split_by_channel, ms_split_by_channel
 
 from extract_from_log import CleanResults, collect_clean_results
+
+from pipeline_profiling import PipelineProfiler, compare_timelines
@@ -0,0 +1,414 @@
+
+'''
+Per-stage and per-task resource profiling for the EVLA pipeline scripts.
+
+The pipeline's `runtiming` hook only records wall-clock time per stage. The
+`PipelineProfiler` here also records CPU time, memory, I/O and child
+processes for each stage and for every wrapped CASA task called within it.
+
+The memory use comes from `ru_maxrss`, which is the peak RSS over the life
+of the process (and of its largest finished child), not of a single task.
+Each record has the peak so far (`cumulative_peak_rss`) and how much the
+task or stage raised it (`peak_rss_increase`). The increase is zero for
+tasks that stayed below an earlier peak.
+
+Child processes that start and finish within a task (e.g., CASA's MPI and
+plotting helpers) are not alive at either end of the call, so they are
+measured by the CPU time of the children that finished during the call
+(`children_cpu_time`). `n_children` is only the number of children alive at
+the start or end.
+
+Records are appended to a JSON lines timeline, which can be compared across
+tracks with `compare_timelines`.
+
+This module does not depend on CASA and can be run directly to compare
+timelines:
+
+    python pipeline_profiling.py 14B.jsonl 16B.jsonl 17B.jsonl
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+from collections import OrderedDict
+
+# Tasks that dominate the run time of the VLA pipelines.
+default_profiled_tasks = ['flagdata', 'statwt', 'applycal', 'gaincal',
+                          'bandpass', 'setjy', 'fluxscale', 'split',
+                          'hanningsmooth', 'plotms', 'plotcal',
+                          'flagmanager', 'importevla', 'listobs']
+
+
+def _read_proc_io(pid='self'):
+    '''
+    Return the bytes read and written from disk from /proc/<pid>/io. Returns
+    None on systems without procfs.
+    '''
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            io_dict = dict(line.strip().split(': ') for line in f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    return int(io_dict['read_bytes']), int(io_dict['write_bytes'])
+
+
+def _count_children(pid=None):
+    '''
+    Count the live child processes of `pid` using procfs.
+    '''
+    if pid is None:
+        pid = os.getpid()
+
+    if not os.path.isdir('/proc'):
+        return 0
+
+    n_children = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue
+        # The command name can contain spaces. The ppid is the second field
+        # after the closing parenthesis.
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        if ppid == pid:
+            n_children += 1
+
+    return n_children
+
+
+def _maxrss_bytes(ru_maxrss):
+    # ru_maxrss is in kB on Linux, bytes on OSX
+    if sys.platform == 'darwin':
+        return ru_maxrss
+    return ru_maxrss * 1024
+
+
+def resource_snapshot():
+    '''
+    Return a dictionary of the current resource usage of this process and
+    its finished children.
+    '''
+    self_use = resource.getrusage(resource.RUSAGE_SELF)
+    child_use = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    snap = {'wall': time.time(),
+            'cpu_user': self_use.ru_utime + child_use.ru_utime,
+            'cpu_sys': self_use.ru_stime + child_use.ru_stime,
+            'cpu_children': child_use.ru_utime + child_use.ru_stime,
+            'maxrss_self': _maxrss_bytes(self_use.ru_maxrss),
+            'maxrss_children': _maxrss_bytes(child_use.ru_maxrss),
+            'n_children': _count_children()}
+
+    proc_io = _read_proc_io()
+    if proc_io is not None:
+        snap['read_bytes'], snap['write_bytes'] = proc_io
+    else:
+        # Fall back to block counts. These are in 512 byte units.
+        snap['read_bytes'] = 512 * (self_use.ru_inblock +
+                                    child_use.ru_inblock)
+        snap['write_bytes'] = 512 * (self_use.ru_oublock +
+                                     child_use.ru_oublock)
+
+    return snap
+
+
+def resource_delta(start, end):
+    '''
+    Difference between two `resource_snapshot` outputs. The peak RSS is
+    cumulative over the process, so only its increase is specific to the
+    interval.
+
+    `children_cpu_time` is the CPU time of the child processes that finished
+    and were waited for during the interval, including those that started
+    and finished within it. `n_children` is the larger of the numbers of
+    live children at the start and end, so it only counts children that
+    outlive one end of the interval (e.g., a persistent MPI server).
+    '''
+    start_rss = max(start['maxrss_self'], start['maxrss_children'])
+    end_rss = max(end['maxrss_self'], end['maxrss_children'])
+
+    return {'wall_time': end['wall'] - start['wall'],
+            'cpu_user': end['cpu_user'] - start['cpu_user'],
+            'cpu_sys': end['cpu_sys'] - start['cpu_sys'],
+            'children_cpu_time': end['cpu_children'] - start['cpu_children'],
+            'cumulative_peak_rss': end_rss,
+            'peak_rss_increase': end_rss - start_rss,
+            'read_bytes': end['read_bytes'] - start['read_bytes'],
+            'write_bytes': end['write_bytes'] - start['write_bytes'],
+            'n_children': max(start['n_children'], end['n_children'])}
+
+
+class ProfiledTask(object):
+    '''
+    Wrap a CASA task so each call is recorded by a `PipelineProfiler`.
+    Attribute access (e.g., `task.parameters`) is passed through to the
+    wrapped task so `catch_fail` and `default` continue to work.
+    '''
+    def __init__(self, task, profiler, name=None):
+        self._task = task
+        self._profiler = profiler
+        self.__name__ = name if name is not None else task.__name__
+
+    def __call__(self, *args, **kwargs):
+        start = resource_snapshot()
+        try:
+            return self._task(*args, **kwargs)
+        finally:
+            end = resource_snapshot()
+            self._profiler.record_task(self.__name__, start, end,
+                                       vis=kwargs.get('vis'))
+
+    def __getattr__(self, attr):
+        return getattr(self._task, attr)
+
+
+class PipelineProfiler(object):
+    '''
+    Record per-stage and per-task resource usage to a JSON lines timeline.
+
+    Parameters
+    ----------
+    timeline_file : str, optional
+        File the records are appended to.
+    track : str, optional
+        Name of the track (e.g., the SDM name). Defaults to the name of the
+        working directory.
+    '''
+    def __init__(self, timeline_file='logs/timing.jsonl', track=None):
+        self.timeline_file = timeline_file
+        if track is None:
+            track = os.path.basename(os.getcwd().rstrip('/'))
+        self.track = track
+
+        self._stage_starts = OrderedDict()
+
+        log_dir = os.path.dirname(timeline_file)
+        if log_dir and not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+
+    @property
+    def current_stage(self):
+        if len(self._stage_starts) == 0:
+            return None
+        return list(self._stage_starts.keys())[-1]
+
+    def _write(self, record):
+        record['track'] = self.track
+        record['host'] = socket.gethostname()
+        with open(self.timeline_file, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    def stage(self, pipestate, status):
+        '''
+        Mark the start or end of a pipeline stage. Meant to be called with the
+        same arguments as `runtiming`.
+        '''
+        if status == 'start':
+            self._stage_starts[pipestate] = resource_snapshot()
+        elif status == 'end':
+            # Some stages are started and ended under different names
+            # (e.g., checkflag/targetflag in statwt). Fall back to the most
+            # recently started stage.
+            if pipestate in self._stage_starts:
+                start = self._stage_starts.pop(pipestate)
+            elif len(self._stage_starts) > 0:
+                start = self._stage_starts.popitem()[1]
+            else:
+                return
+
+            record = OrderedDict(kind='stage', stage=pipestate,
+                                 time=start['wall'])
+            record.update(resource_delta(start, resource_snapshot()))
+            self._write(record)
+        else:
+            raise ValueError("status must be 'start' or 'end'.")
+
+    def record_task(self, name, start, end, vis=None):
+        record = OrderedDict(kind='task', stage=self.current_stage,
+                             task=name, time=start['wall'], vis=vis)
+        record.update(resource_delta(start, end))
+        self._write(record)
+
+    def instrument(self, namespace, task_names=default_profiled_tasks):
+        '''
+        Replace the CASA tasks in `namespace` (typically `globals()` in the
+        pipeline scripts) with profiled versions. Tasks that are not defined
+        are skipped. Calling this more than once does not wrap tasks twice.
+        '''
+        for name in task_names:
+            if name not in namespace:
+                continue
+            if isinstance(namespace[name], ProfiledTask):
+                continue
+            namespace[name] = ProfiledTask(namespace[name], self, name=name)
+
+
+def read_timeline(timeline_file):
+    '''
+    Read a JSON lines timeline into a list of dictionaries.
+    '''
+    records = []
+    with open(timeline_file) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            records.append(json.loads(line))
+    return records
+
+
+def summarize_timeline(records, kind='task'):
+    '''
+    Total the resource usage per task (or per stage) in a timeline.
+
+    Returns
+    -------
+    summary : OrderedDict
+        Keys are the task/stage names. Values are dictionaries with the
+        number of calls, the summed wall and CPU time (and the CPU time of
+        finished child processes) and I/O, the largest
+        cumulative peak RSS at the end of a call, and the largest increase
+        of the peak RSS in one call.
+    '''
+    key = 'task' if kind == 'task' else 'stage'
+
+    summary = OrderedDict()
+    for rec in records:
+        if rec['kind'] != kind:
+            continue
+        name = rec[key]
+        if name not in summary:
+            summary[name] = {'ncalls': 0, 'wall_time': 0., 'cpu_time': 0.,
+                             'children_cpu_time': 0.,
+                             'read_bytes': 0, 'write_bytes': 0,
+                             'cumulative_peak_rss': 0,
+                             'peak_rss_increase': 0}
+        out = summary[name]
+        out['ncalls'] += 1
+        out['wall_time'] += rec['wall_time']
+        out['cpu_time'] += rec['cpu_user'] + rec['cpu_sys']
+        out['children_cpu_time'] += rec.get('children_cpu_time', 0.)
+        out['read_bytes'] += rec['read_bytes']
+        out['write_bytes'] += rec['write_bytes']
+        # Older timelines only have the cumulative peak, as 'peak_rss'
+        out['cumulative_peak_rss'] = \
+            max(out['cumulative_peak_rss'],
+                rec.get('cumulative_peak_rss', rec.get('peak_rss', 0)))
+        out['peak_rss_increase'] = max(out['peak_rss_increase'],
+                                       rec.get('peak_rss_increase', 0))
+
+    return summary
+
+
+def compare_timelines(timeline_files, labels=None, kind='task',
+                      reference=0, regression_factor=1.25,
+                      min_wall_time=10.):
+    '''
+    Compare the per-task or per-stage wall times across tracks.
+
+    Parameters
+    ----------
+    timeline_files : list
+        JSON lines timelines, e.g., one each for 14B, 16B and 17B tracks.
+    labels : list, optional
+        Names for each timeline. Defaults to the file names.
+    kind : {'task', 'stage'}, optional
+        Compare CASA tasks or pipeline stages.
+    reference : int, optional
+        Index of the timeline the others are compared against.
+    regression_factor : float, optional
+        Ratio of wall time to the reference above which an entry is marked
+        as a regression.
+    min_wall_time : float, optional
+        Entries faster than this (in seconds) in every timeline are not
+        marked as regressions.
+
+    Returns
+    -------
+    tab : astropy.table.Table
+        Wall time, fraction of the total run time, largest increase of the
+        peak RSS and ratio to the reference for each entry and timeline. The
+        'regression' column lists the labels of timelines that regressed.
+    '''
+    from astropy.table import Table
+
+    if labels is None:
+        labels = [os.path.basename(name) for name in timeline_files]
+
+    if len(labels) != len(timeline_files):
+        raise ValueError("labels must have the same length as "
+                         "timeline_files.")
+
+    summaries = [summarize_timeline(read_timeline(name), kind=kind)
+                 for name in timeline_files]
+
+    names = []
+    for summ in summaries:
+        for name in summ:
+            if name not in names:
+                names.append(name)
+
+    ref_summ = summaries[reference]
+
+    tab = Table()
+    tab['name'] = names
+
+    regressions = [[] for _ in names]
+
+    for label, summ in zip(labels, summaries):
+        total = sum(val['wall_time'] for val in summ.values())
+
+        walls = [summ[name]['wall_time'] if name in summ else 0.
+                 for name in names]
+        tab['{}_wall'.format(label)] = walls
+        tab['{}_frac'.format(label)] = \
+            [wall / total if total > 0 else 0. for wall in walls]
+        tab['{}_rss_increase_MB'.format(label)] = \
+            [summ[name]['peak_rss_increase'] / 2.**20 if name in summ else 0.
+             for name in names]
+
+        if summ is ref_summ:
+            continue
+
+        ratios = []
+        for i, (name, wall) in enumerate(zip(names, walls)):
+            if name not in ref_summ or ref_summ[name]['wall_time'] == 0.:
+                ratios.append(float('nan'))
+                continue
+            ref_wall = ref_summ[name]['wall_time']
+            ratio = wall / ref_wall
+            ratios.append(ratio)
+            if ratio > regression_factor and \
+                    max(wall, ref_wall) > min_wall_time:
+                regressions[i].append(label)
+
+        tab['{}_ratio'.format(label)] = ratios
+
+    tab['regression'] = [",".join(reg) for reg in regressions]
+
+    # Sort by the reference wall time so the dominant entries are first
+    tab.sort('{}_wall'.format(labels[reference]))
+    tab.reverse()
+
+    return tab
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3:
+        print("Usage: python pipeline_profiling.py ref.jsonl other.jsonl "
+              "[more.jsonl ...]")
+        sys.exit(1)
+
+    for kind in ['stage', 'task']:
+        tab = compare_timelines(sys.argv[1:], kind=kind)
+        print("Per-{} comparison".format(kind))
+        tab.pprint(max_lines=-1, max_width=-1)
@@ -2,7 +2,7 @@
 from spectral_cube import SpectralCube
 from spectral_cube.lower_dimensional_structures import Projection
 from spectral_cube.wcs_utils import drop_axis
-from pvextractor import Path, extract_pv_slice
+from pvextractor import Path
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 from astropy.io import fits
@@ -11,6 +11,8 @@ from aplpy import FITSFigure
 import numpy as np
 import matplotlib.pyplot as p
 
+from pvslice_engine import extract_pv_slices
+
 '''
 Create a PV Slice
 '''
@@ -165,9 +167,11 @@ co21_fig.hide_yaxis_label()
 co21_fig.hide_tick_labels()
 co21_fig.set_title(r"CO(2-1)")
 
-for path, pnum in zip(paths[4:7], [4, 5, 6]):
-        pv = extract_pv_slice(hi_cube, path)
-        pv_co21 = extract_pv_slice(co21_cube, path)
+# Extract the slices of each cube in one pass
+pvs = extract_pv_slices(hi_cube, paths[4:7])
+pvs_co21 = extract_pv_slices(co21_cube, paths[4:7])
+
+for pv, pv_co21, pnum in zip(pvs, pvs_co21, [4, 5, 6]):
 
         pv_fig = FITSFigure(pv, subplot=(2, 3, pnum), figure=fig)
         pv_fig.show_grayscale()
@@ -20,6 +20,7 @@ import matplotlib.pyplot as plt
 
 from plotting_styles import default_figure
 from constants import hi_freq, hi_mass_conversion
+from sky_index import SkyIndex
 # from paths import allfigs_path
 
 
@@ -48,35 +49,30 @@ def distance_map_from_catalogue(gal, tab, header, ra_key="RA", dec_key="Dec",
 
     object_mask = np.zeros_like(coord_map.ra.value, dtype=int)
 
-    # Loop through and mask points belonging at a remnant, or the nearest point
-    for i, co in enumerate(coords):
+    # Index the pixel positions once and find the nearest pixel to every
+    # object in one query
+    grid_index = SkyIndex(coord_map)
 
-        mask_index = np.unravel_index(coord_map.separation(co).argmin(),
-                                      object_mask.shape)
+    nearest_pix = grid_index.nearest(coords)[0]
 
-        if diam_key is not None:
-
-            # Major axis diameter
-
-            diam_rad = (diams[i].to(u.pc) / gal.distance).to(u.dimensionless_unscaled).value * u.rad
-            diam_pix = diam_rad.to(u.deg).value / np.abs(header['CDELT2'])
+    if diam_key is not None:
+        # Gather all pixels within the major axis diameter of each object
+        rad_ang = (0.5 * diams.to(u.pc) / gal.distance).to(u.dimensionless_unscaled).value * u.rad
 
-            # Gather all pixels with a circular region
-            yy, xx = np.mgrid[-(int(diam_pix)//2 + 1):int(diam_pix)//2 + 1,
-                              -(int(diam_pix)//2 + 1):int(diam_pix)//2 + 1]
+        pix_within = grid_index.within(coords, rad_ang)
 
-            # Find all pixels within the diameter
-            valids = np.where(np.sqrt(yy**2 + xx**2) < diam_pix / 2.)
+    # Mask points belonging at a remnant, or the nearest point. Later objects
+    # overwrite earlier ones where they overlap.
+    for i in range(len(coords)):
 
-            y_pts = valids[0] + mask_index[0]
-            x_pts = valids[1] + mask_index[1]
+        mask_index = nearest_pix[i]
 
-            mask_index = (y_pts, x_pts)
+        if diam_key is not None:
+            # Always include the nearest pixel for objects smaller than a
+            # pixel
+            mask_index = np.append(pix_within[i], mask_index)
 
-        object_mask[mask_index] = i + 1
-        # print(object_mask[mask_index])
-        # print(mask_index)
-        # print((object_mask > 0).sum())
+        object_mask.flat[mask_index] = i + 1
 
     dist_transf = nd.distance_transform_edt(~(object_mask > 0))
 
@@ -10,7 +10,6 @@ from astropy.coordinates import SkyCoord
 import os
 from os.path import join as osjoin
 from corner import hist2d, corner
-import emcee
 import matplotlib.pyplot as plt
 import seaborn as sb
 
@@ -22,6 +21,8 @@ from plotting_styles import (default_figure,
                              twocolumn_twopanel_figure,
                              onecolumn_figure)
 from galaxy_params import gal_feath as gal
+from sky_index import nearest_labels
+from eiv_emcee_batch import bayes_linear_batch
 
 
 fig_path = allfigs_path("co_vs_hi")
@@ -52,111 +53,14 @@ cloud_posns = SkyCoord(gmc_tab['RAdeg'], gmc_tab['DEdeg'])
 pix_posns = SkyCoord(tab['RA'], tab['Dec'])
 
 # Just do this for every pixel, even if it's not in the good mask
-cloud_types = []
-for i in range(len(tab)):
-
-    cloud_idx = pix_posns[i].separation(cloud_posns).argmin()
-
-    cloud_types.append(gmc_tab['Type'][cloud_idx])
+cloud_types = nearest_labels(pix_posns, cloud_posns,
+                             labels=gmc_tab['Type'])[0]
 
 cloud_types = Column(cloud_types)
 
 tab.add_column(cloud_types, name='cloud_type')
 
 
-def bayes_linear(x, y, x_err, y_err, nWalkers=10, nBurn=100, nSample=1000,
-                 nThin=5, conf_interval=[15.9, 84.1], fix_intercept=False):
-    '''
-    Fit a line w/ the intercept set to 0.
-    '''
-
-    mean_scatter = np.mean(np.sqrt(x_err**2 + y_err**2))
-    std_scatter = np.std(np.sqrt(x_err**2 + y_err**2))
-
-    if fix_intercept:
-        def _logprob(p, x, y, x_err, y_err):
-            theta, var = p[0], p[1]
-            if np.abs(theta - np.pi / 4) > np.pi / 4:
-                return -np.inf
-            if var < 0:
-                return -np.inf
-
-            Delta = (np.cos(theta) * y - np.sin(theta) * x)**2
-            Sigma = np.sin(theta)**2 * x_err**2 + np.cos(theta)**2 * y_err**2
-            lp = -0.5 * np.nansum(Delta / (Sigma + var)) - \
-                0.5 * np.nansum(np.log(Sigma + var))
-            return lp
-
-        ndim = 2
-
-        p0 = np.zeros((nWalkers, ndim))
-        p0[:, 0] = np.tan(np.nanmean(y / x)) + np.random.randn(nWalkers) * 0.1
-        p0[:, 1] = np.random.normal(mean_scatter, 0.1 * std_scatter,
-                                    size=nWalkers)
-
-    else:
-        def _logprob(p, x, y, x_err, y_err):
-            theta, bcos, var = p[0], p[1], p[2]
-            if np.abs(theta - np.pi / 4) > np.pi / 4:
-                return -np.inf
-            if var < 0:
-                return -np.inf
-
-            Delta = (np.cos(theta) * y - np.sin(theta) * x - bcos)**2
-            Sigma = (np.sin(theta))**2 * x_err**2 + \
-                (np.cos(theta))**2 * y_err**2
-            lp = -0.5 * np.nansum(Delta / (Sigma + var)) - \
-                0.5 * np.nansum(np.log(Sigma + var))
-
-            return lp
-
-        ndim = 3
-        p0 = np.zeros((nWalkers, ndim))
-        p0[:, 0] = np.tan(np.nanmean(y / x)) + np.random.randn(nWalkers) * 0.1
-        p0[:, 1] = np.random.randn(nWalkers) * y.std() + y.mean()
-        p0[:, 2] = np.random.normal(mean_scatter, 0.1 * std_scatter,
-                                    size=nWalkers)
-
-    sampler = emcee.EnsembleSampler(nWalkers, ndim, _logprob,
-                                    args=[x, y, x_err, y_err])
-    pos, prob, state = sampler.run_mcmc(p0, nBurn)
-    sampler.reset()
-    sampler.run_mcmc(pos, nSample, thin=nThin)
-
-    if fix_intercept:
-        slopes = np.tan(sampler.flatchain[:, 0])
-        slope = np.median(slopes)
-
-        var = np.sqrt(sampler.flatchain[:, 1])
-        add_stddev = np.median(var)
-
-        params = np.array([slope, add_stddev])
-        # Use the percentiles given in conf_interval
-        error_intervals = np.empty((2, 2))
-        error_intervals[0] = np.percentile(slopes, conf_interval)
-        error_intervals[1] = np.percentile(var, conf_interval)
-
-    else:
-        slopes = np.tan(sampler.flatchain[:, 0])
-        intercepts = sampler.flatchain[:, 1] / np.cos(sampler.flatchain[:, 0])
-
-        slope = np.median(slopes)
-        intercept = np.median(intercepts)
-
-        var = np.sqrt(sampler.flatchain[:, 1])
-        add_stddev = np.median(var)
-
-        params = np.array([slope, intercept, var])
-
-        # Use the percentiles given in conf_interval
-        error_intervals = np.empty((3, 2))
-        error_intervals[0] = np.percentile(slopes, conf_interval)
-        error_intervals[1] = np.percentile(intercepts, conf_interval)
-        error_intervals[2] = np.percentile(var, conf_interval)
-
-    return params, error_intervals, sampler
-
-
 # Make a single total pop. figure
 onecolumn_figure()
 fig = plt.figure()
@@ -211,27 +115,40 @@ fitted_ratio_errs = []
 intrinsic_scatter = []
 intrinsic_scatter_errs = []
 
-# for c_type, ax in zip(['A', 'B', 'C', 'D'], axs.ravel()):
-for c_type, ax in zip(['A', 'B', 'C'], axs.ravel()):
+# Fit all of the cloud types at once
+# c_types = ['A', 'B', 'C', 'D']
+c_types = ['A', 'B', 'C']
 
-    type_pts = np.logical_and(good_pts,
-                              tab['cloud_type'] == c_type)
+type_masks = [np.logical_and(good_pts, tab['cloud_type'] == c_type)
+              for c_type in c_types]
+
+fit_tab = \
+    bayes_linear_batch([(tab['sigma_HI'][type_pts],
+                         tab['sigma_CO'][type_pts],
+                         tab['sigma_stderr_HI'][type_pts],
+                         tab['sigma_stderr_CO'][type_pts])
+                        for type_pts in type_masks],
+                       names=c_types,
+                       nBurn=500, nSample=2000, nThin=1,
+                       fix_intercept=True, num_cores=len(c_types))
+
+if not fit_tab['converged'].all():
+    print("Chains may be too short for types: {}"
+          .format(list(fit_tab['name'][~fit_tab['converged']])))
 
-    pars_ratio, pars_ratio_ci, sampler_ratio = \
-        bayes_linear(tab['sigma_HI'][type_pts], tab['sigma_CO'][type_pts],
-                     tab['sigma_stderr_HI'][type_pts],
-                     tab['sigma_stderr_CO'][type_pts],
-                     nBurn=500, nSample=2000, nThin=1,
-                     fix_intercept=True)
+for i, (c_type, type_pts, ax) in enumerate(zip(c_types, type_masks,
+                                                 axs.ravel())):
 
-    slope_ratio = pars_ratio[0]
-    slope_ratio_ci = pars_ratio_ci[0]
+    slope_ratio = fit_tab['slope'][i]
+    slope_ratio_ci = np.array([fit_tab['slope_low'][i],
+                               fit_tab['slope_high'][i]])
 
     fitted_ratios.append(slope_ratio)
     fitted_ratio_errs.append(slope_ratio_ci)
 
-    add_stddev_ratio = pars_ratio[1]
-    add_stddev_ratio_ci = pars_ratio_ci[1]
+    add_stddev_ratio = fit_tab['add_stddev'][i]
+    add_stddev_ratio_ci = np.array([fit_tab['add_stddev_low'][i],
+                                    fit_tab['add_stddev_high'][i]])
 
     intrinsic_scatter.append(add_stddev_ratio)
     intrinsic_scatter_errs.append(add_stddev_ratio_ci)
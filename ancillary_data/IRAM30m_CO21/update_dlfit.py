@@ -17,25 +17,30 @@ from os.path import join as osjoin
 
 from paths import iram_co21_data_path, data_path, fourteenB_wGBT_HI_file_dict
 from constants import hi_freq, beam_eff_30m_druard
+from resolution_pyramid import ResolutionPyramid
 
 tab = Table.read(osjoin(data_path, "dlfit.fits"))
 
-co21_mom0 = Projection.from_hdu(fits.open(iram_co21_data_path("m33.co21_iram.mom0.fits"))[0])
+# Smoothed maps are cached and shared with other scripts
+pyramid = ResolutionPyramid(osjoin(data_path, "resolution_pyramid"))
+pyramid.register("co21_mom0", iram_co21_data_path("m33.co21_iram.mom0.fits"))
+pyramid.register("hi_mom0", fourteenB_wGBT_HI_file_dict['Moment0'])
+
 co21_rms = Projection.from_hdu(fits.open(iram_co21_data_path("m33.rms.masked.fits"))[0])
 
-hi_mom0 = Projection.from_hdu(fits.open(fourteenB_wGBT_HI_file_dict['Moment0'])[0])
+hi_mom0 = pyramid.get("hi_mom0")
 
 
 # Convolve to the lowest resolution used for the fits: 500 um Herschel
 # Actually @low-sky used a 60'' beam for the Draine model fitting
 beam = Beam(60. * u.arcsec)
 
-smooth_co21 = co21_mom0.convolve_to(beam)
+smooth_co21 = pyramid.get("co21_mom0", beam=beam)
 # Remove regions outside of the original map extent
 smooth_co21[np.isnan(co21_rms)] = np.NaN
 
 # And the HI
-smooth_hi = hi_mom0.convolve_to(beam)
+smooth_hi = pyramid.get("hi_mom0", beam=beam)
 
 # Now convert HI from Jy m / s to K km / s
 smooth_hi = (smooth_hi.value * beam.jtok(hi_freq) / 1000.) * u.km / u.s
@@ -0,0 +1,246 @@
+
+'''
+Shared, lazily opened handles to the data products.
+
+`ProductRegistry` wraps one of the dictionaries of product names from
+`paths` (e.g., `fourteenB_HI_file_dict`). Products are only opened when they
+are first requested, with the FITS data memory-mapped, and the opened cubes,
+maps and masks are kept so every analysis in the same process shares them.
+Handles are keyed by the file name, so registries that point to the same file
+share its handle as well.
+
+Headers are kept in a small on-disk index with the size and modification
+time of each file. Headers, shapes, units and beams come from the index
+without opening the FITS files again in later sessions.
+'''
+
+import os
+import json
+import astropy.units as u
+from astropy.io import fits
+from radio_beam import Beam
+from spectral_cube import SpectralCube, Projection
+
+from paths import (data_path, fourteenB_HI_file_dict,
+                   fourteenB_wGBT_HI_file_dict,
+                   seventeenB_02kms_HI_file_dict,
+                   seventeenB_02kms_wGBT_HI_file_dict,
+                   seventeenB_1kms_HI_file_dict,
+                   seventeenB_1kms_wGBT_HI_file_dict)
+
+
+default_index_file = os.path.join(data_path, "product_index.json")
+
+# Handles shared by all registries in this process
+_handles = dict()
+_indices = dict()
+
+
+class _HeaderIndex(object):
+    '''
+    On-disk index of FITS headers, kept up to date with the file size and
+    modification time.
+    '''
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self._headers = {}
+
+        if os.path.exists(index_file):
+            with open(index_file, 'r') as f:
+                self._entries = json.load(f)
+        else:
+            self._entries = {}
+
+    def _write(self):
+        folder = os.path.dirname(self.index_file)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        tmp_name = self.index_file + ".tmp"
+        with open(tmp_name, 'w') as f:
+            json.dump(self._entries, f)
+        os.rename(tmp_name, self.index_file)
+
+    def header(self, filename):
+        stat = os.stat(filename)
+        file_id = [stat.st_size, stat.st_mtime]
+
+        entry = self._entries.get(filename)
+
+        if entry is not None and entry[:2] == file_id:
+            if filename not in self._headers:
+                self._headers[filename] = fits.Header.fromstring(entry[2])
+            return self._headers[filename]
+
+        header = fits.getheader(filename)
+
+        self._entries[filename] = file_id + [header.tostring()]
+        self._headers[filename] = header
+
+        try:
+            self._write()
+        except (IOError, OSError):
+            # The index is only a cache
+            pass
+
+        return header
+
+
+def _equivalency_key(equivalencies):
+    '''
+    Hashable key of a list of unit equivalencies. astropy `Equivalency`
+    lists are keyed by their names and arguments, so equal equivalencies
+    made in separate calls share a key. Other lists are keyed by their units
+    and conversion functions.
+    '''
+    if equivalencies is None:
+        return None
+
+    if hasattr(equivalencies, 'name') and hasattr(equivalencies, 'kwargs'):
+        return (tuple(equivalencies.name), repr(equivalencies.kwargs))
+
+    return tuple((str(equiv[0]), str(equiv[1])) + tuple(equiv[2:])
+                 for equiv in equivalencies)
+
+
+def _header_index(index_file):
+    if index_file not in _indices:
+        _indices[index_file] = _HeaderIndex(index_file)
+    return _indices[index_file]
+
+
+class ProductRegistry(object):
+    '''
+    Lazily opened, cached data products.
+
+    Parameters
+    ----------
+    file_dict : dict
+        Product names and file names, as made by
+        `paths.find_dataproduct_names`.
+    index_file : str, optional
+        JSON file with the header index.
+    '''
+    def __init__(self, file_dict, index_file=default_index_file):
+        self.file_dict = file_dict
+        self._index = _header_index(index_file)
+
+    def __contains__(self, key):
+        return key in self.file_dict
+
+    def keys(self):
+        return self.file_dict.keys()
+
+    def path(self, key):
+        if key not in self.file_dict:
+            raise KeyError("No {} product was found.".format(key))
+        return os.path.abspath(self.file_dict[key])
+
+    def header(self, key):
+        '''
+        Header of a product, from the index when the file is unchanged.
+        '''
+        return self._index.header(self.path(key))
+
+    def shape(self, key):
+        header = self.header(key)
+        return tuple(header['NAXIS{}'.format(i)]
+                     for i in range(header['NAXIS'], 0, -1))
+
+    def unit(self, key):
+        return u.Unit(self.header(key).get('BUNIT', ''), parse_strict='warn')
+
+    def beam(self, key):
+        '''
+        Beam from the header. Cubes with a table of beams use their common
+        beam.
+        '''
+        header = self.header(key)
+
+        if 'BMAJ' in header:
+            try:
+                return Beam.from_fits_header(header)
+            except (KeyError, ValueError):
+                pass
+
+        cube = self.cube(key)
+        if hasattr(cube, 'beams'):
+            return cube.beams.common_beam()
+        return cube.beam
+
+    def _shared(self, key, kind, opener):
+        handle_key = (self.path(key), kind)
+        if handle_key not in _handles:
+            _handles[handle_key] = opener(self.path(key))
+        return _handles[handle_key]
+
+    def hdu(self, key):
+        '''
+        Memory-mapped HDU of a product.
+        '''
+        return self._shared(key, 'hdu',
+                            lambda name: fits.open(name, memmap=True)[0])
+
+    def cube(self, key, mask_key=None):
+        '''
+        Memory-mapped SpectralCube. `mask_key` names a mask product (e.g.,
+        "Source_Mask") to apply.
+        '''
+        cube = self._shared(key, 'cube', SpectralCube.read)
+
+        if mask_key is not None:
+            cube = cube.with_mask(self.mask(mask_key))
+
+        return cube
+
+    def mask(self, key):
+        '''
+        Boolean array of a mask product (values > 0).
+        '''
+        return self._shared(key, 'mask',
+                            lambda name: self.hdu(key).data > 0)
+
+    def projection(self, key, unit=None, equivalencies=None):
+        '''
+        2D product as a Projection, optionally converted to `unit` with
+        `equivalencies`.
+        '''
+        proj = self._shared(key, 'projection',
+                            lambda name: Projection.from_hdu(self.hdu(key)))
+
+        if unit is None:
+            return proj
+
+        unit = u.Unit(unit)
+        if proj.unit == unit:
+            return proj
+
+        if equivalencies is None:
+            equivalencies = []
+
+        return self._shared(key, ('projection', unit.to_string(),
+                                  _equivalency_key(equivalencies)),
+                            lambda name: proj.to(unit,
+                                                 equivalencies=equivalencies))
+
+    def __getitem__(self, key):
+        '''
+        Cube or Projection of a product, depending on its shape.
+        '''
+        is_cube = len([size for size in self.shape(key) if size > 1]) > 2
+
+        if is_cube:
+            return self.cube(key)
+        return self.projection(key)
+
+
+fourteenB_HI_products = ProductRegistry(fourteenB_HI_file_dict)
+fourteenB_wGBT_HI_products = ProductRegistry(fourteenB_wGBT_HI_file_dict)
+
+seventeenB_02kms_HI_products = ProductRegistry(seventeenB_02kms_HI_file_dict)
+seventeenB_02kms_wGBT_HI_products = \
+    ProductRegistry(seventeenB_02kms_wGBT_HI_file_dict)
+
+seventeenB_1kms_HI_products = ProductRegistry(seventeenB_1kms_HI_file_dict)
+seventeenB_1kms_wGBT_HI_products = \
+    ProductRegistry(seventeenB_1kms_wGBT_HI_file_dict)
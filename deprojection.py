@@ -0,0 +1,364 @@
+
+'''
+Deproject cubes into the galaxy frame with a cached pixel mapping.
+
+Each position in the deprojected image is found on the sky by shrinking its
+offset from the galaxy centre along the minor axis by cos(inclination); the
+offset along the major axis is unchanged. The deprojected image keeps the
+orientation and pixel size of the input, so only the minor-axis direction is
+stretched. The input pixel of every output pixel only depends on the
+celestial grid and the galaxy parameters, so the mapping is computed once and
+stored as sparse interpolation weights (see `reprojection_weights`), in
+memory and optionally on disk. Deprojecting a channel is then one sparse
+matrix product, and aligned cubes and masks share the same weights.
+
+Blocks of channels are run in a process pool and written straight into the
+pre-allocated output FITS file, which already has the deprojected beam in its
+header.
+'''
+
+import os
+import hashlib
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.coordinates import SkyCoord
+from astropy.wcs.utils import skycoord_to_pixel, proj_plane_pixel_scales
+from astropy.utils.console import ProgressBar
+from multiprocessing import Pool
+from radio_beam import Beam
+from spectral_cube import SpectralCube
+
+from cube_analysis.io_utils import create_huge_fits
+
+from reprojection_weights import ReprojectionMatrix
+from sd_regrid import cube_hdu_data
+
+
+_matrix_cache = dict()
+_worker_state = dict()
+
+
+def deprojected_beam(beam, gal):
+    '''
+    Beam of a deprojected cube. The major axis of the beam is stretched along
+    the minor axis of the galaxy.
+    '''
+    return Beam(major=beam.major / np.cos(gal.inclination),
+                minor=beam.major,
+                pa=gal.position_angle + 90 * u.deg)
+
+
+def _galaxy_axes(wcs, gal):
+    '''
+    Pixel position of the galaxy centre and the unit vector of the major
+    axis in pixel coordinates.
+    '''
+    centre = gal.center_position
+
+    cent_pix = np.array(skycoord_to_pixel(centre, wcs), dtype=float)
+
+    # Small step along the position angle (east of north)
+    step = proj_plane_pixel_scales(wcs).min()
+    pa = gal.position_angle.to(u.rad).value
+
+    lon = centre.spherical.lon.deg
+    lat = centre.spherical.lat.deg
+
+    offset = SkyCoord(lon + step * np.sin(pa) / np.cos(np.deg2rad(lat)),
+                      lat + step * np.cos(pa), unit=u.deg,
+                      frame=centre.frame.replicate_without_data())
+
+    major = np.array(skycoord_to_pixel(offset, wcs), dtype=float) - cent_pix
+    major /= np.sqrt((major**2).sum())
+
+    return cent_pix, major
+
+
+def deprojection_grid(header, gal):
+    '''
+    Geometry of the deprojected grid.
+
+    Parameters
+    ----------
+    header : astropy.io.fits.Header
+        Header of the input map or cube.
+    gal : galaxies.Galaxy
+        Galaxy with `center_position`, `position_angle` and `inclination`.
+
+    Returns
+    -------
+    grid : dict
+        The input and output shapes, the pixel positions of the galaxy
+        centre in each, the major axis direction, and the cosine of the
+        inclination.
+    '''
+    wcs = WCS(header).celestial
+
+    shape_in = (header['NAXIS2'], header['NAXIS1'])
+
+    cent_pix, major = _galaxy_axes(wcs, gal)
+    minor = np.array([-major[1], major[0]])
+
+    cos_inc = np.cos(gal.inclination.to(u.rad).value)
+
+    # Forward map the input corners to find the deprojected extent
+    corners = np.array([[0, 0], [shape_in[1] - 1, 0],
+                        [0, shape_in[0] - 1],
+                        [shape_in[1] - 1, shape_in[0] - 1]], dtype=float)
+    offsets = corners - cent_pix
+    out_offsets = np.outer(offsets.dot(major), major) + \
+        np.outer(offsets.dot(minor) / cos_inc, minor)
+
+    lower = np.floor(out_offsets.min(0))
+    upper = np.ceil(out_offsets.max(0))
+
+    shape_out = (int(upper[1] - lower[1]) + 1, int(upper[0] - lower[0]) + 1)
+
+    return {'shape_in': shape_in, 'shape_out': shape_out,
+            'cent_in': cent_pix, 'cent_out': -lower,
+            'major': major, 'cos_inc': cos_inc}
+
+
+def deprojection_matrix(header, gal, nearest=False, cache_dir=None):
+    '''
+    Return the deprojection weights for a grid and a galaxy, computing them
+    only if they are not in the memory cache or in `cache_dir`.
+
+    Parameters
+    ----------
+    header : astropy.io.fits.Header
+        Header of the input map or cube.
+    gal : galaxies.Galaxy
+        Galaxy with `center_position`, `position_angle` and `inclination`.
+    nearest : bool, optional
+        Use the nearest input pixel (e.g., for masks) instead of bilinear
+        interpolation.
+    cache_dir : str, optional
+        Folder to save and load the weights.
+
+    Returns
+    -------
+    weights : reprojection_weights.ReprojectionMatrix
+    grid : dict
+        See `deprojection_grid`.
+    '''
+    grid = deprojection_grid(header, gal)
+
+    key_str = "|".join([WCS(header).celestial.to_header_string(),
+                        str(grid['shape_in']),
+                        str(gal.center_position.to_string('decimal',
+                                                          precision=8)),
+                        "{0:.8f}".format(gal.position_angle.to(u.deg).value),
+                        "{0:.8f}".format(gal.inclination.to(u.deg).value),
+                        str(nearest)])
+    key = hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+    if key in _matrix_cache:
+        return _matrix_cache[key], grid
+
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, "deproj_weights_{}.npz".format(key))
+
+    if cache_dir is not None and os.path.exists(filename):
+        weights = ReprojectionMatrix.load(filename)
+    else:
+        major = grid['major']
+        minor = np.array([-major[1], major[0]])
+
+        yy, xx = np.indices(grid['shape_out'])
+        dx = xx.ravel() - grid['cent_out'][0]
+        dy = yy.ravel() - grid['cent_out'][1]
+
+        # Shrink the minor-axis offsets back onto the sky
+        along = dx * major[0] + dy * major[1]
+        across = (dx * minor[0] + dy * minor[1]) * grid['cos_inc']
+
+        x_in = grid['cent_in'][0] + along * major[0] + across * minor[0]
+        y_in = grid['cent_in'][1] + along * major[1] + across * minor[1]
+
+        weights = ReprojectionMatrix.from_pixel_coords(x_in, y_in,
+                                                       grid['shape_in'],
+                                                       grid['shape_out'],
+                                                       nearest=nearest)
+        if cache_dir is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            weights.save(filename)
+
+    _matrix_cache[key] = weights
+
+    return weights, grid
+
+
+def _init_worker(input_file, output_file, output_offset, output_shape,
+                 weights, slices, chan_offset, is_mask):
+    '''
+    Open the input and output once in each worker.
+    '''
+    _worker_state['input'] = cube_hdu_data(fits.open(input_file,
+                                                     mode='denywrite')[0])
+    _worker_state['output'] = np.memmap(output_file, dtype='>f4', mode='r+',
+                                        offset=output_offset,
+                                        shape=output_shape)
+    _worker_state['weights'] = weights
+    _worker_state['slices'] = slices
+    _worker_state['chan_offset'] = chan_offset
+    _worker_state['is_mask'] = is_mask
+
+
+def _deproject_block(chans):
+    '''
+    Deproject a block of channels and write them to the output.
+    '''
+    weights = _worker_state['weights']
+    yslice, xslice = _worker_state['slices']
+    offset = _worker_state['chan_offset']
+
+    slab = np.asarray(_worker_state['input'][chans.start + offset:
+                                             chans.stop + offset,
+                                             yslice, xslice], dtype=float)
+
+    if _worker_state['is_mask']:
+        slab = (np.nan_to_num(slab) > 0).astype(float)
+
+    slab = slab.reshape((chans.stop - chans.start, -1))
+
+    out = weights.matrix.dot(slab.T).T
+    out[:, ~weights.valid] = 0. if _worker_state['is_mask'] else np.NaN
+
+    output = _worker_state['output']
+    output[chans.start:chans.stop] = \
+        out.reshape((-1,) + weights.shape_out).astype(np.float32)
+    output.flush()
+
+    return chans
+
+
+def deproject_cube(input_file, output_file, gal, spectral_slice=None,
+                   is_mask=False, chunk=8, num_cores=1, cache_dir=None,
+                   verbose=True):
+    '''
+    Deproject a cube (or a cube mask) into the galaxy frame.
+
+    Parameters
+    ----------
+    input_file : str
+        FITS file of the cube.
+    output_file : str
+        Name of the output FITS file.
+    gal : galaxies.Galaxy
+        Galaxy with `center_position`, `position_angle` and `inclination`.
+    spectral_slice : slice, optional
+        Range of channels to deproject. Defaults to all channels.
+    is_mask : bool, optional
+        The input is a mask. Nearest-neighbour weights are used and the
+        output is 1 within the mask and 0 elsewhere.
+    chunk : int, optional
+        Number of channels in each block.
+    num_cores : int, optional
+        Number of processes.
+    cache_dir : str, optional
+        Folder to save the deprojection weights in.
+    verbose : bool, optional
+        Show a progress bar.
+    '''
+    header = fits.getheader(input_file)
+
+    nchan = header['NAXIS3']
+
+    if spectral_slice is None:
+        spectral_slice = slice(None)
+    start, stop, step = spectral_slice.indices(nchan)
+    if step != 1:
+        raise ValueError("spectral_slice must have a step of 1.")
+
+    weights, grid = deprojection_matrix(header, gal, nearest=is_mask,
+                                        cache_dir=cache_dir)
+    # Only read the part of the input that is used
+    slices, weights = weights.crop_input()
+
+    wcs = WCS(header).celestial
+    cent_world = wcs.wcs_pix2world(grid['cent_in'][0], grid['cent_in'][1], 0)
+
+    output_header = header.copy()
+    output_header['NAXIS1'] = grid['shape_out'][1]
+    output_header['NAXIS2'] = grid['shape_out'][0]
+    output_header['NAXIS3'] = stop - start
+    output_header['CRPIX1'] = grid['cent_out'][0] + 1
+    output_header['CRPIX2'] = grid['cent_out'][1] + 1
+    output_header['CRVAL1'] = float(cent_world[0])
+    output_header['CRVAL2'] = float(cent_world[1])
+    output_header['CRPIX3'] = header['CRPIX3'] - start
+    output_header['BITPIX'] = -32
+    for key in ['BSCALE', 'BZERO', 'BLANK']:
+        if key in output_header:
+            del output_header[key]
+
+    if not is_mask:
+        cube = SpectralCube.read(input_file)
+        if hasattr(cube, 'beams'):
+            raise ValueError("The cube must have a single beam.")
+        output_header.update(deprojected_beam(cube.beam,
+                                              gal).to_header_keywords())
+        del cube
+
+    output_shape = (stop - start,) + grid['shape_out']
+
+    create_huge_fits(output_file, output_header)
+
+    with fits.open(output_file) as hdulist:
+        output_offset = hdulist.fileinfo(0)['datLoc']
+
+    init_args = (input_file, output_file, output_offset, output_shape,
+                 weights, slices, start, is_mask)
+
+    blocks = [slice(chan, min(chan + chunk, output_shape[0]))
+              for chan in range(0, output_shape[0], chunk)]
+
+    if verbose:
+        pbar = ProgressBar(len(blocks))
+
+    if num_cores > 1:
+        pool = Pool(num_cores, initializer=_init_worker, initargs=init_args)
+        try:
+            for _ in pool.imap_unordered(_deproject_block, blocks):
+                if verbose:
+                    pbar.update()
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(*init_args)
+        for block in blocks:
+            _deproject_block(block)
+            if verbose:
+                pbar.update()
+
+    _worker_state.clear()
+
+
+def deproject_cubes(input_files, output_files, gal, mask_files=None,
+                    mask_output_files=None, **kwargs):
+    '''
+    Deproject several aligned cubes and masks, reusing the deprojection
+    weights. Keywords are passed to `deproject_cube`.
+    '''
+    if len(input_files) != len(output_files):
+        raise ValueError("input_files and output_files must have the same "
+                         "length.")
+
+    for input_file, output_file in zip(input_files, output_files):
+        deproject_cube(input_file, output_file, gal, is_mask=False, **kwargs)
+
+    if mask_files is None:
+        return
+
+    if mask_output_files is None or \
+            len(mask_files) != len(mask_output_files):
+        raise ValueError("mask_output_files must be given for each of the "
+                         "mask_files.")
+
+    for input_file, output_file in zip(mask_files, mask_output_files):
+        deproject_cube(input_file, output_file, gal, is_mask=True, **kwargs)
@@ -0,0 +1,235 @@
+
+'''
+Batches of errors-in-variables linear fits with emcee.
+
+This follows the model of `bayes_linear` in `cube_analysis.eiv_emcee`: the
+line is parametrized by its angle theta and the perpendicular offset
+b cos(theta), and an additional variance in the direction perpendicular to
+the line accounts for intrinsic scatter. The log-likelihood is evaluated for
+all walkers at once, and the independent fits are run in a process pool. The
+results are returned in one table with a row per fit.
+'''
+
+import numpy as np
+from astropy.table import Table
+from multiprocessing import Pool
+
+import emcee
+
+from mcmc_utils import integrated_autocorr_time, get_chain
+
+
+def log_prob(p, x, y, x_err, y_err, fix_intercept=False):
+    '''
+    Log-likelihood of the line parameters. `p` can be a single set of
+    parameters or an array of shape (nwalkers, ndim).
+
+    Parameters
+    ----------
+    p : np.ndarray
+        [theta, var] when `fix_intercept` is True, otherwise
+        [theta, bcos, var].
+    x, y, x_err, y_err : np.ndarray
+        Data and uncertainties.
+    fix_intercept : bool, optional
+        Fix the intercept to zero.
+
+    Returns
+    -------
+    lp : float or np.ndarray
+        Log-likelihood of each set of parameters.
+    '''
+    p = np.asarray(p, dtype=float)
+    single = p.ndim == 1
+    p = np.atleast_2d(p)
+
+    theta = p[:, :1]
+    var = p[:, -1:]
+
+    if fix_intercept:
+        bcos = 0.
+    else:
+        bcos = p[:, 1:2]
+
+    outside = (np.abs(theta[:, 0] - np.pi / 4) > np.pi / 4) | (var[:, 0] < 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Delta = (np.cos(theta) * y - np.sin(theta) * x - bcos)**2
+        Sigma = np.sin(theta)**2 * x_err**2 + np.cos(theta)**2 * y_err**2
+        lp = -0.5 * np.nansum(Delta / (Sigma + var), axis=1) - \
+            0.5 * np.nansum(np.log(Sigma + var), axis=1)
+
+    lp[outside] = -np.inf
+
+    if single:
+        return lp[0]
+
+    return lp
+
+
+def _fit_one(args):
+    '''
+    Run the sampler for one dataset and summarize the posteriors.
+    '''
+
+    (i, x, y, x_err, y_err, nWalkers, nBurn, nSample, nThin, conf_interval,
+     fix_intercept, seed, return_chain) = args
+
+    rng = np.random.RandomState(seed)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x_err = np.asarray(x_err, dtype=float)
+    y_err = np.asarray(y_err, dtype=float)
+
+    mean_scatter = np.mean(np.sqrt(x_err**2 + y_err**2))
+    std_scatter = np.std(np.sqrt(x_err**2 + y_err**2))
+
+    ndim = 2 if fix_intercept else 3
+
+    p0 = np.zeros((nWalkers, ndim))
+    p0[:, 0] = np.tan(np.nanmean(y / x)) + rng.randn(nWalkers) * 0.1
+    if not fix_intercept:
+        p0[:, 1] = rng.randn(nWalkers) * y.std() + y.mean()
+    # Keep the walkers independent when the uncertainties are all equal
+    p0[:, -1] = rng.normal(mean_scatter,
+                           max(0.1 * std_scatter, 0.01 * mean_scatter),
+                           size=nWalkers)
+
+    sampler_kwargs = {}
+    if int(emcee.__version__.split('.')[0]) >= 3:
+        # Evaluate all walkers in one call
+        sampler_kwargs['vectorize'] = True
+
+    sampler = emcee.EnsembleSampler(nWalkers, ndim, log_prob,
+                                    args=[x, y, x_err, y_err],
+                                    kwargs={'fix_intercept': fix_intercept},
+                                    **sampler_kwargs)
+    sampler.random_state = rng.get_state()
+
+    sampler.run_mcmc(p0, nBurn)
+    pos = get_chain(sampler)[-1]
+    sampler.reset()
+    sampler.run_mcmc(pos, nSample)
+
+    chain = get_chain(sampler)
+    tau = integrated_autocorr_time(chain)
+
+    flatchain = chain[::nThin].reshape((-1, ndim))
+
+    samples = {'slope': np.tan(flatchain[:, 0])}
+    if not fix_intercept:
+        samples['intercept'] = flatchain[:, 1] / np.cos(flatchain[:, 0])
+    samples['add_stddev'] = np.sqrt(flatchain[:, -1])
+
+    out = {'index': i,
+           'npts': int(np.isfinite(x * y).sum()),
+           'acceptance_fraction': np.mean(sampler.acceptance_fraction),
+           'max_autocorr_time': np.nanmax(tau),
+           'nsample_per_autocorr': nSample / np.nanmax(tau)}
+
+    for name in samples:
+        out[name] = np.median(samples[name])
+        out[name + '_low'], out[name + '_high'] = \
+            np.percentile(samples[name], conf_interval)
+
+    if return_chain:
+        out['flatchain'] = flatchain
+
+    return out
+
+
+def bayes_linear_batch(datasets, names=None, nWalkers=10, nBurn=100,
+                       nSample=1000, nThin=5, conf_interval=[15.9, 84.1],
+                       fix_intercept=False, num_cores=1, seed=None,
+                       min_autocorr_ratio=50, return_chains=False):
+    '''
+    Fit lines to many datasets with errors in both variables.
+
+    Parameters
+    ----------
+    datasets : list
+        (x, y, x_err, y_err) for each fit.
+    names : list, optional
+        Name of each fit. Defaults to the index.
+    nWalkers : int, optional
+        Number of walkers.
+    nBurn : int, optional
+        Number of burn-in steps.
+    nSample : int, optional
+        Number of production steps.
+    nThin : int, optional
+        Thinning of the chains used for the posteriors.
+    conf_interval : list, optional
+        Percentiles given as the lower and upper bounds.
+    fix_intercept : bool, optional
+        Fix the intercept to zero.
+    num_cores : int, optional
+        Number of processes to run the fits in.
+    seed : int, optional
+        Seed for the random states. Fit i uses `seed + i`.
+    min_autocorr_ratio : float, optional
+        Fits with fewer than this many production steps per
+        autocorrelation time are flagged as not converged.
+    return_chains : bool, optional
+        Also return the thinned, flattened chains of each fit.
+
+    Returns
+    -------
+    results : astropy.table.Table
+        One row per fit with the median and `conf_interval` bounds of the
+        slope, intercept (if fit) and additional scatter, and the mean
+        acceptance fraction, the longest autocorrelation time and whether
+        the chain is long enough for it.
+    chains : list
+        The flattened chains of each fit when `return_chains` is True.
+    '''
+
+    if names is None:
+        names = [str(i) for i in range(len(datasets))]
+
+    if len(names) != len(datasets):
+        raise ValueError("names must have one entry per dataset.")
+
+    if seed is None:
+        seeds = np.random.randint(0, 2**31 - 1, size=len(datasets))
+    else:
+        seeds = seed + np.arange(len(datasets))
+
+    tasks = [(i,) + tuple(data) + (nWalkers, nBurn, nSample, nThin,
+                                   conf_interval, fix_intercept, seeds[i],
+                                   return_chains)
+             for i, data in enumerate(datasets)]
+
+    if num_cores > 1 and len(tasks) > 1:
+        pool = Pool(min(num_cores, len(tasks)))
+        try:
+            outputs = pool.map(_fit_one, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outputs = [_fit_one(task) for task in tasks]
+
+    outputs = sorted(outputs, key=lambda out: out['index'])
+
+    params = ['slope', 'add_stddev'] if fix_intercept else \
+        ['slope', 'intercept', 'add_stddev']
+
+    colnames = ['name', 'npts']
+    for par in params:
+        colnames.extend([par, par + '_low', par + '_high'])
+    colnames.extend(['acceptance_fraction', 'max_autocorr_time',
+                     'nsample_per_autocorr'])
+
+    results = Table([[names[out['index']] for out in outputs]] +
+                    [[out[col] for out in outputs] for col in colnames[1:]],
+                    names=colnames)
+
+    results['converged'] = results['nsample_per_autocorr'] >= \
+        min_autocorr_ratio
+
+    if return_chains:
+        return results, [out['flatchain'] for out in outputs]
+
+    return results
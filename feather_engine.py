@@ -0,0 +1,388 @@
+
+'''
+Feather interferometer cubes with single-dish cubes that are on the same grid.
+
+This follows `uvcombine.feather_simple` with its default settings: the
+Fourier transform of the high-resolution plane is weighted by one minus the
+Fourier transform of the low-resolution beam and added to the low-resolution
+plane. The weights only depend on the low-resolution beam and the pixel grid,
+and the unit conversion only on the pair of beams, so both are computed once
+for the cube instead of for every channel.
+
+Since the low-resolution plane is not weighted, only the high-resolution
+plane needs to be transformed. Blocks of channels are transformed together
+(multi-threaded with pyfftw or scipy.fft when available), the blocks are run
+in a process pool, and each block is written straight into the pre-allocated
+output FITS file.
+
+`feather_cubes` combines one interferometer cube with several single-dish
+cubes in the same pass: each interferometer block is read and transformed
+once, then combined with every single-dish cube and written to each output.
+'''
+
+import os
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs.utils import proj_plane_pixel_scales
+from astropy.utils.console import ProgressBar
+from multiprocessing import Pool
+from spectral_cube import SpectralCube
+
+from cube_analysis.io_utils import create_huge_fits
+
+from sd_regrid import cube_hdu_data
+
+try:
+    import pyfftw
+    from pyfftw.interfaces.numpy_fft import rfft2, irfft2
+    pyfftw.interfaces.cache.enable()
+    _threads_kwarg = 'threads'
+except ImportError:
+    try:
+        from scipy.fft import rfft2, irfft2
+        _threads_kwarg = 'workers'
+    except ImportError:
+        from numpy.fft import rfft2, irfft2
+        _threads_kwarg = None
+
+
+_weight_cache = dict()
+_worker_state = dict()
+
+
+def _fft_kwargs(threads):
+    if _threads_kwarg is None or threads is None:
+        return {}
+    return {_threads_kwarg: threads}
+
+
+def feather_weights(shape, lowresfwhm, pixscale):
+    '''
+    Fourier-domain weights of the high-resolution data for `rfft2`, as in
+    `uvcombine.feather_kernel`. The weights are cached for each grid and
+    low-resolution beam.
+
+    Parameters
+    ----------
+    shape : tuple
+        Spatial shape of the grid.
+    lowresfwhm : astropy.units.Quantity
+        FWHM of the low-resolution beam.
+    pixscale : astropy.units.Quantity
+        Pixel size.
+
+    Returns
+    -------
+    ikfft : np.ndarray
+        One minus the normalized transform of the low-resolution beam, with
+        shape (shape[0], shape[1] // 2 + 1).
+    '''
+    sigma = (lowresfwhm / np.sqrt(8 * np.log(2)) / pixscale).decompose().value
+
+    key = (tuple(shape), round(sigma, 6))
+
+    if key in _weight_cache:
+        return _weight_cache[key]
+
+    nax2, nax1 = shape
+
+    ygrid, xgrid = (np.indices([nax2, nax1]) -
+                    np.array([(nax2 - 1.) / 2, (nax1 - 1.) / 2.])[:, None, None])
+
+    kernel = np.fft.fftshift(np.exp(-(xgrid**2 + ygrid**2) / (2 * sigma**2)))
+
+    kfft = np.abs(np.fft.rfft2(kernel))
+    kfft /= kfft.max()
+
+    ikfft = 1 - kfft
+
+    _weight_cache[key] = ikfft
+
+    return ikfft
+
+
+def lowres_unit_factor(cube_hi, cube_lo, restfreq=None):
+    '''
+    Factors that convert each channel of `cube_lo` to the units of
+    `cube_hi`. Per-beam units are converted to the high-resolution beam, as
+    in `uvcombine.feather_simple`.
+
+    Returns
+    -------
+    factors : np.ndarray
+        One factor per channel.
+    '''
+    jybm = u.Jy / u.beam
+
+    nchan = cube_hi.shape[0]
+
+    if hasattr(cube_hi, 'beams'):
+        beams_hi = list(cube_hi.beams)
+    else:
+        beams_hi = [cube_hi.beam] * nchan
+
+    if restfreq is None:
+        restfreq = cube_hi.header.get('RESTFRQ', cube_hi.header.get('RESTFREQ'))
+        if restfreq is not None:
+            restfreq = restfreq * u.Hz
+
+    def jtok(beam):
+        if restfreq is None:
+            raise ValueError("restfreq is needed to convert between K and "
+                             "Jy/beam.")
+        return beam.jtok(restfreq).value
+
+    unit_hi = cube_hi.unit
+    unit_lo = cube_lo.unit
+
+    if unit_hi.is_equivalent(jybm) and unit_lo.is_equivalent(jybm):
+        scale = unit_lo.to(unit_hi)
+        return np.array([scale * (beam.sr / cube_lo.beam.sr).decompose().value
+                         for beam in beams_hi])
+    elif unit_hi.is_equivalent(jybm) and unit_lo.is_equivalent(u.K):
+        scale = unit_lo.to(u.K) * jybm.to(unit_hi)
+        return np.array([scale / jtok(beam) for beam in beams_hi])
+    elif unit_hi.is_equivalent(u.K) and unit_lo.is_equivalent(jybm):
+        scale = unit_lo.to(jybm) * jtok(cube_lo.beam) * u.K.to(unit_hi)
+        return np.ones(nchan) * scale
+    elif unit_lo.is_equivalent(unit_hi):
+        return np.ones(nchan) * unit_lo.to(unit_hi)
+
+    raise ValueError("Brightness units are not equivalent: hires: {0}; "
+                     "lowres: {1}".format(unit_hi, unit_lo))
+
+
+def _check_spectral_axes(cube_hi, cube_lo, spec_rtol):
+    '''
+    The spectral axes must agree to `spec_rtol` times the channel width.
+    '''
+    spec_hi = cube_hi.spectral_axis
+    spec_lo = cube_lo.spectral_axis.to(spec_hi.unit)
+
+    if spec_hi.size == 1:
+        return
+
+    chan_width = np.abs(np.diff(spec_hi.value)).min()
+
+    if np.any(np.abs(spec_hi.value - spec_lo.value) > spec_rtol * chan_width):
+        raise ValueError("The spectral axes of the cubes differ by more than"
+                         " {0} of the channel width.".format(spec_rtol))
+
+
+def _init_worker(hi_file, lo_files, pb_file, output_files, output_offsets,
+                 ikffts, factors, weights, highresscalefactor,
+                 lowresscalefactor, fft_threads):
+    '''
+    Open the cubes and the outputs once in each worker.
+    '''
+    _worker_state['hi'] = cube_hdu_data(fits.open(hi_file,
+                                                  mode='denywrite')[0])
+    _worker_state['lo'] = [cube_hdu_data(fits.open(lo_file,
+                                                   mode='denywrite')[0])
+                           for lo_file in lo_files]
+
+    if isinstance(pb_file, str):
+        _worker_state['pb'] = cube_hdu_data(fits.open(pb_file,
+                                                      mode='denywrite')[0])
+    else:
+        _worker_state['pb'] = pb_file
+
+    _worker_state['output'] = \
+        [np.memmap(output_file, dtype='>f4', mode='r+', offset=offset,
+                   shape=_worker_state['hi'].shape)
+         for output_file, offset in zip(output_files, output_offsets)]
+
+    _worker_state['ikfft'] = ikffts
+    _worker_state['factors'] = factors
+    _worker_state['weights'] = 1. if weights is None else weights
+    _worker_state['highresscalefactor'] = highresscalefactor
+    _worker_state['lowresscalefactor'] = lowresscalefactor
+    _worker_state['fft_threads'] = fft_threads
+
+
+def _feather_block(chans):
+    '''
+    Feather a block of channels with each single-dish cube and write them to
+    the outputs.
+    '''
+    state = _worker_state
+
+    shape = state['hi'].shape[1:]
+
+    hi = np.nan_to_num(np.asarray(state['hi'][chans], dtype=np.float32))
+    hi *= state['highresscalefactor'] * state['weights']
+
+    pb = state['pb']
+    if pb is not None and pb.ndim == 3:
+        pb = np.asarray(pb[chans], dtype=np.float32)
+
+    fft_kwargs = _fft_kwargs(state['fft_threads'])
+
+    # The interferometer block is only transformed once
+    fft_hi = rfft2(hi, **fft_kwargs)
+
+    for lo_data, ikfft, factors, output in \
+            zip(state['lo'], state['ikfft'], state['factors'],
+                state['output']):
+
+        lo = np.nan_to_num(np.asarray(lo_data[chans], dtype=np.float32))
+        lo *= state['lowresscalefactor'] * state['weights'] * \
+            factors[chans][:, np.newaxis, np.newaxis]
+
+        if pb is not None:
+            lo *= pb
+
+        combo = lo + irfft2(ikfft * fft_hi, s=shape, **fft_kwargs)
+
+        if pb is not None:
+            combo /= pb
+
+        output[chans.start:chans.stop] = combo.astype(np.float32)
+        output.flush()
+
+    return chans
+
+
+def feather_cubes(hi_file, lo_files, save_names, restfreq=None, pb_hi=None,
+                  weights=None, highresscalefactor=1.0, lowresscalefactor=1.0,
+                  chunk=8, num_cores=1, fft_threads=1, spec_rtol=0.01,
+                  overwrite=False, verbose=True):
+    '''
+    Feather a cube with one or more single-dish cubes that have been
+    regridded onto the same grid. The interferometer cube is read and
+    transformed once for all of the single-dish cubes.
+
+    Parameters
+    ----------
+    hi_file : str
+        FITS file of the interferometer cube.
+    lo_files : list
+        FITS files of the single-dish cubes.
+    save_names : list
+        Names of the feathered cubes, one for each of `lo_files`.
+    restfreq : astropy.units.Quantity, optional
+        Rest frequency for converting between K and Jy/beam. Taken from the
+        header when not given.
+    pb_hi : str or np.ndarray, optional
+        Primary beam response of `hi_file` as a FITS cube or a 2D array. When
+        given, `hi_file` should not be primary beam corrected.
+    weights : np.ndarray, optional
+        Weights applied to all cubes to taper the map edges.
+    highresscalefactor : float, optional
+        Factor for the interferometer data.
+    lowresscalefactor : float, optional
+        Factor for the single-dish data.
+    chunk : int, optional
+        Number of channels transformed together.
+    num_cores : int, optional
+        Number of processes.
+    fft_threads : int, optional
+        Number of threads used in each FFT.
+    spec_rtol : float, optional
+        Allowed offset between the spectral axes, as a fraction of the channel
+        width.
+    overwrite : bool, optional
+        Overwrite existing outputs.
+    verbose : bool, optional
+        Show a progress bar.
+    '''
+    if len(lo_files) == 0:
+        raise ValueError("lo_files must have at least one single-dish cube.")
+
+    if len(lo_files) != len(save_names):
+        raise ValueError("save_names must have one name for each of "
+                         "lo_files.")
+
+    if not overwrite:
+        for save_name in save_names:
+            if os.path.exists(save_name):
+                raise IOError("{} already exists. Enable overwrite to replace "
+                              "it.".format(save_name))
+
+    cube_hi = SpectralCube.read(hi_file)
+
+    if weights is not None and weights.shape != cube_hi.shape[1:]:
+        raise ValueError("weights must have the spatial shape of the cube.")
+
+    pixscale = proj_plane_pixel_scales(cube_hi.wcs.celestial)[0] * u.deg
+
+    ikffts = []
+    factors = []
+
+    for lo_file in lo_files:
+        cube_lo = SpectralCube.read(lo_file)
+
+        if cube_hi.shape != cube_lo.shape:
+            raise ValueError("{} must be regridded onto the interferometer "
+                             "grid (see sd_regrid).".format(lo_file))
+
+        _check_spectral_axes(cube_hi, cube_lo, spec_rtol)
+
+        ikffts.append(feather_weights(cube_hi.shape[1:], cube_lo.beam.major,
+                                      pixscale))
+        factors.append(lowres_unit_factor(cube_hi, cube_lo,
+                                          restfreq=restfreq))
+
+    output_header = cube_hi.header.copy()
+    output_header['BITPIX'] = -32
+
+    # Existing outputs are only removed once all of the inputs are valid
+    output_offsets = []
+    for save_name in save_names:
+        if os.path.exists(save_name):
+            os.remove(save_name)
+
+        create_huge_fits(save_name, output_header)
+
+        with fits.open(save_name) as hdulist:
+            output_offsets.append(hdulist.fileinfo(0)['datLoc'])
+
+    nchan = cube_hi.shape[0]
+
+    del cube_hi, cube_lo
+
+    init_args = (hi_file, lo_files, pb_hi, save_names, output_offsets, ikffts,
+                 factors, weights, highresscalefactor, lowresscalefactor,
+                 fft_threads)
+
+    blocks = [slice(start, min(start + chunk, nchan))
+              for start in range(0, nchan, chunk)]
+
+    if verbose:
+        pbar = ProgressBar(len(blocks))
+
+    if num_cores > 1:
+        pool = Pool(num_cores, initializer=_init_worker, initargs=init_args)
+        try:
+            for _ in pool.imap_unordered(_feather_block, blocks):
+                if verbose:
+                    pbar.update()
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(*init_args)
+        for block in blocks:
+            _feather_block(block)
+            if verbose:
+                pbar.update()
+
+    _worker_state.clear()
+
+
+def feather_cube(hi_file, lo_file, save_name, **kwargs):
+    '''
+    Feather a cube with a single-dish cube that has been regridded onto the
+    same grid. See `feather_cubes` for the keyword arguments.
+
+    Parameters
+    ----------
+    hi_file : str
+        FITS file of the interferometer cube.
+    lo_file : str
+        FITS file of the single-dish cube.
+    save_name : str
+        Name of the feathered cube.
+    '''
+    feather_cubes(hi_file, [lo_file], [save_name], **kwargs)
@@ -15,6 +15,27 @@ def if_empty_return_old(string, old_val):
         return float(string)
 
 
+def apply_rflag(spw, freqdevscale, timedevscale, growfreq, growtime,
+                extend_pol=False):
+    if extend_pol:
+        flagdata(vis=ms_name, mode='rflag', spw=str(spw),
+                 freqdevscale=freqdevscale, timedevscale=timedevscale,
+                 growfreq=growfreq, growtime=growtime,
+                 datacolumn='corrected',
+                 action='apply', display='report', flagbackup=False)
+        flagdata(vis=ms_name, mode='extend', extendpols=True,
+                 spw=str(spw), action='apply', display='report',
+                 datacolumn='corrected',
+                 flagbackup=False)
+    else:
+        flagdata(vis=ms_name, spw=str(spw), mode='rflag',
+                 freqdevscale=freqdevscale, timedevscale=timedevscale,
+                 growfreq=growfreq, growtime=growtime,
+                 datacolumn='corrected',
+                 extendpols=False, action='apply', display='report',
+                 flagbackup=False)
+
+
 try:
     ms_name = sys.argv[1]
     apply_flagging = True if sys.argv[2] == "True" else False
@@ -26,6 +47,14 @@ except IndexError:
     extend_pol = \
         True if raw_input("Extend across pols? : ") == "True" else False
 
+# Optionally choose the thresholds from a grid sweep instead of by hand
+try:
+    run_sweep = True if sys.argv[4] == "True" else False
+    num_cores = int(sys.argv[5])
+except IndexError:
+    run_sweep = False
+    num_cores = 1
+
 # Just want the number of SPWs
 tb.open(os.path.join(ms_name, "SPECTRAL_WINDOW"))
 nchans = tb.getcol('NUM_CHAN')
@@ -37,88 +66,100 @@ params_used = np.empty((len(nchans), 4))
 
 default('flagdata')
 
-for spw in spws:
-    print("On spw "+str(spw)+" of "+str(len(nchans)))
-    freqdevscale = 4.0
-    timedevscale = 4.0
-    growtime = 99.0
-    growfreq = 99.0
-    print("Starting at freqdevscale = %s and timedevscale = %s" %
-          (freqdevscale, timedevscale))
-    print("Starting at growfreq = %s and growtime = %s" % (growfreq, growtime))
-    while True:
-        flagdata(vis=ms_name, mode='rflag', field='*3C48*',
-                 spw=str(spw), datacolumn='corrected',
-                 action='calculate', display='both',
-                 freqdevscale=freqdevscale, timedevscale=timedevscale,
-                 growtime=growtime, growfreq=growfreq,
-                 flagbackup=False)
+if run_sweep:
+    from paths import root
+    os.sys.path.insert(0, os.path.join(root, "flagging_scripts"))
+    from rflag_sweep import (MSAmplitudes, sweep_rflag_thresholds,
+                             write_sweep_results)
+
+    print("Sweeping rflag thresholds for all SPWs")
+    results = sweep_rflag_thresholds(MSAmplitudes(ms_name, field='*3C48*'),
+                                     spws, num_cores=num_cores)
+    params_used = write_sweep_results(results, ms_name[:-3])
+
+    for spw, params in zip(spws, params_used):
+        print("SPW {0}: freqdevscale = {1}, timedevscale = {2}"
+              .format(spw, params[0], params[1]))
 
-        adjust = True if raw_input("New thresholds? : ") == "True" else False
-
-        if adjust:
-            print("Current freqdevscale and timedevscale: %s %s" %
-                  (freqdevscale, timedevscale))
-            freqdevscale = \
-                if_empty_return_old(raw_input("New freqdevscale : "),
-                                    freqdevscale)
-            timedevscale = \
-                if_empty_return_old(raw_input("New timedevscale : "),
-                                    timedevscale)
-            growfreq = if_empty_return_old(raw_input("New growfreq : "),
-                                           growfreq)
-            growtime = if_empty_return_old(raw_input("New growtime : "),
-                                           growtime)
+        if apply_flagging:
+            apply_rflag(spw, params[0], params[1], params[2], params[3],
+                        extend_pol=extend_pol)
         else:
-            break
+            print("Applying not enabled.")
+
+else:
+    for spw in spws:
+        print("On spw "+str(spw)+" of "+str(len(nchans)))
+        freqdevscale = 4.0
+        timedevscale = 4.0
+        growtime = 99.0
+        growfreq = 99.0
+        print("Starting at freqdevscale = %s and timedevscale = %s" %
+              (freqdevscale, timedevscale))
+        print("Starting at growfreq = %s and growtime = %s" %
+              (growfreq, growtime))
+        while True:
+            flagdata(vis=ms_name, mode='rflag', field='*3C48*',
+                     spw=str(spw), datacolumn='corrected',
+                     action='calculate', display='both',
+                     freqdevscale=freqdevscale, timedevscale=timedevscale,
+                     growtime=growtime, growfreq=growfreq,
+                     flagbackup=False)
+
+            adjust = \
+                True if raw_input("New thresholds? : ") == "True" else False
+
+            if adjust:
+                print("Current freqdevscale and timedevscale: %s %s" %
+                      (freqdevscale, timedevscale))
+                freqdevscale = \
+                    if_empty_return_old(raw_input("New freqdevscale : "),
+                                        freqdevscale)
+                timedevscale = \
+                    if_empty_return_old(raw_input("New timedevscale : "),
+                                        timedevscale)
+                growfreq = if_empty_return_old(raw_input("New growfreq : "),
+                                               growfreq)
+                growtime = if_empty_return_old(raw_input("New growtime : "),
+                                               growtime)
+            else:
+                break
 
-    # Now apply the flagging
-    if apply_flagging:
+        # Now apply the flagging
+        if apply_flagging:
 
-        apply_rfi = True if raw_input("Apply RFI flagging? : ") == "True" else False
+            apply_rfi = \
+                True if raw_input("Apply RFI flagging? : ") == "True" else False
 
-        if apply_rfi:
+            if apply_rfi:
 
-            if extend_pol:
-                flagdata(vis=ms_name, mode='rflag', spw=str(spw),
-                         freqdevscale=freqdevscale, timedevscale=timedevscale,
-                         growfreq=growfreq, growtime=growtime,
-                         datacolumn='corrected',
-                         action='apply', display='report', flagbackup=False)
-                flagdata(vis=ms_name, mode='extend', extendpols=True,
-                         spw=str(spw), action='apply', display='report',
-                         datacolumn='corrected',
-                         flagbackup=False)
-            else:
-                flagdata(vis=ms_name, spw=str(spw), mode='rflag',
-                         freqdevscale=freqdevscale, timedevscale=timedevscale,
-                         growfreq=growfreq, growtime=growtime,
-                         datacolumn='corrected',
-                         extendpols=False, action='apply', display='report',
-                         flagbackup=False)
+                apply_rflag(spw, freqdevscale, timedevscale, growfreq,
+                            growtime, extend_pol=extend_pol)
 
-            params_used[spw, :] = \
-                [freqdevscale, timedevscale, growfreq, growtime]
+                params_used[spw, :] = \
+                    [freqdevscale, timedevscale, growfreq, growtime]
 
-        else:
-            params_used[spw, :] = \
-                [np.NaN, np.NaN, np.NaN, np.NaN]
+            else:
+                params_used[spw, :] = \
+                    [np.NaN, np.NaN, np.NaN, np.NaN]
 
-        obliterate = \
-            True if raw_input("Flag whole SPW? : ") == "True" else False
+            obliterate = \
+                True if raw_input("Flag whole SPW? : ") == "True" else False
 
-        if obliterate:
-            flagdata(vis=ms_name, spw=str(spw), mode='apply')
-            print("Flagged all of SPW " + str(spw))
-            params_used[spw, :] = [0.0, 0.0, 0.0, 0.0]
+            if obliterate:
+                flagdata(vis=ms_name, spw=str(spw), mode='apply')
+                print("Flagged all of SPW " + str(spw))
+                params_used[spw, :] = [0.0, 0.0, 0.0, 0.0]
 
-    else:
-        print("Applying not enabled.")
+        else:
+            print("Applying not enabled.")
 
-if apply_flagging:
+# The sweep has already written its parameters
+if apply_flagging and not run_sweep:
     np.savetxt(ms_name[:-3]+"_RFI_params.txt", params_used,
                header="freqdevscale, timedevscale, growfreq, growtime")
 
+if apply_flagging:
     flagmanager(vis=ms_name, mode='save',
                 versionname='after_manual_rflagging_1')
 
@@ -21,6 +21,9 @@ def listdir_fullpath(d):
     return [os.path.join(d, f) for f in os.listdir(d)]
 
 
+auto_find_bad_scans = \
+    True if raw_input("Automatic bad scan finding? (True/False): ") == "True" \
+    else False
 find_bad_scans = \
     True if raw_input("Bad scan finding? (True/False): ") == "True" else False
 plot_bad_scans = \
@@ -35,6 +38,21 @@ out_file = os.path.join(ms_active + "_badscans.json")
 
 bad_scan_dict = {}
 
+# Propose bad scans from the visibility statistics instead of looking
+# through every plot. Only the proposed scans are plotted below.
+if auto_find_bad_scans:
+    from paths import root
+    os.sys.path.insert(0, os.path.join(root, "flagging_scripts"))
+    from scan_statistics import find_bad_scans as auto_bad_scans
+
+    bad_scan_dict, rankings = auto_bad_scans(ms_active, out_file=out_file)
+
+    for spw_key in sorted(rankings.keys()):
+        print("{0}: {1}".format(spw_key, bad_scan_dict[spw_key]))
+
+    # Skip the by-eye search
+    find_bad_scans = False
+
 if find_bad_scans:
     # Check if the scan plots directory exists
     plot_direc = ms_active[:-3] + "_scan_plots"
@@ -0,0 +1,866 @@
+
+'''
+Compile the per-track manual flag lists into a minimal set of commands.
+
+The track_flagging/*_flags.txt files contain many overlapping
+`mode='manual'` lines. Each line is parsed into a `FlagRule`: a selection in
+scan x spw (with channel ranges) x antenna (or baseline) x time. Rules are
+then deduplicated, rules that differ only in time are merged into a single
+interval, rules that differ only in scan are combined, and rules contained
+in another rule are dropped. The result can be checked against the MS
+metadata, written back out as a flagdata list file, and applied with a
+single `flagdata(mode='list')` call.
+
+Commands that are not compiled (other modes, field, correlation and
+uvrange selections, autocorrelation or wildcard baseline selections, and
+selections that cannot be parsed, like inverted ranges) are passed through
+to the output unchanged.
+'''
+
+import re
+import os
+import numpy as np
+from datetime import datetime
+from collections import OrderedDict
+
+# MJD zero point used for the MS TIME column
+mjd_epoch = datetime(1858, 11, 17)
+
+_keyval_re = re.compile(r"(\w+)=(['\"])([^'\"]*)['\"]?")
+
+# Modes that only add flags, independent of the existing flags, so they can
+# be applied in any order
+_additive_modes = ('manual', 'clip', 'quack', 'shadow', 'elevation')
+
+
+class FlagRule(object):
+    '''
+    A normalized manual flagging selection.
+
+    Parameters
+    ----------
+    scans : frozenset or None
+        Scan numbers. None selects all scans.
+    spws : frozenset or None
+        (spw, first channel, last channel) tuples. The channels are None when
+        the whole SPW is selected. None selects all SPWs.
+    antennas : frozenset or None
+        Antenna names. All baselines with these antennas are selected.
+    baselines : frozenset or None
+        (antenna, antenna, separator) tuples when specific baselines were
+        given. The antennas are sorted, and the separator is '&' (the cross
+        correlation only) or '&&' (also the autocorrelations of both
+        antennas).
+    timerange : tuple
+        (start, end) in seconds. The times are seconds of the day unless
+        `absolute` is set, in which case they are MJD seconds.
+    absolute : bool
+        Whether `timerange` has a date.
+    sources : list
+        The (file, line number, text) of the lines this rule was compiled
+        from.
+    '''
+    def __init__(self, scans=None, spws=None, antennas=None, baselines=None,
+                 timerange=(-np.inf, np.inf), absolute=False, sources=None):
+        self.scans = scans
+        self.spws = spws
+        self.antennas = antennas
+        self.baselines = baselines
+        self.timerange = tuple(timerange)
+        self.absolute = absolute
+        self.sources = sources if sources is not None else []
+
+    def key(self):
+        return (self.scans, self.spws, self.antennas, self.baselines,
+                self.timerange, self.absolute)
+
+    def __eq__(self, other):
+        return self.key() == other.key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return "FlagRule({})".format(self.to_command())
+
+    def contains(self, other):
+        '''
+        Whether every visibility selected by `other` is also selected by
+        this rule.
+        '''
+        if self.absolute != other.absolute:
+            return False
+
+        if self.scans is not None:
+            if other.scans is None or not other.scans <= self.scans:
+                return False
+
+        if self.spws is not None:
+            if other.spws is None:
+                return False
+            for spw, lo, hi in other.spws:
+                if not any(_chan_contains(sel, (spw, lo, hi))
+                           for sel in self.spws):
+                    return False
+
+        if self.antennas is not None or self.baselines is not None:
+            if other.antennas is None and other.baselines is None:
+                return False
+            own_ants = self.antennas if self.antennas is not None \
+                else frozenset()
+            own_bls = self.baselines if self.baselines is not None \
+                else frozenset()
+            if other.antennas is not None and \
+                    not other.antennas <= own_ants:
+                return False
+            if other.baselines is not None:
+                for bl in other.baselines:
+                    if bl in own_bls:
+                        continue
+                    # The autocorrelations of '&&' are only contained in
+                    # the same selection
+                    if bl[2] != '&' or \
+                            not (bl[0] in own_ants or bl[1] in own_ants or
+                                 bl[:2] + ('&&',) in own_bls):
+                        return False
+
+        return self.timerange[0] <= other.timerange[0] and \
+            self.timerange[1] >= other.timerange[1]
+
+    def to_command(self, reason=True):
+        '''
+        Return the rule as a flagdata list-mode command.
+        '''
+        parts = ["mode='manual'"]
+
+        if self.scans is not None:
+            parts.append("scan='{}'".format(_format_scans(self.scans)))
+
+        if self.spws is not None:
+            parts.append("spw='{}'".format(_format_spws(self.spws)))
+
+        if self.antennas is not None or self.baselines is not None:
+            ants = sorted(self.antennas) if self.antennas is not None else []
+            bls = ["{0}{2}{1}".format(*bl) for bl in sorted(self.baselines)] \
+                if self.baselines is not None else []
+            parts.append("antenna='{}'".format(";".join(ants + bls)
+                                                if len(bls) > 0
+                                                else ",".join(ants)))
+
+        if np.isfinite(self.timerange).any():
+            parts.append("timerange='{}'"
+                         .format(_format_timerange(self.timerange,
+                                                   self.absolute)))
+
+        if reason and len(self.sources) > 0:
+            lines = set("{0}:{1}".format(os.path.basename(src[0]), src[1])
+                        for src in self.sources)
+            parts.append("reason='{}'".format(",".join(sorted(lines))))
+
+        return " ".join(parts)
+
+
+class PassThroughCommand(object):
+    '''
+    A flag command that is not compiled and is written out unchanged.
+
+    Parameters
+    ----------
+    text : str
+        The command, without comments.
+    additive : bool
+        Whether the command only adds flags independently of the existing
+        flags (e.g., manual or quack), so its order relative to the compiled
+        rules does not matter.
+    sources : list
+        The (file, line number, text) of the lines with this command.
+    '''
+    def __init__(self, text, additive=False, sources=None):
+        self.text = text
+        self.additive = additive
+        self.sources = sources if sources is not None else []
+
+    def __repr__(self):
+        return "PassThroughCommand({})".format(self.text)
+
+    def to_command(self, reason=True):
+        return self.text
+
+
+def _chan_contains(sel, other):
+    spw, lo, hi = sel
+    ospw, olo, ohi = other
+    if spw != ospw:
+        return False
+    if lo is None:
+        return True
+    if olo is None:
+        return False
+    return lo <= olo and hi >= ohi
+
+
+def _parse_time(string):
+    '''
+    Parse a CASA time string. Returns (seconds, absolute).
+    '''
+    string = string.strip()
+    if "/" in string:
+        date, clock = string.rsplit("/", 1)
+        ymd = datetime.strptime(date, "%Y/%m/%d")
+        day = (ymd - mjd_epoch).days * 86400.
+        return day + _clock_seconds(clock), True
+
+    return _clock_seconds(string), False
+
+
+def _clock_seconds(clock):
+    hms = [float(val) for val in clock.split(":")]
+    while len(hms) < 3:
+        hms.append(0.)
+    return hms[0] * 3600. + hms[1] * 60. + hms[2]
+
+
+def _format_clock(seconds):
+    hours = int(seconds // 3600)
+    minutes = int((seconds - hours * 3600) // 60)
+    secs = seconds - hours * 3600 - minutes * 60
+    if secs == int(secs):
+        return "{0:02d}:{1:02d}:{2:02d}".format(hours, minutes, int(secs))
+    return "{0:02d}:{1:02d}:{2:04.1f}".format(hours, minutes, secs)
+
+
+def _format_time(seconds, absolute):
+    if not absolute:
+        return _format_clock(seconds)
+    day = int(seconds // 86400)
+    date = datetime.fromordinal(mjd_epoch.toordinal() + day)
+    return "{0}/{1}".format(date.strftime("%Y/%m/%d"),
+                            _format_clock(seconds - day * 86400.))
+
+
+def _format_timerange(timerange, absolute):
+    start, end = timerange
+    if not np.isfinite(start):
+        return "<" + _format_time(end, absolute)
+    if not np.isfinite(end):
+        return ">" + _format_time(start, absolute)
+    return "{0}~{1}".format(_format_time(start, absolute),
+                            _format_time(end, absolute))
+
+
+def parse_timerange(string):
+    '''
+    Convert a CASA timerange string into ((start, end), absolute).
+    '''
+    string = string.strip()
+    if string == "":
+        return (-np.inf, np.inf), False
+    if string.startswith("<"):
+        end, absolute = _parse_time(string[1:])
+        return (-np.inf, end), absolute
+    if string.startswith(">"):
+        start, absolute = _parse_time(string[1:])
+        return (start, np.inf), absolute
+    if "~" in string:
+        start, end = string.split("~")
+        start, absolute = _parse_time(start)
+        end, end_absolute = _parse_time(end)
+        return (start, end), absolute
+    # A single time selects that integration.
+    time, absolute = _parse_time(string)
+    return (time, time), absolute
+
+
+def _parse_range(string):
+    '''
+    Parse 'lo~hi' or a single number. Raises a ValueError for inverted
+    ranges.
+    '''
+    lo, hi = string.split("~") if "~" in string else (string, string)
+    lo, hi = int(lo), int(hi)
+    if lo > hi:
+        raise ValueError("Inverted range: {}".format(string))
+    return lo, hi
+
+
+def parse_scans(string):
+    '''
+    Parse a scan selection (e.g., '1,3~5'). Raises a ValueError when no
+    scans are selected.
+    '''
+    scans = set()
+    for part in string.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        lo, hi = _parse_range(part)
+        scans.update(range(lo, hi + 1))
+
+    if len(scans) == 0:
+        raise ValueError("Empty scan selection: {}".format(string))
+
+    return frozenset(scans)
+
+
+def _format_scans(scans):
+    scans = sorted(scans)
+    parts = []
+    start = prev = scans[0]
+    for scan in scans[1:] + [None]:
+        if scan is not None and scan == prev + 1:
+            prev = scan
+            continue
+        parts.append(str(start) if start == prev
+                     else "{0}~{1}".format(start, prev))
+        start = prev = scan
+    return ",".join(parts)
+
+
+def parse_spws(string):
+    '''
+    Parse a spw selection (e.g., '3,4:0~30,5~7') into (spw, lo, hi) tuples.
+    Raises a ValueError for inverted ranges, or when no SPWs are selected.
+    '''
+    spws = set()
+    for part in string.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if ":" in part:
+            spw_part, chan_part = part.split(":", 1)
+        else:
+            spw_part, chan_part = part, None
+
+        lo, hi = _parse_range(spw_part)
+        spw_list = range(lo, hi + 1)
+
+        for spw in spw_list:
+            if chan_part is None:
+                spws.add((spw, None, None))
+                continue
+            for chans in chan_part.split(";"):
+                lo, hi = _parse_range(chans)
+                spws.add((spw, lo, hi))
+
+    if len(spws) == 0:
+        raise ValueError("Empty spw selection: {}".format(string))
+
+    return frozenset(spws)
+
+
+def _format_spws(spws):
+    whole = sorted(spw for spw, lo, hi in spws if lo is None)
+    parts = [str(spw) for spw in whole]
+    chans = OrderedDict()
+    for spw, lo, hi in sorted((s for s in spws if s[1] is not None)):
+        if spw in whole:
+            continue
+        chans.setdefault(spw, []).append("{0}~{1}".format(lo, hi))
+    for spw, ranges in chans.items():
+        parts.append("{0}:{1}".format(spw, ";".join(ranges)))
+    return ",".join(parts)
+
+
+def parse_antennas(string):
+    '''
+    Split an antenna selection into antennas and baselines. Only single
+    baselines ('ea01&ea02' or 'ea01&&ea02') are kept as baselines. Raises a
+    ValueError for other '&' selections (e.g., 'ea01&', 'ea01&&*' or the
+    autocorrelations only with 'ea01&&&'), negations and empty selections.
+    '''
+    antennas = set()
+    baselines = set()
+    for part in re.split("[,;]", string):
+        part = part.strip()
+        if part == "":
+            continue
+        if part.startswith("!") or "*" in part:
+            raise ValueError("Unsupported antenna selection: {}"
+                             .format(part))
+        if "&" in part:
+            match = re.match(r"^([^&]+)(&{1,2})([^&]+)$", part)
+            if match is None or match.group(1) == match.group(3):
+                raise ValueError("Unsupported baseline selection: {}"
+                                 .format(part))
+            ant1, sep, ant2 = match.groups()
+            baselines.add(tuple(sorted([ant1, ant2])) + (sep,))
+        else:
+            antennas.add(part)
+
+    if len(antennas) == 0 and len(baselines) == 0:
+        raise ValueError("Empty antenna selection: {}".format(string))
+
+    return (frozenset(antennas) if len(antennas) > 0 else None,
+            frozenset(baselines) if len(baselines) > 0 else None)
+
+
+def parse_flag_line(line):
+    '''
+    Parse one line of a flag list file. Returns None for comments and blank
+    lines, and a `PassThroughCommand` for commands that are not compiled
+    (non-manual modes, field, correlation or uvrange selections, and
+    selections that `parse_scans`, `parse_spws` or `parse_antennas` cannot
+    represent exactly).
+    '''
+    line = line.split("#", 1)[0].strip()
+    if line == "":
+        return None
+
+    pars = {key: value for key, _, value in _keyval_re.findall(line)}
+
+    mode = pars.get('mode', 'manual')
+
+    if mode != 'manual' or 'field' in pars or 'correlation' in pars or \
+            'uvrange' in pars:
+        return PassThroughCommand(line, additive=mode in _additive_modes)
+
+    # Empty selections select everything
+    try:
+        scans = parse_scans(pars['scan']) \
+            if pars.get('scan', '').strip() != '' else None
+        spws = parse_spws(pars['spw']) \
+            if pars.get('spw', '').strip() != '' else None
+        antennas, baselines = parse_antennas(pars['antenna']) \
+            if pars.get('antenna', '').strip() != '' else (None, None)
+    except ValueError:
+        return PassThroughCommand(line, additive=True)
+
+    timerange, absolute = parse_timerange(pars.get('timerange', ''))
+
+    return FlagRule(scans=scans, spws=spws, antennas=antennas,
+                    baselines=baselines, timerange=timerange,
+                    absolute=absolute)
+
+
+def read_flag_file(filename):
+    '''
+    Parse all of the flagging commands in a flag list file.
+    '''
+    rules = []
+    with open(filename) as f:
+        for i, line in enumerate(f):
+            rule = parse_flag_line(line)
+            if rule is None:
+                continue
+            rule.sources.append((filename, i + 1, line.strip()))
+            rules.append(rule)
+    return rules
+
+
+def _merge_by(rules, key_func, merge_func):
+    groups = OrderedDict()
+    for rule in rules:
+        groups.setdefault(key_func(rule), []).append(rule)
+
+    out = []
+    for group in groups.values():
+        out.extend(merge_func(group))
+    return out
+
+
+def _merge_times(group):
+    group = sorted(group, key=lambda rule: rule.timerange)
+    merged = [group[0]]
+    for rule in group[1:]:
+        last = merged[-1]
+        if rule.timerange[0] <= last.timerange[1]:
+            merged[-1] = FlagRule(scans=last.scans, spws=last.spws,
+                                  antennas=last.antennas,
+                                  baselines=last.baselines,
+                                  timerange=(last.timerange[0],
+                                             max(last.timerange[1],
+                                                 rule.timerange[1])),
+                                  absolute=last.absolute,
+                                  sources=last.sources + rule.sources)
+        else:
+            merged.append(rule)
+    return merged
+
+
+def _merge_scans(group):
+    if len(group) == 1:
+        return group
+    if any(rule.scans is None for rule in group):
+        scans = None
+    else:
+        scans = frozenset().union(*[rule.scans for rule in group])
+    first = group[0]
+    return [FlagRule(scans=scans, spws=first.spws, antennas=first.antennas,
+                     baselines=first.baselines, timerange=first.timerange,
+                     absolute=first.absolute,
+                     sources=sum([rule.sources for rule in group], []))]
+
+
+def compile_flag_rules(rules):
+    '''
+    Deduplicate and merge a list of `FlagRule` and `PassThroughCommand`.
+
+    Additive pass-through commands are written once, after the compiled
+    rules. Other pass-through commands (e.g., unflag, or modes like rflag
+    that depend on the existing flags) keep their place: the rules before
+    and after each of them are compiled separately.
+
+    Returns
+    -------
+    compiled : list
+        The compiled rules and the pass-through commands.
+    '''
+    compiled = []
+    block = []
+    passed = OrderedDict()
+
+    for rule in rules:
+        if not isinstance(rule, PassThroughCommand):
+            block.append(rule)
+        elif rule.additive:
+            if rule.text in passed:
+                passed[rule.text].sources.extend(rule.sources)
+            else:
+                passed[rule.text] = \
+                    PassThroughCommand(rule.text, additive=True,
+                                       sources=list(rule.sources))
+        else:
+            compiled.extend(_compile_manual_rules(block))
+            compiled.extend(passed.values())
+            compiled.append(rule)
+            block = []
+            passed = OrderedDict()
+
+    compiled.extend(_compile_manual_rules(block))
+    compiled.extend(passed.values())
+
+    return compiled
+
+
+def _compile_manual_rules(rules):
+    '''
+    Deduplicate and merge a list of `FlagRule`.
+
+    Returns
+    -------
+    compiled : list
+        The minimal list of rules. The `sources` of each rule record every
+        input line it replaces.
+    '''
+    # Exact duplicates (e.g., the same line given for several tracks)
+    unique = OrderedDict()
+    for rule in rules:
+        if rule in unique:
+            unique[rule].sources.extend(rule.sources)
+        else:
+            unique[rule] = FlagRule(*rule.key()[:4],
+                                    timerange=rule.timerange,
+                                    absolute=rule.absolute,
+                                    sources=list(rule.sources))
+    rules = list(unique.values())
+
+    # Overlapping time ranges for the same scan/spw/antenna selection
+    rules = _merge_by(rules,
+                      lambda r: (r.scans, r.spws, r.antennas, r.baselines,
+                                 r.absolute),
+                      _merge_times)
+
+    # The same selection repeated for several scans. Only whole-scan or
+    # whole-time selections are combined since time ranges are usually
+    # specific to one scan.
+    rules = _merge_by(rules,
+                      lambda r: (r.spws, r.antennas, r.baselines,
+                                 r.timerange, r.absolute)
+                      if not np.isfinite(r.timerange).any()
+                      else id(r),
+                      _merge_scans)
+
+    # Drop rules contained in another
+    keep = []
+    for i, rule in enumerate(rules):
+        container = None
+        for j, other in enumerate(rules):
+            if i == j or not other.contains(rule):
+                continue
+            # For identical selections, keep the first
+            if rule.contains(other) and j > i:
+                continue
+            container = other
+            break
+        if container is None:
+            keep.append(rule)
+        else:
+            container.sources.extend(rule.sources)
+
+    return keep
+
+
+def compile_flag_files(filenames):
+    '''
+    Read and compile one or more flag list files.
+    '''
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    rules = []
+    for filename in filenames:
+        rules.extend(read_flag_file(filename))
+    return compile_flag_rules(rules)
+
+
+def write_flag_file(rules, filename, header=None):
+    '''
+    Write compiled rules as a flagdata list file.
+    '''
+    with open(filename, 'w') as f:
+        if header is not None:
+            f.write("# {}\n".format(header))
+        for rule in rules:
+            f.write(rule.to_command() + "\n")
+
+
+def ms_metadata(vis):
+    '''
+    Collect the metadata needed to validate the flag rules.
+    '''
+    from taskinit import msmdtool
+
+    msmd = msmdtool()
+    msmd.open(vis)
+
+    scans = msmd.scannumbers()
+    metadata = {'scans': set(int(scan) for scan in scans),
+                'nchans': {spw: msmd.nchan(spw)
+                           for spw in range(msmd.nspw())},
+                'antennas': list(msmd.antennanames()),
+                'scan_times': {}}
+
+    for scan in scans:
+        times = msmd.timesforscan(scan)
+        metadata['scan_times'][int(scan)] = (times.min(), times.max())
+
+    msmd.close()
+
+    first_time = min(times[0] for times in metadata['scan_times'].values())
+    metadata['day0'] = np.floor(first_time / 86400.) * 86400.
+
+    return metadata
+
+
+def validate_flag_rules(rules, metadata):
+    '''
+    Check the rules select data that exist in the MS.
+
+    Returns
+    -------
+    problems : list
+        (rule, message) for every problem found.
+    '''
+    problems = []
+    all_ants = set(metadata['antennas'])
+
+    for rule in rules:
+        # Pass-through commands are checked by flagdata
+        if isinstance(rule, PassThroughCommand):
+            continue
+
+        if rule.scans is not None:
+            missing = rule.scans - metadata['scans']
+            if len(missing) > 0:
+                problems.append((rule, "Scans not in MS: {}"
+                                 .format(sorted(missing))))
+
+        if rule.spws is not None:
+            if len(rule.spws) == 0:
+                problems.append((rule, "Empty SPW selection"))
+            for spw, lo, hi in rule.spws:
+                if spw not in metadata['nchans']:
+                    problems.append((rule, "SPW {} not in MS".format(spw)))
+                elif hi is not None and \
+                        (lo > hi or hi >= metadata['nchans'][spw]):
+                    problems.append((rule, "Channels {0}~{1} outside SPW {2}"
+                                     .format(lo, hi, spw)))
+
+        ants = set()
+        if rule.antennas is not None:
+            ants.update(rule.antennas)
+        if rule.baselines is not None:
+            for bl in rule.baselines:
+                ants.update(bl[:2])
+        missing = ants - all_ants
+        if len(missing) > 0:
+            problems.append((rule, "Antennas not in MS: {}"
+                             .format(sorted(missing))))
+
+        if rule.scans is not None and np.isfinite(rule.timerange).any():
+            start, end = _absolute_timerange(rule, metadata['day0'])
+            overlap = False
+            for scan in rule.scans & metadata['scans']:
+                t0, t1 = metadata['scan_times'][scan]
+                if start <= t1 and end >= t0:
+                    overlap = True
+                    break
+            if not overlap:
+                problems.append((rule, "Time range does not overlap the "
+                                 "selected scans"))
+
+    return problems
+
+
+def _absolute_timerange(rule, day0):
+    if rule.absolute:
+        return rule.timerange
+    return rule.timerange[0] + day0, rule.timerange[1] + day0
+
+
+def rule_row_mask(rule, scan, spw, ant1, ant2, time, antenna_names, day0):
+    '''
+    Boolean mask of the rows selected by a rule. Channel selections are
+    handled separately in `count_rule_flags`.
+    '''
+    mask = np.ones(scan.shape, dtype=bool)
+
+    if rule.scans is not None:
+        mask &= np.in1d(scan, list(rule.scans))
+
+    if rule.spws is not None:
+        mask &= np.in1d(spw, [sel[0] for sel in rule.spws])
+
+    if rule.antennas is not None or rule.baselines is not None:
+        names = np.asarray(antenna_names)
+        name1 = names[ant1]
+        name2 = names[ant2]
+        ant_mask = np.zeros(scan.shape, dtype=bool)
+        if rule.antennas is not None:
+            ants = list(rule.antennas)
+            ant_mask |= np.in1d(name1, ants) | np.in1d(name2, ants)
+        if rule.baselines is not None:
+            for a, b, sep in rule.baselines:
+                ant_mask |= ((name1 == a) & (name2 == b)) | \
+                    ((name1 == b) & (name2 == a))
+                if sep == '&&':
+                    ant_mask |= (name1 == name2) & \
+                        ((name1 == a) | (name1 == b))
+        mask &= ant_mask
+
+    start, end = _absolute_timerange(rule, day0)
+    mask &= (time >= start) & (time <= end)
+
+    return mask
+
+
+def count_rule_flags(rules, scan, spw, ant1, ant2, time, flags,
+                     antenna_names, day0):
+    '''
+    Count the visibilities newly flagged by each rule, applying the rules in
+    order.
+
+    Parameters
+    ----------
+    flags : np.ndarray
+        Existing flags of shape (ncorr, nchan, nrow) for rows of a single
+        SPW. Updated in place.
+
+    Returns
+    -------
+    counts : np.ndarray
+        Number of visibilities each rule flags that were not already
+        flagged. Pass-through commands are not counted.
+    '''
+    counts = np.zeros(len(rules), dtype=int)
+
+    for i, rule in enumerate(rules):
+        if isinstance(rule, PassThroughCommand):
+            continue
+
+        rows = rule_row_mask(rule, scan, spw, ant1, ant2, time,
+                             antenna_names, day0)
+        if not rows.any():
+            continue
+
+        chans = np.ones(flags.shape[1], dtype=bool)
+        if rule.spws is not None:
+            this_spw = spw[rows][0]
+            sels = [sel for sel in rule.spws if sel[0] == this_spw]
+            if not any(sel[1] is None for sel in sels):
+                chans[:] = False
+                for _, lo, hi in sels:
+                    chans[lo:hi + 1] = True
+
+        sub = flags[:, chans][:, :, rows]
+        counts[i] += (~sub).sum()
+
+        # Record the flags so later rules are not double counted
+        idx_chan = np.where(chans)[0]
+        idx_row = np.where(rows)[0]
+        flags[np.ix_(np.arange(flags.shape[0]), idx_chan, idx_row)] = True
+
+    return counts
+
+
+def report_flag_counts(vis, rules, metadata=None, maxrows=100000):
+    '''
+    Read the FLAG column once and count how many visibilities each rule
+    will remove.
+    '''
+    from taskinit import mstool, tbtool
+
+    if metadata is None:
+        metadata = ms_metadata(vis)
+
+    tb = tbtool()
+    tb.open(os.path.join(vis, "DATA_DESCRIPTION"))
+    ddid_spw = tb.getcol("SPECTRAL_WINDOW_ID")
+    tb.close()
+
+    counts = np.zeros(len(rules), dtype=int)
+
+    myms = mstool()
+    myms.open(vis)
+    for ddid, spw_id in enumerate(ddid_spw):
+        myms.selectinit(datadescid=ddid)
+        myms.iterinit(maxrows=maxrows)
+        myms.iterorigin()
+        while True:
+            rec = myms.getdata(['flag', 'scan_number', 'antenna1',
+                                'antenna2', 'time'])
+            if len(rec) == 0:
+                break
+            spw = np.full(rec['scan_number'].shape, spw_id, dtype=int)
+            counts += count_rule_flags(rules, rec['scan_number'], spw,
+                                       rec['antenna1'], rec['antenna2'],
+                                       rec['time'], rec['flag'],
+                                       metadata['antennas'],
+                                       metadata['day0'])
+            if not myms.iternext():
+                break
+        myms.iterend()
+    myms.close()
+
+    return counts
+
+
+def apply_flag_rules(vis, rules, report=True, flagbackup=True,
+                     versionname="compiled_manual_flags"):
+    '''
+    Apply the rules with a single list-mode flagdata call.
+
+    Returns
+    -------
+    counts : np.ndarray or None
+        Visibilities removed by each rule when `report` is enabled.
+    '''
+    from tasks import flagdata, flagmanager
+
+    counts = None
+    if report:
+        counts = report_flag_counts(vis, rules)
+        for rule, count in zip(rules, counts):
+            print("{0}: {1}".format(rule.to_command(), count))
+
+    if flagbackup:
+        flagmanager(vis=vis, mode='save', versionname=versionname,
+                    comment="Before applying compiled manual flags.")
+
+    flagdata(vis=vis, mode='list',
+             inpfile=[rule.to_command() for rule in rules],
+             action='apply', flagbackup=False)
+
+    return counts
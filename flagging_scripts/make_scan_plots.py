@@ -19,6 +19,23 @@ try:
 except NameError:
     ms_active = raw_input("ms_active is not defined. Provide MS name: ")
 
+# Only plot the scans proposed by scan_statistics.find_bad_scans, when
+# candidates_only is enabled before running this script.
+try:
+    candidates_only
+except NameError:
+    candidates_only = False
+
+candidate_scans = None
+if candidates_only:
+    import json
+    with open(ms_active + "_badscans.json", "r") as f:
+        candidate_scans = {}
+        for spw_key, spw_scans in json.load(f).items():
+            candidate_scans[spw_key] = \
+                set([int(num) for scans in spw_scans.values()
+                     for num in scans.split(",") if len(num) > 0])
+
 # Average over baselines for spectral-line data, but not the continuum
 if "continuum" in ms_active:
     avg_baseline = True
@@ -105,6 +122,11 @@ for spw_num in spws:
                 print("All data flagged in SPW {0} scan {1}".format(spw_num, jj))
                 continue
 
+            if candidate_scans is not None:
+                if jj not in candidate_scans.get("spw_{}".format(spw_num),
+                                                 []):
+                    continue
+
             print("On scan {}".format(jj))
 
             # Amp vs. time
@@ -0,0 +1,455 @@
+
+'''
+Non-interactive search for rflag thresholds.
+
+The rflag statistics (sliding-window time RMS and spectral deviation) do
+not depend on the threshold scales, so they are computed once per SPW and
+every (freqdevscale, timedevscale) pair on the grid is evaluated with array
+comparisons. The SPWs are evaluated concurrently, and the thresholds are
+chosen from the knee of the flagged fraction vs. residual RMS curve.
+
+The data getter and flagger are arguments so the sweep can be run on
+synthetic spectra with a stub in place of the MS reader. Running this module
+checks the sweep on synthetic spectra with injected RFI:
+
+    python rflag_sweep.py [num_cores]
+'''
+
+import numpy as np
+from multiprocessing import Pool
+
+
+def _nan_rolling_std(arr, winsize=3):
+    '''
+    NaN-aware standard deviation in a sliding window along the last axis.
+    '''
+    half = winsize // 2
+    padded = np.pad(arr, [(0, 0), (half, half)], mode='constant',
+                    constant_values=np.NaN)
+    stack = np.array([padded[:, i:i + arr.shape[1]]
+                      for i in range(winsize)])
+    return np.nanstd(stack, axis=0)
+
+
+def _nan_rolling_median(arr, winsize=9):
+    '''
+    NaN-aware median in a sliding window along the first axis.
+    '''
+    half = winsize // 2
+    padded = np.pad(arr, [(half, half), (0, 0)], mode='constant',
+                    constant_values=np.NaN)
+    stack = np.array([padded[i:i + arr.shape[0]] for i in range(winsize)])
+    return np.nanmedian(stack, axis=0)
+
+
+def rflag_statistics(amp, winsize=3, spectral_winsize=9):
+    '''
+    Compute the threshold-independent rflag statistics for one baseline.
+
+    Parameters
+    ----------
+    amp : np.ndarray
+        Amplitudes with shape (nchan, ntime). Previously flagged data should
+        be NaN.
+    winsize : int, optional
+        Number of integrations in the sliding time window (rflag's
+        `winsize`).
+    spectral_winsize : int, optional
+        Number of channels used for the running median that the spectral
+        deviation is measured from.
+
+    Returns
+    -------
+    time_ratio : np.ndarray
+        Sliding-window time RMS divided by the per-channel median RMS. A
+        point is flagged by the time test when this exceeds `timedevscale`.
+    freq_ratio : np.ndarray
+        Absolute spectral deviation divided by the median deviation over the
+        baseline. A point is flagged by the spectral test when this exceeds
+        `freqdevscale`.
+    resid : np.ndarray
+        Deviation from the running spectral median, used for the residual
+        RMS.
+    '''
+    with np.errstate(invalid='ignore'):
+        time_rms = _nan_rolling_std(amp, winsize=winsize)
+        timedev = np.nanmedian(time_rms, axis=1)[:, np.newaxis]
+        time_ratio = time_rms / timedev
+
+        resid = amp - _nan_rolling_median(amp, winsize=spectral_winsize)
+        abs_resid = np.abs(resid)
+        freqdev = np.nanmedian(abs_resid)
+        freq_ratio = abs_resid / freqdev
+
+    return time_ratio, freq_ratio, resid
+
+
+def rflag_metrics(data, freqdevscales, timedevscales, **stat_kwargs):
+    '''
+    Evaluate the flagged fraction and residual RMS for every pair of
+    threshold scales.
+
+    Parameters
+    ----------
+    data : list of np.ndarray
+        Amplitudes for each baseline with shape (nchan, ntime).
+    freqdevscales : np.ndarray
+        Spectral threshold scales to test.
+    timedevscales : np.ndarray
+        Time threshold scales to test.
+
+    Returns
+    -------
+    flag_frac : np.ndarray
+        Fraction of the unflagged input data that would be flagged. Shape is
+        (len(freqdevscales), len(timedevscales)).
+    resid_rms : np.ndarray
+        RMS of the spectral residuals of the remaining data.
+    '''
+    time_ratio = []
+    freq_ratio = []
+    resid = []
+
+    for amp in data:
+        stats = rflag_statistics(amp, **stat_kwargs)
+        valid = np.isfinite(stats[2])
+        time_ratio.append(stats[0][valid])
+        freq_ratio.append(stats[1][valid])
+        resid.append(stats[2][valid])
+
+    time_ratio = np.concatenate(time_ratio)
+    freq_ratio = np.concatenate(freq_ratio)
+    resid_sq = np.concatenate(resid)**2
+
+    # Windows with a single valid point give a NaN RMS. These cannot be
+    # flagged by the time test.
+    time_ratio[~np.isfinite(time_ratio)] = 0.
+    freq_ratio[~np.isfinite(freq_ratio)] = 0.
+
+    flag_frac = np.empty((len(freqdevscales), len(timedevscales)))
+    resid_rms = np.empty_like(flag_frac)
+
+    freq_flags = [freq_ratio > fscale for fscale in freqdevscales]
+    time_flags = [time_ratio > tscale for tscale in timedevscales]
+
+    for i, fflag in enumerate(freq_flags):
+        for j, tflag in enumerate(time_flags):
+            keep = ~(fflag | tflag)
+            flag_frac[i, j] = 1. - keep.mean()
+            resid_rms[i, j] = np.sqrt(resid_sq[keep].mean()) \
+                if keep.any() else np.NaN
+
+    return flag_frac, resid_rms
+
+
+def knee_point(flag_frac, resid_rms):
+    '''
+    Find the knee of the residual RMS vs. flagged fraction curve.
+
+    Only settings on the lower envelope (the smallest RMS for a given amount
+    of flagging) are considered. Both axes are normalized to [0, 1], and the
+    knee is the point that falls furthest below the line joining the least
+    and most aggressive settings. Beyond this point, flagging more data
+    barely lowers the RMS.
+
+    Returns
+    -------
+    index : int
+        Index into the flattened input arrays.
+    '''
+    x = np.asarray(flag_frac, dtype=float).ravel()
+    y = np.asarray(resid_rms, dtype=float).ravel()
+
+    finite = np.where(np.isfinite(x) & np.isfinite(y))[0]
+    if finite.size == 0:
+        raise ValueError("No finite metrics to find the knee of.")
+
+    order = finite[np.lexsort((y[finite], x[finite]))]
+
+    # Lower envelope: each point must have a lower RMS than every setting
+    # that flags less.
+    envelope = [order[0]]
+    for idx in order[1:]:
+        if y[idx] < y[envelope[-1]]:
+            envelope.append(idx)
+    envelope = np.array(envelope)
+
+    if envelope.size < 3:
+        return envelope[0]
+
+    xe = x[envelope]
+    ye = y[envelope]
+    xn = (xe - xe[0]) / (xe[-1] - xe[0]) if xe[-1] > xe[0] else \
+        np.zeros_like(xe)
+    yn = (ye - ye[-1]) / (ye[0] - ye[-1]) if ye[0] > ye[-1] else \
+        np.zeros_like(ye)
+
+    # Distance below the chord from (0, 1) to (1, 0)
+    dist = (1. - xn) - yn
+
+    return envelope[np.argmax(dist)]
+
+
+class MSAmplitudes(object):
+    '''
+    Read the visibility amplitudes of one SPW from an MS, split by baseline.
+    Picklable so each worker in the pool reads its own SPW.
+
+    Parameters
+    ----------
+    vis : str
+        MS name.
+    field : str, optional
+        Field selection.
+    datacolumn : str, optional
+        'corrected' or 'data'.
+    '''
+    def __init__(self, vis, field='', datacolumn='corrected'):
+        self.vis = vis
+        self.field = field
+        self.datacolumn = datacolumn
+
+    def __call__(self, spw):
+        from taskinit import mstool
+
+        column = "corrected_data" if self.datacolumn == 'corrected' \
+            else "data"
+
+        myms = mstool()
+        myms.open(self.vis)
+        myms.selectinit(reset=True)
+        assert myms.msselect({'field': self.field, 'spw': str(spw)}), \
+            "Data selection has failed"
+        datadict = myms.getdata([column, 'flag', 'antenna1', 'antenna2'])
+        myms.close()
+
+        # Average the correlations. Shape is (nchan, nrow)
+        amp = np.abs(datadict[column])
+        amp[datadict['flag']] = np.NaN
+        with np.errstate(invalid='ignore'):
+            amp = np.nanmean(amp, axis=0)
+
+        baselines = datadict['antenna1'] * 1000 + datadict['antenna2']
+
+        return [amp[:, baselines == bl] for bl in np.unique(baselines)]
+
+
+def _sweep_one_spw(args):
+    data_getter, flagger, spw, freqdevscales, timedevscales = args
+
+    flag_frac, resid_rms = flagger(data_getter(spw), freqdevscales,
+                                   timedevscales)
+    best = knee_point(flag_frac, resid_rms)
+    i, j = np.unravel_index(best, flag_frac.shape)
+
+    return {'spw': spw,
+            'flag_frac': flag_frac,
+            'resid_rms': resid_rms,
+            'freqdevscales': freqdevscales,
+            'timedevscales': timedevscales,
+            'freqdevscale': freqdevscales[i],
+            'timedevscale': timedevscales[j]}
+
+
+def sweep_rflag_thresholds(data_getter, spws,
+                           freqdevscales=np.arange(2.0, 6.5, 0.5),
+                           timedevscales=np.arange(2.0, 6.5, 0.5),
+                           flagger=rflag_metrics, num_cores=1):
+    '''
+    Evaluate a grid of rflag thresholds for all SPWs and choose the
+    thresholds at the knee of each SPW's flagging curve.
+
+    Parameters
+    ----------
+    data_getter : callable
+        Returns the list of per-baseline (nchan, ntime) amplitude arrays for
+        a given SPW, e.g., `MSAmplitudes`. Must be picklable when
+        `num_cores > 1`.
+    spws : list
+        SPWs to sweep.
+    freqdevscales : np.ndarray, optional
+        Grid of spectral threshold scales.
+    timedevscales : np.ndarray, optional
+        Grid of time threshold scales.
+    flagger : callable, optional
+        Function with the signature of `rflag_metrics` returning the flagged
+        fraction and residual RMS grids.
+    num_cores : int, optional
+        Number of processes used to evaluate the SPWs.
+
+    Returns
+    -------
+    results : list of dict
+        Chosen thresholds and the metric grids for each SPW.
+    '''
+    freqdevscales = np.asarray(freqdevscales)
+    timedevscales = np.asarray(timedevscales)
+
+    args = [(data_getter, flagger, spw, freqdevscales, timedevscales)
+            for spw in spws]
+
+    if num_cores > 1:
+        pool = Pool(num_cores)
+        try:
+            results = pool.map(_sweep_one_spw, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = list(map(_sweep_one_spw, args))
+
+    return results
+
+
+def write_sweep_results(results, prefix, growfreq=99.0, growtime=99.0):
+    '''
+    Save the chosen thresholds in the same format as the `params_used` table
+    from the interactive flagging, and a summary of every grid point.
+
+    Returns
+    -------
+    params_used : np.ndarray
+        Rows of freqdevscale, timedevscale, growfreq, growtime for each
+        SPW.
+    '''
+    params_used = np.array([[res['freqdevscale'], res['timedevscale'],
+                             growfreq, growtime] for res in results])
+
+    np.savetxt(prefix + "_RFI_params.txt", params_used,
+               header="freqdevscale, timedevscale, growfreq, growtime")
+
+    rows = []
+    for res in results:
+        for i, fscale in enumerate(res['freqdevscales']):
+            for j, tscale in enumerate(res['timedevscales']):
+                chosen = fscale == res['freqdevscale'] and \
+                    tscale == res['timedevscale']
+                rows.append([res['spw'], fscale, tscale,
+                             res['flag_frac'][i, j], res['resid_rms'][i, j],
+                             chosen])
+
+    np.savetxt(prefix + "_RFI_sweep.txt", np.array(rows, dtype=float),
+               header="spw, freqdevscale, timedevscale, flagged_fraction, "
+                      "residual_rms, chosen")
+
+    return params_used
+
+
+class SyntheticAmplitudes(object):
+    '''
+    Stand-in for `MSAmplitudes` that returns noise spectra with narrow-band,
+    time-variable RFI injected. Picklable so it can be swept in a pool.
+
+    Parameters
+    ----------
+    nbase : int, optional
+        Number of baselines.
+    nchan : int, optional
+        Number of channels.
+    ntime : int, optional
+        Number of integrations.
+    rfi_frac : float, optional
+        Fraction of the channels with RFI.
+    rfi_amp : float, optional
+        RFI amplitude relative to the noise.
+    seed : int, optional
+        Seed for the noise. Each SPW is offset from it.
+    '''
+    def __init__(self, nbase=10, nchan=128, ntime=60, rfi_frac=0.05,
+                 rfi_amp=20., seed=0):
+        self.nbase = nbase
+        self.nchan = nchan
+        self.ntime = ntime
+        self.rfi_frac = rfi_frac
+        self.rfi_amp = rfi_amp
+        self.seed = seed
+
+    def rfi_mask(self, spw):
+        '''
+        Boolean (nchan, ntime) array of the points with RFI.
+        '''
+        rng = np.random.RandomState(self.seed + spw)
+        nrfi = max(1, int(self.rfi_frac * self.nchan))
+        chans = rng.choice(self.nchan, nrfi, replace=False)
+
+        mask = np.zeros((self.nchan, self.ntime), dtype=bool)
+        # RFI is on for half of the integrations
+        mask[chans, self.ntime // 4: 3 * self.ntime // 4] = True
+        return mask
+
+    def __call__(self, spw):
+        rng = np.random.RandomState(self.seed + spw)
+        mask = self.rfi_mask(spw)
+
+        data = []
+        for _ in range(self.nbase):
+            amp = 10. + rng.randn(self.nchan, self.ntime)
+            amp[mask] += self.rfi_amp
+            data.append(amp)
+        return data
+
+
+def stub_flagger(data, freqdevscales, timedevscales):
+    '''
+    Flagger with the signature of `rflag_metrics` that flags the points
+    above the median by more than `freqdevscale` times the noise. The time
+    scale is ignored. Used to check the sweep without the rflag statistics.
+    '''
+    amp = np.concatenate([arr.ravel() for arr in data])
+    med = np.median(amp)
+    dev = (amp - med) / (1.4826 * np.median(np.abs(amp - med)))
+
+    flag_frac = np.empty((len(freqdevscales), len(timedevscales)))
+    resid_rms = np.empty_like(flag_frac)
+    for i, fscale in enumerate(freqdevscales):
+        keep = dev <= fscale
+        flag_frac[i] = 1. - keep.mean()
+        resid_rms[i] = np.sqrt(np.mean((amp[keep] - med)**2))
+
+    return flag_frac, resid_rms
+
+
+def check_sweep(num_cores=1):
+    '''
+    Sweep synthetic spectra with injected RFI, using both `rflag_metrics`
+    and `stub_flagger`. The chosen thresholds should flag at least the RFI
+    and bring the residual RMS down to that of the same spectra without RFI.
+    '''
+    getter = SyntheticAmplitudes()
+    clean_getter = SyntheticAmplitudes(rfi_amp=0.)
+    spws = [0, 1]
+
+    for flagger in [rflag_metrics, stub_flagger]:
+        results = sweep_rflag_thresholds(getter, spws, flagger=flagger,
+                                         num_cores=num_cores)
+
+        for res in results:
+            i = np.where(res['freqdevscales'] == res['freqdevscale'])[0][0]
+            j = np.where(res['timedevscales'] == res['timedevscale'])[0][0]
+
+            rfi_frac = getter.rfi_mask(res['spw']).mean()
+            flag_frac = res['flag_frac'][i, j]
+
+            # Residual RMS with no flagging, with and without the RFI
+            no_flag = [np.inf]
+            rfi_rms = flagger(getter(res['spw']), no_flag, no_flag)[1][0, 0]
+            clean_rms = \
+                flagger(clean_getter(res['spw']), no_flag, no_flag)[1][0, 0]
+
+            print("{0}, SPW {1}: freqdevscale = {2}, timedevscale = {3}, "
+                  "flagged {4:.3f} (RFI {5:.3f}), residual RMS {6:.3f} "
+                  "(unflagged {7:.3f}, no RFI {8:.3f})"
+                  .format(flagger.__name__, res['spw'],
+                          res['freqdevscale'], res['timedevscale'],
+                          flag_frac, rfi_frac, res['resid_rms'][i, j],
+                          rfi_rms, clean_rms))
+
+            assert flag_frac >= rfi_frac
+            assert res['resid_rms'][i, j] <= clean_rms < rfi_rms
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    check_sweep(num_cores=int(sys.argv[1]) if len(sys.argv) > 1 else 1)
@@ -0,0 +1,504 @@
+
+'''
+Automatically propose bad scans from robust visibility statistics.
+
+Replaces looking through every per-scan plot from make_scan_plots.py. The MS
+is read once, and each row is reduced to its channel- and parallel-hand
+averaged visibility. Per-scan, per-SPW, per-antenna statistics are computed
+from these:
+
+* median amplitude and the MAD of the amplitude,
+* circular scatter of the phase,
+* fraction of closure phases involving the antenna beyond a threshold.
+
+Each scan is compared to the other scans on the same field in the same SPW
+with robust z-scores. Outlying scans are written in the same `_badscans.json`
+format as find_flag_badscans.py so only those need to be plotted.
+
+Running this module checks the proposals on synthetic visibilities:
+
+    python scan_statistics.py
+'''
+
+import os
+import json
+import numpy as np
+
+
+def robust_zscore(values, axis=None):
+    '''
+    (x - median) / (1.4826 * MAD). Returns zeros when the MAD is zero.
+    '''
+    values = np.asarray(values, dtype=float)
+    med = np.nanmedian(values, axis=axis, keepdims=True)
+    mad = 1.4826 * np.nanmedian(np.abs(values - med), axis=axis,
+                                keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (values - med) / mad
+    z[~np.isfinite(z)] = 0.
+    return z
+
+
+def circular_std(phases):
+    '''
+    Circular standard deviation of phases in radians.
+    '''
+    R = np.abs(np.nanmean(np.exp(1j * phases)))
+    R = np.clip(R, 1e-10, 1.)
+    return np.sqrt(-2 * np.log(R))
+
+
+def closure_outlier_fraction(time, ant1, ant2, vis, ants,
+                             threshold=np.deg2rad(20.)):
+    '''
+    For each antenna, the fraction of closure phases (over all triangles and
+    integrations) containing the antenna whose absolute value exceeds
+    `threshold`.
+
+    Parameters
+    ----------
+    time, ant1, ant2 : np.ndarray
+        Row times and antennas for a single scan and SPW.
+    vis : np.ndarray
+        Channel-averaged complex visibilities. Flagged rows are NaN.
+    ants : np.ndarray
+        Antenna IDs to return values for.
+    threshold : float, optional
+        Closure phase threshold in radians.
+
+    Returns
+    -------
+    frac : np.ndarray
+        Outlier fraction for each antenna in `ants`. NaN when the antenna is
+        in no valid triangle.
+    '''
+    nant = max(ant1.max(), ant2.max()) + 1 if ant1.size > 0 else 0
+    n_out = np.zeros(nant)
+    n_tot = np.zeros(nant)
+
+    # Triangles (i < j < k) for every antenna
+    ii, jj, kk = np.array([(i, j, k) for i in range(nant)
+                           for j in range(i + 1, nant)
+                           for k in range(j + 1, nant)], dtype=int).T \
+        if nant >= 3 else (np.array([], dtype=int),) * 3
+
+    for t in np.unique(time):
+        sel = time == t
+        V = np.full((nant, nant), np.NaN, dtype=complex)
+        a1 = ant1[sel]
+        a2 = ant2[sel]
+        V[a1, a2] = vis[sel]
+        V[a2, a1] = np.conj(vis[sel])
+
+        closure = V[ii, jj] * V[jj, kk] * V[kk, ii]
+        valid = np.isfinite(closure)
+        if not valid.any():
+            continue
+        outlier = np.zeros_like(valid)
+        outlier[valid] = np.abs(np.angle(closure[valid])) > threshold
+
+        for tri_ant in (ii, jj, kk):
+            n_tot += np.bincount(tri_ant[valid], minlength=nant)
+            n_out += np.bincount(tri_ant[outlier], minlength=nant)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = n_out / n_tot
+
+    return frac[ants]
+
+
+def antenna_statistics(scan, time, ant1, ant2, vis, closure=True,
+                       closure_threshold=np.deg2rad(20.)):
+    '''
+    Per-scan, per-antenna robust statistics for one SPW.
+
+    Returns
+    -------
+    stats : dict
+        Keys are scan numbers. Each value is a dictionary of arrays over
+        antennas: 'antennas', 'median_amp', 'mad_amp', 'phase_scatter' and
+        'closure_frac'.
+    '''
+    cross = ant1 != ant2
+    scan = scan[cross]
+    time = time[cross]
+    ant1 = ant1[cross]
+    ant2 = ant2[cross]
+    vis = vis[cross]
+
+    stats = {}
+
+    for sc in np.unique(scan):
+        sel = scan == sc
+        s_vis = vis[sel]
+        s_ant1 = ant1[sel]
+        s_ant2 = ant2[sel]
+
+        # Each baseline contributes to both of its antennas
+        ants_rows = np.concatenate([s_ant1, s_ant2])
+        vis_rows = np.concatenate([s_vis, s_vis])
+        good = np.isfinite(vis_rows)
+        ants_rows = ants_rows[good]
+        vis_rows = vis_rows[good]
+
+        if vis_rows.size == 0:
+            continue
+
+        order = np.argsort(ants_rows, kind='mergesort')
+        ants_rows = ants_rows[order]
+        vis_rows = vis_rows[order]
+        ants, starts = np.unique(ants_rows, return_index=True)
+        groups = np.split(vis_rows, starts[1:])
+
+        amps = [np.abs(grp) for grp in groups]
+        median_amp = np.array([np.median(amp) for amp in amps])
+        mad_amp = np.array([np.median(np.abs(amp - med))
+                            for amp, med in zip(amps, median_amp)])
+        phase_scatter = np.array([circular_std(np.angle(grp))
+                                  for grp in groups])
+
+        if closure:
+            closure_frac = \
+                closure_outlier_fraction(time[sel], s_ant1, s_ant2, s_vis,
+                                         ants, threshold=closure_threshold)
+        else:
+            closure_frac = np.zeros_like(median_amp)
+
+        stats[sc] = {'antennas': ants,
+                     'median_amp': median_amp,
+                     'mad_amp': mad_amp,
+                     'phase_scatter': phase_scatter,
+                     'closure_frac': closure_frac}
+
+    return stats
+
+
+def score_scans(stats, scan_fields, phase_fields=None):
+    '''
+    Score each scan against the other scans on the same field.
+
+    Parameters
+    ----------
+    stats : dict
+        Output of `antenna_statistics`.
+    scan_fields : dict
+        Field ID of each scan.
+    phase_fields : list, optional
+        Fields for which phase statistics are meaningful (i.e., the
+        calibrators). Defaults to all fields.
+
+    Returns
+    -------
+    scores : dict
+        For each scan, the 'amp' and 'phase' scores (the largest robust
+        z-score of the scan-level statistics), the closure outlier fraction
+        ('closure_frac', zero outside of `phase_fields`) and the number of
+        outlier antennas within the scan ('n_bad_ants' out of 'n_ants').
+    '''
+    scans = np.array(sorted(stats.keys()))
+    fields = np.array([scan_fields[sc] for sc in scans])
+
+    def scan_level(key):
+        return np.array([np.nanmedian(stats[sc][key]) for sc in scans])
+
+    med_amp = scan_level('median_amp')
+    mad_amp = scan_level('mad_amp')
+    phase_scat = scan_level('phase_scatter')
+    closure_frac = scan_level('closure_frac')
+
+    # Closure phases of noise-dominated fields are close to random
+    is_phase_field = np.array([phase_fields is None or field in phase_fields
+                               for field in fields], dtype=bool)
+    closure_frac[~is_phase_field] = 0.
+
+    amp_score = np.zeros(len(scans))
+    phase_score = np.zeros(len(scans))
+
+    for field in np.unique(fields):
+        sel = fields == field
+        # Amplitude offsets are bad in both directions, while only larger
+        # scatter is bad.
+        amp_score[sel] = np.maximum(np.abs(robust_zscore(med_amp[sel])),
+                                    robust_zscore(mad_amp[sel]))
+        if is_phase_field[sel][0]:
+            phase_score[sel] = np.maximum(robust_zscore(phase_scat[sel]),
+                                          robust_zscore(closure_frac[sel]))
+
+    scores = {}
+    for i, sc in enumerate(scans):
+        # Outlier antennas within the scan
+        ant_amp_z = np.abs(robust_zscore(stats[sc]['median_amp']))
+        ant_mad_z = robust_zscore(stats[sc]['mad_amp'])
+        bad_ants = (ant_amp_z > 5) | (ant_mad_z > 5)
+
+        scores[sc] = {'field': fields[i],
+                      'amp': amp_score[i],
+                      'phase': phase_score[i],
+                      'closure_frac': closure_frac[i],
+                      'n_bad_ants': int(bad_ants.sum()),
+                      'n_ants': int(bad_ants.size)}
+
+    return scores
+
+
+def propose_bad_scans(scores, nsigma=5., flag_nsigma=10.,
+                      flag_closure_frac=0.5):
+    '''
+    Sort scans into the categories used by find_flag_badscans.py. Besides
+    large z-scores, calibrator scans with at least `flag_closure_frac` of
+    their closure phases beyond the threshold are proposed for flagging.
+
+    Returns
+    -------
+    spw_dict : dict
+        With keys 'Amp' and 'Phase' (scans to inspect) and 'Flag' (scans to
+        flag entirely), each a comma-separated string of scan numbers.
+    ranking : list
+        (scan, score) sorted from most to least outlying.
+    '''
+    amp_scans = []
+    phase_scans = []
+    flag_scans = []
+
+    for sc in sorted(scores.keys()):
+        score = scores[sc]
+        if max(score['amp'], score['phase']) >= flag_nsigma or \
+                score['closure_frac'] >= flag_closure_frac:
+            flag_scans.append(sc)
+        elif score['amp'] >= nsigma:
+            amp_scans.append(sc)
+        elif score['phase'] >= nsigma:
+            phase_scans.append(sc)
+
+    def to_str(scans):
+        return ",".join(str(sc) for sc in scans)
+
+    ranking = sorted([(sc, max(scores[sc]['amp'], scores[sc]['phase']))
+                      for sc in scores], key=lambda x: x[1], reverse=True)
+
+    return {"Amp": to_str(amp_scans), "Phase": to_str(phase_scans),
+            "Flag": to_str(flag_scans)}, ranking
+
+
+def read_channel_averaged(vis, datacolumn='corrected', field='',
+                          maxrows=100000):
+    '''
+    Stream through an MS once, keeping only the channel- and
+    parallel-hand-averaged visibility of each row.
+
+    Returns
+    -------
+    spw_data : dict
+        For each data description ID, a dictionary of the row 'scan',
+        'time', 'field', 'ant1', 'ant2' and 'vis' arrays.
+    '''
+    from taskinit import mstool, tbtool
+
+    column = "corrected_data" if datacolumn == 'corrected' else "data"
+
+    tb = tbtool()
+    tb.open(os.path.join(vis, "DATA_DESCRIPTION"))
+    nddid = tb.nrows()
+    tb.close()
+
+    myms = mstool()
+    myms.open(vis)
+
+    spw_data = {}
+
+    for ddid in range(nddid):
+        myms.selectinit(datadescid=ddid)
+        if field != '':
+            myms.msselect({'field': field})
+
+        pieces = {key: [] for key in ['scan', 'time', 'field', 'ant1',
+                                      'ant2', 'vis']}
+
+        myms.iterinit(maxrows=maxrows)
+        myms.iterorigin()
+        while True:
+            rec = myms.getdata([column, 'flag', 'scan_number', 'time',
+                                'field_id', 'antenna1', 'antenna2'])
+            if len(rec) == 0:
+                break
+
+            data = rec[column][[0, -1]]
+            flags = rec['flag'][[0, -1]]
+            data[flags] = np.NaN
+            with np.errstate(invalid='ignore'):
+                avg = np.nanmean(data, axis=(0, 1))
+
+            pieces['scan'].append(rec['scan_number'])
+            pieces['time'].append(rec['time'])
+            pieces['field'].append(rec['field_id'])
+            pieces['ant1'].append(rec['antenna1'])
+            pieces['ant2'].append(rec['antenna2'])
+            pieces['vis'].append(avg)
+
+            if not myms.iternext():
+                break
+
+        myms.iterend()
+
+        if len(pieces['vis']) == 0:
+            continue
+
+        spw_data[ddid] = {key: np.concatenate(val)
+                          for key, val in pieces.items()}
+
+    myms.close()
+
+    return spw_data
+
+
+def calibrator_fields(vis):
+    '''
+    Field IDs observed with a CALIBRATE intent.
+    '''
+    from taskinit import tbtool
+
+    tb = tbtool()
+    tb.open(os.path.join(vis, 'STATE'))
+    intentcol = tb.getcol('OBS_MODE')
+    tb.close()
+
+    tb.open(vis)
+    field_ids = tb.getcol("FIELD_ID")
+    state_ids = tb.getcol("STATE_ID")
+    tb.close()
+
+    calib = set()
+    for fid in np.unique(field_ids):
+        intents = intentcol[np.unique(state_ids[field_ids == fid])]
+        if any("CALIBRATE" in intent for intent in intents):
+            calib.add(fid)
+    return calib
+
+
+def find_bad_scans(vis, out_file=None, nsigma=5., flag_nsigma=10.,
+                   datacolumn='corrected', closure=True):
+    '''
+    Compute the scan statistics for an MS and propose scans for flagging.
+
+    Parameters
+    ----------
+    vis : str
+        MS name.
+    out_file : str, optional
+        JSON file for the proposals. Defaults to `vis + "_badscans.json"`.
+    nsigma : float, optional
+        Robust z-score above which a scan is proposed for inspection.
+    flag_nsigma : float, optional
+        Robust z-score above which a scan is proposed to be flagged entirely.
+
+    Returns
+    -------
+    bad_scan_dict : dict
+        Proposals keyed by "spw_N", in the find_flag_badscans.py format.
+    rankings : dict
+        Scan rankings for each SPW.
+    '''
+    if out_file is None:
+        out_file = vis + "_badscans.json"
+
+    phase_fields = calibrator_fields(vis)
+
+    spw_data = read_channel_averaged(vis, datacolumn=datacolumn)
+
+    bad_scan_dict = {}
+    rankings = {}
+
+    for spw in sorted(spw_data.keys()):
+        dat = spw_data[spw]
+
+        stats = antenna_statistics(dat['scan'], dat['time'], dat['ant1'],
+                                   dat['ant2'], dat['vis'], closure=closure)
+        if len(stats) == 0:
+            continue
+
+        scan_fields = dict(zip(dat['scan'], dat['field']))
+
+        scores = score_scans(stats, scan_fields, phase_fields=phase_fields)
+
+        spw_key = "spw_{}".format(spw)
+        bad_scan_dict[spw_key], rankings[spw_key] = \
+            propose_bad_scans(scores, nsigma=nsigma, flag_nsigma=flag_nsigma)
+
+    with open(out_file, "w") as f:
+        json.dump(bad_scan_dict, f)
+
+    return bad_scan_dict, rankings
+
+
+def synthetic_scans(nscan=8, nant=10, ntime=20, target_flux=0.,
+                    noise=1., seed=0):
+    '''
+    Channel-averaged visibilities of alternating calibrator (field 0) and
+    target (field 1) scans. The calibrator is a 10 Jy point source, and the
+    target has a point source of `target_flux` so it is noise-dominated by
+    default.
+
+    Returns
+    -------
+    data : dict
+        Row 'scan', 'time', 'field', 'ant1', 'ant2' and 'vis' arrays, as in
+        the output of `read_channel_averaged`.
+    '''
+    rng = np.random.RandomState(seed)
+
+    a1, a2 = np.triu_indices(nant, k=1)
+    nbase = a1.size
+
+    pieces = {key: [] for key in ['scan', 'time', 'field', 'ant1', 'ant2',
+                                  'vis']}
+
+    for sc in range(1, nscan + 1):
+        field = 0 if sc % 2 == 1 else 1
+        flux = 10. if field == 0 else target_flux
+
+        # Antenna-based phases cancel in the closure phases
+        ant_phase = rng.uniform(-np.pi, np.pi, nant)
+
+        for t in range(ntime):
+            vis = flux * np.exp(1j * (ant_phase[a1] - ant_phase[a2])) + \
+                noise * (rng.randn(nbase) + 1j * rng.randn(nbase)) / \
+                np.sqrt(2)
+
+            pieces['scan'].append(np.full(nbase, sc))
+            pieces['time'].append(np.full(nbase, 100. * sc + t))
+            pieces['field'].append(np.full(nbase, field))
+            pieces['ant1'].append(a1)
+            pieces['ant2'].append(a2)
+            pieces['vis'].append(vis)
+
+    return {key: np.concatenate(val) for key, val in pieces.items()}
+
+
+def check_noise_target():
+    '''
+    A clean, noise-only target field should not have any scans proposed for
+    flagging, even though most of its closure phases exceed the threshold.
+    '''
+    dat = synthetic_scans()
+
+    stats = antenna_statistics(dat['scan'], dat['time'], dat['ant1'],
+                               dat['ant2'], dat['vis'])
+    scan_fields = dict(zip(dat['scan'], dat['field']))
+    scores = score_scans(stats, scan_fields, phase_fields=[0])
+
+    proposals, ranking = propose_bad_scans(scores)
+
+    target_closure = [np.nanmedian(stats[sc]['closure_frac'])
+                      for sc in stats if scan_fields[sc] == 1]
+
+    print("Target closure outlier fraction: {:.2f}"
+          .format(np.median(target_closure)))
+    print("Proposals: {}".format(proposals))
+
+    assert np.median(target_closure) > 0.5
+    assert proposals['Flag'] == ""
+
+
+if __name__ == "__main__":
+
+    check_noise_target()
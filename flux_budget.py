@@ -0,0 +1,406 @@
+
+'''
+Total flux spectra of several cubes within several spatial masks.
+
+The total spectrum of a cube within a mask is the sum of each channel over
+the mask, converted to Jy. All of the masks for a cube are summed in the same
+pass: each block of channels is read once and multiplied by the stack of
+masks. Blocks are run in a process pool.
+
+The cubes must share a pixel grid. A larger cube on the same grid (e.g.,
+a single-dish cube registered to the full VLA grid, compared with a VLA cube
+cut to the primary beam) is summed over the cutout that matches the
+smallest cube.
+
+Spectra are saved in the cache folder with keys made from the checksum of
+the cube (and of its signal mask) and the checksum of the spatial mask, so
+a cube is only read again when it changes. Adding a new cube to a comparison
+only processes the new cube, and the single-dish cube shared by several
+comparisons is summed once.
+'''
+
+import os
+import json
+import hashlib
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs.utils import proj_plane_pixel_area
+from astropy.utils.console import ProgressBar
+from multiprocessing import Pool
+from spectral_cube import SpectralCube
+
+from resolution_pyramid import file_checksum
+from sd_regrid import cube_hdu_data
+from feather_engine import _check_spectral_axes
+
+
+_worker_state = dict()
+
+
+def jy_per_pixel_factors(cube, restfreq=None):
+    '''
+    Factors that convert each channel of a cube to Jy per pixel.
+
+    Parameters
+    ----------
+    cube : spectral_cube.SpectralCube
+        Cube in brightness temperature or in Jy/beam.
+    restfreq : astropy.units.Quantity, optional
+        Frequency for the K to Jy/beam conversion. Taken from the header if
+        not given.
+
+    Returns
+    -------
+    factors : np.ndarray
+        One factor per channel.
+    '''
+    nchan = cube.shape[0]
+
+    if hasattr(cube, 'beams'):
+        beams = list(cube.beams)
+    else:
+        beams = [cube.beam] * nchan
+
+    if restfreq is None:
+        restfreq = cube.header.get('RESTFRQ', cube.header.get('RESTFREQ'))
+        if restfreq is not None:
+            restfreq = restfreq * u.Hz
+
+    pix_area = proj_plane_pixel_area(cube.wcs.celestial) * u.deg**2
+
+    jybm = u.Jy / u.beam
+
+    if cube.unit.is_equivalent(jybm):
+        scale = cube.unit.to(jybm)
+        return np.array([scale * (pix_area / beam.sr).decompose().value
+                         for beam in beams])
+    elif cube.unit.is_equivalent(u.K):
+        if restfreq is None:
+            raise ValueError("restfreq is needed to convert from K to "
+                             "Jy/beam.")
+        scale = cube.unit.to(u.K)
+        return np.array([scale / beam.jtok(restfreq).value *
+                         (pix_area / beam.sr).decompose().value
+                         for beam in beams])
+
+    raise ValueError("Cannot convert {} to Jy.".format(cube.unit))
+
+
+def grid_cutout(ref_cube, cube, atol=1e-3):
+    '''
+    Spatial slices of `cube` that match the grid of `ref_cube`.
+
+    Parameters
+    ----------
+    ref_cube : spectral_cube.SpectralCube
+        Cube that sets the grid.
+    cube : spectral_cube.SpectralCube
+        Cube on the same pixel grid as `ref_cube`, and covering all of it.
+    atol : float, optional
+        Allowed offset from whole pixels.
+
+    Returns
+    -------
+    cutout : tuple of slice
+        Slices along the y and x axes, or None when the cubes have the same
+        spatial shape.
+    '''
+    if cube.shape[1:] == ref_cube.shape[1:]:
+        return None
+
+    ny, nx = ref_cube.shape[1:]
+
+    # The corners of the reference grid must land on whole pixels with the
+    # same offset, so the pixel size and orientation also have to match.
+    corners = np.array([[0, 0], [nx - 1, 0], [0, ny - 1], [nx - 1, ny - 1]],
+                       dtype=float)
+    world = ref_cube.wcs.celestial.wcs_pix2world(corners, 0)
+    offsets = cube.wcs.celestial.wcs_world2pix(world, 0) - corners
+
+    offset = np.round(offsets[0])
+
+    if np.any(np.abs(offsets - offset) > atol):
+        raise ValueError("The cube with shape {0} is not on the grid of the "
+                         "cube with shape {1}. Regrid it first (see "
+                         "sd_regrid).".format(cube.shape, ref_cube.shape))
+
+    x0, y0 = int(offset[0]), int(offset[1])
+
+    if x0 < 0 or y0 < 0 or x0 + nx > cube.shape[2] or \
+            y0 + ny > cube.shape[1]:
+        raise ValueError("The cube with shape {0} does not cover the cube "
+                         "with shape {1}.".format(cube.shape, ref_cube.shape))
+
+    return (slice(y0, y0 + ny), slice(x0, x0 + nx))
+
+
+def _mask_key(mask):
+    sha = hashlib.sha1(str(mask.shape).encode('utf-8'))
+    sha.update(np.ascontiguousarray(mask, dtype=bool).view(np.uint8))
+    return sha.hexdigest()
+
+
+def _init_worker(cube_file, signal_mask_file, masks, factors, cutout):
+    '''
+    Open the cube (and its signal mask) once in each worker.
+    '''
+    _worker_state['cube'] = cube_hdu_data(fits.open(cube_file,
+                                                    mode='denywrite')[0])
+    if signal_mask_file is not None:
+        _worker_state['signal_mask'] = \
+            cube_hdu_data(fits.open(signal_mask_file, mode='denywrite')[0])
+    else:
+        _worker_state['signal_mask'] = None
+    _worker_state['masks'] = masks
+    _worker_state['factors'] = factors
+    _worker_state['cutout'] = cutout
+
+
+def _sum_block(chans):
+    '''
+    Sum a block of channels within each of the masks.
+    '''
+    nchan = chans.stop - chans.start
+
+    cutout = _worker_state['cutout']
+    if cutout is None:
+        cutout = (slice(None), slice(None))
+    view = (chans,) + cutout
+
+    slab = np.asarray(_worker_state['cube'][view], dtype=float)
+    slab = slab.reshape((nchan, -1))
+
+    good = np.isfinite(slab)
+
+    signal_mask = _worker_state['signal_mask']
+    if signal_mask is not None:
+        good &= np.asarray(signal_mask[view]).reshape((nchan, -1)) > 0
+
+    sums = np.where(good, slab, 0.).dot(_worker_state['masks'].T)
+    sums *= _worker_state['factors'][chans][:, np.newaxis]
+
+    return chans, sums
+
+
+class FluxBudget(object):
+    '''
+    Disk-cached total flux spectra of cubes within spatial masks.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Folder for the saved spectra and the index of checksums.
+    restfreq : astropy.units.Quantity, optional
+        Frequency for converting cubes in K to Jy/beam.
+    '''
+    def __init__(self, cache_dir, restfreq=None):
+        self.cache_dir = cache_dir
+        self.restfreq = restfreq
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self._index_file = os.path.join(cache_dir, "flux_budget_index.json")
+
+    def _read_index(self):
+        if not os.path.exists(self._index_file):
+            return {'checksums': {}}
+        with open(self._index_file, 'r') as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        tmp_name = self._index_file + ".tmp"
+        with open(tmp_name, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.rename(tmp_name, self._index_file)
+
+    def checksum(self, filename):
+        '''
+        Checksum of a file. The checksum is kept in the index with the file
+        size and modification time so each version of a file is only read
+        once.
+        '''
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        file_id = [stat.st_size, stat.st_mtime]
+
+        index = self._read_index()
+        saved = index['checksums'].get(filename)
+
+        if saved is not None and saved[:2] == file_id:
+            return saved[2]
+
+        checksum = file_checksum(filename)
+        index['checksums'][filename] = file_id + [checksum]
+        self._write_index(index)
+
+        return checksum
+
+    def _cube_key(self, cube_file, signal_mask_file, cutout=None):
+        parts = [self.checksum(cube_file)]
+        if signal_mask_file is not None:
+            parts.append(self.checksum(signal_mask_file))
+        if self.restfreq is not None:
+            parts.append(str(self.restfreq.to(u.Hz).value))
+        if cutout is not None:
+            parts.append("{0}:{1},{2}:{3}".format(cutout[0].start,
+                                                  cutout[0].stop,
+                                                  cutout[1].start,
+                                                  cutout[1].stop))
+        return hashlib.sha1("|".join(parts).encode('utf-8')).hexdigest()
+
+    def _cache_name(self, cube_key, mask_key):
+        return os.path.join(self.cache_dir,
+                            "flux_{0}_{1}.npy".format(cube_key[:16],
+                                                      mask_key[:16]))
+
+    def _sum_cube(self, cube_file, signal_mask_file, masks, factors, cutout,
+                  chunk, num_cores, verbose):
+        '''
+        Total spectra of one cube within a stack of masks, in one pass.
+        '''
+        nchan = factors.size
+
+        init_args = (cube_file, signal_mask_file,
+                     masks.reshape((masks.shape[0], -1)).astype(float),
+                     factors, cutout)
+
+        blocks = [slice(start, min(start + chunk, nchan))
+                  for start in range(0, nchan, chunk)]
+
+        spectra = np.empty((masks.shape[0], nchan))
+
+        if verbose:
+            pbar = ProgressBar(len(blocks))
+
+        if num_cores > 1:
+            pool = Pool(num_cores, initializer=_init_worker,
+                        initargs=init_args)
+            try:
+                for chans, sums in pool.imap_unordered(_sum_block, blocks):
+                    spectra[:, chans] = sums.T
+                    if verbose:
+                        pbar.update()
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _init_worker(*init_args)
+            for block in blocks:
+                chans, sums = _sum_block(block)
+                spectra[:, chans] = sums.T
+                if verbose:
+                    pbar.update()
+
+        _worker_state.clear()
+
+        return spectra
+
+    def total_spectra(self, cubes, masks, chunk=8, num_cores=1,
+                      spec_rtol=None, verbose=True):
+        '''
+        Total flux spectra of each cube within each mask. Only the
+        combinations that are not in the cache are computed.
+
+        Parameters
+        ----------
+        cubes : dict
+            Cubes on a common pixel grid, given as {name: filename} or
+            {name: (filename, signal_mask_filename)}. Pixels outside of the
+            signal mask are not included in the sums. Larger cubes are
+            summed over the cutout matching the smallest cube.
+        masks : dict
+            Spatial masks on the grid of the smallest cube, given as
+            {name: 2D boolean array}. A mask of None includes every pixel.
+        chunk : int, optional
+            Number of channels in each block.
+        num_cores : int, optional
+            Number of processes.
+        spec_rtol : float, optional
+            When given, the spectral axes of the cubes must agree to this
+            fraction of the channel width.
+        verbose : bool, optional
+            Show a progress bar for each cube that is read.
+
+        Returns
+        -------
+        spectra : dict
+            {cube name: {mask name: spectrum}}, with the spectra in Jy.
+        '''
+        opened = []
+
+        for name, cube_file in cubes.items():
+            if isinstance(cube_file, (tuple, list)):
+                cube_file, signal_mask_file = cube_file
+            else:
+                signal_mask_file = None
+
+            opened.append((name, cube_file, signal_mask_file,
+                           SpectralCube.read(cube_file)))
+
+        # The smallest cube sets the common grid
+        ref_cube = min([cube for _, _, _, cube in opened],
+                       key=lambda cube: cube.shape[1] * cube.shape[2])
+
+        cutouts = {}
+        for name, _, _, cube in opened:
+            try:
+                cutouts[name] = grid_cutout(ref_cube, cube)
+            except ValueError as err:
+                raise ValueError("{0}: {1}".format(name, err))
+
+            if spec_rtol is not None:
+                _check_spectral_axes(ref_cube, cube, spec_rtol)
+
+        grid_shape = ref_cube.shape[1:]
+
+        del ref_cube
+
+        spectra = {}
+
+        for name, cube_file, signal_mask_file, cube in opened:
+            cutout = cutouts[name]
+
+            cube_key = self._cube_key(cube_file, signal_mask_file, cutout)
+
+            spectra[name] = {}
+            missing = []
+
+            for mask_name, mask in masks.items():
+                if mask is None:
+                    mask = np.ones(grid_shape, dtype=bool)
+                mask = np.asarray(mask, dtype=bool)
+                if mask.ndim > 2:
+                    mask = np.squeeze(mask)
+
+                if mask.shape != grid_shape:
+                    raise ValueError("Mask {0} has shape {1}, but the cubes "
+                                     "have shape {2}."
+                                     .format(mask_name, mask.shape,
+                                             grid_shape))
+
+                cache_name = self._cache_name(cube_key, _mask_key(mask))
+
+                if os.path.exists(cache_name):
+                    spectra[name][mask_name] = np.load(cache_name)
+                else:
+                    missing.append((mask_name, mask, cache_name))
+
+            if len(missing) == 0:
+                continue
+
+            factors = jy_per_pixel_factors(cube, restfreq=self.restfreq)
+
+            sums = self._sum_cube(cube_file, signal_mask_file,
+                                  np.array([mask for _, mask, _ in missing]),
+                                  factors, cutout, chunk, num_cores,
+                                  verbose)
+
+            for (mask_name, mask, cache_name), spec in zip(missing, sums):
+                tmp_name = cache_name + ".tmp.npy"
+                np.save(tmp_name, spec)
+                os.rename(tmp_name, cache_name)
+                spectra[name][mask_name] = spec
+
+        return spectra
@@ -1,43 +1,126 @@
 
 '''
 Use parameters from Diskfit in the Galaxy class
+
+The galaxies are made the first time one of their attributes is used, so
+importing `gal` or `gal_feath` does not read the DiskFit tables or import
+`galaxies` and `cube_analysis`. The parameter tables are cached in a pickle
+next to each table and are reread when the table changes.
 '''
 
-from galaxies import Galaxy
-from astropy.table import Table
+import os
+import pickle
 import astropy.units as u
 
-from cube_analysis.rotation_curves import update_galaxy_params
-
 from paths import fourteenB_HI_data_path, fourteenB_HI_data_wGBT_path
 
-# The models from the peak velocity aren't as biased, based on comparing
-# the VLA and VLA+GBT velocity curves. Using these as the defaults
 
-folder_name = "diskfit_peakvels_noasymm_noradial_nowarp_output"
+def read_param_table(param_name):
+    '''
+    Read a DiskFit parameter table. The columns are cached in
+    `param_name + ".pkl"` and used until the size or modification time of the
+    table changes.
+    '''
+    from astropy.table import Table
 
-param_name = \
-    fourteenB_HI_data_path("{}/rad.out.params.csv".format(folder_name))
+    stat = os.stat(param_name)
+    file_id = [stat.st_size, stat.st_mtime]
 
-param_table = Table.read(param_name)
+    cache_name = param_name + ".pkl"
 
-gal = Galaxy("M33")
+    if os.path.exists(cache_name):
+        try:
+            with open(cache_name, 'rb') as f:
+                cached = pickle.load(f)
+            if cached['file_id'] == file_id:
+                return Table(cached['columns'], names=cached['names'])
+        except Exception:
+            # Rebuild unreadable caches
+            pass
 
-update_galaxy_params(gal, param_table)
+    param_table = Table.read(param_name)
 
-# Load in the model from the feathered data as well.
-folder_name = "diskfit_peakvels_noasymm_noradial_nowarp_output"
+    cached = {'file_id': file_id, 'names': param_table.colnames,
+              'columns': [param_table[name].data
+                          for name in param_table.colnames]}
 
-param_name = \
-    fourteenB_HI_data_wGBT_path("{}/rad.out.params.csv".format(folder_name))
+    try:
+        tmp_name = cache_name + ".tmp"
+        with open(tmp_name, 'wb') as f:
+            pickle.dump(cached, f, protocol=2)
+        os.rename(tmp_name, cache_name)
+    except (IOError, OSError):
+        # The cache is optional
+        pass
+
+    return param_table
+
+
+class LazyGalaxy(object):
+    '''
+    Stand-in for a `galaxies.Galaxy` of M33 that is made on first use, with
+    the parameters from a DiskFit table.
+
+    Parameters
+    ----------
+    param_name : str
+        DiskFit rad.out.params.csv table.
+    distance : astropy.units.Quantity, optional
+        Distance to set, in place of the default in `galaxies`.
+    '''
+    def __init__(self, param_name, distance=840 * u.kpc):
+        object.__setattr__(self, '_param_name', param_name)
+        object.__setattr__(self, '_distance', distance)
+        object.__setattr__(self, '_galaxy', None)
+
+    def galaxy(self):
+        '''
+        Return the Galaxy, making it on the first call.
+        '''
+        if self._galaxy is None:
+            from galaxies import Galaxy
+            from cube_analysis.rotation_curves import update_galaxy_params
+
+            gal = Galaxy("M33")
 
-param_table = Table.read(param_name)
+            update_galaxy_params(gal, read_param_table(self._param_name))
 
-gal_feath = Galaxy("M33")
+            gal.distance = self._distance
 
-update_galaxy_params(gal_feath, param_table)
+            object.__setattr__(self, '_galaxy', gal)
+
+        return self._galaxy
+
+    def __getattr__(self, name):
+        # Avoid making the galaxy when copying or pickling the stand-in
+        if name.startswith('__') or name in ('_param_name', '_distance',
+                                             '_galaxy'):
+            raise AttributeError(name)
+
+        return getattr(self.galaxy(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.galaxy(), name, value)
+
+    def __repr__(self):
+        return repr(self.galaxy())
+
+
+# The models from the peak velocity aren't as biased, based on comparing
+# the VLA and VLA+GBT velocity curves. Using these as the defaults
+
+folder_name = "diskfit_peakvels_noasymm_noradial_nowarp_output"
+
+param_name = \
+    fourteenB_HI_data_path("{}/rad.out.params.csv".format(folder_name),
+                           no_check=True)
 
 # Force 840 kpc for the distance
+gal = LazyGalaxy(param_name, distance=840 * u.kpc)
+
+# Load in the model from the feathered data as well.
+feath_param_name = \
+    fourteenB_HI_data_wGBT_path("{}/rad.out.params.csv".format(folder_name),
+                                no_check=True)
 
-gal.distance = 840 * u.kpc
-gal_feath.distance = 840 * u.kpc
+gal_feath = LazyGalaxy(feath_param_name, distance=840 * u.kpc)
@@ -0,0 +1,318 @@
+
+'''
+Convolve cubes to a target beam and regrid them onto a target grid in one
+pass.
+
+This matches the spatial-only `cube_analysis.reprojection.reproject_cube` with
+`common_beam=True`: every channel is convolved to the beam of the target cube
+and then reprojected with bilinear interpolation (see
+`reprojection_weights`), keeping the spectral axis of the input.
+
+* Only the part of the input that overlaps the target grid, padded by the
+  size of the convolution kernel, is read and convolved.
+* The reprojection weights for the pair of grids are computed once and
+  cached, so cubes at different spectral resolutions on the same spatial grid
+  share them.
+* The convolution kernels are computed once for each distinct beam. Channels
+  in a block with the same beam are convolved together with one batched FFT,
+  using the Fourier transform of the kernel computed once in each worker.
+
+Blocks of channels are run in a process pool and written straight into the
+pre-allocated output FITS file.
+'''
+
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_area
+from astropy.utils.console import ProgressBar
+from multiprocessing import Pool
+from spectral_cube import SpectralCube
+
+from cube_analysis.io_utils import create_huge_fits
+
+from reprojection_weights import reprojection_matrix
+from sd_regrid import cube_hdu_data
+from feather_engine import rfft2, irfft2, _fft_kwargs
+
+
+_worker_state = dict()
+
+
+def target_beam(cube):
+    '''
+    Beam of a cube, or the common beam of a cube with multiple beams.
+    '''
+    if hasattr(cube, 'beams'):
+        return cube.beams.common_beam()
+    return cube.beam
+
+
+def beam_kernels(cube, beam):
+    '''
+    Convolution kernels from the beams of a cube to `beam`.
+
+    Returns
+    -------
+    kernels : list
+        Kernel arrays for each distinct beam.
+    kernel_ids : np.ndarray
+        Index of the kernel for each channel, or -1 for channels that are
+        already at `beam`.
+    ratios : np.ndarray
+        Factor applied to each convolved channel to keep Jy/beam units.
+    '''
+    nchan = cube.shape[0]
+
+    if hasattr(cube, 'beams'):
+        beams = list(cube.beams)
+    else:
+        beams = [cube.beam] * nchan
+
+    pixscale = proj_plane_pixel_area(cube.wcs.celestial)**0.5 * u.deg
+
+    # Only use the beam ratios when convolving in Jy/beam
+    is_jybm = cube.unit.is_equivalent(u.Jy / u.beam)
+
+    kernels = []
+    kernel_beams = []
+    kernel_ids = np.empty(nchan, dtype=int)
+    ratios = np.ones(nchan)
+
+    for chan, chan_beam in enumerate(beams):
+        if chan_beam == beam:
+            kernel_ids[chan] = -1
+            continue
+
+        if is_jybm:
+            ratios[chan] = (beam.sr / chan_beam.sr).decompose().value
+
+        if chan_beam in kernel_beams:
+            kernel_ids[chan] = kernel_beams.index(chan_beam)
+            continue
+
+        kern = beam.deconvolve(chan_beam).as_kernel(pixscale).array
+        kernels.append(kern / kern.sum())
+        kernel_beams.append(chan_beam)
+        kernel_ids[chan] = len(kernels) - 1
+
+    return kernels, kernel_ids, ratios
+
+
+def _kernel_fft(kern_id, fshape):
+    '''
+    Fourier transform of a kernel, computed once per worker.
+    '''
+    key = (kern_id, fshape)
+
+    kfft_cache = _worker_state['kernel_ffts']
+
+    if key not in kfft_cache:
+        kfft_cache[key] = rfft2(_worker_state['kernels'][kern_id], s=fshape,
+                                **_fft_kwargs(_worker_state['fft_threads']))
+
+    return kfft_cache[key]
+
+
+def _convolve_stack(stack, kern_id):
+    '''
+    Convolve a stack of planes with one kernel. NaNs are interpolated over
+    and kept in the output, and the edges are filled with zeros, as in
+    `astropy.convolution.convolve` used by `SpectralCube.convolve_to`.
+    '''
+    kern = _worker_state['kernels'][kern_id]
+    fft_kwargs = _fft_kwargs(_worker_state['fft_threads'])
+
+    ny, nx = stack.shape[1:]
+    ky, kx = kern.shape
+
+    # Pad to avoid wrapping around
+    fshape = (ny + ky - 1, nx + kx - 1)
+
+    kfft = _kernel_fft(kern_id, fshape)
+
+    finite = np.isfinite(stack)
+
+    def conv(arr):
+        return irfft2(rfft2(arr, s=fshape, **fft_kwargs) * kfft, s=fshape,
+                      **fft_kwargs)[:, ky // 2:ky // 2 + ny,
+                                    kx // 2:kx // 2 + nx]
+
+    # Only the NaNs are interpolated over. The zero-filled edges keep their
+    # kernel weight.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = conv(np.where(finite, stack, 0.)) / \
+            (1. - conv((~finite).astype(float)))
+
+    out[~finite] = np.NaN
+
+    return out
+
+
+def _init_worker(input_file, output_file, output_offset, output_shape,
+                 weights, slices, kernels, kernel_ids, ratios, fft_threads):
+    '''
+    Open the input and output once in each worker.
+    '''
+    _worker_state['input'] = cube_hdu_data(fits.open(input_file,
+                                                     mode='denywrite')[0])
+    _worker_state['output'] = np.memmap(output_file, dtype='>f4', mode='r+',
+                                        offset=output_offset,
+                                        shape=output_shape)
+    _worker_state['weights'] = weights
+    _worker_state['slices'] = slices
+    _worker_state['kernels'] = kernels
+    _worker_state['kernel_ids'] = kernel_ids
+    _worker_state['ratios'] = ratios
+    _worker_state['fft_threads'] = fft_threads
+    _worker_state['kernel_ffts'] = dict()
+
+
+def _match_block(chans):
+    '''
+    Convolve and reproject a block of channels and write them to the output.
+    '''
+    weights = _worker_state['weights']
+    yslice, xslice = _worker_state['slices']
+
+    slab = np.asarray(_worker_state['input'][chans, yslice, xslice],
+                      dtype=float)
+
+    kernel_ids = _worker_state['kernel_ids'][chans]
+    ratios = _worker_state['ratios'][chans]
+
+    for kern_id in np.unique(kernel_ids):
+        if kern_id < 0:
+            continue
+        same = kernel_ids == kern_id
+        slab[same] = _convolve_stack(slab[same], kern_id) * \
+            ratios[same][:, np.newaxis, np.newaxis]
+
+    slab = slab.reshape((chans.stop - chans.start, -1))
+
+    out = weights.matrix.dot(slab.T).T
+    out[:, ~weights.valid] = np.NaN
+
+    output = _worker_state['output']
+    output[chans.start:chans.stop] = \
+        out.reshape((-1,) + weights.shape_out).astype(np.float32)
+    output.flush()
+
+    return chans
+
+
+def match_cube(input_file, target_file, output_file, beam=None, chunk=8,
+               num_cores=1, fft_threads=1, cache_dir=None, verbose=True):
+    '''
+    Convolve a cube to the beam of a target cube and reproject it onto the
+    target's spatial grid. The spectral axis is unchanged.
+
+    Parameters
+    ----------
+    input_file : str
+        FITS file of the cube.
+    target_file : str
+        FITS file of the cube with the target grid and beam.
+    output_file : str
+        Name of the output FITS file.
+    beam : radio_beam.Beam, optional
+        Beam to convolve to. Defaults to the (common) beam of the target.
+    chunk : int, optional
+        Number of channels in each block.
+    num_cores : int, optional
+        Number of processes.
+    fft_threads : int, optional
+        Threads used by each process for the FFTs.
+    cache_dir : str, optional
+        Folder to save the reprojection weights in.
+    verbose : bool, optional
+        Show a progress bar.
+    '''
+    target_header = fits.getheader(target_file)
+
+    if beam is None:
+        beam = target_beam(SpectralCube.read(target_file))
+
+    cube = SpectralCube.read(input_file)
+
+    kernels, kernel_ids, ratios = beam_kernels(cube, beam)
+
+    shape_out = (target_header['NAXIS2'], target_header['NAXIS1'])
+    output_shape = (cube.shape[0],) + shape_out
+
+    weights = reprojection_matrix(cube.wcs.celestial, cube.shape[1:],
+                                  WCS(target_header).celestial, shape_out,
+                                  cache_dir=cache_dir)
+    # Only read and convolve the part of the input that overlaps the target,
+    # with enough padding for the convolution to be the same as for the
+    # whole plane.
+    pad = max([max(kern.shape) // 2 for kern in kernels] + [0])
+    slices, weights = weights.crop_input(pad=pad)
+
+    # Target grid with the input spectral axis and the new beam
+    output_header = cube.header.copy()
+    for key in list(output_header.keys()):
+        if key[:2] in ('PC', 'CD') and '_' in key and \
+                ('1' in key[2:] or '2' in key[2:]):
+            del output_header[key]
+    celestial_header = WCS(target_header).celestial.to_header()
+    for key in celestial_header:
+        output_header[key] = celestial_header[key]
+    output_header['NAXIS1'] = shape_out[1]
+    output_header['NAXIS2'] = shape_out[0]
+    output_header['BITPIX'] = -32
+    if 'CASAMBM' in output_header:
+        del output_header['CASAMBM']
+    output_header.update(beam.to_header_keywords())
+
+    del cube
+
+    create_huge_fits(output_file, output_header)
+
+    with fits.open(output_file) as hdulist:
+        output_offset = hdulist.fileinfo(0)['datLoc']
+
+    init_args = (input_file, output_file, output_offset, output_shape,
+                 weights, slices, kernels, kernel_ids, ratios, fft_threads)
+
+    blocks = [slice(start, min(start + chunk, output_shape[0]))
+              for start in range(0, output_shape[0], chunk)]
+
+    if verbose:
+        pbar = ProgressBar(len(blocks))
+
+    if num_cores > 1:
+        pool = Pool(num_cores, initializer=_init_worker, initargs=init_args)
+        try:
+            for _ in pool.imap_unordered(_match_block, blocks):
+                if verbose:
+                    pbar.update()
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(*init_args)
+        for block in blocks:
+            _match_block(block)
+            if verbose:
+                pbar.update()
+
+    _worker_state.clear()
+
+
+def match_cubes(input_files, target_file, output_files, **kwargs):
+    '''
+    Match several cubes to one target. The target beam is found once and
+    cubes on the same spatial grid share the reprojection weights. Keywords
+    are passed to `match_cube`.
+    '''
+    if len(input_files) != len(output_files):
+        raise ValueError("input_files and output_files must have the same "
+                         "length.")
+
+    if kwargs.get('beam') is None:
+        kwargs['beam'] = target_beam(SpectralCube.read(target_file))
+
+    for input_file, output_file in zip(input_files, output_files):
+        match_cube(input_file, target_file, output_file, **kwargs)
@@ -0,0 +1,67 @@
+
+'''
+Time the imports of the configuration modules used by every script. Each
+module is imported in a new interpreter, so nothing is reused from earlier
+imports.
+
+Fails when an import is slower than the limit, or when galaxy_params loads
+the galaxy models at import instead of on first use.
+
+Usage:
+python import_benchmark.py [max_seconds]
+'''
+
+import sys
+import subprocess
+
+
+modules = ["paths", "constants", "galaxy_params"]
+
+# Modules only needed once a galaxy is used
+deferred_modules = ["galaxies", "cube_analysis"]
+
+timer_code = \
+    "import sys, time; t0 = time.time(); import {0}; " \
+    "print('{{0}} {{1}}'.format(time.time() - t0, " \
+    "','.join([mod for mod in {1} if mod in sys.modules])))"
+
+
+def time_import(module):
+    '''
+    Return the import time of `module` in seconds and the deferred modules
+    that it imported.
+    '''
+    output = subprocess.check_output([sys.executable, "-c",
+                                      timer_code.format(module,
+                                                        deferred_modules)])
+    # The timing is on the last line
+    last_line = output.decode('utf-8').strip().splitlines()[-1].split(' ')
+
+    import_time = float(last_line[0])
+    loaded = [mod for mod in last_line[1].split(',') if mod] \
+        if len(last_line) > 1 else []
+
+    return import_time, loaded
+
+
+if __name__ == "__main__":
+
+    max_time = float(sys.argv[1]) if len(sys.argv) > 1 else 2.
+
+    failed = False
+
+    for module in modules:
+        import_time, loaded = time_import(module)
+
+        print("{0}: {1:.3f} s".format(module, import_time))
+
+        if import_time > max_time:
+            print("  slower than {} s".format(max_time))
+            failed = True
+
+        if loaded:
+            print("  imported {}".format(", ".join(loaded)))
+            failed = True
+
+    if failed:
+        sys.exit(1)
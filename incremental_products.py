@@ -0,0 +1,354 @@
+
+'''
+Moment maps, peak temperature and stacked spectra that are updated one
+channel at a time.
+
+The moments are kept as per-pixel partial sums over the channels within the
+signal mask:
+
+    S0 = sum(T), S1 = sum(T * v), S2 = sum(T * v**2)
+
+so moment 0 is S0 * |dv|, moment 1 is S1 / S0 and moment 2 is
+S2 / S0 - (S1 / S0)**2. The stacked spectra are sums of the spectra in each
+bin (e.g., radial bins), shifted to the nearest channel by a fixed velocity
+surface (e.g., the rotation model or the peak velocities), so each channel
+adds to a single channel of each stack.
+
+When a channel image is replaced (e.g., after re-imaging a channel that
+diverged in clean), its old contribution is subtracted from the sums and
+stacks and the new one added. The peak temperature is updated directly,
+except where the replaced channel held the peak and its value dropped. Only
+those spectra are read to find the new peak. The cube on disk is updated so
+later replacements subtract the right values.
+
+The saved state records the size and modification time of the cube and
+the signal mask, and a hash of the stacking parameters. The products are
+rebuilt when these change outside of `replace_channel`.
+'''
+
+import os
+import hashlib
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.utils.console import ProgressBar
+from spectral_cube import SpectralCube
+
+from sd_regrid import cube_hdu_data
+
+
+class IncrementalProducts(object):
+    '''
+    Per-channel partial sums for the moments, peak temperature and stacks
+    of a cube.
+
+    Parameters
+    ----------
+    cube_file : str
+        FITS file of the assembled cube. It is updated in place when a
+        channel is replaced.
+    state_file : str
+        npz file with the saved sums.
+    mask_file : str, optional
+        FITS file of the signal mask, with the shape of the cube.
+    stacks : dict, optional
+        {name: (velocity_surface, labels)}. `velocity_surface` is a
+        quantity map that each spectrum is shifted by, and `labels` is an
+        integer map of the bin of each pixel (negative values are not
+        stacked).
+    vsys : astropy.units.Quantity, optional
+        Velocity the spectra are shifted to, as in
+        `cube_analysis.spectra_shifter.cube_shifter`. Defaults to 0.
+    '''
+    def __init__(self, cube_file, state_file, mask_file=None, stacks=None,
+                 vsys=None):
+        self.cube_file = cube_file
+        self.state_file = state_file
+        self.mask_file = mask_file
+
+        cube = SpectralCube.read(cube_file)
+        self.header = cube.header
+        self.unit = cube.unit
+        self.spectral_axis = cube.spectral_axis.to(u.km / u.s)
+        self.shape = cube.shape
+        del cube
+
+        self.chan_width = np.abs(self.spectral_axis[1] -
+                                 self.spectral_axis[0]).value
+
+        if stacks is None:
+            stacks = {}
+
+        if vsys is None:
+            vsys = 0. * u.km / u.s
+        vsys = vsys.to(u.km / u.s).value
+
+        # Integer channel shift and bin of every pixel for each stack
+        self._stack_maps = {}
+        for name, (vel_surface, labels) in stacks.items():
+            vel_surface = vel_surface.to(u.km / u.s).value - vsys
+            offsets = vel_surface / (self.spectral_axis[1] -
+                                     self.spectral_axis[0]).value
+            good = np.isfinite(offsets) & (labels >= 0)
+            shifts = np.where(good, np.round(np.nan_to_num(offsets)), 0)
+            self._stack_maps[name] = (shifts.astype(int).ravel(),
+                                      np.where(good, labels, -1).ravel(),
+                                      int(np.max(labels)) + 1)
+
+        if os.path.exists(state_file):
+            self._load()
+        else:
+            self.build()
+
+    def _open(self, mode='denywrite'):
+        cube = cube_hdu_data(fits.open(self.cube_file, mode=mode)[0])
+        if self.mask_file is not None:
+            mask = cube_hdu_data(fits.open(self.mask_file,
+                                           mode='denywrite')[0])
+        else:
+            mask = None
+        return cube, mask
+
+    def _plane(self, data, mask, chan):
+        '''
+        Flattened channel with zeros outside of the signal mask.
+        '''
+        plane = np.asarray(data[chan], dtype=float).ravel()
+        good = np.isfinite(plane)
+        if mask is not None:
+            good &= np.asarray(mask[chan]).ravel() > 0
+        return np.where(good, plane, 0.), good
+
+    def _add_channel(self, chan, plane, good, sign=1.):
+        '''
+        Add (or subtract, with sign=-1) one channel to the sums and stacks.
+        '''
+        vel = self.spectral_axis[chan].value
+
+        self.sums[0] += sign * plane
+        self.sums[1] += sign * plane * vel
+        self.sums[2] += sign * plane * vel**2
+        self.nchans += sign * good
+
+        nchan = self.shape[0]
+
+        for name, (shifts, labels, nbins) in self._stack_maps.items():
+            stack_chans = chan - shifts
+            use = (labels >= 0) & (stack_chans >= 0) & (stack_chans < nchan)
+
+            np.add.at(self.stacks[name],
+                      (labels[use], stack_chans[use]), sign * plane[use])
+
+    def build(self, verbose=True):
+        '''
+        Compute all of the sums from the cube, one channel at a time.
+        '''
+        npix = self.shape[1] * self.shape[2]
+
+        self.sums = np.zeros((3, npix))
+        self.nchans = np.zeros(npix)
+        self.peak = np.full(npix, -np.inf)
+        self.peak_chan = np.full(npix, -1, dtype=int)
+        self.stacks = dict((name, np.zeros((nbins, self.shape[0])))
+                           for name, (_, _, nbins) in
+                           self._stack_maps.items())
+
+        data, mask = self._open()
+
+        if verbose:
+            pbar = ProgressBar(self.shape[0])
+
+        for chan in range(self.shape[0]):
+            plane, good = self._plane(data, mask, chan)
+
+            self._add_channel(chan, plane, good)
+
+            higher = good & (plane > self.peak)
+            self.peak[higher] = plane[higher]
+            self.peak_chan[higher] = chan
+
+            if verbose:
+                pbar.update()
+
+        self._save()
+
+    def replace_channel(self, chan, new_plane):
+        '''
+        Replace one channel of the cube and update the products.
+
+        Parameters
+        ----------
+        chan : int
+            Channel to replace.
+        new_plane : np.ndarray or str
+            New channel image, or a FITS file of it, on the grid of the cube.
+        '''
+        if isinstance(new_plane, str):
+            new_plane = fits.getdata(new_plane)
+        new_plane = np.squeeze(new_plane)
+
+        if new_plane.shape != self.shape[1:]:
+            raise ValueError("The new channel has shape {0}, but the cube "
+                             "has shape {1}.".format(new_plane.shape,
+                                                     self.shape[1:]))
+
+        hdulist = fits.open(self.cube_file, mode='update')
+        try:
+            data = cube_hdu_data(hdulist[0])
+            mask = None
+            if self.mask_file is not None:
+                mask = cube_hdu_data(fits.open(self.mask_file,
+                                               mode='denywrite')[0])
+
+            old, old_good = self._plane(data, mask, chan)
+
+            data[chan] = new_plane
+            hdulist.flush()
+
+            new, new_good = self._plane(data, mask, chan)
+
+            self._add_channel(chan, old, old_good, sign=-1.)
+            self._add_channel(chan, new, new_good)
+
+            # The peak can only move away from this channel where it dropped
+            higher = new_good & (new > self.peak)
+            self.peak[higher] = new[higher]
+            self.peak_chan[higher] = chan
+
+            dropped = np.where((self.peak_chan == chan) & ~higher &
+                               (~new_good | (new < self.peak)))[0]
+
+            if dropped.size > 0:
+                yy, xx = np.unravel_index(dropped, self.shape[1:])
+                spectra = np.asarray(data[:, yy, xx], dtype=float)
+                if mask is not None:
+                    spectra[np.asarray(mask[:, yy, xx]) <= 0] = np.NaN
+                spectra[~np.isfinite(spectra)] = -np.inf
+
+                self.peak_chan[dropped] = spectra.argmax(0)
+                self.peak[dropped] = spectra.max(0)
+                self.peak_chan[dropped[~np.isfinite(self.peak[dropped])]] = -1
+        finally:
+            hdulist.close()
+
+        self._save()
+
+    def replace_channels(self, channel_images):
+        '''
+        Replace several channels, given as {channel: image or FITS file}.
+        '''
+        for chan, new_plane in sorted(channel_images.items()):
+            self.replace_channel(chan, new_plane)
+
+    def _inputs(self):
+        '''
+        Size and modification time of the cube and the signal mask, and a
+        hash of the stack shifts and bins (from the velocity surfaces,
+        labels and vsys).
+        '''
+        parts = []
+        for filename in (self.cube_file, self.mask_file):
+            if filename is None:
+                parts.append("")
+                continue
+            stat = os.stat(filename)
+            parts.append("{0}:{1!r}".format(stat.st_size, stat.st_mtime))
+
+        sha = hashlib.sha1()
+        for name in sorted(self._stack_maps):
+            shifts, labels, nbins = self._stack_maps[name]
+            sha.update("{0}:{1}".format(name, nbins).encode('utf-8'))
+            sha.update(np.ascontiguousarray(shifts, dtype=np.int64)
+                       .view(np.uint8))
+            sha.update(np.ascontiguousarray(labels, dtype=np.int64)
+                       .view(np.uint8))
+        parts.append(sha.hexdigest())
+
+        return "|".join(parts)
+
+    def _save(self):
+        tmp_name = self.state_file + ".tmp"
+        with open(tmp_name, 'wb') as f:
+            arrays = dict(sums=self.sums, nchans=self.nchans, peak=self.peak,
+                          peak_chan=self.peak_chan,
+                          inputs=np.array(self._inputs()))
+            for name, stack in self.stacks.items():
+                arrays['stack_' + name] = stack
+            np.savez(f, **arrays)
+        os.rename(tmp_name, self.state_file)
+
+    def _load(self):
+        saved = np.load(self.state_file)
+
+        if 'inputs' not in saved.files or \
+                str(saved['inputs']) != self._inputs():
+            # The cube, mask or stacks changed since the state was saved
+            self.build()
+            return
+
+        self.sums = saved['sums']
+        self.nchans = saved['nchans']
+        self.peak = saved['peak']
+        self.peak_chan = saved['peak_chan']
+        self.stacks = dict((name, saved['stack_' + name])
+                           for name in self._stack_maps)
+
+    def _as_map(self, arr):
+        arr = arr.reshape(self.shape[1:])
+        return np.where(self.nchans.reshape(self.shape[1:]) > 0, arr, np.NaN)
+
+    def moment0(self):
+        return self._as_map(self.sums[0] * self.chan_width) * \
+            self.unit * u.km / u.s
+
+    def moment1(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._as_map(self.sums[1] / self.sums[0]) * u.km / u.s
+
+    def moment2(self):
+        '''
+        Second moment (the variance of the spectrum).
+        '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mom1 = self.sums[1] / self.sums[0]
+            return self._as_map(self.sums[2] / self.sums[0] - mom1**2) * \
+                (u.km / u.s)**2
+
+    def linewidth_sigma(self):
+        return np.sqrt(self.moment2())
+
+    def peak_temperature(self):
+        peak = np.where(self.peak_chan >= 0, self.peak, np.NaN)
+        return peak.reshape(self.shape[1:]) * self.unit
+
+    def peak_velocity(self):
+        vels = self.spectral_axis.value[np.clip(self.peak_chan, 0, None)]
+        vels = np.where(self.peak_chan >= 0, vels, np.NaN)
+        return vels.reshape(self.shape[1:]) * u.km / u.s
+
+    def stack(self, name):
+        '''
+        Stacked spectra of each bin. Channels are on the spectral axis of the
+        cube, with the velocity surface moved to `vsys`.
+        '''
+        return self.stacks[name] * self.unit
+
+    def write_maps(self, output_name, overwrite=True):
+        '''
+        Write the moment and peak maps to FITS files named
+        `output_name.{product}.fits`.
+        '''
+        header = WCS(self.header).celestial.to_header()
+
+        products = {'mom0': self.moment0(), 'mom1': self.moment1(),
+                    'lwidth': self.linewidth_sigma(),
+                    'peaktemps': self.peak_temperature(),
+                    'peakvels': self.peak_velocity()}
+
+        for label, product in products.items():
+            hdr = header.copy()
+            hdr['BUNIT'] = product.unit.to_string()
+            fits.PrimaryHDU(product.value.astype(np.float32), hdr)\
+                .writeto("{0}.{1}.fits".format(output_name, label),
+                         overwrite=overwrite)
@@ -0,0 +1,45 @@
+
+'''
+Helpers shared by the emcee fits (`eiv_emcee_batch` and the harmonic
+decomposition in `harmdec_mcmc2`).
+'''
+
+import numpy as np
+
+
+def integrated_autocorr_time(chain, c=5):
+    '''
+    Integrated autocorrelation time of each parameter from an ensemble
+    chain with shape (nsteps, nwalkers, ndim). The autocorrelation function
+    is averaged over the walkers and the sum is truncated with the
+    automated window of Sokal (1989), as in `emcee.autocorr`.
+    '''
+
+    nsteps = chain.shape[0]
+
+    nfft = 1
+    while nfft < 2 * nsteps:
+        nfft *= 2
+
+    x = chain - chain.mean(axis=0)
+    fx = np.fft.rfft(x, n=nfft, axis=0)
+    acf = np.fft.irfft(fx * np.conj(fx), n=nfft, axis=0)[:nsteps]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acf = (acf / acf[:1]).mean(axis=1)
+
+    taus = 2.0 * np.cumsum(acf, axis=0) - 1.0
+
+    window = np.arange(nsteps)[:, np.newaxis] >= c * taus
+    m = np.where(window.any(0), window.argmax(0), nsteps - 1)
+
+    return taus[m, np.arange(chain.shape[2])]
+
+
+def get_chain(sampler):
+    '''
+    Chain with shape (nsteps, nwalkers, ndim) for emcee 2 and 3.
+    '''
+    if hasattr(sampler, 'get_chain'):
+        return sampler.get_chain()
+    return sampler.chain.swapaxes(0, 1)
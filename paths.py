@@ -3,6 +3,11 @@ import socket
 from functools import partial
 import glob
 
+try:
+    from configparser import ConfigParser
+except ImportError:
+    from ConfigParser import ConfigParser
+
 '''
 Common set of paths giving the location of data products.
 '''
@@ -17,27 +22,72 @@ def name_return_check(filename, path, no_check=False):
     return full_path
 
 
-if socket.gethostname() == 'ewk':
-    root = os.path.expanduser('~/ownCloud/code_development/VLA_Lband/')
-    # data_path = "/mnt/MyRAID/M33/"
-    data_path = "/home/eric/bigdata/ekoch/M33/"
-# Add in path for NRAO and cloud instances
-elif socket.gethostname() == 'caterwauler':
-    root = os.path.expanduser('~/ownCloud/code_development/VLA_Lband/')
-    data_path = os.path.expanduser("~/volume/data/")
-# NRAO
-elif "nmpost" in socket.gethostname():
-    root = os.path.expanduser("~/VLA_Lband")
-    data_path = os.path.expanduser("~/data")
-elif "segfault" == socket.gethostname():
-    root = os.path.expanduser("~/ownCloud/code_development/VLA_Lband/")
-    data_path = "/mnt/bigdata/ekoch/M33"
-elif "cedar.computecanada" in socket.gethostname():
-    root = "/home/ekoch/code/VLA_Lband/"
-    data_path = "/home/ekoch/project/ekoch/"
-elif 'ewk-laptop' in socket.gethostname():
-    root = os.path.expanduser("~/ownCloud/code_development/VLA_Lband/")
-    data_path = os.path.expanduser("~/storage/M33")
+# Repository and data roots of known machines
+host_paths = [(lambda host: host == 'ewk',
+               '~/ownCloud/code_development/VLA_Lband/',
+               # "/mnt/MyRAID/M33/"
+               "/home/eric/bigdata/ekoch/M33/"),
+              # Add in path for NRAO and cloud instances
+              (lambda host: host == 'caterwauler',
+               '~/ownCloud/code_development/VLA_Lband/',
+               "~/volume/data/"),
+              # NRAO
+              (lambda host: "nmpost" in host, "~/VLA_Lband", "~/data"),
+              (lambda host: host == "segfault",
+               "~/ownCloud/code_development/VLA_Lband/",
+               "/mnt/bigdata/ekoch/M33"),
+              (lambda host: "cedar.computecanada" in host,
+               "/home/ekoch/code/VLA_Lband/", "/home/ekoch/project/ekoch/"),
+              (lambda host: 'ewk-laptop' in host,
+               "~/ownCloud/code_development/VLA_Lband/", "~/storage/M33")]
+
+
+def find_roots():
+    '''
+    Return the repository and data roots. These are set, in order of
+    preference, by the VLA_LBAND_ROOT and VLA_LBAND_DATA environment
+    variables, the "root" and "data_path" options in the [paths] section of
+    the config file in VLA_LBAND_CONFIG (default ~/.vla_lband.cfg), or the
+    host name of a known machine. The repository root defaults to the
+    folder of this file.
+    '''
+    root = os.environ.get("VLA_LBAND_ROOT")
+    data_path = os.environ.get("VLA_LBAND_DATA")
+
+    config_file = os.path.expanduser(os.environ.get("VLA_LBAND_CONFIG",
+                                                    "~/.vla_lband.cfg"))
+
+    if (root is None or data_path is None) and os.path.exists(config_file):
+        config = ConfigParser()
+        config.read(config_file)
+
+        if root is None and config.has_option("paths", "root"):
+            root = config.get("paths", "root")
+        if data_path is None and config.has_option("paths", "data_path"):
+            data_path = config.get("paths", "data_path")
+
+    if root is None or data_path is None:
+        hostname = socket.gethostname()
+        for match, host_root, host_data_path in host_paths:
+            if match(hostname):
+                if root is None:
+                    root = host_root
+                if data_path is None:
+                    data_path = host_data_path
+                break
+
+    if root is None:
+        root = os.path.dirname(os.path.abspath(__file__))
+
+    if data_path is None:
+        raise OSError("No data path is set for this machine. Set "
+                      "VLA_LBAND_DATA or the data_path option in {}."
+                      .format(config_file))
+
+    return os.path.expanduser(root), os.path.expanduser(data_path)
+
+
+root, data_path = find_roots()
 
 c_path = os.path.join(root, '14B-088')
 archival_path = os.path.join(root, 'AT0206')
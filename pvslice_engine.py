@@ -0,0 +1,391 @@
+
+'''
+Extract many PV slices from a cube in one pass over the spectral axis.
+
+`pvextractor.extract_pv_slice` samples the cube separately for each path,
+and for paths with a width it loops over every pixel of every sample polygon
+and reads its full spectrum. The sampling of a path only depends on the
+celestial grid, so here it is done once for all of the paths:
+
+* Paths with a width are split into the same sample polygons as in
+  pvextractor (`Path.sample_polygons`). The overlap area of each polygon
+  with each pixel is found by clipping the polygons to the pixels, for all
+  polygon and pixel pairs at once.
+* Paths without a width use nearest-neighbour or bilinear interpolation
+  weights at the sample points (see `reprojection_weights`).
+
+The weights of each path are kept in memory for each grid, and the weights
+of all of the paths are stacked into one sparse matrix of shape
+(samples, pixels). The cube is read in blocks of channels, only within the
+bounding box of the pixels that are used, and every PV slice is filled from
+one sparse matrix product per block. As in pvextractor, NaNs are ignored in
+the area-weighted means of paths with a width and propagate for paths
+without one.
+'''
+
+import hashlib
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.utils.console import ProgressBar
+from scipy import sparse
+from spectral_cube import SpectralCube
+from pvextractor import Path
+from pvextractor.utils.wcs_utils import get_spatial_scale, sanitize_wcs
+from pvextractor.utils.wcs_slicing import slice_wcs
+
+from reprojection_weights import ReprojectionMatrix
+
+
+_weights_cache = dict()
+
+
+def _compact(x, y, keep):
+    '''
+    Move the kept vertices of each polygon to the front and pad the rest by
+    repeating the first vertex, which adds no area.
+    '''
+    rows = np.arange(x.shape[0])[:, np.newaxis]
+
+    order = np.argsort(~keep, axis=1, kind='mergesort')
+    x = x[rows, order]
+    y = y[rows, order]
+
+    count = keep.sum(1)
+    nvert = max(count.max(), 1)
+
+    x = x[:, :nvert]
+    y = y[:, :nvert]
+
+    pad = np.arange(nvert)[np.newaxis] >= count[:, np.newaxis]
+    x = np.where(pad, x[:, :1], x)
+    y = np.where(pad, y[:, :1], y)
+
+    return x, y, count
+
+
+def _clip(x, y, along_x, value, upper):
+    '''
+    Clip convex polygons (one per row of the vertex arrays `x` and `y`) to
+    one side of a vertical (along_x=True) or horizontal line at `value`.
+    '''
+    coord = x if along_x else y
+    value = value[:, np.newaxis]
+
+    inside = coord <= value if upper else coord >= value
+
+    next_x = np.roll(x, -1, axis=1)
+    next_y = np.roll(y, -1, axis=1)
+    next_coord = np.roll(coord, -1, axis=1)
+
+    crosses = inside != np.roll(inside, -1, axis=1)
+
+    # Edges along the line give NaN crossings, but never cross it
+    with np.errstate(invalid='ignore', divide='ignore'):
+        frac = (value - coord) / (next_coord - coord)
+
+        if along_x:
+            cross_x = np.broadcast_to(value, x.shape)
+            cross_y = y + frac * (next_y - y)
+        else:
+            cross_x = x + frac * (next_x - x)
+            cross_y = np.broadcast_to(value, y.shape)
+
+    # Each edge adds its first vertex if inside, and the crossing point
+    out_x = np.stack([x, cross_x], axis=2).reshape((x.shape[0], -1))
+    out_y = np.stack([y, cross_y], axis=2).reshape((y.shape[0], -1))
+    keep = np.stack([inside, crosses], axis=2).reshape((x.shape[0], -1))
+
+    return _compact(out_x, out_y, keep)
+
+
+def _area(x, y):
+    '''
+    Shoelace area of each polygon.
+    '''
+    return 0.5 * np.abs((x * np.roll(y, -1, axis=1) -
+                         np.roll(x, -1, axis=1) * y).sum(1))
+
+
+def polygon_pixel_weights(poly_x, poly_y, shape, block=64):
+    '''
+    Overlap areas of convex polygons with the pixels of a grid.
+
+    Parameters
+    ----------
+    poly_x, poly_y : np.ndarray
+        Pixel coordinates of the polygon vertices, with shape
+        (polygons, vertices).
+    shape : tuple
+        Spatial shape of the grid.
+    block : int, optional
+        Number of polygons handled together.
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        Overlap areas with shape (polygons, pixels).
+    '''
+    ny, nx = shape
+    npoly = poly_x.shape[0]
+
+    all_rows = []
+    all_cols = []
+    all_areas = []
+
+    for start in range(0, npoly, block):
+        px = np.asarray(poly_x[start:start + block], dtype=float)
+        py = np.asarray(poly_y[start:start + block], dtype=float)
+
+        # Rows of pixels that each polygon spans
+        ylo = np.clip(np.floor(py.min(1) + 0.5).astype(int), 0, ny - 1)
+        yhi = np.clip(np.floor(py.max(1) + 0.5).astype(int), 0, ny - 1)
+
+        nrows = yhi - ylo + 1
+        poly_idx = np.repeat(np.arange(px.shape[0]), nrows)
+        pix_y = np.repeat(ylo, nrows) + np.arange(nrows.sum()) - \
+            np.repeat(np.cumsum(nrows) - nrows, nrows)
+
+        # Clip each polygon to each row
+        bx, by, count = _clip(px[poly_idx], py[poly_idx], False,
+                              pix_y - 0.5, False)
+        alive = count > 0
+        bx, by, count = _clip(bx, by, False, pix_y + 0.5, True)
+        alive &= count > 0
+
+        # Columns spanned within each row
+        xlo = np.clip(np.floor(bx.min(1) + 0.5).astype(int), 0, nx - 1)
+        xhi = np.clip(np.floor(bx.max(1) + 0.5).astype(int), 0, nx - 1)
+
+        ncols = np.where(alive, xhi - xlo + 1, 0)
+        pair_idx = np.repeat(np.arange(bx.shape[0]), ncols)
+        pix_x = np.repeat(xlo, ncols) + np.arange(ncols.sum()) - \
+            np.repeat(np.cumsum(ncols) - ncols, ncols)
+
+        # Clip each row piece to each pixel in the row
+        cx, cy, count = _clip(bx[pair_idx], by[pair_idx], True,
+                              pix_x - 0.5, False)
+        alive = count > 0
+        cx, cy, count = _clip(cx, cy, True, pix_x + 0.5, True)
+        alive &= count > 0
+
+        areas = np.where(alive, _area(cx, cy), 0.)
+
+        nonzero = areas > 0
+
+        all_rows.append(start + poly_idx[pair_idx][nonzero])
+        all_cols.append(pix_y[pair_idx][nonzero] * nx + pix_x[nonzero])
+        all_areas.append(areas[nonzero])
+
+    return sparse.csr_matrix((np.concatenate(all_areas),
+                              (np.concatenate(all_rows),
+                               np.concatenate(all_cols))),
+                             shape=(npoly, ny * nx))
+
+
+def _path_key(path, wcs, shape, spacing, order):
+    key = hashlib.sha1("|".join([wcs.celestial.to_header_string(),
+                                 str(tuple(shape)),
+                                 "{0:.8f}".format(spacing),
+                                 str(order),
+                                 str(path.width)]).encode('utf-8'))
+    xy = np.asarray(path.get_xy(wcs=wcs), dtype=float)
+    key.update(np.round(xy, 6).tobytes())
+    return key.hexdigest()
+
+
+def path_weights(path, wcs, shape, spacing=1.0, order=1):
+    '''
+    Sampling weights of one path on a grid, kept in memory so they are
+    reused for other cubes on the same grid.
+
+    Parameters
+    ----------
+    path : pvextractor.Path
+        Path to sample.
+    wcs : astropy.wcs.WCS
+        WCS of the cube.
+    shape : tuple
+        Spatial shape of the cube.
+    spacing : float, optional
+        Spacing of the samples along the path, in pixels.
+    order : int, optional
+        Interpolation for a path without a width: 0 for the nearest pixel
+        or 1 for bilinear.
+
+    Returns
+    -------
+    matrix : scipy.sparse.csr_matrix
+        Weights with shape (samples, pixels).
+    valid : np.ndarray
+        Samples that fall on the grid.
+    '''
+    shape = tuple(shape)[-2:]
+
+    key = _path_key(path, wcs, shape, spacing, order)
+
+    if key in _weights_cache:
+        return _weights_cache[key]
+
+    if path.width is None:
+        if order not in (0, 1):
+            raise ValueError("Only order=0 or order=1 interpolation is "
+                             "supported for paths without a width.")
+
+        x, y = path.sample_points(spacing=spacing, wcs=wcs)
+        weights = ReprojectionMatrix.from_pixel_coords(x, y, shape,
+                                                       (1, len(x)),
+                                                       nearest=order == 0)
+        matrix = weights.matrix
+        valid = weights.valid
+    else:
+        polygons = path.sample_polygons(spacing=spacing, wcs=wcs)
+        poly_x = np.array([poly.x for poly in polygons], dtype=float)
+        poly_y = np.array([poly.y for poly in polygons], dtype=float)
+
+        matrix = polygon_pixel_weights(poly_x, poly_y, shape)
+        valid = np.asarray(matrix.sum(1)).ravel() > 0
+
+    _weights_cache[key] = (matrix, valid)
+
+    return matrix, valid
+
+
+def pv_slice_weights(paths, wcs, shape, spacing=1.0, order=1):
+    '''
+    Sampling weights of a set of paths on a grid, stacked into one matrix.
+    See `path_weights`.
+
+    Returns
+    -------
+    weights : reprojection_weights.ReprojectionMatrix
+        Weights of all samples of all paths, with shape (samples, pixels).
+    bounds : list
+        (start, stop) rows of the samples of each path.
+    is_mean : np.ndarray
+        Samples that are area-weighted means (paths with a width).
+    '''
+    shape = tuple(shape)[-2:]
+
+    matrices = []
+    valids = []
+    bounds = []
+    is_mean = []
+
+    nrow = 0
+
+    for path in paths:
+        if not isinstance(path, Path):
+            path = Path(path)
+
+        matrix, valid = path_weights(path, wcs, shape, spacing=spacing,
+                                     order=order)
+
+        matrices.append(matrix)
+        valids.append(valid)
+        bounds.append((nrow, nrow + matrix.shape[0]))
+        is_mean.append(np.ones(matrix.shape[0], dtype=bool) *
+                       (path.width is not None))
+
+        nrow += matrix.shape[0]
+
+    weights = ReprojectionMatrix(sparse.vstack(matrices),
+                                 np.concatenate(valids), shape, (nrow,))
+
+    return weights, bounds, np.concatenate(is_mean)
+
+
+def extract_pv_slices(cube, paths, spacing=1.0, order=1, respect_nan=True,
+                      chunk=64, verbose=True):
+    '''
+    Extract PV slices along many paths with one pass over the cube. The
+    slices match `pvextractor.extract_pv_slice` for paths with a width.
+
+    Parameters
+    ----------
+    cube : spectral_cube.SpectralCube or str
+        Cube, or its FITS file.
+    paths : list of pvextractor.Path
+        Paths to extract, in pixel or world coordinates.
+    spacing : float or astropy.units.Quantity, optional
+        Spacing of the samples along the paths, in pixels or as an angle.
+    order : int, optional
+        Interpolation for paths without a width: 0 for the nearest pixel or
+        1 for bilinear.
+    respect_nan : bool, optional
+        If False, NaNs are set to zero before sampling, as in pvextractor.
+    chunk : int, optional
+        Number of channels read at once.
+    verbose : bool, optional
+        Show a progress bar.
+
+    Returns
+    -------
+    pvslices : list of astropy.io.fits.PrimaryHDU
+        PV slice of each path.
+    '''
+    if not isinstance(cube, SpectralCube):
+        cube = SpectralCube.read(cube)
+
+    wcs = sanitize_wcs(cube.wcs)
+
+    scale = get_spatial_scale(wcs)
+    if isinstance(spacing, u.Quantity):
+        pixel_spacing = (spacing / scale).decompose().value
+        world_spacing = spacing
+    else:
+        pixel_spacing = spacing
+        world_spacing = spacing * scale
+
+    weights, bounds, is_mean = pv_slice_weights(paths, wcs, cube.shape[1:],
+                                                spacing=pixel_spacing,
+                                                order=order)
+
+    # Only read the part of the cube that is used
+    (yslice, xslice), weights = weights.crop_input()
+
+    matrix = weights.matrix
+
+    nchan = cube.shape[0]
+    out = np.empty((matrix.shape[0], nchan))
+
+    blocks = [slice(start, min(start + chunk, nchan))
+              for start in range(0, nchan, chunk)]
+
+    if verbose:
+        pbar = ProgressBar(len(blocks))
+
+    for block in blocks:
+        slab = cube.filled_data[block, yslice, xslice].value
+        slab = slab.reshape((slab.shape[0], -1)).T
+
+        if not respect_nan:
+            slab = np.nan_to_num(slab)
+
+        finite = np.isfinite(slab)
+
+        total = matrix.dot(np.where(finite, slab, 0.))
+        used = matrix.dot(finite.astype(float))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / used
+
+        # Means over the finite values for paths with a width. Otherwise,
+        # any NaN used in the interpolation gives a NaN.
+        block_out = np.where(is_mean[:, np.newaxis], mean, total)
+        block_out[is_mean[:, np.newaxis] & (used == 0)] = np.NaN
+        if not is_mean.all():
+            missing = matrix.dot((~finite).astype(float))
+            block_out[~is_mean[:, np.newaxis] & (missing > 0)] = np.NaN
+
+        out[:, block] = block_out
+
+        if verbose:
+            pbar.update()
+
+    out[~weights.valid] = np.NaN
+
+    header = slice_wcs(wcs, spatial_scale=world_spacing).to_header()
+
+    return [fits.PrimaryHDU(data=out[start:stop].T, header=header.copy())
+            for start, stop in bounds]
@@ -0,0 +1,362 @@
+
+'''
+Bilinear reprojection with precomputed sparse weight matrices.
+
+For a pair of input and output grids, the position of every output pixel on
+the input grid and its bilinear interpolation weights only depend on the two
+WCS. They are computed once and stored as a sparse matrix of shape
+(output pixels, input pixels), so reprojecting a map is one sparse
+matrix-vector product, and reprojecting a cube is one per channel. Matrices
+are kept in memory for each grid pair and, optionally, saved to disk so they
+are shared between scripts and runs.
+
+The interpolation follows `reproject.reproject_interp` with
+order='bilinear': output pixels within half a pixel of the input edge use
+the edge values, pixels further out are NaN, and NaNs in the input propagate
+to the output pixels that use them.
+'''
+
+import os
+import hashlib
+import numpy as np
+from scipy import sparse
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import pixel_to_skycoord, skycoord_to_pixel
+
+
+_matrix_cache = dict()
+
+
+def _celestial(wcs_or_header):
+    if isinstance(wcs_or_header, WCS):
+        return wcs_or_header.celestial
+    return WCS(wcs_or_header).celestial
+
+
+def _pair_key(wcs_in, shape_in, wcs_out, shape_out):
+    key = "|".join([wcs_in.to_header_string(), str(tuple(shape_in)),
+                    wcs_out.to_header_string(), str(tuple(shape_out))])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class ReprojectionMatrix(object):
+    '''
+    Sparse bilinear interpolation weights from one celestial grid to another.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.csr_matrix
+        Weights with shape (output pixels, input pixels).
+    valid : np.ndarray
+        Output pixels that fall on the input grid.
+    shape_in : tuple
+        Spatial shape of the input grid.
+    shape_out : tuple
+        Spatial shape of the output grid.
+    '''
+    def __init__(self, matrix, valid, shape_in, shape_out):
+        self.matrix = matrix.tocsr()
+        self.valid = np.asarray(valid, dtype=bool).ravel()
+        self.shape_in = tuple(shape_in)
+        self.shape_out = tuple(shape_out)
+
+    @classmethod
+    def from_wcs(cls, wcs_in, shape_in, wcs_out, shape_out):
+        '''
+        Compute the weights between two celestial WCS.
+        '''
+        wcs_in = _celestial(wcs_in)
+        wcs_out = _celestial(wcs_out)
+
+        ny_out, nx_out = shape_out
+
+        yy, xx = np.mgrid[:ny_out, :nx_out]
+
+        # Going through SkyCoord handles different celestial frames
+        coords = pixel_to_skycoord(xx.ravel(), yy.ravel(), wcs_out)
+        x_in, y_in = skycoord_to_pixel(coords, wcs_in)
+
+        return cls.from_pixel_coords(x_in, y_in, shape_in, shape_out)
+
+    @classmethod
+    def from_pixel_coords(cls, x_in, y_in, shape_in, shape_out,
+                          nearest=False):
+        '''
+        Compute the weights from the input pixel position of every output
+        pixel.
+
+        Parameters
+        ----------
+        x_in, y_in : np.ndarray
+            Input pixel coordinates with shape `shape_out` (or flattened).
+        shape_in, shape_out : tuple
+            Spatial shapes of the input and output grids.
+        nearest : bool, optional
+            Use the nearest input pixel instead of bilinear interpolation.
+        '''
+        ny_in, nx_in = shape_in
+        ny_out, nx_out = shape_out
+
+        x_in = np.asarray(x_in, dtype=float).ravel()
+        y_in = np.asarray(y_in, dtype=float).ravel()
+
+        valid = np.isfinite(x_in) & np.isfinite(y_in) & \
+            (x_in >= -0.5) & (x_in <= nx_in - 0.5) & \
+            (y_in >= -0.5) & (y_in <= ny_in - 0.5)
+
+        rows = np.where(valid)[0]
+
+        # Use the edge values within half a pixel of the edge
+        x_in = np.clip(x_in[valid], 0, nx_in - 1)
+        y_in = np.clip(y_in[valid], 0, ny_in - 1)
+
+        if nearest:
+            cols = np.round(y_in).astype(int) * nx_in + \
+                np.round(x_in).astype(int)
+            matrix = sparse.csr_matrix((np.ones(rows.size), (rows, cols)),
+                                       shape=(ny_out * nx_out, ny_in * nx_in))
+            return cls(matrix, valid, shape_in, shape_out)
+
+        x0 = np.clip(np.floor(x_in).astype(int), 0, max(nx_in - 2, 0))
+        y0 = np.clip(np.floor(y_in).astype(int), 0, max(ny_in - 2, 0))
+
+        fx = x_in - x0
+        fy = y_in - y0
+
+        x1 = np.minimum(x0 + 1, nx_in - 1)
+        y1 = np.minimum(y0 + 1, ny_in - 1)
+
+        corners = [(y0, x0, (1 - fy) * (1 - fx)),
+                   (y0, x1, (1 - fy) * fx),
+                   (y1, x0, fy * (1 - fx)),
+                   (y1, x1, fy * fx)]
+
+        all_rows = np.concatenate([rows] * 4)
+        all_cols = np.concatenate([y * nx_in + x for y, x, w in corners])
+        all_wts = np.concatenate([w for y, x, w in corners])
+
+        # Drop zero weights so NaNs only propagate from pixels that are used
+        nonzero = all_wts > 0
+
+        matrix = sparse.csr_matrix((all_wts[nonzero],
+                                    (all_rows[nonzero], all_cols[nonzero])),
+                                   shape=(ny_out * nx_out, ny_in * nx_in))
+
+        return cls(matrix, valid, shape_in, shape_out)
+
+    def crop_input(self, pad=0):
+        '''
+        Restrict the input grid to the bounding box of the input pixels that
+        are used, so only that part of a large input needs to be read.
+
+        Parameters
+        ----------
+        pad : int, optional
+            Number of pixels to extend the bounding box by on each side
+            (e.g., to include the pixels needed to convolve the input).
+
+        Returns
+        -------
+        slices : tuple
+            (y, x) slices of the input grid.
+        weights : ReprojectionMatrix
+            Weights for the cropped input grid.
+        '''
+        if self.matrix.nnz == 0:
+            raise ValueError("The output grid does not overlap the input "
+                             "grid.")
+
+        yy, xx = np.unravel_index(self.matrix.indices, self.shape_in)
+
+        ylo = max(yy.min() - pad, 0)
+        yhi = min(yy.max() + 1 + pad, self.shape_in[0])
+        xlo = max(xx.min() - pad, 0)
+        xhi = min(xx.max() + 1 + pad, self.shape_in[1])
+
+        shape_in = (yhi - ylo, xhi - xlo)
+
+        matrix = sparse.csr_matrix((self.matrix.data,
+                                    (yy - ylo) * shape_in[1] + (xx - xlo),
+                                    self.matrix.indptr),
+                                   shape=(self.matrix.shape[0],
+                                          shape_in[0] * shape_in[1]))
+
+        return (slice(ylo, yhi), slice(xlo, xhi)), \
+            ReprojectionMatrix(matrix, self.valid, shape_in, self.shape_out)
+
+    def save(self, filename):
+        '''
+        Save the weights to an npz file.
+        '''
+        tmp_name = filename + ".tmp"
+        with open(tmp_name, 'wb') as f:
+            np.savez(f, data=self.matrix.data, indices=self.matrix.indices,
+                     indptr=self.matrix.indptr, valid=self.valid,
+                     shape_in=self.shape_in, shape_out=self.shape_out)
+        os.rename(tmp_name, filename)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Load weights saved with `save`.
+        '''
+        saved = np.load(filename)
+
+        shape_in = tuple(saved['shape_in'])
+        shape_out = tuple(saved['shape_out'])
+
+        matrix = sparse.csr_matrix((saved['data'], saved['indices'],
+                                    saved['indptr']),
+                                   shape=(np.prod(shape_out),
+                                          np.prod(shape_in)))
+
+        return cls(matrix, saved['valid'], shape_in, shape_out)
+
+    def reproject_plane(self, data):
+        '''
+        Reproject a 2D array.
+        '''
+        data = np.asarray(data, dtype=float)
+
+        if data.shape != self.shape_in:
+            raise ValueError("data has shape {0}, but the weights are for "
+                             "{1}.".format(data.shape, self.shape_in))
+
+        out = self.matrix.dot(data.ravel())
+        out[~self.valid] = np.NaN
+
+        return out.reshape(self.shape_out)
+
+    def reproject_cube(self, data, out=None):
+        '''
+        Reproject each plane of a 3D array.
+
+        Parameters
+        ----------
+        data : np.ndarray
+            Array with shape (nchan,) + `shape_in`. Can be a memory-mapped
+            array.
+        out : np.ndarray, optional
+            Array with shape (nchan,) + `shape_out` to write to (e.g., a
+            memory-mapped FITS file).
+        '''
+        if out is None:
+            out = np.empty((data.shape[0],) + self.shape_out)
+
+        for chan in range(data.shape[0]):
+            out[chan] = self.reproject_plane(data[chan])
+
+        return out
+
+    def __call__(self, data, out=None):
+        if np.ndim(data) == 2:
+            return self.reproject_plane(data)
+        return self.reproject_cube(data, out=out)
+
+
+def reprojection_matrix(wcs_in, shape_in, wcs_out, shape_out,
+                        cache_dir=None):
+    '''
+    Return the weights for a pair of grids, computing them only if they are
+    not in the memory cache or in `cache_dir`.
+
+    Parameters
+    ----------
+    wcs_in, wcs_out : astropy.wcs.WCS or astropy.io.fits.Header
+        Input and output grids. Only the celestial axes are used.
+    shape_in, shape_out : tuple
+        Spatial shapes of the input and output grids.
+    cache_dir : str, optional
+        Folder to save and load the weights.
+
+    Returns
+    -------
+    weights : ReprojectionMatrix
+    '''
+    wcs_in = _celestial(wcs_in)
+    wcs_out = _celestial(wcs_out)
+
+    shape_in = tuple(shape_in)[-2:]
+    shape_out = tuple(shape_out)[-2:]
+
+    key = _pair_key(wcs_in, shape_in, wcs_out, shape_out)
+
+    if key in _matrix_cache:
+        return _matrix_cache[key]
+
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, "reproj_weights_{}.npz".format(key))
+
+    if cache_dir is not None and os.path.exists(filename):
+        weights = ReprojectionMatrix.load(filename)
+    else:
+        weights = ReprojectionMatrix.from_wcs(wcs_in, shape_in, wcs_out,
+                                              shape_out)
+        if cache_dir is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            weights.save(filename)
+
+    _matrix_cache[key] = weights
+
+    return weights
+
+
+def _parse_input(input_data):
+    if isinstance(input_data, (fits.PrimaryHDU, fits.ImageHDU)):
+        return input_data.data, WCS(input_data.header)
+    if isinstance(input_data, fits.HDUList):
+        return input_data[0].data, WCS(input_data[0].header)
+    data, wcs = input_data
+    if not isinstance(wcs, WCS):
+        wcs = WCS(wcs)
+    return data, wcs
+
+
+def reproject_cached(input_data, output_projection, shape_out=None,
+                     cache_dir=None, out=None):
+    '''
+    Drop-in replacement for `reproject.reproject_interp` with bilinear
+    interpolation that reuses the weights for each pair of grids.
+
+    Parameters
+    ----------
+    input_data : astropy.io.fits.PrimaryHDU or tuple
+        HDU or (array, WCS or header). 3D arrays are reprojected channel by
+        channel.
+    output_projection : astropy.wcs.WCS or astropy.io.fits.Header
+        Output grid.
+    shape_out : tuple, optional
+        Spatial shape of the output. Taken from the header if not given.
+    cache_dir : str, optional
+        Folder to save and load the weights.
+    out : np.ndarray, optional
+        Output array for 3D inputs.
+
+    Returns
+    -------
+    array : np.ndarray
+        Reprojected data.
+    footprint : np.ndarray
+        1 where the output is valid, 0 elsewhere.
+    '''
+    data, wcs_in = _parse_input(input_data)
+
+    if shape_out is None:
+        if isinstance(output_projection, WCS):
+            raise ValueError("shape_out must be given with a WCS.")
+        shape_out = (output_projection['NAXIS2'],
+                     output_projection['NAXIS1'])
+
+    data = np.squeeze(data) if np.ndim(data) > 3 else data
+
+    weights = reprojection_matrix(wcs_in, data.shape[-2:], output_projection,
+                                  shape_out, cache_dir=cache_dir)
+
+    reproj = weights(data, out=out)
+
+    # As in reproject, the footprint excludes pixels that are NaN.
+    footprint = np.isfinite(reproj).astype(float)
+
+    return reproj, footprint
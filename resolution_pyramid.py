@@ -0,0 +1,293 @@
+
+'''
+Disk cache of maps and cubes convolved to lower resolutions and regridded.
+
+Sources are registered with a name, and products are requested with a target
+beam and, optionally, a target header to regrid to. Each product is made the
+first time it is requested and written to the cache folder. The file name
+includes a checksum of the source and the target beam (and target grid), so
+later requests from any script load the cached product instead of
+reconvolving. A changed source has a different checksum and is rebuilt.
+
+New levels are convolved from the largest cached level that is smaller than
+the target beam instead of from the original resolution. Away from the map
+edges, this is the same as convolving the original.
+Products that were made elsewhere (e.g., moment maps from smoothed cubes) can
+be registered as levels so they are served directly. They are not used to
+make other levels, since the cache names only identify the source.
+'''
+
+import os
+import json
+import hashlib
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from radio_beam import Beam
+from spectral_cube import SpectralCube, Projection
+
+
+def _beam_key(beam):
+    '''
+    String key of a beam to 0.01 arcsec and 0.1 deg.
+    '''
+    return "{0:.2f}x{1:.2f}arcsec_{2:.1f}deg"\
+        .format(beam.major.to(u.arcsec).value,
+                beam.minor.to(u.arcsec).value,
+                beam.pa.to(u.deg).value % 180.)
+
+
+def _header_key(header):
+    '''
+    Checksum of the WCS and shape of a target grid.
+    '''
+    wcs_str = WCS(header).to_header_string()
+    shape = [header['NAXIS{}'.format(i)]
+             for i in range(1, header['NAXIS'] + 1)]
+    return hashlib.sha1((wcs_str + str(shape)).encode('utf-8')).hexdigest()
+
+
+def _as_beam(beam):
+    if beam is None or isinstance(beam, Beam):
+        return beam
+    # A quantity is a circular beam FWHM
+    return Beam(beam)
+
+
+def file_checksum(filename, blocksize=2**26):
+    '''
+    SHA1 checksum of a file, read in blocks.
+    '''
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ResolutionPyramid(object):
+    '''
+    Lazily-built, disk-cached versions of maps and cubes at a set of
+    resolutions.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Folder for the cached products and the index of checksums.
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self._index_file = os.path.join(cache_dir, "pyramid_index.json")
+        self._sources = {}
+
+    def _read_index(self):
+        if not os.path.exists(self._index_file):
+            return {'checksums': {}, 'levels': {}}
+        with open(self._index_file, 'r') as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        tmp_name = self._index_file + ".tmp"
+        with open(tmp_name, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.rename(tmp_name, self._index_file)
+
+    def register(self, name, source, levels=None):
+        '''
+        Register a map or cube.
+
+        Parameters
+        ----------
+        name : str
+            Name used to request products.
+        source : str or astropy.io.fits.PrimaryHDU
+            FITS file or HDU of the source at its original resolution.
+        levels : dict, optional
+            Existing lower-resolution versions of the source, given as
+            {beam: filename}. These are served instead of making a new
+            product at that beam, but are not convolved to make other
+            products.
+        '''
+        if levels is None:
+            levels = {}
+
+        self._sources[name] = \
+            {'source': source,
+             'levels': dict((_beam_key(_as_beam(beam)),
+                             (_as_beam(beam), filename))
+                            for beam, filename in levels.items()),
+             'checksum': None}
+
+    def checksum(self, name):
+        '''
+        Checksum of a registered source. For files, the checksum is kept in
+        the index with the file size and modification time so each version
+        of a file is only read once.
+        '''
+        info = self._sources[name]
+
+        if info['checksum'] is not None:
+            return info['checksum']
+
+        source = info['source']
+
+        if isinstance(source, str):
+            filename = os.path.abspath(source)
+            stat = os.stat(filename)
+            file_id = [stat.st_size, stat.st_mtime]
+
+            index = self._read_index()
+            saved = index['checksums'].get(filename)
+
+            if saved is not None and saved[:2] == file_id:
+                checksum = saved[2]
+            else:
+                checksum = file_checksum(filename)
+                index['checksums'][filename] = file_id + [checksum]
+                self._write_index(index)
+        else:
+            sha = hashlib.sha1(source.header.tostring().encode('utf-8'))
+            sha.update(np.ascontiguousarray(source.data).view(np.uint8))
+            checksum = sha.hexdigest()
+
+        info['checksum'] = checksum
+
+        return checksum
+
+    def _cache_name(self, name, beam, header):
+        # Only the checksum identifies the source, so sources registered
+        # under different names in different scripts share products.
+        parts = [self.checksum(name)[:16]]
+        if beam is not None:
+            parts.append(_beam_key(beam))
+        if header is not None:
+            parts.append("grid" + _header_key(header)[:12])
+        return os.path.join(self.cache_dir, "_".join(parts) + ".fits")
+
+    @staticmethod
+    def _load(source):
+        if isinstance(source, str):
+            hdr = fits.getheader(source)
+        else:
+            hdr = source.header
+
+        is_cube = hdr['NAXIS'] >= 3 and \
+            any(hdr['NAXIS{}'.format(i)] > 1
+                for i in range(3, hdr['NAXIS'] + 1))
+
+        if is_cube:
+            return SpectralCube.read(source)
+
+        if isinstance(source, str):
+            # Maps are small, so read them into memory to get a writeable
+            # array.
+            source = fits.open(source, memmap=False)[0]
+
+        return Projection.from_hdu(source)
+
+    def _base_level(self, name, beam):
+        '''
+        Find the largest level made by the pyramid that can be convolved to
+        `beam`. Registered levels are not used since the cache names do not
+        depend on them.
+        '''
+        info = self._sources[name]
+
+        candidates = []
+
+        cached = self._read_index()['levels'].get(self.checksum(name), {})
+        for key, (major, minor, pa) in cached.items():
+            level_beam = Beam(major=major * u.arcsec, minor=minor * u.arcsec,
+                              pa=pa * u.deg)
+            candidates.append((level_beam,
+                               self._cache_name(name, level_beam, None)))
+
+        best = (None, info['source'])
+        for level_beam, filename in candidates:
+            if not os.path.exists(filename):
+                continue
+            try:
+                beam.deconvolve(level_beam)
+            except ValueError:
+                continue
+            if best[0] is None or level_beam.sr > best[0].sr:
+                best = (level_beam, filename)
+
+        return best[1]
+
+    def get(self, name, beam=None, header=None):
+        '''
+        Return a registered source at a resolution and on a grid.
+
+        Parameters
+        ----------
+        name : str
+            Registered name.
+        beam : radio_beam.Beam or astropy.units.Quantity, optional
+            Target beam. A quantity is the FWHM of a circular beam. Defaults
+            to the original resolution.
+        header : astropy.io.fits.Header, optional
+            Target grid to reproject to.
+
+        Returns
+        -------
+        product : spectral_cube.Projection or spectral_cube.SpectralCube
+            Product loaded from the cache.
+        '''
+        if name not in self._sources:
+            raise KeyError("{} is not registered.".format(name))
+
+        beam = _as_beam(beam)
+        info = self._sources[name]
+
+        if beam is None and header is None:
+            return self._load(info['source'])
+
+        # Products made elsewhere
+        if beam is not None and header is None:
+            level = info['levels'].get(_beam_key(beam))
+            if level is not None:
+                return self._load(level[1])
+
+        cache_name = self._cache_name(name, beam, header)
+
+        if os.path.exists(cache_name):
+            return self._load(cache_name)
+
+        if beam is not None:
+            product = self._load(self._base_level(name, beam))
+            if product.beam != beam:
+                product = product.convolve_to(beam)
+        else:
+            product = self._load(info['source'])
+
+        if header is not None:
+            product = product.reproject(header)
+
+        tmp_name = os.path.join(self.cache_dir,
+                                "tmp_" + os.path.basename(cache_name))
+        product.write(tmp_name, overwrite=True)
+        os.rename(tmp_name, cache_name)
+
+        # Keep track of the convolved levels that can be reused to make
+        # lower-resolution levels.
+        if beam is not None and header is None:
+            index = self._read_index()
+            levels = index['levels'].setdefault(self.checksum(name), {})
+            levels[_beam_key(beam)] = [beam.major.to(u.arcsec).value,
+                                       beam.minor.to(u.arcsec).value,
+                                       beam.pa.to(u.deg).value]
+            self._write_index(index)
+
+        return self._load(cache_name)
+
+    def get_levels(self, name, beams, header=None):
+        '''
+        Return a registered source at each of the beams in `beams`.
+        '''
+        return [self.get(name, beam=beam, header=header) for beam in beams]
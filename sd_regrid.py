@@ -0,0 +1,219 @@
+
+'''
+Regrid single-dish cubes onto the VLA grids in one pass.
+
+Spectral interpolation and spatial reprojection are both linear, so each
+output channel is a weighted sum of at most two input channels, followed by
+the bilinear reprojection of that sum. Blocks of output channels are made
+from the slab of input channels they need (so the input is read once) and are
+written straight into the pre-allocated output FITS file (so the output is
+written once). Blocks are independent and are run in a process pool, with each
+worker writing to its own channels of the output.
+
+The spectral interpolation matches `SpectralCube.spectral_interpolate`
+(linear, with the edge channels used outside of the input spectral range) and
+the reprojection matches `reproject.reproject_interp` with bilinear
+interpolation. See `reprojection_weights`.
+'''
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.utils.console import ProgressBar
+from multiprocessing import Pool
+from spectral_cube import SpectralCube
+
+from cube_analysis.io_utils import create_huge_fits
+
+from reprojection_weights import reprojection_matrix
+
+
+_worker_state = dict()
+
+
+def spectral_interp_weights(spec_in, spec_out):
+    '''
+    Linear interpolation weights from one spectral axis to another.
+
+    Parameters
+    ----------
+    spec_in : astropy.units.Quantity
+        Input spectral axis. Can be in increasing or decreasing order.
+    spec_out : astropy.units.Quantity
+        Output spectral axis.
+
+    Returns
+    -------
+    chan0, chan1 : np.ndarray
+        The two input channels used for each output channel.
+    wt0, wt1 : np.ndarray
+        Weights of the two input channels. Output channels outside of the
+        input range use the nearest edge channel.
+    '''
+    spec_in = spec_in.to(spec_out.unit).value
+    spec_out = spec_out.value
+
+    if spec_in.size == 1:
+        zeros = np.zeros(spec_out.size, dtype=int)
+        return zeros, zeros, np.ones(spec_out.size), np.zeros(spec_out.size)
+
+    order = np.argsort(spec_in)
+
+    # Fractional position in the sorted input axis, clipped to the edges
+    posn = np.interp(spec_out, spec_in[order], np.arange(spec_in.size))
+
+    lower = np.clip(np.floor(posn).astype(int), 0, spec_in.size - 2)
+    frac = posn - lower
+
+    return order[lower], order[lower + 1], 1 - frac, frac
+
+
+def cube_hdu_data(hdu):
+    '''
+    Data of a cube HDU without any degenerate leading (e.g., Stokes) axes.
+    '''
+    data = hdu.data
+
+    if data.ndim > 3:
+        if np.prod(data.shape[:-3]) != 1:
+            raise ValueError("Only one Stokes plane is supported.")
+        data = data.reshape(data.shape[-3:])
+
+    return data
+
+
+def _init_worker(input_file, output_file, output_offset, output_shape,
+                 weights, slices, spec_weights, scale):
+    '''
+    Open the input and output once in each worker.
+    '''
+    _worker_state['input'] = cube_hdu_data(fits.open(input_file,
+                                                     mode='denywrite')[0])
+    _worker_state['output'] = np.memmap(output_file, dtype='>f4', mode='r+',
+                                        offset=output_offset,
+                                        shape=output_shape)
+    _worker_state['weights'] = weights
+    _worker_state['slices'] = slices
+    _worker_state['spec_weights'] = spec_weights
+    _worker_state['scale'] = scale
+
+
+def _regrid_block(chans):
+    '''
+    Spectrally interpolate and reproject a block of output channels and write
+    them to the output.
+    '''
+    weights = _worker_state['weights']
+    yslice, xslice = _worker_state['slices']
+    chan0, chan1, wt0, wt1 = \
+        [arr[chans] for arr in _worker_state['spec_weights']]
+
+    # Read all of the input channels for the block at once
+    lo = min(chan0.min(), chan1.min())
+    hi = max(chan0.max(), chan1.max()) + 1
+
+    slab = np.asarray(_worker_state['input'][lo:hi, yslice, xslice],
+                      dtype=float)
+    slab = slab.reshape((hi - lo, -1))
+
+    wt0 = wt0[:, np.newaxis]
+    wt1 = wt1[:, np.newaxis]
+
+    # Zero weights are skipped so NaNs only come from channels that are used
+    spec = np.where(wt0 > 0, wt0 * slab[chan0 - lo], 0.) + \
+        np.where(wt1 > 0, wt1 * slab[chan1 - lo], 0.)
+
+    out = weights.matrix.dot(spec.T).T
+    out[:, ~weights.valid] = np.NaN
+    out *= _worker_state['scale']
+
+    output = _worker_state['output']
+    output[chans.start:chans.stop] = \
+        out.reshape((-1,) + weights.shape_out).astype(np.float32)
+    output.flush()
+
+    return chans
+
+
+def regrid_single_dish(input_file, spectral_axis, target_header, output_file,
+                       output_header, scale=1., chunk_size=8, num_cores=1,
+                       cache_dir=None, verbose=True):
+    '''
+    Regrid a single-dish cube spectrally and spatially, reading and writing
+    the data once.
+
+    Parameters
+    ----------
+    input_file : str
+        FITS file of the single-dish cube.
+    spectral_axis : astropy.units.Quantity
+        Spectral axis of the output cube.
+    target_header : astropy.io.fits.Header
+        2D header of the output grid.
+    output_file : str
+        Name of the output FITS file.
+    output_header : astropy.io.fits.Header
+        Header of the output cube. It must match `spectral_axis` and
+        `target_header`.
+    scale : float, optional
+        Factor the output is multiplied by (e.g., Ta* to Tmb).
+    chunk_size : int, optional
+        Number of output channels in each block.
+    num_cores : int, optional
+        Number of processes.
+    cache_dir : str, optional
+        Folder to save the reprojection weights in.
+    verbose : bool, optional
+        Show a progress bar.
+    '''
+    cube = SpectralCube.read(input_file)
+
+    shape_out = (target_header['NAXIS2'], target_header['NAXIS1'])
+    output_shape = (spectral_axis.size,) + shape_out
+
+    if (output_header['NAXIS3'], output_header['NAXIS2'],
+            output_header['NAXIS1']) != output_shape:
+        raise ValueError("output_header does not match the spectral axis "
+                         "and target_header.")
+
+    spec_weights = spectral_interp_weights(cube.spectral_axis, spectral_axis)
+
+    weights = reprojection_matrix(cube.wcs.celestial, cube.shape[1:],
+                                  WCS(target_header).celestial, shape_out,
+                                  cache_dir=cache_dir)
+    # Only read the part of the input that overlaps the output grid
+    slices, weights = weights.crop_input()
+
+    del cube
+
+    create_huge_fits(output_file, output_header)
+
+    with fits.open(output_file) as hdulist:
+        output_offset = hdulist.fileinfo(0)['datLoc']
+
+    init_args = (input_file, output_file, output_offset, output_shape,
+                 weights, slices, spec_weights, scale)
+
+    blocks = [slice(start, min(start + chunk_size, output_shape[0]))
+              for start in range(0, output_shape[0], chunk_size)]
+
+    if verbose:
+        pbar = ProgressBar(len(blocks))
+
+    if num_cores > 1:
+        pool = Pool(num_cores, initializer=_init_worker, initargs=init_args)
+        try:
+            for _ in pool.imap_unordered(_regrid_block, blocks):
+                if verbose:
+                    pbar.update()
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(*init_args)
+        for block in blocks:
+            _regrid_block(block)
+            if verbose:
+                pbar.update()
+
+    _worker_state.clear()
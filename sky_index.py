@@ -0,0 +1,233 @@
+
+'''
+Nearest-neighbour and within-radius matching of sky positions.
+
+Positions are converted to 3D unit vectors and stored in a KD-tree (as in
+`astropy.coordinates.match_coordinates_sky`). The Euclidean (chord) distance
+between two unit vectors is a monotonic function of their angular separation,
+so nearest neighbours in the tree are nearest neighbours on the sky, and a
+radius on the sky is a fixed chord length. Whole tables or pixel grids are
+matched with a single query.
+'''
+
+import numpy as np
+import astropy.units as u
+from astropy.coordinates import Angle
+from astropy.wcs import WCS
+from astropy.wcs.utils import pixel_to_skycoord
+from scipy.spatial import cKDTree
+
+
+def _unit_vectors(coords):
+    '''
+    Unit vectors of a SkyCoord with shape (N, 3).
+    '''
+    xyz = coords.cartesian
+
+    xyz = np.vstack([xyz.x.value.ravel(), xyz.y.value.ravel(),
+                     xyz.z.value.ravel()]).T
+
+    # Positions with a distance are projected onto the sphere.
+    return xyz / np.sqrt((xyz**2).sum(1))[:, np.newaxis]
+
+
+def _chord_to_angle(chord):
+    return Angle(2 * np.arcsin(np.clip(0.5 * chord, 0., 1.)), u.rad)
+
+
+def _angle_to_chord(angle):
+    angle = np.clip(Angle(angle).to(u.rad).value, 0., np.pi)
+    return 2 * np.sin(0.5 * angle)
+
+
+def grid_skycoords(header):
+    '''
+    Sky positions of the pixel centres of an image.
+
+    Parameters
+    ----------
+    header : astropy.io.fits.Header
+        Header of the image. Only the celestial axes are used.
+
+    Returns
+    -------
+    coords : astropy.coordinates.SkyCoord
+        Positions with the shape of the celestial axes of the image.
+    '''
+    wcs = WCS(header).celestial
+
+    ny, nx = header['NAXIS2'], header['NAXIS1']
+
+    yy, xx = np.mgrid[:ny, :nx]
+
+    return pixel_to_skycoord(xx, yy, wcs)
+
+
+class SkyIndex(object):
+    '''
+    KD-tree of a set of sky positions.
+
+    Parameters
+    ----------
+    coords : astropy.coordinates.SkyCoord
+        Positions to index. Positions of any shape are flattened, and the
+        indices returned by the queries are into the flattened array.
+    '''
+    def __init__(self, coords):
+        self.coords = coords
+        self.shape = coords.shape
+        self.size = coords.size
+
+        self._tree = cKDTree(_unit_vectors(coords))
+
+    def _query_vectors(self, coords):
+        # Compare in the frame of the indexed positions
+        return _unit_vectors(coords.transform_to(self.coords.frame))
+
+    def nearest(self, coords, k=1):
+        '''
+        Find the nearest indexed positions.
+
+        Parameters
+        ----------
+        coords : astropy.coordinates.SkyCoord
+            Positions to match.
+        k : int, optional
+            Number of neighbours to return.
+
+        Returns
+        -------
+        idx : np.ndarray
+            Flattened indices of the nearest positions. The shape is that of
+            `coords`, with an extra last axis of length `k` when k > 1.
+        sep : astropy.coordinates.Angle
+            Angular separations to the nearest positions.
+        '''
+        chord, idx = self._tree.query(self._query_vectors(coords), k=k)
+
+        out_shape = coords.shape if k == 1 else coords.shape + (k,)
+
+        return idx.reshape(out_shape), \
+            _chord_to_angle(chord).reshape(out_shape)
+
+    def nearest_grid_index(self, coords):
+        '''
+        Like `nearest`, but returns the indices into the unflattened
+        positions (e.g., the (y, x) pixel of a grid).
+        '''
+        idx, sep = self.nearest(coords)
+        return np.unravel_index(idx, self.shape), sep
+
+    def within(self, coords, radius):
+        '''
+        Find all indexed positions within a radius.
+
+        Parameters
+        ----------
+        coords : astropy.coordinates.SkyCoord
+            Positions to match.
+        radius : astropy.units.Quantity
+            Angular radius. Either a scalar or one radius per position in
+            `coords`.
+
+        Returns
+        -------
+        matches : list
+            For each position in the flattened `coords`, an array of the
+            flattened indices within the radius.
+        '''
+        vecs = self._query_vectors(coords)
+        chords = np.atleast_1d(_angle_to_chord(radius)).ravel()
+
+        if chords.size == 1:
+            matches = self._tree.query_ball_point(vecs, chords[0])
+        elif chords.size == vecs.shape[0]:
+            matches = [self._tree.query_ball_point(vec, chord)
+                       for vec, chord in zip(vecs, chords)]
+        else:
+            raise ValueError("radius must be a scalar or have one value per "
+                             "position.")
+
+        return [np.array(sorted(match), dtype=int) for match in matches]
+
+    def count_within(self, coords, radius):
+        '''
+        Number of indexed positions within a radius of each position.
+        '''
+        counts = np.array([len(match) for match in
+                           self.within(coords, radius)])
+        return counts.reshape(coords.shape)
+
+
+def nearest_labels(coords, catalogue_coords, labels=None):
+    '''
+    Assign each position to its nearest catalogue object.
+
+    Parameters
+    ----------
+    coords : astropy.coordinates.SkyCoord
+        Positions to assign (e.g., every row of a table or every pixel of a
+        grid).
+    catalogue_coords : astropy.coordinates.SkyCoord
+        Catalogue positions.
+    labels : np.ndarray, optional
+        Label of each catalogue object. Defaults to the catalogue index.
+
+    Returns
+    -------
+    out_labels : np.ndarray
+        Label of the nearest object with the shape of `coords`.
+    sep : astropy.coordinates.Angle
+        Separation to the nearest object.
+    '''
+    idx, sep = SkyIndex(catalogue_coords).nearest(coords)
+
+    if labels is None:
+        return idx, sep
+
+    return np.asarray(labels)[idx], sep
+
+
+def label_map(catalogue_coords, header, labels=None, max_sep=None):
+    '''
+    Label every pixel of an image with its nearest catalogue object.
+
+    Parameters
+    ----------
+    catalogue_coords : astropy.coordinates.SkyCoord
+        Catalogue positions.
+    header : astropy.io.fits.Header
+        Header of the image.
+    labels : np.ndarray, optional
+        Label of each object. Defaults to the catalogue index + 1, so that 0
+        can be used for unassigned pixels.
+    max_sep : astropy.units.Quantity, optional
+        Pixels further than this from every object are set to 0.
+
+    Returns
+    -------
+    lab_map : np.ndarray
+        Label of the nearest object in each pixel.
+    dist_map : astropy.coordinates.Angle
+        Angular distance to the nearest object in each pixel.
+    '''
+    if labels is None:
+        labels = np.arange(1, catalogue_coords.size + 1)
+
+    lab_map, dist_map = \
+        nearest_labels(grid_skycoords(header), catalogue_coords,
+                       labels=labels)
+
+    if max_sep is not None:
+        lab_map = lab_map.copy()
+        lab_map[dist_map > max_sep] = 0
+
+    return lab_map, dist_map
+
+
+def distance_map(catalogue_coords, header):
+    '''
+    Angular distance of every pixel in an image to the nearest catalogue
+    object.
+    '''
+    return label_map(catalogue_coords, header)[1]
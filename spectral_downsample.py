@@ -0,0 +1,301 @@
+
+'''
+Spatially convolve, spectrally smooth and resample a cube in one pass.
+
+This gives the same result as running `SpectralCube.convolve_to`,
+`SpectralCube.spectral_smooth` and `SpectralCube.spectral_interpolate` in
+turn, without making the intermediate cubes:
+
+* Each output channel is linearly interpolated from two smoothed channels,
+  so only those smoothed channels are computed, instead of smoothing every
+  input channel.
+* Each of those smoothed channels is a kernel-weighted sum of nearby input
+  channels. Following `astropy.convolution.convolve`, NaNs are interpolated
+  over and the edges are padded with zeros. The sums for a block of output
+  channels are one sparse matrix product, taken over the slab of input
+  channels the block needs.
+* Only the input channels in a slab are convolved to the target beam.
+
+Blocks of output channels are run in a process pool and written straight
+into the pre-allocated output FITS file, so memory use is set by the block
+size.
+'''
+
+import numpy as np
+import astropy.units as u
+from astropy.io import fits
+from astropy.convolution import convolve_fft
+from astropy.wcs.utils import proj_plane_pixel_area
+from astropy.utils.console import ProgressBar
+from multiprocessing import Pool
+from scipy import sparse
+from spectral_cube import SpectralCube
+
+from cube_analysis.io_utils import create_huge_fits
+
+from sd_regrid import spectral_interp_weights, cube_hdu_data
+
+
+_worker_state = dict()
+
+
+def smoothing_matrix(nchan, kernel, channels=None):
+    '''
+    Sparse matrix of the normalized kernel weights for smoothed channels.
+
+    Parameters
+    ----------
+    nchan : int
+        Number of input channels.
+    kernel : astropy.convolution.Kernel1D or np.ndarray
+        Smoothing kernel with an odd number of elements.
+    channels : np.ndarray, optional
+        The smoothed channels to compute. Defaults to all channels.
+
+    Returns
+    -------
+    matrix : scipy.sparse.csr_matrix
+        Weights with shape (len(channels), nchan).
+    edge_weight : np.ndarray
+        Kernel weight that falls off the edges of the spectrum for each of
+        the channels. It counts towards the normalization, as for zero
+        padding in `astropy.convolution.convolve`.
+    '''
+    kern = np.asarray(getattr(kernel, 'array', kernel), dtype=float)
+
+    if kern.size % 2 == 0:
+        raise ValueError("The kernel must have an odd number of elements.")
+
+    kern = kern / kern.sum()
+
+    if channels is None:
+        channels = np.arange(nchan)
+    channels = np.asarray(channels, dtype=int)
+
+    # Kernel is flipped for the convolution
+    offsets = np.arange(kern.size) - kern.size // 2
+    wts = kern[::-1]
+
+    cols = channels[:, np.newaxis] + offsets[np.newaxis, :]
+    rows = np.repeat(np.arange(channels.size), kern.size)\
+        .reshape(channels.size, kern.size)
+    vals = np.tile(wts, (channels.size, 1))
+
+    inside = (cols >= 0) & (cols < nchan)
+
+    matrix = sparse.csr_matrix((vals[inside], (rows[inside], cols[inside])),
+                               shape=(channels.size, nchan))
+
+    edge_weight = (vals * ~inside).sum(1)
+
+    return matrix, edge_weight
+
+
+def _init_worker(input_file, output_file, output_offset, output_shape,
+                 kernels, ratios, spec_weights, smooth_kernel):
+    '''
+    Open the input and output once in each worker.
+    '''
+    _worker_state['input'] = cube_hdu_data(fits.open(input_file,
+                                                     mode='denywrite')[0])
+    _worker_state['output'] = np.memmap(output_file, dtype='>f4', mode='r+',
+                                        offset=output_offset,
+                                        shape=output_shape)
+    _worker_state['kernels'] = kernels
+    _worker_state['ratios'] = ratios
+    _worker_state['spec_weights'] = spec_weights
+    _worker_state['smooth_kernel'] = smooth_kernel
+
+
+def _convolve_plane(chan):
+    '''
+    Read and convolve one input channel to the target beam.
+    '''
+    img = np.asarray(_worker_state['input'][chan], dtype=float)
+
+    kernel = _worker_state['kernels'][chan]
+
+    if kernel is None:
+        return img
+
+    conv = convolve_fft(img, kernel, normalize_kernel=True) * \
+        _worker_state['ratios'][chan]
+    # Masked pixels stay masked
+    conv[~np.isfinite(img)] = np.NaN
+
+    return conv
+
+
+def _downsample_block(chans):
+    '''
+    Make a block of output channels and write them to the output.
+    '''
+    nchan_in = _worker_state['input'].shape[0]
+
+    chan0, chan1, wt0, wt1 = \
+        [arr[chans] for arr in _worker_state['spec_weights']]
+
+    # Smoothed channels used by the block
+    needed = np.unique(np.append(chan0[wt0 > 0], chan1[wt1 > 0]))
+
+    smooth_kernel = _worker_state['smooth_kernel']
+
+    if smooth_kernel is not None:
+        matrix, edge_weight = smoothing_matrix(nchan_in, smooth_kernel,
+                                               channels=needed)
+        used = np.unique(matrix.indices)
+    else:
+        used = needed
+
+    lo, hi = used.min(), used.max() + 1
+
+    slab = np.array([_convolve_plane(chan) for chan in range(lo, hi)])
+    plane_shape = slab.shape[1:]
+    slab = slab.reshape((hi - lo, -1))
+
+    if smooth_kernel is not None:
+        matrix = matrix[:, lo:hi]
+
+        finite = np.isfinite(slab)
+
+        num = matrix.dot(np.where(finite, slab, 0.))
+        den = matrix.dot(finite.astype(float)) + edge_weight[:, np.newaxis]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            smoothed = num / den
+
+        # The mask is unchanged by the smoothing
+        smoothed[~finite[needed - lo]] = np.NaN
+    else:
+        smoothed = slab[needed - lo]
+
+    # Rows of the smoothed channels. Channels with zero weights map to the
+    # first row and are skipped.
+    rows = np.zeros(nchan_in, dtype=int)
+    rows[needed] = np.arange(needed.size)
+
+    wt0 = wt0[:, np.newaxis]
+    wt1 = wt1[:, np.newaxis]
+
+    # Zero weights are skipped so NaNs only come from channels that are used
+    out = np.where(wt0 > 0, wt0 * smoothed[rows[chan0]], 0.) + \
+        np.where(wt1 > 0, wt1 * smoothed[rows[chan1]], 0.)
+
+    output = _worker_state['output']
+    output[chans.start:chans.stop] = \
+        out.reshape((-1,) + plane_shape).astype(np.float32)
+    output.flush()
+
+    return chans
+
+
+def downsample_cube(input_file, spectral_axis, output_file, kernel=None,
+                    target_beam=None, chunk=8, num_cores=1, verbose=True):
+    '''
+    Convolve a cube to a common beam, smooth it spectrally and interpolate
+    it onto a new spectral axis in one pass.
+
+    Parameters
+    ----------
+    input_file : str
+        FITS file of the cube.
+    spectral_axis : astropy.units.Quantity
+        Linear spectral axis of the output.
+    output_file : str
+        Name of the output FITS file.
+    kernel : astropy.convolution.Kernel1D, optional
+        Spectral smoothing kernel. No smoothing when not given.
+    target_beam : radio_beam.Beam, optional
+        Beam to convolve every channel to. No spatial convolution when not
+        given.
+    chunk : int, optional
+        Number of output channels in each block.
+    num_cores : int, optional
+        Number of processes.
+    verbose : bool, optional
+        Show a progress bar.
+    '''
+    cube = SpectralCube.read(input_file)
+
+    nchan_in = cube.shape[0]
+
+    if target_beam is not None:
+        pixscale = proj_plane_pixel_area(cube.wcs.celestial)**0.5 * u.deg
+
+        if hasattr(cube, 'beams'):
+            beams = list(cube.beams)
+        else:
+            beams = [cube.beam] * nchan_in
+
+        # Only use the beam ratios when convolving in Jy/beam
+        is_jybm = cube.unit.is_equivalent(u.Jy / u.beam)
+
+        kernels = []
+        ratios = []
+        for beam in beams:
+            if beam == target_beam:
+                kernels.append(None)
+                ratios.append(1.)
+                continue
+            kernels.append(target_beam.deconvolve(beam).as_kernel(pixscale))
+            ratios.append((target_beam.sr / beam.sr).decompose().value
+                          if is_jybm else 1.)
+    else:
+        kernels = [None] * nchan_in
+        ratios = [1.] * nchan_in
+
+    spec_weights = spectral_interp_weights(cube.spectral_axis, spectral_axis)
+
+    # Output header with the new spectral axis and beam
+    output_header = cube.header.copy()
+    output_header['NAXIS3'] = spectral_axis.size
+    output_header['CRPIX3'] = 1
+    output_header['CRVAL3'] = spectral_axis[0].to(cube.spectral_axis.unit).value
+    if spectral_axis.size > 1:
+        output_header['CDELT3'] = \
+            (spectral_axis[1] - spectral_axis[0]).to(cube.spectral_axis.unit).value
+    output_header['CUNIT3'] = cube.spectral_axis.unit.to_string('fits')
+    output_header['BITPIX'] = -32
+    if 'CASAMBM' in output_header:
+        del output_header['CASAMBM']
+    if target_beam is not None:
+        output_header.update(target_beam.to_header_keywords())
+    elif hasattr(cube, 'beams'):
+        raise ValueError("A target_beam is needed for cubes with multiple "
+                         "beams.")
+
+    output_shape = (spectral_axis.size,) + cube.shape[1:]
+
+    del cube
+
+    create_huge_fits(output_file, output_header)
+
+    with fits.open(output_file) as hdulist:
+        output_offset = hdulist.fileinfo(0)['datLoc']
+
+    init_args = (input_file, output_file, output_offset, output_shape,
+                 kernels, ratios, spec_weights, kernel)
+
+    blocks = [slice(start, min(start + chunk, output_shape[0]))
+              for start in range(0, output_shape[0], chunk)]
+
+    if verbose:
+        pbar = ProgressBar(len(blocks))
+
+    if num_cores > 1:
+        pool = Pool(num_cores, initializer=_init_worker, initargs=init_args)
+        try:
+            for _ in pool.imap_unordered(_downsample_block, blocks):
+                if verbose:
+                    pbar.update()
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(*init_args)
+        for block in blocks:
+            _downsample_block(block)
+            if verbose:
+                pbar.update()
+
+    _worker_state.clear()